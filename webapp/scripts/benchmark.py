@@ -0,0 +1,239 @@
+"""
+Route benchmark
+زمان‌سنجی مسیرهای پرترافیک روی دیتابیس آزمایشی و خروجی JSON برای مقایسه با baseline
+
+    python scripts/generate_clinic_dataset.py --db bench.db
+    python scripts/benchmark.py --db bench.db --output baseline.json
+    python scripts/benchmark.py --db bench.db --compare baseline.json
+
+Each case runs through the Flask test client as a logged-in manager
+(repository cases run inside a request context) against a temporary copy
+of the dataset. After --warmup untimed runs, --repeat runs are timed; the
+JSON holds min/median/p95/mean in ms per case plus the dataset's row
+counts. With --compare, medians are checked against a saved file and the
+exit status is 1 when any case got slower by more than --threshold.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# Add webapp to path
+current_dir = Path(__file__).parent.parent
+sys.path.append(str(current_dir))
+
+DATASET_TABLES = ('patients', 'invoices', 'visits', 'injections', 'procedures', 'consumables_ledger',
+                  'invoice_item_payments', 'activity_logs')
+
+
+def _jalali(d) -> str:
+    import jdatetime
+    jd = jdatetime.date.fromgregorian(date=d)
+    return f"{jd.year}/{jd.month:02d}/{jd.day:02d}"
+
+
+def _dataset_info(db_path: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in DATASET_TABLES}
+        last_day = conn.execute("SELECT MAX(work_date) FROM invoices").fetchone()[0]
+        # فاکتور با بیشترین آیتم - بدترین حالت صفحه فاکتور
+        busiest = conn.execute("""
+            SELECT invoice_id FROM invoice_item_payments
+            GROUP BY invoice_id ORDER BY COUNT(*) DESC, invoice_id DESC LIMIT 1
+        """).fetchone()
+        manager = conn.execute("SELECT id FROM users WHERE role = 'manager' ORDER BY id LIMIT 1").fetchone()
+    finally:
+        conn.close()
+    if not last_day or not busiest or not manager:
+        raise SystemExit(f"{db_path} has no invoices or no manager user - build it with generate_clinic_dataset.py")
+    return {
+        'counts': counts,
+        'last_day': datetime.strptime(last_day, '%Y-%m-%d').date(),
+        'invoice_id': busiest[0],
+        'manager_id': manager[0],
+    }
+
+
+def _cases(info: dict, days: int):
+    """(name, kind, target, payload) - kind: 'get' / 'post' (URL) or 'call' (callable in a request context)."""
+    from src.adapters.sqlite.invoices_repo import InvoiceRepository
+
+    end = info['last_day']
+    start = end - timedelta(days=days - 1)
+    j_range = {'from': _jalali(start), 'to': _jalali(end)}
+    invoice_id = info['invoice_id']
+    return [
+        ('get_invoice_items', 'call', lambda: InvoiceRepository().get_invoice_items(invoice_id), None),
+        ('get_financials', 'call', lambda: InvoiceRepository().get_financials(invoice_id), None),
+        ('invoice_details', 'get', f'/reception/api/invoice/{invoice_id}/details', None),
+        ('chart_data', 'get', '/manager/api/chart-data', dict(j_range, type='revenue')),
+        ('patients_report', 'get', '/manager/reports/patients', j_range),
+        ('users_report', 'get', '/manager/reports/users', j_range),
+        ('insurance_arrears', 'get', '/manager/insurance_arrears', j_range),
+        ('calculate_payroll', 'post', '/manager/payroll/calculate', {
+            'staff_type': 'all', 'shift': 'all',
+            'date_from': start.isoformat(), 'date_to': end.isoformat(),
+        }),
+        ('list_patients', 'get', '/reception/patients/list', None),
+        ('list_patients_search', 'get', '/reception/patients/list', {'q': 'رضایی'}),
+    ]
+
+
+def _run_once(app, client, kind, target, payload):
+    if kind == 'call':
+        with app.test_request_context():
+            target()
+        return 200
+    if kind == 'post':
+        response = client.post(target, data=payload)
+    else:
+        response = client.get(target, query_string=payload)
+    response.get_data()
+    return response.status_code
+
+
+def _summary(samples_ms):
+    ordered = sorted(samples_ms)
+    p95 = statistics.quantiles(ordered, n=20)[18] if len(ordered) > 1 else ordered[0]
+    return {
+        'min_ms': round(ordered[0], 3),
+        'median_ms': round(statistics.median(ordered), 3),
+        'p95_ms': round(p95, 3),
+        'mean_ms': round(statistics.fmean(ordered), 3),
+        'runs': len(ordered),
+    }
+
+
+def run_benchmark(db_path: str, repeat: int = 20, warmup: int = 2, days: int = 30, only=None) -> dict:
+    info = _dataset_info(db_path)
+    # روی یک کپی اجرا می‌شود: لاگ‌هایی که مسیرها می‌نویسند دیتاست را برای اجرای بعدی تغییر ندهند
+    workdir = tempfile.mkdtemp(prefix='clinic-bench-')
+    try:
+        work_db = os.path.join(workdir, 'bench.db')
+        source = sqlite3.connect(db_path)
+        target = sqlite3.connect(work_db)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        results = _run_cases(work_db, info, repeat, warmup, days, only)
+    finally:
+        from src.adapters.sqlite.core import close_pool
+        close_pool()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'dataset': {
+            'path': os.path.basename(db_path),
+            'counts': info['counts'],
+            'last_day': info['last_day'].isoformat(),
+            'range_days': days,
+        },
+        'repeat': repeat,
+        'cases': results,
+    }
+
+
+def _run_cases(work_db: str, info: dict, repeat: int, warmup: int, days: int, only) -> dict:
+    from src.config.settings import Config
+    Config.DATABASE_PATH = work_db
+
+    from src.app import create_app
+    app = create_app({'TESTING': True, 'SECRET_KEY': 'benchmark'})
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = info['manager_id']
+        sess['role'] = 'manager'
+
+    results = {}
+    for name, kind, target, payload in _cases(info, days):
+        if only and name not in only:
+            continue
+        status = None
+        for _ in range(warmup):
+            status = _run_once(app, client, kind, target, payload)
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            status = _run_once(app, client, kind, target, payload)
+            samples.append((time.perf_counter() - started) * 1000)
+        results[name] = dict(_summary(samples), status=status)
+        print(f"  {name:<22} median {results[name]['median_ms']:>9.2f} ms   "
+              f"p95 {results[name]['p95_ms']:>9.2f} ms   [{status}]")
+    return results
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Print median changes; return names of cases slower than ``1 + threshold`` times the baseline."""
+    regressions = []
+    print(f"\n  {'case':<22} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, result in current['cases'].items():
+        old = baseline.get('cases', {}).get(name)
+        if not old or not old.get('median_ms'):
+            print(f"  {name:<22} {'-':>10} {result['median_ms']:>10.2f}      new")
+            continue
+        ratio = result['median_ms'] / old['median_ms']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f"  {name:<22} {old['median_ms']:>10.2f} {result['median_ms']:>10.2f} {ratio - 1:>+7.0%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time hot routes on a generated dataset.')
+    parser.add_argument('--db', required=True, help='Dataset from generate_clinic_dataset.py (runs on a temporary copy).')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--days', type=int, default=30, help='Report date range ending at the last work date.')
+    parser.add_argument('--case', action='append', help='Run only this case (repeatable).')
+    parser.add_argument('--output', help='Write results as JSON (e.g. a new baseline).')
+    parser.add_argument('--compare', help='Baseline JSON to compare medians against.')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown before failing (0.25 = 25%%).')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        parser.error(f'{args.db} not found - build it with scripts/generate_clinic_dataset.py')
+
+    print(f"Benchmarking {args.db} ({args.repeat} runs per case)")
+    result = run_benchmark(args.db, repeat=args.repeat, warmup=args.warmup, days=args.days, only=args.case)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+
+    failed = [name for name, r in result['cases'].items() if r['status'] != 200]
+    if failed:
+        print(f"Non-200 responses: {', '.join(failed)}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('dataset', {}).get('counts') != result['dataset']['counts']:
+            print("Note: baseline was taken on a dataset with different row counts.")
+        regressions = compare(result, baseline, args.threshold)
+        if regressions:
+            print(f"\nSlower than baseline by more than {args.threshold:.0%}: {', '.join(regressions)}")
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,401 @@
+"""
+Synthetic clinic dataset generator
+ساخت دیتابیس آزمایشی چندساله (بیمار، فاکتور، ویزیت، تزریق، کار عملی، مصرفی، پرداخت، لاگ) برای بنچمارک
+
+    python scripts/generate_clinic_dataset.py --db bench.db --years 2 --invoices-per-day 60
+
+The file is built through the app's own schema and migrations, so it has
+the same indexes, triggers and rollups as a real installation. Volumes,
+shift mix and insurance mix are configurable; a fixed --seed gives the same
+database every time.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+# Add webapp to path
+current_dir = Path(__file__).parent.parent
+sys.path.append(str(current_dir))
+
+FIRST_NAMES = [
+    'علی', 'محمد', 'حسین', 'رضا', 'مهدی', 'امیر', 'حسن', 'سعید', 'مجید', 'کامران',
+    'زهرا', 'فاطمه', 'مریم', 'سارا', 'نرگس', 'الهام', 'لیلا', 'مینا', 'ندا', 'پریسا',
+]
+LAST_NAMES = [
+    'رضایی', 'احمدی', 'محمدی', 'کریمی', 'حسینی', 'موسوی', 'جعفری', 'صادقی', 'رحیمی', 'نوری',
+    'قاسمی', 'کاظمی', 'یوسفی', 'عباسی', 'ملکی', 'طاهری', 'شریفی', 'اکبری', 'باقری', 'زارعی',
+]
+
+# (insurance_type, visit price, nursing_covers, is_base_tariff, weight)
+INSURANCES = [
+    ('آزاد', 250000, 0, 1, 30),
+    ('تامین اجتماعی', 120000, 1, 0, 40),
+    ('سلامت', 110000, 1, 0, 20),
+    ('نیروهای مسلح', 130000, 0, 0, 10),
+]
+SUPPLEMENTARY = [('دی', 0), ('آتیه سازان', 0)]
+NURSING_SERVICES = [
+    ('تزریق عضلانی', 25000), ('تزریق وریدی', 35000), ('سرم تراپی', 85000),
+    ('پانسمان ساده', 45000), ('تزریق زیرجلدی', 20000), ('نبولایزر', 40000),
+]
+PROCEDURES = [('نوار قلب', 120000), ('بخیه', 250000), ('شستشوی گوش', 150000), ('کشیدن بخیه', 80000)]
+CONSUMABLES = [
+    ('سرنگ 5 سی سی', 5000, 'supply'), ('آنژیوکت آبی', 45000, 'supply'), ('سرم نرمال سالین', 65000, 'drug'),
+    ('گاز استریل', 15000, 'supply'), ('دگزامتازون', 30000, 'drug'), ('آمپول پنی‌سیلین', 55000, 'drug'),
+]
+# شیفت: (وزن، ساعت شروع، طول به ساعت)
+SHIFTS = {'morning': (45, 7, 7), 'evening': (35, 14, 6), 'night': (20, 20, 11)}
+PAYMENT_TYPES = (('cash', 45), ('card', 40), ('insurance', 15))
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/120.0 Safari/537.36'
+
+
+def _weighted(rng, pairs):
+    return rng.choices([p[0] for p in pairs], weights=[p[-1] for p in pairs])[0]
+
+
+def _ts(dt: datetime) -> str:
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+
+class _Ids:
+    """شمارنده id برای درج دسته‌ای (آیتم‌ها قبل از درج به پرداخت‌ها و لاگ‌ها لینک می‌شوند)"""
+
+    def __init__(self, db):
+        self._next = {}
+        self._db = db
+
+    def next(self, table: str) -> int:
+        if table not in self._next:
+            row = self._db.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()
+            self._next[table] = row[0] + 1
+        value = self._next[table]
+        self._next[table] += 1
+        return value
+
+    def issued(self, table: str) -> int:
+        return self._next.get(table, 1) - 1
+
+
+def _seed_catalog(db, auth, rng, doctors: int, nurses: int, receptionists: int):
+    auth.register_user('manager', 'manager123', 'manager', 'مدیر سیستم')
+    for i in range(1, receptionists + 1):
+        auth.register_user(f'reception{i}', 'rec123', 'reception', f'پذیرش {i}')
+
+    for _ in range(doctors):
+        db.execute("INSERT INTO medical_staff (full_name, staff_type) VALUES (?, ?)",
+                   (f"دکتر {rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}", 'doctor'))
+    for _ in range(nurses):
+        db.execute("INSERT INTO medical_staff (full_name, staff_type) VALUES (?, ?)",
+                   (f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}", 'nurse'))
+    db.execute("""
+        INSERT OR IGNORE INTO payroll_settings
+            (staff_id, base_morning, base_evening, base_night, visit_fee, injection_percent,
+             procedure_percent, tax_percent, nursing_percent, nurse_procedure_percent)
+        SELECT id, 2000000, 2200000, 2800000, 40000, 10, 30, 10, 20, 25 FROM medical_staff
+    """)
+
+    db.execute("DELETE FROM visit_tariffs")
+    for name, price, covers, base, _ in INSURANCES:
+        db.execute("""
+            INSERT INTO visit_tariffs (insurance_type, tariff_price, nursing_tariff, nursing_covers,
+                                       is_active, is_supplementary, is_base_tariff)
+            VALUES (?, ?, 0, ?, 1, 0, ?)
+        """, (name, price, covers, base))
+    for name, price in SUPPLEMENTARY:
+        db.execute("""
+            INSERT INTO visit_tariffs (insurance_type, tariff_price, nursing_tariff, nursing_covers,
+                                       is_active, is_supplementary, is_base_tariff)
+            VALUES (?, ?, 0, 0, 1, 1, 0)
+        """, (name, price))
+    db.executemany("INSERT OR IGNORE INTO nursing_services (service_name, unit_price) VALUES (?, ?)", NURSING_SERVICES)
+    db.executemany("INSERT OR IGNORE INTO procedure_tariffs (name, unit_price) VALUES (?, ?)", PROCEDURES)
+    db.executemany("INSERT OR IGNORE INTO consumable_tariffs (name, default_price, category) VALUES (?, ?, ?)", CONSUMABLES)
+    db.commit()
+
+
+def _seed_patients(db, rng, count: int, start: date):
+    rows = []
+    used = set()
+    for _ in range(count):
+        national_id = None
+        while national_id is None or national_id in used:
+            national_id = ''.join(rng.choice('0123456789') for _ in range(10))
+        used.add(national_id)
+        born = date(rng.randint(1940, 2022), rng.randint(1, 12), rng.randint(1, 28))
+        created = start + timedelta(days=rng.randint(0, 30))
+        rows.append((
+            rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), national_id,
+            '09' + ''.join(rng.choice('0123456789') for _ in range(9)),
+            born.isoformat(), rng.choice(('male', 'female')),
+            _weighted(rng, [(x[0], x[4]) for x in INSURANCES]), 'reception1',
+            _ts(datetime.combine(created, datetime.min.time()) + timedelta(hours=9)),
+        ))
+    db.executemany("""
+        INSERT INTO patients (name, family_name, national_id, phone_number, birthdate, gender,
+                              insurance_type, created_by, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, rows)
+    db.commit()
+    return [dict(r) for r in db.execute("SELECT id, name, family_name, insurance_type FROM patients").fetchall()]
+
+
+class _DayBatch:
+    """ردیف‌های یک بازه برای executemany"""
+
+    def __init__(self):
+        self.invoices, self.visits, self.injections = [], [], []
+        self.procedures, self.consumables, self.payments, self.logs = [], [], [], []
+
+    def flush(self, db):
+        db.executemany("""
+            INSERT INTO invoices (id, patient_id, doctor_id, nurse_id, status, insurance_type, supplementary_insurance,
+                                  total_amount, work_date, shift, opened_at, closed_at, opened_by, opened_by_name,
+                                  closed_by, closed_by_name)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, self.invoices)
+        db.executemany("""
+            INSERT INTO visits (id, patient_id, doctor_name, visit_date, shift, work_date, insurance_type,
+                                supplementary_insurance, price, payment_status, reception_user, invoice_id,
+                                doctor_id, nurse_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, self.visits)
+        db.executemany("""
+            INSERT INTO injections (id, patient_id, injection_type, service_id, injection_date, shift, work_date,
+                                    count, unit_price, total_price, patient_amount, insurance_amount,
+                                    covered_by_insurance, reception_user, invoice_id, doctor_id, nurse_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, self.injections)
+        db.executemany("""
+            INSERT INTO procedures (id, patient_id, procedure_type, procedure_date, shift, work_date, price,
+                                    reception_user, invoice_id, performer_type, performer_id, doctor_id, nurse_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, self.procedures)
+        db.executemany("""
+            INSERT INTO consumables_ledger (id, patient_id, item_name, category, quantity, unit_price, total_cost,
+                                            usage_date, shift, work_date, reception_user, invoice_id,
+                                            doctor_id, nurse_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, self.consumables)
+        db.executemany("""
+            INSERT INTO invoice_item_payments (invoice_id, item_type, item_id, payment_type, is_paid, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, self.payments)
+        db.executemany("""
+            INSERT INTO activity_logs (user_id, username, action_type, action_category, description, target_type,
+                                       target_id, invoice_id, patient_id, patient_name, amount,
+                                       ip_address, user_agent, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, self.logs)
+        db.commit()
+        self.__init__()
+
+
+def generate(db_path: str, years: float = 2, invoices_per_day: int = 60, patients: int = 20000,
+             doctors: int = 8, nurses: int = 10, receptionists: int = 6, end: date = None,
+             seed: int = 42, with_logs: bool = True, open_ratio: float = 0.1, verbose: bool = True) -> dict:
+    """Build a new database at ``db_path``; returns row counts per table."""
+    from src.config.settings import Config
+    Config.DATABASE_PATH = os.path.abspath(db_path)
+    Config.ACTIVITY_LOG_ASYNC = False
+
+    from src.app import create_app
+    from src.adapters.sqlite.core import get_db
+    from src.adapters.sqlite.daily_stats_repo import rebuild_daily_stats
+    from src.common.utils import iran_now
+    from src.services.auth_service import AuthService
+
+    rng = random.Random(seed)
+    end = end or iran_now().date()
+    start = end - timedelta(days=int(365 * years) - 1)
+    started = time.perf_counter()
+
+    app = create_app({'TESTING': True, 'SECRET_KEY': 'dataset-generator'})
+    with app.app_context():
+        db = get_db()
+        # فقط برای ساخت داده: سرعت درج مهم‌تر از دوام در برابر قطع برق است
+        db.execute("PRAGMA synchronous = OFF")
+        _seed_catalog(db, AuthService(), rng, doctors, nurses, receptionists)
+        patient_rows = _seed_patients(db, rng, patients, start)
+        users = [dict(r) for r in db.execute("SELECT id, username, full_name FROM users WHERE role = 'reception'").fetchall()]
+        staff = db.execute("SELECT id, full_name, staff_type FROM medical_staff").fetchall()
+        doctor_rows = [s for s in staff if s['staff_type'] == 'doctor']
+        nurse_rows = [s for s in staff if s['staff_type'] == 'nurse']
+        services = db.execute("SELECT id, service_name, unit_price FROM nursing_services").fetchall()
+        covers = {name: c for name, _, c, _, _ in INSURANCES}
+        prices = {name: p for name, p, _, _, _ in INSURANCES}
+        # بیماران پرمراجعه: 20٪ بیماران 60٪ فاکتورها را دارند
+        frequent = patient_rows[:max(1, len(patient_rows) // 5)]
+        ids = _Ids(db)
+        batch = _DayBatch()
+
+        day = start
+        while day <= end:
+            work_date = day.isoformat()
+            last_day = day == end
+            staff_by_shift = {s: (rng.choice(doctor_rows), rng.choice(nurse_rows)) for s in SHIFTS}
+            user_by_shift = {s: rng.choice(users) for s in SHIFTS}
+            if with_logs:
+                for shift, (_, hour, length) in SHIFTS.items():
+                    user = user_by_shift[shift]
+                    base = datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)
+                    for action, at in (('login', base), ('logout', base + timedelta(hours=length))):
+                        batch.logs.append((user['id'], user['username'], action, 'auth',
+                                           'ورود به سیستم' if action == 'login' else 'خروج از سیستم',
+                                           None, None, None, None, None, 0,
+                                           '192.168.1.10', USER_AGENT, _ts(at)))
+
+            count = max(0, int(rng.gauss(invoices_per_day, invoices_per_day * 0.2)))
+            for _ in range(count):
+                shift = _weighted(rng, [(k, v[0]) for k, v in SHIFTS.items()])
+                _, hour, length = SHIFTS[shift]
+                opened = (datetime.combine(day, datetime.min.time())
+                          + timedelta(hours=hour, seconds=rng.randint(0, length * 3600 - 1)))
+                patient = rng.choice(frequent if rng.random() < 0.6 else patient_rows)
+                insurance = patient['insurance_type'] if rng.random() < 0.8 else _weighted(rng, [(x[0], x[4]) for x in INSURANCES])
+                supplementary = rng.choice(SUPPLEMENTARY)[0] if rng.random() < 0.15 else None
+                doctor, nurse = staff_by_shift[shift]
+                user = user_by_shift[shift]
+                is_open = last_day and rng.random() < open_ratio
+                invoice_id = ids.next('invoices')
+                patient_name = f"{patient['name']} {patient['family_name']}"
+                items = []  # (item_type, item_id, amount, at)
+                at = opened
+
+                def log(action, category, description, target_type=None, target_id=None, amount=0):
+                    if with_logs:
+                        batch.logs.append((user['id'], user['username'], action, category, description,
+                                           target_type, target_id, invoice_id, patient['id'], patient_name,
+                                           amount, '192.168.1.10', USER_AGENT, _ts(at)))
+
+                if rng.random() < 0.5:
+                    log('patient_search', 'patient', f'جستجوی بیمار {patient_name}')
+                log('invoice_create', 'invoice', f'ایجاد فاکتور برای {patient_name}', 'invoice', invoice_id)
+
+                if rng.random() < 0.85:
+                    at += timedelta(minutes=rng.randint(1, 5))
+                    item_id = ids.next('visits')
+                    price = prices[insurance]
+                    batch.visits.append((item_id, patient['id'], doctor['full_name'], _ts(at), shift, work_date,
+                                         insurance, supplementary, price, 'unpaid', user['username'],
+                                         invoice_id, doctor['id'], nurse['id']))
+                    items.append(('visit', item_id, price, at))
+                    log('visit_add', 'visit', f'ثبت ویزیت {patient_name}', 'visit', item_id, price)
+
+                for _ in range(rng.choice((1, 1, 2)) if rng.random() < 0.4 else 0):
+                    at += timedelta(minutes=rng.randint(2, 15))
+                    service = rng.choice(services)
+                    qty = rng.randint(1, 3)
+                    total = service['unit_price'] * qty
+                    covered = covers.get(insurance, 0)
+                    item_id = ids.next('injections')
+                    batch.injections.append((item_id, patient['id'], service['service_name'], service['id'], _ts(at),
+                                             shift, work_date, qty, service['unit_price'], total,
+                                             0 if covered else total, total if covered else 0, covered,
+                                             user['username'], invoice_id, doctor['id'], nurse['id']))
+                    items.append(('injection', item_id, total, at))
+                    log('injection_add', 'injection', f"ثبت {service['service_name']}", 'injection', item_id, total)
+
+                if rng.random() < 0.15:
+                    at += timedelta(minutes=rng.randint(5, 30))
+                    name, price = rng.choice(PROCEDURES)
+                    performer = rng.choice(('doctor', 'nurse'))
+                    performer_id = doctor['id'] if performer == 'doctor' else nurse['id']
+                    item_id = ids.next('procedures')
+                    batch.procedures.append((item_id, patient['id'], name, _ts(at), shift, work_date, price,
+                                             user['username'], invoice_id, performer, performer_id,
+                                             doctor['id'], nurse['id']))
+                    items.append(('procedure', item_id, price, at))
+                    log('procedure_add', 'procedure', f'ثبت کار عملی {name}', 'procedure', item_id, price)
+
+                for _ in range(rng.randint(1, 3) if rng.random() < 0.3 else 0):
+                    at += timedelta(minutes=rng.randint(1, 5))
+                    name, price, category = rng.choice(CONSUMABLES)
+                    qty = rng.randint(1, 2)
+                    item_id = ids.next('consumables_ledger')
+                    batch.consumables.append((item_id, patient['id'], name, category, qty, price, price * qty,
+                                              _ts(at), shift, work_date, user['username'], invoice_id,
+                                              doctor['id'], nurse['id']))
+                    items.append(('consumable', item_id, price * qty, at))
+                    log('consumable_use', 'consumable', f'ثبت مصرفی {name}', 'consumable', item_id, price * qty)
+
+                for item_type, item_id, amount, item_at in items:
+                    if is_open and rng.random() < 0.5:
+                        continue
+                    payment_type = _weighted(rng, PAYMENT_TYPES)
+                    batch.payments.append((invoice_id, item_type, item_id, payment_type, 1, _ts(item_at)))
+                    log('item_payment_set', 'invoice', f'پرداخت {item_type} ({payment_type})', item_type, item_id, amount)
+
+                total_amount = sum(i[2] for i in items)
+                closed_at = None
+                if not is_open:
+                    at += timedelta(minutes=rng.randint(1, 20))
+                    closed_at = _ts(at)
+                    log('invoice_close', 'invoice', f'بستن فاکتور {patient_name}', 'invoice', invoice_id, total_amount)
+                    if rng.random() < 0.3:
+                        log('print_invoice', 'print', f'چاپ فاکتور {patient_name}', 'invoice', invoice_id)
+                batch.invoices.append((invoice_id, patient['id'], doctor['id'], nurse['id'],
+                                       'open' if is_open else 'closed', insurance, supplementary, total_amount,
+                                       work_date, shift, _ts(opened), closed_at, user['username'],
+                                       user['full_name'], None if is_open else user['username'],
+                                       None if is_open else user['full_name']))
+
+            if day.day == 1 or last_day:
+                batch.flush(db)
+                if verbose:
+                    print(f"  {work_date}: {ids.issued('invoices')} invoices so far")
+            day += timedelta(days=1)
+
+        batch.flush(db)
+        rebuild_daily_stats(db)
+        db.commit()
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.execute("ANALYZE")
+
+        tables = ('patients', 'invoices', 'visits', 'injections', 'procedures', 'consumables_ledger',
+                  'invoice_item_payments', 'activity_logs', 'daily_stats')
+        counts = {t: db.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in tables}
+
+    if verbose:
+        print(f"Generated {db_path} in {time.perf_counter() - started:.1f}s")
+        for table, n in counts.items():
+            print(f"  {table}: {n}")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db', required=True, help='Output database file (must not exist unless --force).')
+    parser.add_argument('--years', type=float, default=2, help='Years of history ending at --end (default 2).')
+    parser.add_argument('--invoices-per-day', type=int, default=60)
+    parser.add_argument('--patients', type=int, default=20000)
+    parser.add_argument('--doctors', type=int, default=8)
+    parser.add_argument('--nurses', type=int, default=10)
+    parser.add_argument('--receptionists', type=int, default=6)
+    parser.add_argument('--end', help='Last work date, YYYY-MM-DD (default today).')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-logs', action='store_true', help='Skip activity_logs rows.')
+    parser.add_argument('--force', action='store_true', help='Overwrite an existing file.')
+    args = parser.parse_args(argv)
+
+    if os.path.exists(args.db):
+        if not args.force:
+            parser.error(f'{args.db} exists (use --force to overwrite)')
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.db + suffix):
+                os.remove(args.db + suffix)
+
+    generate(
+        args.db, years=args.years, invoices_per_day=args.invoices_per_day, patients=args.patients,
+        doctors=args.doctors, nurses=args.nurses, receptionists=args.receptionists,
+        end=datetime.strptime(args.end, '%Y-%m-%d').date() if args.end else None,
+        seed=args.seed, with_logs=not args.no_logs,
+    )
+
+
+if __name__ == '__main__':
+    main()
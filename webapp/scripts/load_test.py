@@ -0,0 +1,384 @@
+"""
+HTTP load test
+شبیه‌سازی یک شیفت پذیرش: چند ایستگاه پذیرش همزمان + یک ایستگاه مدیر روی سرور در حال اجرا
+
+    python scripts/generate_clinic_dataset.py --db load.db
+    (start the server on load.db: DATABASE_PATH / start.py)
+    python scripts/load_test.py --db load.db --url http://127.0.0.1:8080 --stations 6 --duration 120
+
+Only the standard library is used, so it runs from any Python next to the
+server. ``--db`` is read (read-only) once for the catalogue: reception
+users, doctors/nurses, nursing services, insurances and existing patients;
+everything else goes over HTTP with one cookie session per station.
+
+Each reception station loops over patients: search, register a new patient
+or reopen an existing one (`open_invoice_existing`), add a visit,
+injections + consumables and procedures, toggle an item payment, settle
+all items and close the invoice. The manager station pulls reports at the
+same time. At the end it prints throughput, p50/p95/p99 per endpoint and
+error / lock rates (``database is locked`` / busy responses); --output
+writes the same numbers as JSON.
+
+Logins use the passwords set by generate_clinic_dataset.py (override with
+--reception-password / --manager-password). The run writes real rows: use
+a throwaway copy of the dataset.
+"""
+
+import argparse
+import http.cookiejar
+import json
+import random
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+MANAGER_REPORTS = [
+    ('manager.index', '/manager/'),
+    ('manager.chart_data', '/manager/api/chart-data?type=revenue'),
+    ('manager.patients_report', '/manager/reports/patients'),
+    ('manager.users_report', '/manager/reports/users'),
+    ('manager.insurance_arrears', '/manager/insurance_arrears'),
+    ('manager.activity_logs', '/manager/logs'),
+]
+PROCEDURES = [('نوار قلب', 120000), ('بخیه', 250000), ('شستشوی گوش', 150000)]
+CONSUMABLES = [('سرنگ 5 سی سی', 5000, 'supply'), ('آنژیوکت آبی', 45000, 'supply'), ('دگزامتازون', 30000, 'drug')]
+FIRST_NAMES = ['علی', 'محمد', 'زهرا', 'فاطمه', 'حسین', 'مریم', 'رضا', 'سارا']
+LAST_NAMES = ['رضایی', 'احمدی', 'محمدی', 'کریمی', 'حسینی', 'موسوی', 'جعفری', 'صادقی']
+LOCK_MARKERS = ('database is locked', 'database is busy', 'sqlite_busy')
+
+
+def _catalog(db_path: str) -> dict:
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        receptionists = [r['username'] for r in conn.execute(
+            "SELECT username FROM users WHERE role = 'reception' AND is_active = 1 ORDER BY id")]
+        staff = conn.execute("SELECT id, staff_type FROM medical_staff WHERE is_active = 1").fetchall()
+        services = [r['id'] for r in conn.execute("SELECT id FROM nursing_services WHERE is_active = 1")]
+        insurances = [r['insurance_type'] for r in conn.execute(
+            "SELECT insurance_type FROM visit_tariffs WHERE is_active = 1 AND COALESCE(is_supplementary, 0) = 0")]
+        patients = [dict(r) for r in conn.execute(
+            "SELECT id, national_id, family_name FROM patients WHERE national_id IS NOT NULL "
+            "ORDER BY id DESC LIMIT 5000")]
+    finally:
+        conn.close()
+    doctors = [s['id'] for s in staff if s['staff_type'] == 'doctor']
+    nurses = [s['id'] for s in staff if s['staff_type'] == 'nurse']
+    if not receptionists or not doctors or not services or not insurances:
+        raise SystemExit(f"{db_path} has no reception users, doctors, nursing services or tariffs - "
+                         "build it with generate_clinic_dataset.py")
+    return {'receptionists': receptionists, 'doctors': doctors, 'nurses': nurses, 'services': services,
+            'insurances': insurances, 'patients': patients}
+
+
+def _national_id(rng) -> str:
+    """Random national id with a valid check digit."""
+    while True:
+        digits = [rng.randint(0, 9) for _ in range(9)]
+        if len(set(digits)) > 1:
+            break
+    remainder = sum(d * (10 - i) for i, d in enumerate(digits)) % 11
+    check = remainder if remainder < 2 else 11 - remainder
+    return ''.join(map(str, digits)) + str(check)
+
+
+class Recorder:
+    """Latency samples and failures per endpoint, shared by all stations."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self.flows = 0
+
+    def add(self, name: str, ms: float, status: int, body: str) -> None:
+        text = body[:2000].lower()
+        locked = any(marker in text for marker in LOCK_MARKERS)
+        with self._lock:
+            entry = self._samples.setdefault(name, {'ms': [], 'errors': 0, 'locks': 0, 'statuses': {}})
+            entry['ms'].append(ms)
+            entry['statuses'][status] = entry['statuses'].get(status, 0) + 1
+            if status == 0 or status >= 400:
+                entry['errors'] += 1
+            if locked:
+                entry['locks'] += 1
+
+    def flow_done(self) -> None:
+        with self._lock:
+            self.flows += 1
+
+    def report(self, elapsed: float) -> dict:
+        with self._lock:
+            samples = {name: dict(e, ms=list(e['ms'])) for name, e in self._samples.items()}
+        endpoints = {}
+        for name, e in sorted(samples.items()):
+            ordered = sorted(e['ms'])
+            endpoints[name] = dict(_percentiles(ordered), requests=len(ordered), errors=e['errors'],
+                                   locks=e['locks'], statuses={str(k): v for k, v in e['statuses'].items()})
+        total = sum(e['requests'] for e in endpoints.values())
+        errors = sum(e['errors'] for e in endpoints.values())
+        locks = sum(e['locks'] for e in endpoints.values())
+        return {
+            'elapsed_s': round(elapsed, 2),
+            'requests': total,
+            'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+            'patients_completed': self.flows,
+            'patients_per_hour': round(self.flows * 3600 / elapsed, 1) if elapsed else 0,
+            'error_rate': round(errors / total, 4) if total else 0,
+            'lock_rate': round(locks / total, 4) if total else 0,
+            'endpoints': endpoints,
+        }
+
+
+def _percentiles(ordered) -> dict:
+    if not ordered:
+        return {}
+    if len(ordered) > 1:
+        cuts = statistics.quantiles(ordered, n=100, method='inclusive')
+        p50, p95, p99 = statistics.median(ordered), cuts[94], cuts[98]
+    else:
+        p50 = p95 = p99 = ordered[0]
+    return {'p50_ms': round(p50, 2), 'p95_ms': round(p95, 2), 'p99_ms': round(p99, 2),
+            'max_ms': round(ordered[-1], 2)}
+
+
+class FlowError(Exception):
+    """A step failed; the station drops the current patient and starts the next one."""
+
+
+class Station(threading.Thread):
+    def __init__(self, name: str, base_url: str, recorder: Recorder, deadline: float, think: float, seed: int):
+        super().__init__(name=name, daemon=True)
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.deadline = deadline
+        self.think = think
+        self.rng = random.Random(seed)
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def call(self, name: str, path: str, form=None, payload=None):
+        """One request; returns (status, parsed JSON or None, final URL after redirects)."""
+        data = None
+        headers = {'Accept': 'application/json'}
+        if payload is not None:
+            data = json.dumps(payload).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode('utf-8')
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers)
+        url = req.full_url
+        started = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                status, body, url = resp.status, resp.read(), resp.geturl()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        except (urllib.error.URLError, OSError) as e:
+            status, body = 0, str(e).encode('utf-8')
+        elapsed = (time.perf_counter() - started) * 1000
+        text = body.decode('utf-8', 'replace')
+        self.recorder.add(name, elapsed, status, text)
+        try:
+            parsed = json.loads(text)
+        except ValueError:
+            parsed = None
+        return status, parsed, url
+
+    def expect(self, name: str, path: str, form=None, payload=None):
+        status, data, _ = self.call(name, path, form, payload)
+        if status != 200 or not isinstance(data, dict) or data.get('error'):
+            error = data.get('error') if isinstance(data, dict) else 'non-JSON response (session expired?)'
+            raise FlowError(f'{name}: {status} {error}')
+        return data
+
+    def login(self, form: dict) -> None:
+        status, _, url = self.call('auth.login', '/auth/login', form=form)
+        # ورود موفق به داشبورد redirect می‌شود؛ ماندن روی فرم یعنی رمز اشتباه یا حساب قفل
+        if status != 200 or urllib.parse.urlparse(url).path.rstrip('/').endswith('/auth/login'):
+            raise SystemExit(f'{self.name}: login failed ({status})')
+
+    def pause(self) -> None:
+        if self.think:
+            time.sleep(self.think * (0.5 + self.rng.random()))
+
+    def running(self) -> bool:
+        return time.monotonic() < self.deadline
+
+
+class ReceptionStation(Station):
+    def __init__(self, username: str, password: str, catalog: dict, *args):
+        super().__init__(f'reception:{username}', *args)
+        self.username = username
+        self.password = password
+        self.catalog = catalog
+
+    def run(self):
+        self.login({'role': 'reception', 'reception_username': self.username, 'password': self.password})
+        while self.running():
+            try:
+                self.patient()
+                self.recorder.flow_done()
+            except FlowError as e:
+                print(f'  [{self.name}] {e}')
+
+    def patient(self) -> None:
+        rng, catalog = self.rng, self.catalog
+        existing = catalog['patients'] and rng.random() < 0.6
+        if existing:
+            patient = rng.choice(catalog['patients'])
+            self.expect('reception.list_patients', '/reception/patients/list?'
+                        + urllib.parse.urlencode({'q': patient['family_name']}))
+            self.expect('reception.search_patient', '/reception/search_patient?'
+                        + urllib.parse.urlencode({'national_id': patient['national_id']}))
+            self.pause()
+            invoice_id = self.expect('reception.open_invoice_existing', '/reception/invoice/open_existing',
+                                     form={'patient_id': patient['id']})['invoice_id']
+        else:
+            national_id = _national_id(rng)
+            self.expect('reception.search_patient', '/reception/search_patient?'
+                        + urllib.parse.urlencode({'national_id': national_id}))
+            self.pause()
+            invoice_id = self.expect('reception.new_visit', '/reception/new', form={
+                'name': rng.choice(FIRST_NAMES), 'family_name': rng.choice(LAST_NAMES),
+                'national_id': national_id, 'phone': '09' + ''.join(rng.choice('0123456789') for _ in range(9)),
+                'insurance_type': rng.choice(catalog['insurances']),
+            })['invoice_id']
+        self.pause()
+
+        self.expect('reception.add_visit_to_invoice', '/reception/add_visit', form={'invoice_id': invoice_id})
+        self.pause()
+        if rng.random() < 0.6:
+            self.expect('reception.injections_submit', '/reception/injections', payload={
+                'invoice_id': invoice_id,
+                'services': [{'id': rng.choice(catalog['services']), 'qty': rng.randint(1, 2)}],
+                'consumables': [self._consumable()],
+            })
+            self.pause()
+        if rng.random() < 0.25:
+            name, price = rng.choice(PROCEDURES)
+            self.expect('reception.procedures_submit', '/reception/procedures', payload={
+                'invoice_id': invoice_id,
+                'procedures': [{'name': name, 'unit_price': price, 'qty': 1, 'performer_type': 'doctor'}],
+                'consumables': [self._consumable()],
+            })
+            self.pause()
+
+        items = self.expect('reception.get_invoice_details_api',
+                            f'/reception/api/invoice/{invoice_id}/details')['items']
+        # یک آیتم پرداخت و دوباره لغو می‌شود (تغییر روش پرداخت در پیشخوان)
+        item = rng.choice(items)
+        for is_paid in ('true', 'false'):
+            self.expect('reception.set_item_payment', '/reception/item/payment', form={
+                'invoice_id': invoice_id, 'item_type': item['type'], 'item_id': item['id'],
+                'payment_type': 'cash', 'is_paid': is_paid,
+            })
+        self.pause()
+        self.expect('reception.settle_all_items', '/reception/item/settle_all',
+                    form={'invoice_id': invoice_id, 'payment_type': rng.choice(('cash', 'card'))})
+        self.expect('reception.close_invoice', '/reception/invoice/close', form={'invoice_id': invoice_id})
+        self.pause()
+
+    def _consumable(self) -> dict:
+        name, price, category = self.rng.choice(CONSUMABLES)
+        return {'name': name, 'qty': 1, 'unit_price': price, 'category': category}
+
+
+class ManagerStation(Station):
+    def __init__(self, password: str, *args):
+        super().__init__('manager', *args)
+        self.password = password
+
+    def run(self):
+        self.login({'role': 'manager', 'username': 'manager', 'password': self.password})
+        while self.running():
+            name, path = self.rng.choice(MANAGER_REPORTS)
+            self.call(name, path)
+            self.pause()
+
+
+def _set_shift_staff(base_url: str, catalog: dict, password: str, recorder: Recorder) -> None:
+    """Visits need doctor/nurse of the current shift; set once before the stations start."""
+    station = ReceptionStation(catalog['receptionists'][0], password, catalog, base_url, recorder, 0, 0, 0)
+    station.login({'role': 'reception', 'reception_username': station.username, 'password': password})
+    form = {'doctor_id': catalog['doctors'][0]}
+    if catalog['nurses']:
+        form['nurse_id'] = catalog['nurses'][0]
+    station.expect('reception.set_shift_staff_route', '/reception/shift_staff', form=form)
+
+
+def run_load(base_url: str, catalog: dict, stations: int = 4, duration: float = 60, think: float = 0.5,
+             manager: bool = True, reception_password: str = 'rec123', manager_password: str = 'manager123',
+             seed: int = 1) -> dict:
+    recorder = Recorder()
+    _set_shift_staff(base_url, catalog, reception_password, recorder)
+
+    deadline = time.monotonic() + duration
+    users = catalog['receptionists']
+    threads = [ReceptionStation(users[i % len(users)], reception_password, catalog,
+                                base_url, recorder, deadline, think, seed + i)
+               for i in range(stations)]
+    if manager:
+        threads.append(ManagerStation(manager_password, base_url, recorder, deadline, think * 4, seed + 1000))
+
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    result = recorder.report(time.monotonic() - started)
+    result.update({
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'url': base_url,
+        'stations': stations,
+        'manager': manager,
+        'think_s': think,
+    })
+    return result
+
+
+def _print_report(result: dict) -> None:
+    print(f"\n  {'endpoint':<38} {'reqs':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'err':>5} {'lock':>5}")
+    for name, e in result['endpoints'].items():
+        print(f"  {name:<38} {e['requests']:>6} {e['p50_ms']:>8.1f} {e['p95_ms']:>8.1f} {e['p99_ms']:>8.1f} "
+              f"{e['max_ms']:>8.1f} {e['errors']:>5} {e['locks']:>5}")
+    print(f"\n  {result['requests']} requests in {result['elapsed_s']} s = {result['throughput_rps']} req/s, "
+          f"{result['patients_completed']} patients ({result['patients_per_hour']}/h), "
+          f"errors {result['error_rate']:.2%}, locks {result['lock_rate']:.2%}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a reception shift against a running server.')
+    parser.add_argument('--db', required=True, help='The seeded DB the server runs on (read once for ids).')
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--stations', type=int, default=4, help='Concurrent reception stations.')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to run.')
+    parser.add_argument('--think', type=float, default=0.5, help='Mean pause between steps in seconds (0 = flat out).')
+    parser.add_argument('--no-manager', action='store_true', help='Do not run the manager report station.')
+    parser.add_argument('--reception-password', default='rec123')
+    parser.add_argument('--manager-password', default='manager123')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='Write results as JSON.')
+    args = parser.parse_args(argv)
+
+    catalog = _catalog(args.db)
+    print(f"Load test {args.url}: {args.stations} reception stations"
+          f"{'' if args.no_manager else ' + manager'}, {args.duration:g} s")
+    result = run_load(args.url, catalog, stations=args.stations, duration=args.duration, think=args.think,
+                      manager=not args.no_manager, reception_password=args.reception_password,
+                      manager_password=args.manager_password, seed=args.seed)
+    _print_report(result)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+    return 1 if result['requests'] == 0 or result['error_rate'] > 0.05 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,305 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.adapters.sqlite.core import get_db
+from src.adapters.sqlite.tariff_cache import TariffData, get_tariffs
+
+
+@dataclass
+class ArrearsRules:
+    """Tariff rules for insurer claims, built once from the tariff cache."""
+    base_visit_price: float = 0.0
+    # insurance_type -> (patient share of a visit, insurance covers nursing)
+    insurances: Dict[str, Tuple[float, bool]] = field(default_factory=dict)
+    # supplementary insurance -> final patient share
+    supplementary: Dict[str, float] = field(default_factory=dict)
+    # insurance_type -> excluded nursing service ids
+    exclusions: Dict[str, set] = field(default_factory=dict)
+    insurance_names: List[str] = field(default_factory=list)
+
+    @classmethod
+    def from_tariffs(cls, tariffs: TariffData) -> 'ArrearsRules':
+        rules = cls()
+        base_tariff = tariffs.base_tariff(active_only=False)
+        rules.base_visit_price = float((base_tariff['tariff_price'] if base_tariff else 0) or 0)
+        # همه تعرفه‌ها به جز آزاد/پایه (ردیف آخر هر بیمه برنده است)
+        rows = [
+            t for t in tariffs.visit_tariffs
+            if t['insurance_type'] != 'آزاد' and not (t.get('is_base_tariff') or 0)
+        ]
+        for t in rows:
+            rules.insurances[t['insurance_type']] = (
+                float(t.get('tariff_price') or 0), bool(t.get('nursing_covers') or 0)
+            )
+        for t in tariffs.visit_tariffs:
+            if t.get('is_supplementary') == 1 and t['is_active'] == 1:
+                rules.supplementary[t['insurance_type']] = float(t.get('tariff_price') or 0)
+        rules.exclusions = tariffs.exclusions
+        rules.insurance_names = sorted({t['insurance_type'] for t in rows})
+        return rules
+
+
+def _values_cte(name: str, columns: Tuple[str, ...], rows: List[Tuple]) -> Tuple[str, List]:
+    """`name(cols) AS (VALUES ...)` for a small lookup table passed as parameters."""
+    cols = ', '.join(columns)
+    if not rows:
+        nulls = ', '.join('NULL' for _ in columns)
+        return f"{name}({cols}) AS (SELECT {nulls} WHERE 0)", []
+    placeholders = ', '.join('(' + ', '.join('?' for _ in columns) + ')' for _ in rows)
+    return f"{name}({cols}) AS (VALUES {placeholders})", [v for row in rows for v in row]
+
+
+class InsuranceArrearsRepository:
+    """Insurer debts (مطالبات بیمه) computed set-based in SQL.
+
+    Tariff rules and nursing exclusions are loaded once from the tariff cache
+    and joined as small lookup tables, so a whole date range is one grouped
+    query per debt kind. Detail rows are only fetched when asked for.
+
+    Debt rules (same as the per-row implementation):
+    - base visit debt = base tariff - insurance tariff (patient share), if > 0
+    - supplementary debt = patient share - supplementary tariff, if > 0
+    - nursing debt = injection price, if the invoice insurance covers nursing
+      and the service is not excluded for it
+    """
+
+    def __init__(self, date_from: str = '', date_to: str = '', insurance: str = '',
+                 rules: Optional[ArrearsRules] = None):
+        self.date_from = date_from
+        self.date_to = date_to
+        self.insurance = insurance
+        self.rules = rules or ArrearsRules.from_tariffs(get_tariffs())
+
+    # ---------- SQL building ----------
+
+    def _ctes(self) -> Tuple[str, List]:
+        r = self.rules
+        ins_sql, ins_params = _values_cte(
+            'ins_rules', ('insurance_type', 'patient_share', 'nursing_covers'),
+            [(k, share, 1 if covers else 0) for k, (share, covers) in r.insurances.items()]
+        )
+        supp_sql, supp_params = _values_cte(
+            'supp_rules', ('insurance_type', 'final_share'),
+            list(r.supplementary.items())
+        )
+        exc_sql, exc_params = _values_cte(
+            'excluded', ('insurance_type', 'service_id'),
+            [(k, sid) for k, ids in r.exclusions.items() for sid in ids]
+        )
+        return f"WITH {ins_sql}, {supp_sql}, {exc_sql}", ins_params + supp_params + exc_params
+
+    def _filters(self, alias: str, insurance_col: str) -> Tuple[str, List]:
+        sql, params = '', []
+        if self.date_from:
+            sql += f" AND {alias}.work_date >= ?"
+            params.append(self.date_from)
+        if self.date_to:
+            sql += f" AND {alias}.work_date <= ?"
+            params.append(self.date_to)
+        if self.insurance:
+            sql += f" AND {insurance_col} = ?"
+            params.append(self.insurance)
+        return sql, params
+
+    def _visits_sql(self) -> Tuple[str, List]:
+        """CTE `iv`: insured visits with their patient share and supplementary share."""
+        ctes, params = self._ctes()
+        where, where_params = self._filters('v', 'v.insurance_type')
+        sql = f"""{ctes},
+            iv AS (
+                SELECT v.id, v.visit_date, v.insurance_type, v.supplementary_insurance,
+                       p.full_name AS patient_name, p.national_id, inv.id AS invoice_id,
+                       COALESCE(r.patient_share, 0) AS patient_share,
+                       s.insurance_type IS NOT NULL AS has_supp,
+                       COALESCE(s.final_share, 0) AS final_share
+                FROM visits v
+                JOIN patients p ON v.patient_id = p.id
+                JOIN invoices inv ON v.invoice_id = inv.id
+                LEFT JOIN ins_rules r ON r.insurance_type = v.insurance_type
+                LEFT JOIN supp_rules s ON s.insurance_type = v.supplementary_insurance
+                    AND v.supplementary_insurance != ''
+                WHERE v.insurance_type IS NOT NULL AND v.insurance_type != 'آزاد'{where}
+            )"""
+        return sql, params + where_params
+
+    def _nursing_sql(self, select: str, tail: str = '') -> Tuple[str, List]:
+        ctes, params = self._ctes()
+        where, where_params = self._filters('i', 'inv.insurance_type')
+        sql = f"""{ctes}
+            SELECT {select}
+            FROM injections i
+            JOIN patients p ON i.patient_id = p.id
+            JOIN invoices inv ON i.invoice_id = inv.id
+            JOIN ins_rules r ON r.insurance_type = inv.insurance_type AND r.nursing_covers = 1
+            WHERE inv.insurance_type IS NOT NULL AND inv.insurance_type != 'آزاد'{where}
+              AND NOT EXISTS (
+                  SELECT 1 FROM excluded e
+                  WHERE e.insurance_type = inv.insurance_type AND e.service_id = i.service_id
+              )
+            {tail}"""
+        return sql, params + where_params
+
+    # ---------- summary ----------
+
+    def summary(self) -> Dict:
+        """Per-insurer counts/debts and grand totals, without fetching item rows."""
+        db = get_db()
+        base = self.rules.base_visit_price
+        by_insurance: Dict[str, Dict] = {}
+
+        def bucket(ins: str) -> Dict:
+            if ins not in by_insurance:
+                by_insurance[ins] = {
+                    'visit_count': 0,
+                    'visit_debt': 0,
+                    'nursing_count': 0,
+                    'nursing_debt': 0,
+                    'supplementary_count': 0,
+                    'supplementary_debt': 0,
+                    'total_debt': 0,
+                    'is_supplementary': False
+                }
+            return by_insurance[ins]
+
+        visits_sql, params = self._visits_sql()
+        rows = db.execute(f"""{visits_sql}
+            SELECT 'visit' AS kind, insurance_type AS ins, COUNT(*) AS cnt, SUM(? - patient_share) AS debt
+            FROM iv WHERE ? - patient_share > 0
+            GROUP BY insurance_type
+            UNION ALL
+            SELECT 'supplementary', supplementary_insurance, COUNT(*), SUM(patient_share - final_share)
+            FROM iv WHERE has_supp AND patient_share > 0 AND patient_share - final_share > 0
+            GROUP BY supplementary_insurance
+        """, params + [base, base]).fetchall()
+        for r in rows:
+            b = bucket(r['ins'])
+            b[f"{r['kind']}_count"] += r['cnt']
+            b[f"{r['kind']}_debt"] += r['debt'] or 0
+            b['total_debt'] += r['debt'] or 0
+            if r['kind'] == 'supplementary':
+                b['is_supplementary'] = True
+
+        nursing_sql, params = self._nursing_sql(
+            "inv.insurance_type AS ins, COUNT(*) AS cnt, SUM(COALESCE(i.total_price, 0)) AS debt",
+            "GROUP BY inv.insurance_type"
+        )
+        for r in db.execute(nursing_sql, params).fetchall():
+            b = bucket(r['ins'])
+            b['nursing_count'] += r['cnt']
+            b['nursing_debt'] += r['debt'] or 0
+            b['total_debt'] += r['debt'] or 0
+
+        totals = {k: sum(b[k] for b in by_insurance.values()) for k in (
+            'visit_count', 'visit_debt', 'supplementary_count', 'supplementary_debt',
+            'nursing_count', 'nursing_debt', 'total_debt'
+        )}
+        return {'by_insurance': by_insurance, 'totals': totals}
+
+    # ---------- detail rows ----------
+
+    def visit_rows(self, limit: Optional[int] = None) -> List[Dict]:
+        base = self.rules.base_visit_price
+        visits_sql, params = self._visits_sql()
+        sql = f"""{visits_sql}
+            SELECT id, visit_date AS date, insurance_type, patient_name, national_id, invoice_id,
+                   patient_share, ? - patient_share AS insurance_debt
+            FROM iv WHERE ? - patient_share > 0
+            ORDER BY visit_date DESC"""
+        params = params + [base, base]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [{
+            'id': r['id'],
+            'date': r['date'],
+            'type': 'visit',
+            'type_fa': 'ویزیت',
+            'insurance_type': r['insurance_type'],
+            'patient_name': r['patient_name'],
+            'national_id': r['national_id'],
+            'invoice_id': r['invoice_id'],
+            'base_price': base,
+            'patient_paid': r['patient_share'],
+            'insurance_debt': r['insurance_debt']
+        } for r in get_db().execute(sql, params).fetchall()]
+
+    def supplementary_rows(self, limit: Optional[int] = None) -> List[Dict]:
+        visits_sql, params = self._visits_sql()
+        sql = f"""{visits_sql}
+            SELECT id, visit_date AS date, insurance_type, supplementary_insurance,
+                   patient_name, national_id, invoice_id, patient_share, final_share,
+                   patient_share - final_share AS insurance_debt
+            FROM iv WHERE has_supp AND patient_share > 0 AND patient_share - final_share > 0
+            ORDER BY visit_date DESC"""
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return [{
+            'id': r['id'],
+            'date': r['date'],
+            'type': 'visit',
+            'type_fa': 'ویزیت',
+            'insurance_type': r['supplementary_insurance'],  # نام بیمه تکمیلی
+            'base_insurance': r['insurance_type'],  # نام بیمه پایه
+            'patient_name': r['patient_name'],
+            'national_id': r['national_id'],
+            'invoice_id': r['invoice_id'],
+            'base_price': r['patient_share'],  # سهم بیمار از بیمه پایه
+            'patient_paid': r['final_share'],  # سهم نهایی بیمار با تکمیلی
+            'insurance_debt': r['insurance_debt']  # معوقه از بیمه تکمیلی
+        } for r in get_db().execute(sql, params).fetchall()]
+
+    def nursing_rows(self, limit: Optional[int] = None) -> List[Dict]:
+        sql, params = self._nursing_sql("""
+            i.id, i.injection_date AS date, i.injection_type, inv.insurance_type,
+            p.full_name AS patient_name, p.national_id, inv.id AS invoice_id,
+            COALESCE(i.total_price, 0) AS service_price
+        """, "ORDER BY i.injection_date DESC" + (" LIMIT ?" if limit else ''))
+        if limit:
+            params.append(limit)
+        return [{
+            'id': r['id'],
+            'date': r['date'],
+            'type': 'injection',
+            'type_fa': r['injection_type'],
+            'insurance_type': r['insurance_type'],
+            'patient_name': r['patient_name'],
+            'national_id': r['national_id'],
+            'invoice_id': r['invoice_id'],
+            'service_price': r['service_price'],  # مبلغ خدمت که بیمه باید پرداخت کند
+        } for r in get_db().execute(sql, params).fetchall()]
+
+    def iter_export_rows(self) -> Iterator[List]:
+        """CSV rows (base visits, supplementary visits, nursing) streamed from the cursors."""
+        from src.common.csv_export import iter_cursor
+        db = get_db()
+        base = self.rules.base_visit_price
+
+        visits_sql, params = self._visits_sql()
+        cursor = db.execute(f"""{visits_sql}
+            SELECT visit_date, patient_name, national_id, insurance_type, patient_share
+            FROM iv WHERE ? - patient_share > 0
+            ORDER BY visit_date DESC
+        """, params + [base])
+        for r in iter_cursor(cursor):
+            yield [r['visit_date'], r['patient_name'], r['national_id'] or '', r['insurance_type'],
+                   'ویزیت', base, r['patient_share'], base - r['patient_share']]
+
+        cursor = db.execute(f"""{visits_sql}
+            SELECT visit_date, patient_name, national_id, supplementary_insurance,
+                   patient_share, final_share
+            FROM iv WHERE has_supp AND patient_share > 0 AND patient_share - final_share > 0
+            ORDER BY visit_date DESC
+        """, params)
+        for r in iter_cursor(cursor):
+            yield [r['visit_date'], r['patient_name'], r['national_id'] or '', r['supplementary_insurance'],
+                   'ویزیت (تکمیلی)', r['patient_share'], r['final_share'],
+                   r['patient_share'] - r['final_share']]
+
+        sql, params = self._nursing_sql("""
+            i.injection_date, p.full_name AS patient_name, p.national_id, inv.insurance_type,
+            i.injection_type, COALESCE(i.total_price, 0) AS service_price
+        """, "ORDER BY i.injection_date DESC")
+        for r in iter_cursor(db.execute(sql, params)):
+            yield [r['injection_date'], r['patient_name'], r['national_id'] or '', r['insurance_type'],
+                   r['injection_type'], '-', '0', r['service_price']]
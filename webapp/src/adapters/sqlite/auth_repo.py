@@ -2,6 +2,7 @@ import sqlite3
 from typing import Optional, List, Dict
 
 from src.adapters.sqlite.core import get_db
+from src.adapters.sqlite.user_cache import user_cache
 
 
 class AuthRepository:
@@ -27,6 +28,7 @@ class AuthRepository:
             (failed_attempts, locked_until, user_id),
         )
         db.commit()
+        user_cache.invalidate_user(user_id)
 
     def reset_failed_attempts(self, user_id: int):
         db = get_db()
@@ -35,6 +37,7 @@ class AuthRepository:
             (user_id,),
         )
         db.commit()
+        user_cache.invalidate_user(user_id)
 
     def set_last_login(self, user_id: int):
         db = get_db()
@@ -44,6 +47,7 @@ class AuthRepository:
                 (user_id,),
             )
             db.commit()
+            user_cache.invalidate_user(user_id)
         except sqlite3.OperationalError:
             db.rollback()
 
@@ -68,6 +72,7 @@ class AuthRepository:
                 (password_hash, user_id),
             )
             db.commit()
+            user_cache.invalidate_user(user_id)
             return True
         except Exception as e:
             print(f"Error updating user password: {e}")
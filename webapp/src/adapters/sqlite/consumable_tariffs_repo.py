@@ -1,27 +1,36 @@
 from typing import List, Dict, Optional
 from src.adapters.sqlite.core import get_db
+from src.adapters.sqlite.tariff_cache import get_tariffs, bump_tariff_generation
 
 class ConsumableTariffsRepository:
     def list_active(self, category: Optional[str] = None) -> List[Dict]:
-        db = get_db()
+        rows = [
+            r for r in get_tariffs().consumable_tariffs
+            if r['is_active'] == 1 and (not category or r['category'] == category)
+        ]
         if category:
-            rows = db.execute("SELECT id, name, default_price, category FROM consumable_tariffs WHERE is_active = 1 AND category = ? ORDER BY name", (category,)).fetchall()
+            rows.sort(key=lambda r: r['name'])
         else:
-            rows = db.execute("SELECT id, name, default_price, category FROM consumable_tariffs WHERE is_active = 1 ORDER BY category, name").fetchall()
-        return [dict(r) for r in rows]
+            rows.sort(key=lambda r: (r['category'] or '', r['name']))
+        return [self._public(r) for r in rows]
 
     def create(self, name: str, default_price: float, category: str) -> int:
         db = get_db()
         cur = db.execute("INSERT INTO consumable_tariffs (name, default_price, category) VALUES (?,?,?)", (name, default_price, category))
+        bump_tariff_generation(db)
         db.commit()
         return cur.lastrowid
 
     def deactivate(self, tariff_id: int):
         db = get_db()
         db.execute("UPDATE consumable_tariffs SET is_active = 0 WHERE id = ?", (tariff_id,))
+        bump_tariff_generation(db)
         db.commit()
 
     def get(self, tariff_id: int) -> Optional[Dict]:
-        db = get_db()
-        row = db.execute("SELECT id, name, default_price, category FROM consumable_tariffs WHERE id = ?", (tariff_id,)).fetchone()
-        return dict(row) if row else None
+        row = next((r for r in get_tariffs().consumable_tariffs if r['id'] == tariff_id), None)
+        return self._public(row) if row else None
+
+    @staticmethod
+    def _public(r: Dict) -> Dict:
+        return {'id': r['id'], 'name': r['name'], 'default_price': r['default_price'], 'category': r['category']}
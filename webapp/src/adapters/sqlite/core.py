@@ -1,124 +1,328 @@
+import shutil
 import sqlite3
 import pkgutil
 import os
+import atexit
+import threading
 from flask import g
 from src.config.settings import Config
+from src.common.event_hub import event_hub
+from src.common.metrics import metrics
 import sys
 
-def _ensure_column(db, table: str, column: str, decl_sql: str) -> None:
-    try:
-        cols = db.execute(f"PRAGMA table_info({table})").fetchall()
-        if any(c["name"] == column for c in cols):
+
+class ClinicConnection(sqlite3.Connection):
+    """sqlite3 connection that lets repositories join a unit of work.
+
+    While a unit of work is active (see `unit_of_work.py`), `commit()` from a
+    repository is deferred to the end of the unit and `rollback()` marks the
+    whole unit for rollback, so several repository calls become one
+    transaction with one commit.
+
+    With ``query_stats`` set (during a request, see `query_stats.py`) every
+    statement is counted and timed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.uow_depth = 0
+        self.uow_rollback_only = False
+        self.uow_after_commit = []
+        self.query_stats = None
+
+    def execute(self, sql, parameters=()):
+        stats = self.query_stats
+        if stats is None:
+            return super().execute(sql, parameters)
+        return stats.execute(self, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        stats = self.query_stats
+        if stats is None:
+            return super().executemany(sql, seq_of_parameters)
+        return stats.timed(sql, super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        stats = self.query_stats
+        if stats is None:
+            return super().executescript(sql_script)
+        return stats.timed(sql_script, super().executescript, sql_script)
+
+    def commit(self):
+        if self.uow_depth:
             return
-        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl_sql}")
-        db.commit()
-    except Exception:
-        # Keep app usable even if migration fails.
-        pass
+        super().commit()
+
+    def rollback(self):
+        if self.uow_depth:
+            self.uow_rollback_only = True
+            return
+        super().rollback()
+
+    def reset_unit_of_work(self):
+        self.uow_depth = 0
+        self.uow_rollback_only = False
+        self.uow_after_commit = []
 
 
-def _ensure_work_date_columns(db) -> None:
-    """Ensure `work_date` exists on operational tables.
+class ConnectionPool:
+    """Small thread-safe pool of SQLite connections shared by request threads.
 
-    Manual shifts can span midnight (especially night shift). Relying on
-    DATE(timestamp) splits a single work shift across two calendar dates.
-    We persist `work_date` so reports/ledgers can stay consistent.
+    Each request borrows one connection (stored on `g._database`) and gives it
+    back at teardown. Pragmas are applied once when a connection is created,
+    so requests get a warm page cache instead of a cold `sqlite3.connect`.
+    At most `max_idle` connections are kept; extra ones are closed on release.
+    At most `max_size` are open at once: `acquire` waits `wait_seconds` for
+    one to come back, then raises PoolExhausted.
+
+    Every connection remembers its pool (``conn.pool``). After `close_all`
+    (restore/reset, see close_pool) the pool is closed: connections borrowed
+    before that are closed on release instead of being reused.
     """
-    _ensure_column(db, "invoices", "work_date", "TEXT")
-    _ensure_column(db, "invoices", "shift", "TEXT")
-    _ensure_column(db, "visits", "work_date", "TEXT")
-    _ensure_column(db, "injections", "work_date", "TEXT")
-    _ensure_column(db, "procedures", "work_date", "TEXT")
-    _ensure_column(db, "consumables_ledger", "work_date", "TEXT")
-
-    # Best-effort backfill for existing rows.
+
+    def __init__(self, db_path: str, max_idle: int = 8, max_size: int = 32,
+                 wait_seconds: float = 10.0):
+        self.db_path = db_path
+        self.max_idle = max_idle
+        self.max_size = max(max_size, 1)
+        self.wait_seconds = wait_seconds
+        self._idle = []
+        self._lock = threading.Lock()
+        self._returned = threading.Condition(self._lock)
+        self._in_use = 0
+        self._closed = False
+
+    def _connect(self):
+        timeout = getattr(Config, 'DB_BUSY_TIMEOUT_MS', 5000) / 1000.0
+        conn = sqlite3.connect(self.db_path, timeout=timeout, check_same_thread=False,
+                               factory=ClinicConnection)
+        conn.row_factory = sqlite3.Row
+        conn.pool = self
+        _apply_pragmas(conn)
+        return conn
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        """Return a healthy connection (reused when possible)."""
+        while True:
+            with self._lock:
+                if not self._idle and self._in_use >= self.max_size:
+                    if not self._returned.wait_for(
+                            lambda: self._idle or self._in_use < self.max_size,
+                            timeout=self.wait_seconds):
+                        raise PoolExhausted(
+                            f"all {self.max_size} database connections are in use")
+                conn = self._idle.pop() if self._idle else None
+                self._in_use += 1
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    self._forget()
+                    raise
+            if self._is_healthy(conn):
+                return conn
+            # Broken/closed connection: drop it and try the next one
+            self._forget()
+            _close_quietly(conn)
+
+    def _forget(self) -> None:
+        """One borrowed connection is gone (closed, not returned)."""
+        with self._lock:
+            self._in_use -= 1
+            self._returned.notify()
+
+    def release(self, conn) -> None:
+        """Give a connection back; roll back anything left uncommitted."""
+        if getattr(conn, 'pool', None) is not self:
+            # مال pool دیگری است - آن pool حسابش را نگه می‌دارد
+            owner = getattr(conn, 'pool', None)
+            if owner is not None:
+                owner.release(conn)
+            else:
+                _close_quietly(conn)
+            return
+        try:
+            # unit of work رها شده (مثلاً خطا قبل از exit) نباید به درخواست بعدی برسد
+            if getattr(conn, 'uow_depth', 0):
+                conn.reset_unit_of_work()
+            if getattr(conn, 'query_stats', None) is not None:
+                conn.query_stats = None
+            if conn.in_transaction:
+                conn.rollback()
+            # آرشیو لاگ ATTACH شده روی کانکشن بیکار نمی‌ماند (چرخش/حذف فایل آرشیو)
+            from src.adapters.sqlite.log_archive import detach_archive
+            detach_archive(conn)
+        except Exception:
+            # Closed by the caller (e.g. reset_database) - discard
+            self._forget()
+            _close_quietly(conn)
+            return
+        with self._lock:
+            self._in_use -= 1
+            self._returned.notify()
+            if not self._closed and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        _close_quietly(conn)
+
+    def close_all(self) -> None:
+        """Close idle connections; borrowed ones are closed on release."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            _close_quietly(conn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'idle': len(self._idle), 'in_use': self._in_use,
+                    'max_idle': self.max_idle, 'max_size': self.max_size}
+
+
+class PoolExhausted(RuntimeError):
+    """Every pooled connection stayed borrowed for the whole wait."""
+
+
+def _close_quietly(conn) -> None:
     try:
-        db.execute("UPDATE invoices SET work_date = substr(opened_at, 1, 10) WHERE work_date IS NULL OR work_date = ''")
-        
-        # Backfill shift for invoices based on hour
-        db.execute("""
-            UPDATE invoices SET shift = CASE 
-                WHEN strftime('%H', opened_at) BETWEEN '07' AND '13' THEN 'morning'
-                WHEN strftime('%H', opened_at) BETWEEN '14' AND '19' THEN 'evening'
-                ELSE 'night'
-            END
-            WHERE shift IS NULL OR shift = ''
-        """)
-
-        db.execute("UPDATE visits SET work_date = substr(visit_date, 1, 10) WHERE work_date IS NULL OR work_date = ''")
-        db.execute("UPDATE injections SET work_date = substr(injection_date, 1, 10) WHERE work_date IS NULL OR work_date = ''")
-        db.execute("UPDATE procedures SET work_date = substr(procedure_date, 1, 10) WHERE work_date IS NULL OR work_date = ''")
-        db.execute("UPDATE consumables_ledger SET work_date = substr(usage_date, 1, 10) WHERE work_date IS NULL OR work_date = ''")
-        db.commit()
+        conn.close()
     except Exception:
         pass
 
 
-def _ensure_indexes(db) -> None:
-    """Create performance indexes if they don't exist."""
+def _apply_pragmas(conn) -> None:
+    """Per-connection tuning: WAL for concurrent readers + one writer, fewer fsyncs."""
+    pragmas = (
+        "PRAGMA journal_mode = WAL",
+        "PRAGMA synchronous = NORMAL",
+        f"PRAGMA cache_size = -{int(getattr(Config, 'DB_CACHE_SIZE_KB', 20000))}",
+        f"PRAGMA mmap_size = {int(getattr(Config, 'DB_MMAP_SIZE', 268435456))}",
+        "PRAGMA temp_store = MEMORY",
+        f"PRAGMA busy_timeout = {int(getattr(Config, 'DB_BUSY_TIMEOUT_MS', 5000))}",
+    )
+    for sql in pragmas:
+        try:
+            conn.execute(sql)
+        except Exception:
+            # e.g. journal_mode on a read-only or in-memory DB - keep going
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# با هر close_pool (بازگردانی/ریست فایل) یکی زیاد می‌شود تا کش‌های پروسه دور ریخته شوند
+_pool_epoch = 0
+
+
+def get_pool() -> ConnectionPool:
+    """Process-wide pool for Config.DATABASE_PATH (recreated if the path changes)."""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.db_path != Config.DATABASE_PATH:
+            if _pool is not None:
+                _pool.close_all()
+            _pool = ConnectionPool(Config.DATABASE_PATH, getattr(Config, 'DB_POOL_SIZE', 8),
+                                   getattr(Config, 'DB_POOL_MAX', 32),
+                                   getattr(Config, 'DB_POOL_WAIT_SECONDS', 10.0))
+        return _pool
+
+
+def close_pool() -> None:
+    """Close all pooled connections (shutdown, or before replacing the DB file)."""
+    global _pool, _migrations_done, _pool_epoch
+    with _pool_lock:
+        pool, _pool = _pool, None
+        _pool_epoch += 1
+        # فایل جدید (بازگردانی/ریست) ممکن است هنوز migrate نشده باشد
+        _migrations_done = False
+    # تعداد فاکتورهای باز کش‌شده مال فایل قبلی است
+    event_hub.invalidate()
+    if pool is not None:
+        pool.close_all()
+
+
+def _pool_metrics():
+    # فقط خواندن - اسکرپ /metrics نباید pool بسازد
+    pool = _pool
+    if pool is None:
+        return None
+    stats = pool.stats()
+    return {('in_use',): stats['in_use'], ('idle',): stats['idle']}
+
+
+metrics.gauge('clinic_db_connections', 'Pooled SQLite connections by state.', ('state',), fn=_pool_metrics)
+
+
+def pool_epoch() -> int:
+    """Changes whenever the database file may have been replaced (see close_pool)."""
+    return _pool_epoch
+
+
+def checkpoint_wal(db=None) -> None:
+    """Fold the WAL file back into the main DB so a plain file copy is complete."""
+    conn = db if db is not None else get_db()
     try:
-        # Invoices indexes
-        db.execute("CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices (status)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_invoices_work_date ON invoices (work_date)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_invoices_patient_id ON invoices (patient_id)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_invoices_status_opened_at ON invoices (status, opened_at DESC)")
-        
-        # Visits indexes
-        db.execute("CREATE INDEX IF NOT EXISTS idx_visits_invoice_id ON visits (invoice_id)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_visits_work_date ON visits (work_date)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_visits_patient_id ON visits (patient_id)")
-        
-        # Injections indexes
-        db.execute("CREATE INDEX IF NOT EXISTS idx_injections_invoice_id ON injections (invoice_id)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_injections_work_date ON injections (work_date)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_injections_patient_id ON injections (patient_id)")
-        
-        # Procedures indexes
-        db.execute("CREATE INDEX IF NOT EXISTS idx_procedures_invoice_id ON procedures (invoice_id)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_procedures_work_date ON procedures (work_date)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_procedures_patient_id ON procedures (patient_id)")
-        
-        # Consumables indexes
-        db.execute("CREATE INDEX IF NOT EXISTS idx_consumables_invoice_id ON consumables_ledger (invoice_id)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_consumables_work_date ON consumables_ledger (work_date)")
-        
-        # Patients indexes
-        db.execute("CREATE INDEX IF NOT EXISTS idx_patients_national_id ON patients (national_id)")
-        
-        # Activity logs indexes
-        db.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_created_at ON activity_logs (created_at DESC)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_user_id ON activity_logs (user_id)")
-        db.execute("CREATE INDEX IF NOT EXISTS idx_activity_logs_invoice_id ON activity_logs (invoice_id)")
-        
-        # Medical staff indexes
-        db.execute("CREATE INDEX IF NOT EXISTS idx_medical_staff_type_active ON medical_staff (staff_type, is_active)")
-        
-        # Payments indexes
-        db.execute("CREATE INDEX IF NOT EXISTS idx_payments_invoice_id ON invoice_item_payments (invoice_id)")
-        
-        db.commit()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
     except Exception:
         pass
 
 
-def _ensure_settings_table(db) -> None:
-    """Ensure settings table exists for existing databases."""
+def replace_database(source_path, db_path=None) -> None:
+    """Overwrite the live database with the contents of ``source_path`` (restore / reset).
+
+    Copies through the SQLite backup API into the open file instead of
+    deleting or copying over it: a file swapped under a leftover ``-wal`` /
+    ``-shm`` can be corrupted by a WAL replay, and connections still borrowed
+    (SSE streams, log writer, other requests) keep a valid handle and see the
+    new contents. Pooled connections are dropped afterwards so caches are
+    invalidated and migrations run on the restored data.
+    """
+    db_path = str(db_path or Config.DATABASE_PATH)
+    timeout = getattr(Config, 'DB_BUSY_TIMEOUT_MS', 5000) / 1000.0
+    src = sqlite3.connect(str(source_path))
+    dst = sqlite3.connect(db_path, timeout=timeout)
+    staged = None
     try:
-        db.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key TEXT UNIQUE NOT NULL,
-                value TEXT,
-                created_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes')),
-                updated_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes'))
-            )
-        """)
-        db.commit()
-    except Exception:
-        pass
+        src_page = src.execute("PRAGMA page_size").fetchone()[0]
+        dst_page = dst.execute("PRAGMA page_size").fetchone()[0]
+        dst_wal = dst.execute("PRAGMA journal_mode").fetchone()[0].lower() == 'wal'
+        if dst_wal and src_page != dst_page:
+            # در حالت WAL اندازه صفحه مقصد عوض نمی‌شود - نسخه‌ای با همان اندازه صفحه می‌سازیم
+            src.close()
+            staged = db_path + '.replace.tmp'
+            shutil.copyfile(str(source_path), staged)
+            src = sqlite3.connect(staged)
+            src.execute("PRAGMA journal_mode = DELETE")
+            src.execute(f"PRAGMA page_size = {int(dst_page)}")
+            src.execute("VACUUM")
+        # یک مرحله: قفل نوشتن یک بار گرفته می‌شود و محتوا یکجا جایگزین می‌شود
+        src.backup(dst, pages=-1)
+        dst.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    finally:
+        dst.close()
+        src.close()
+        if staged:
+            _remove_quietly(staged)
+    close_pool()
+
+
+def _remove_quietly(path) -> None:
+    try:
+        os.remove(path)
+    except OSError:
         pass
 
 
+atexit.register(close_pool)
+
 def _load_schema_and_initialize(db):
     """Load bundled schema.sql (works in source and frozen modes) and run it."""
     # Try to load schema from package data (works when bundled by PyInstaller)
@@ -194,9 +398,8 @@ def get_db():
             except Exception:
                 pass
 
-        # Connect (this will create the file if missing)
-        db = g._database = sqlite3.connect(db_path)
-        db.row_factory = sqlite3.Row
+        # Borrow a pooled connection (this will create the file if missing)
+        db = g._database = get_pool().acquire()
 
         # Simple check: if users table missing, initialize schema
         try:
@@ -212,19 +415,27 @@ def get_db():
             except Exception:
                 pass
 
-        # Run migrations only ONCE per process (not per request)
+        # Run migrations only ONCE per process (not per request); each step
+        # runs once per database, tracked by PRAGMA user_version
         if not _migrations_done:
-            _ensure_work_date_columns(db)
-            _ensure_indexes(db)  # Create performance indexes
-            _ensure_settings_table(db)  # Create settings table if missing
+            from src.adapters.sqlite.migrations import run_migrations
+            run_migrations(db)
             _migrations_done = True
 
+        # شمارش/زمان‌سنجی کوئری‌های همین درخواست (query_stats.py)
+        db.query_stats = g.get('query_stats')
+
     return db
 
 def close_connection(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
+        # به pool خودش برمی‌گردد؛ اگر آن pool بسته شده (close_pool) بسته می‌شود
+        pool = getattr(db, 'pool', None)
+        if pool is not None:
+            pool.release(db)
+        else:
+            _close_quietly(db)
 
 def init_db():
     """Initialize the database with the schema."""
@@ -0,0 +1,228 @@
+from typing import Dict, Iterable, Optional, Tuple
+from src.adapters.sqlite.core import get_db
+
+
+# ستون‌های جمع‌پذیر جدول daily_stats (بر اساس work_date + shift)
+STAT_COLUMNS = (
+    'invoices_count',
+    'closed_invoices_count',
+    'visits_count',
+    'injections_count',
+    'nursing_count',
+    'procedures_count',
+    'consumables_count',
+    'visits_revenue',
+    'injections_revenue',
+    'procedures_revenue',
+)
+
+
+def _collect(db, date_filter: str, params: Tuple) -> Dict[Tuple[str, str], Dict[str, float]]:
+    """Aggregate source tables into {(work_date, shift): {column: value}}.
+
+    `date_filter` is applied to each table's own work_date column (aliased as
+    `t`), so the same code serves a single-day refresh and a full rebuild.
+    Counts follow the item's own work_date/shift (like the dashboard); revenue
+    follows the closed invoice's work_date/shift (like the revenue reports).
+    """
+    stats: Dict[Tuple[str, str], Dict[str, float]] = {}
+
+    def add(rows, mapping):
+        for r in rows:
+            key = (r['work_date'], r['shift'] or '')
+            bucket = stats.setdefault(key, {c: 0 for c in STAT_COLUMNS})
+            for src, dst in mapping.items():
+                bucket[dst] += r[src] or 0
+
+    add(db.execute(f"""
+        SELECT t.work_date, t.shift, COUNT(*) AS cnt,
+               SUM(CASE WHEN t.status = 'closed' THEN 1 ELSE 0 END) AS closed_cnt
+        FROM invoices t
+        WHERE t.work_date IS NOT NULL AND {date_filter}
+        GROUP BY t.work_date, t.shift
+    """, params).fetchall(), {'cnt': 'invoices_count', 'closed_cnt': 'closed_invoices_count'})
+
+    add(db.execute(f"""
+        SELECT t.work_date, t.shift, COUNT(*) AS cnt
+        FROM visits t
+        WHERE t.work_date IS NOT NULL AND {date_filter}
+        GROUP BY t.work_date, t.shift
+    """, params).fetchall(), {'cnt': 'visits_count'})
+
+    # شمارش خدمات پرستاری = تزریقاتی که nurse_id دارند
+    add(db.execute(f"""
+        SELECT t.work_date, t.shift, COUNT(*) AS cnt,
+               SUM(CASE WHEN t.nurse_id IS NOT NULL THEN 1 ELSE 0 END) AS nursing_cnt
+        FROM injections t
+        WHERE t.work_date IS NOT NULL AND {date_filter}
+        GROUP BY t.work_date, t.shift
+    """, params).fetchall(), {'cnt': 'injections_count', 'nursing_cnt': 'nursing_count'})
+
+    add(db.execute(f"""
+        SELECT t.work_date, t.shift, COUNT(*) AS cnt
+        FROM procedures t
+        WHERE t.work_date IS NOT NULL AND {date_filter}
+        GROUP BY t.work_date, t.shift
+    """, params).fetchall(), {'cnt': 'procedures_count'})
+
+    # Count only consumables provided by the center and not exception items
+    add(db.execute(f"""
+        SELECT t.work_date, t.shift, COUNT(*) AS cnt
+        FROM consumables_ledger t
+        WHERE t.work_date IS NOT NULL AND {date_filter}
+          AND (COALESCE(t.patient_provided, 0) = 0 AND COALESCE(t.is_exception, 0) = 0)
+        GROUP BY t.work_date, t.shift
+    """, params).fetchall(), {'cnt': 'consumables_count'})
+
+    # Revenue = visits + injections + procedures (NOT consumables), closed invoices only
+    add(db.execute(f"""
+        SELECT t.work_date, t.shift,
+               COALESCE((SELECT SUM(v.price) FROM visits v WHERE v.invoice_id = t.id), 0) AS v_rev,
+               COALESCE((SELECT SUM(inj.total_price) FROM injections inj WHERE inj.invoice_id = t.id), 0) AS inj_rev,
+               COALESCE((SELECT SUM(pr.price) FROM procedures pr WHERE pr.invoice_id = t.id), 0) AS pr_rev
+        FROM invoices t
+        WHERE t.status = 'closed' AND t.work_date IS NOT NULL AND {date_filter}
+    """, params).fetchall(), {'v_rev': 'visits_revenue', 'inj_rev': 'injections_revenue', 'pr_rev': 'procedures_revenue'})
+
+    return stats
+
+
+def _write(db, stats: Dict[Tuple[str, str], Dict[str, float]]) -> None:
+    cols = ', '.join(STAT_COLUMNS)
+    placeholders = ', '.join('?' for _ in STAT_COLUMNS)
+    db.executemany(
+        f"""INSERT OR REPLACE INTO daily_stats (work_date, shift, {cols}, updated_at)
+            VALUES (?, ?, {placeholders}, datetime('now', '+3 hours', '+30 minutes'))""",
+        [(wd, sh) + tuple(vals[c] for c in STAT_COLUMNS) for (wd, sh), vals in stats.items()]
+    )
+
+
+def rebuild_daily_stats(db) -> int:
+    """Rebuild the whole rollup from source tables (caller commits). Returns number of rows written."""
+    stats = _collect(db, '1 = 1', ())
+    db.execute("DELETE FROM daily_stats")
+    _write(db, stats)
+    return len(stats)
+
+
+# ستون شمارش هر نوع آیتم و جدول آن
+ITEM_TABLES = {
+    'visit': ('visits', 'visits_count'),
+    'injection': ('injections', 'injections_count'),
+    'procedure': ('procedures', 'procedures_count'),
+    'consumable': ('consumables_ledger', 'consumables_count'),
+}
+
+
+def _item_deltas(item_type: str, rows, sign: int) -> Dict[Tuple[str, str], Dict[str, float]]:
+    """Count deltas of item rows, with the same rules as `_collect`."""
+    column = ITEM_TABLES[item_type][1]
+    deltas: Dict[Tuple[str, str], Dict[str, float]] = {}
+    for r in rows:
+        if not r['work_date']:
+            continue
+        if item_type == 'consumable' and (r['patient_provided'] or r['is_exception']):
+            continue
+        bucket = deltas.setdefault((r['work_date'], r['shift'] or ''), {})
+        bucket[column] = bucket.get(column, 0) + sign
+        if item_type == 'injection' and r['nurse_id'] is not None:
+            bucket['nursing_count'] = bucket.get('nursing_count', 0) + sign
+    return deltas
+
+
+def _apply(db, deltas: Dict[Tuple[str, str], Dict[str, float]]) -> None:
+    """Add deltas to the rollup rows (upsert; missing rows start from zero)."""
+    for (wd, sh), vals in deltas.items():
+        cols = [c for c in STAT_COLUMNS if vals.get(c)]
+        if not cols:
+            continue
+        db.execute(
+            f"""INSERT INTO daily_stats (work_date, shift, {', '.join(cols)}, updated_at)
+                VALUES (?, ?, {', '.join('?' for _ in cols)}, datetime('now', '+3 hours', '+30 minutes'))
+                ON CONFLICT(work_date, shift) DO UPDATE SET
+                {', '.join(f'{c} = {c} + excluded.{c}' for c in cols)}, updated_at = excluded.updated_at""",
+            (wd, sh) + tuple(vals[c] for c in cols)
+        )
+
+
+class DailyStatsRepository:
+    """Materialized per-day/per-shift KPIs for the manager dashboard and charts.
+
+    Writes apply small deltas (invoice opened/closed, items added/deleted)
+    inside the caller's transaction; `rebuild` / `refresh_days` recompute
+    from the source tables when the rollup needs repair.
+    """
+
+    def refresh_days(self, work_dates: Iterable[Optional[str]]) -> None:
+        """Recompute rollup rows for the given work dates (indexed single-day scans)."""
+        db = get_db()
+        days = sorted({d for d in work_dates if d})
+        for day in days:
+            stats = _collect(db, 't.work_date = ?', (day,))
+            db.execute("DELETE FROM daily_stats WHERE work_date = ?", (day,))
+            _write(db, stats)
+        if days:
+            db.commit()
+
+    def invoice_opened(self, work_date: Optional[str], shift: Optional[str]) -> None:
+        if work_date:
+            _apply(get_db(), {(work_date, shift or ''): {'invoices_count': 1}})
+
+    def invoice_closed(self, invoice_id: int) -> None:
+        """Add a just-closed invoice's revenue (item prices) to its work date/shift."""
+        db = get_db()
+        row = db.execute("""
+            SELECT t.work_date, t.shift,
+                   COALESCE((SELECT SUM(v.price) FROM visits v WHERE v.invoice_id = t.id), 0) AS v_rev,
+                   COALESCE((SELECT SUM(inj.total_price) FROM injections inj WHERE inj.invoice_id = t.id), 0) AS inj_rev,
+                   COALESCE((SELECT SUM(pr.price) FROM procedures pr WHERE pr.invoice_id = t.id), 0) AS pr_rev
+            FROM invoices t
+            WHERE t.id = ?
+        """, (invoice_id,)).fetchone()
+        if not row or not row['work_date']:
+            return
+        _apply(db, {(row['work_date'], row['shift'] or ''): {
+            'closed_invoices_count': 1,
+            'visits_revenue': row['v_rev'],
+            'injections_revenue': row['inj_rev'],
+            'procedures_revenue': row['pr_rev'],
+        }})
+
+    def items_added(self, item_type: str, item_ids: Iterable[int]) -> None:
+        """Count newly inserted items (one indexed lookup for the batch).
+
+        Items are only added to open invoices, so revenue is not touched here;
+        it is added when the invoice closes.
+        """
+        ids = [int(i) for i in item_ids if i]
+        if not ids:
+            return
+        db = get_db()
+        table = ITEM_TABLES[item_type][0]
+        rows = db.execute(
+            f"SELECT * FROM {table} WHERE id IN ({', '.join('?' for _ in ids)})", ids
+        ).fetchall()
+        _apply(db, _item_deltas(item_type, rows, 1))
+
+    def item_deleted(self, item_type: str, row) -> None:
+        """Uncount an item given its row as read before the DELETE."""
+        _apply(get_db(), _item_deltas(item_type, [row], -1))
+
+    def rebuild(self) -> int:
+        """Drop and recompute all rollup rows from source tables."""
+        db = get_db()
+        rows = rebuild_daily_stats(db)
+        db.commit()
+        return rows
+
+    def get_totals(self, start_date: str, end_date: str) -> Dict[str, float]:
+        """Sum of all rollup columns over [start_date, end_date], plus `revenue`."""
+        db = get_db()
+        sums = ', '.join(f'COALESCE(SUM({c}), 0) AS {c}' for c in STAT_COLUMNS)
+        row = db.execute(
+            f"SELECT {sums} FROM daily_stats WHERE work_date BETWEEN ? AND ?",
+            (start_date, end_date)
+        ).fetchone()
+        totals = {c: row[c] for c in STAT_COLUMNS}
+        totals['revenue'] = totals['visits_revenue'] + totals['injections_revenue'] + totals['procedures_revenue']
+        return totals
@@ -1,6 +1,14 @@
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple
 from src.adapters.sqlite.core import get_db
+from src.adapters.sqlite.daily_stats_repo import DailyStatsRepository
+from src.adapters.sqlite.tariff_cache import get_tariffs
+from src.domain.billing import TariffSnapshot, price_invoice_items, compute_financials
 from src.common.utils import get_work_date_for_datetime
+from src.common.event_hub import event_hub
+from src.common.metrics import metrics
+from src.adapters.sqlite.unit_of_work import after_commit
+
+invoice_events = metrics.counter('clinic_invoice_events_total', 'Committed invoice opens and closes.', ('event',))
 
 
 class InvoiceRepository:
@@ -30,8 +38,30 @@ class InvoiceRepository:
             ) VALUES (?, ?, ?, 'open', ?, ?, 0, ?, ?)""",
             (patient_id, insurance_type, supplementary_insurance, opened_by, opener_name, work_date, shift)
         )
+        DailyStatsRepository().invoice_opened(work_date, shift)
         db.commit()
-        return cursor.lastrowid
+        invoice_id = cursor.lastrowid
+        patient = db.execute("SELECT full_name FROM patients WHERE id = ?", (patient_id,)).fetchone()
+        self._notify('invoice_opened', {
+            'invoice_id': invoice_id,
+            'patient_id': patient_id,
+            'patient_name': patient['full_name'] if patient else None,
+            'insurance_type': insurance_type,
+            'opened_by': opener_name,
+        })
+        return invoice_id
+
+    def count_open_invoices(self) -> int:
+        db = get_db()
+        return db.execute("SELECT COUNT(*) FROM invoices WHERE status = 'open'").fetchone()[0]
+
+    def _notify(self, event: str, data: Dict) -> None:
+        """Publish to the reception event hub once the change is committed."""
+        def send():
+            invoice_events.inc(event=event.replace('invoice_', ''))
+            event_hub.publish(event, data)
+            event_hub.refresh_open_invoice_count(self.count_open_invoices)
+        after_commit(send)
 
     def get_open_invoices(self, limit: int = 300) -> List[Dict]:
         """Get all open invoices with patient info."""
@@ -70,30 +100,13 @@ class InvoiceRepository:
         """, (invoice_id,)).fetchone()
         return dict(row) if row else None
 
-    def get_invoice_items(self, invoice_id: int) -> List[Dict]:
-        """Get all items (visits, injections, procedures, consumables) for an invoice."""
-        db = get_db()
-        # Determine invoice insurance to apply nursing coverage rules
-        inv_row = db.execute("SELECT insurance_type FROM invoices WHERE id = ?", (invoice_id,)).fetchone()
-        invoice_insurance = inv_row['insurance_type'] if inv_row else None
-        # Read both nursing_covers (boolean) and nursing_tariff (legacy numeric)
-        nursing_covers = None
-        nursing_tariff = None
-        if invoice_insurance:
-            t = db.execute("SELECT nursing_covers, nursing_tariff FROM visit_tariffs WHERE insurance_type = ?", (invoice_insurance,)).fetchone()
-            if t:
-                # prefer explicit boolean flag if present
-                if 'nursing_covers' in t.keys():
-                    nursing_covers = bool(t['nursing_covers'])
-                nursing_tariff = t['nursing_tariff'] if 'nursing_tariff' in t.keys() else None
-        items = []
-        
-        # Get base tariff (آزاد / پایه) for visits
-        base_tariff_row = db.execute("SELECT tariff_price FROM visit_tariffs WHERE is_base_tariff = 1 AND is_active = 1 LIMIT 1").fetchone()
-        if not base_tariff_row:
-            base_tariff_row = db.execute("SELECT tariff_price FROM visit_tariffs WHERE insurance_type = 'آزاد' AND is_active = 1 LIMIT 1").fetchone()
-        base_visit_price = float(base_tariff_row['tariff_price']) if base_tariff_row else 0.0
+    def _load_tariff_snapshot(self) -> TariffSnapshot:
+        """Visit tariffs + nursing exclusions for pricing a whole invoice (process-wide cache)."""
+        return get_tariffs().snapshot
 
+    def _price_items(self, invoice_id: int, invoice_insurance: Optional[str]) -> List[Dict]:
+        """Fetch raw item rows (one query per item table) and price them in one pass."""
+        db = get_db()
         # Visits: read doctor from item itself (no nurse for visits)
         visits = db.execute("""
             SELECT 'visit' AS type, v.id, v.visit_date AS date,
@@ -107,44 +120,8 @@ class InvoiceRepository:
             LEFT JOIN medical_staff doc ON doc.id = v.doctor_id
             WHERE v.invoice_id = ?
         """, (invoice_id,)).fetchall()
-        for r in visits:
-            it = dict(r)
-            # recorded_price = تعرفه پایه/آزاد (base tariff)
-            # patient_share = تعرفه بیمه ای (سهم بیمار) - what insurance says patient pays
-            recorded_price = base_visit_price
-            
-            # Get patient share from insurance tariff
-            visit_insurance = it.get('insurance_type') or invoice_insurance
-            patient_share = recorded_price  # default to base if no insurance
-            
-            if visit_insurance:
-                ins_row = db.execute("SELECT tariff_price FROM visit_tariffs WHERE insurance_type = ? AND is_active = 1 AND COALESCE(is_supplementary,0)=0 LIMIT 1", (visit_insurance,)).fetchone()
-                if ins_row and ins_row['tariff_price'] is not None:
-                    patient_share = float(ins_row['tariff_price'])
-            
-            # If supplementary insurance exists, it may override patient_share
-            supp = it.get('supplementary_insurance')
-            if supp:
-                srow = db.execute("SELECT tariff_price FROM visit_tariffs WHERE insurance_type = ? AND is_active = 1 AND COALESCE(is_supplementary,0)=1 LIMIT 1", (supp,)).fetchone()
-                if srow and srow['tariff_price'] is not None:
-                    patient_share = float(srow['tariff_price'])
-            
-            insurance_share = recorded_price - patient_share if recorded_price > patient_share else 0
-            covered = 1 if patient_share == 0 and recorded_price > 0 else 0
-            
-            it['recorded_price'] = float(recorded_price)
-            it['patient_share'] = float(patient_share)
-            it['insurance_share'] = float(insurance_share)
-            it['covered_by_insurance'] = covered
-            items.append(it)
 
         # Injections: read doctor/nurse from item itself (i.doctor_id, i.nurse_id)
-        # Load exclusions for this invoice's insurance (nursing services that are NOT covered)
-        excluded_services = set()
-        if invoice_insurance:
-            rows_ex = db.execute("SELECT nursing_service_id FROM insurance_nursing_exclusions WHERE insurance_type = ?", (invoice_insurance,)).fetchall()
-            excluded_services = {r['nursing_service_id'] for r in rows_ex}
-
         injections = db.execute("""
             SELECT 'injection' AS type, i.id, i.injection_date AS date,
                    doc.full_name AS doctor_name,
@@ -158,32 +135,6 @@ class InvoiceRepository:
             LEFT JOIN medical_staff nurse ON nurse.id = i.nurse_id
             WHERE i.invoice_id = ?
         """, (invoice_id,)).fetchall()
-        inj_rows = [dict(r) for r in injections]
-        for r in inj_rows:
-            original = float(r.get('recorded_price') or 0)
-            # Default patient share is recorded price
-            patient_share = original
-            insurance_share = 0
-            covered = 0
-            # Determine coverage: prefer `nursing_covers` flag (manager UI),
-            # fall back to legacy `nursing_tariff==0` meaning free.
-            if (nursing_covers is not None and nursing_covers) or (nursing_covers is None and nursing_tariff is not None and float(nursing_tariff) == 0):
-                # If service_id is excluded for this insurance, do NOT mark as covered
-                svc_id = r.get('service_id')
-                if svc_id and svc_id in excluded_services:
-                    # Not covered due to explicit exclusion
-                    insurance_share = 0
-                    patient_share = original
-                    covered = 0
-                else:
-                    insurance_share = original
-                    patient_share = 0
-                    covered = 1
-            r['recorded_price'] = original
-            r['patient_share'] = float(patient_share)
-            r['insurance_share'] = float(insurance_share)
-            r['covered_by_insurance'] = covered
-        items.extend(inj_rows)
 
         # Procedures: read doctor/nurse from item itself (pr.doctor_id, pr.nurse_id)
         procedures = db.execute("""
@@ -200,21 +151,6 @@ class InvoiceRepository:
             LEFT JOIN medical_staff nurse ON nurse.id = pr.nurse_id
             WHERE pr.invoice_id = ?
         """, (invoice_id,)).fetchall()
-        proc_rows = [dict(r) for r in procedures]
-        for r in proc_rows:
-            original = float(r.get('recorded_price') or 0)
-            patient_share = original
-            insurance_share = 0
-            covered = 0
-            if r.get('description', '').endswith('(پرستار)') and ((nursing_covers is not None and nursing_covers) or (nursing_covers is None and nursing_tariff is not None and float(nursing_tariff) == 0)):
-                insurance_share = original
-                patient_share = 0
-                covered = 1
-            r['recorded_price'] = original
-            r['patient_share'] = float(patient_share)
-            r['insurance_share'] = float(insurance_share)
-            r['covered_by_insurance'] = covered
-        items.extend(proc_rows)
 
         # Consumables: read doctor/nurse from item itself (c.doctor_id, c.nurse_id)
         consumables = db.execute("""
@@ -230,26 +166,39 @@ class InvoiceRepository:
             LEFT JOIN medical_staff nurse ON nurse.id = c.nurse_id
             WHERE c.invoice_id = ?
         """, (invoice_id,)).fetchall()
-        for r in consumables:
-            it = dict(r)
-            original = float(it.get('recorded_price') or 0)
-            it['recorded_price'] = original
-            it['patient_share'] = float(original)
-            it['insurance_share'] = 0.0
-            it['covered_by_insurance'] = 0
-            items.append(it)
-        
-        # Fallback: if doctor_name still empty for non-visit items, use latest visit doctor
-        last_visit_doctor = None
-        for it in items:
-            if it['type'] == 'visit' and it.get('doctor_name'):
-                last_visit_doctor = it.get('doctor_name')
-                break
-        if last_visit_doctor:
-            for it in items:
-                if it['type'] != 'visit' and not it.get('doctor_name'):
-                    it['doctor_name'] = last_visit_doctor
-        return sorted(items, key=lambda x: x['date'], reverse=True)
+
+        return price_invoice_items(
+            invoice_insurance, self._load_tariff_snapshot(),
+            visits, injections, procedures, consumables
+        )
+
+    def get_invoice_items(self, invoice_id: int) -> List[Dict]:
+        """Get all items (visits, injections, procedures, consumables) for an invoice."""
+        return self.get_invoice_view(invoice_id)[0]
+
+    def get_invoice_view(self, invoice_id: int) -> Tuple[List[Dict], Dict]:
+        """Priced items and financials of an invoice together.
+
+        Runs a fixed number of queries regardless of item count: invoice row,
+        tariff snapshot, one query per item table and the payments.
+        """
+        db = get_db()
+        inv_row = db.execute("SELECT insurance_type, total_amount FROM invoices WHERE id = ?", (invoice_id,)).fetchone()
+        invoice_insurance = inv_row['insurance_type'] if inv_row else None
+        items = self._price_items(invoice_id, invoice_insurance)
+        invoice_total = None
+        if inv_row and inv_row['total_amount'] is not None:
+            invoice_total = float(inv_row['total_amount'])
+        financials = compute_financials(items, self._get_payments(invoice_id), invoice_total)
+        return items, financials
+
+    def _get_payments(self, invoice_id: int) -> List:
+        db = get_db()
+        return db.execute("""
+            SELECT item_type, item_id, payment_type, is_paid 
+            FROM invoice_item_payments 
+            WHERE invoice_id = ?
+        """, (invoice_id,)).fetchall()
 
     def close_invoice(self, invoice_id: int, closed_by: str) -> bool:
         """Close an invoice and update totals."""
@@ -271,15 +220,25 @@ class InvoiceRepository:
             SET status = 'closed', closed_at = datetime('now', '+3 hours', '+30 minutes'), closed_by = ?, closed_by_name = ?
             WHERE id = ? AND status = 'open'
         """, (closed_by, closer_name, invoice_id))
-        
+        closed = cursor.rowcount > 0
+        if closed:
+            # درآمد فاکتور فقط یک بار و هنگام بستن به daily_stats اضافه می‌شود
+            DailyStatsRepository().invoice_closed(invoice_id)
         db.commit()
-        return cursor.rowcount > 0
+        if closed:
+            self._notify('invoice_closed', {'invoice_id': invoice_id, 'closed_by': closer_name})
+        return closed
+
+    def update_invoice_totals(self, invoice_id: int) -> Dict:
+        """Recalculate and update total_amount for the invoice.
 
-    def update_invoice_totals(self, invoice_id: int):
-        """Recalculate and update total_amount for the invoice."""
+        Returns the invoice financials computed from the same priced items, so
+        callers do not need a second `get_financials` round.
+        """
         db = get_db()
+        inv_row = db.execute("SELECT insurance_type FROM invoices WHERE id = ?", (invoice_id,)).fetchone()
+        items = self._price_items(invoice_id, inv_row['insurance_type'] if inv_row else None)
         # Recalculate total as the sum of patient-facing amounts (patient_share)
-        items = self.get_invoice_items(invoice_id)
         total = 0.0
         for it in items:
             amt = it.get('patient_share') or 0
@@ -290,67 +249,9 @@ class InvoiceRepository:
             (total, invoice_id)
         )
         db.commit()
+        return compute_financials(items, self._get_payments(invoice_id), total if inv_row else None)
 
     def get_financials(self, invoice_id: int) -> Dict:
         """Return total per category, paid amount (by type), and remaining for invoice.
         IMPORTANT: Consumables are NOT counted in revenue/income calculations."""
-        db = get_db()
-        # Build financials from computed invoice items (summing patient_share per category)
-        items = self.get_invoice_items(invoice_id)
-        totals = {'visit': 0.0, 'injection': 0.0, 'procedure': 0.0, 'consumable': 0.0}
-        for it in items:
-            t = it.get('type')
-            amt = float(it.get('patient_share') or 0)
-            if t in totals:
-                totals[t] += amt
-
-        # Revenue = visits + injections + procedures (NOT consumables)
-        revenue_total = totals['visit'] + totals['injection'] + totals['procedure']
-        consumables_total = totals['consumable']
-        
-        # Grand total includes consumables for invoice balance
-        grand_total = revenue_total + consumables_total
-
-        # Invoice total_amount should reflect patient-facing total (may already be set)
-        inv_total = db.execute("SELECT total_amount FROM invoices WHERE id = ?", (invoice_id,)).fetchone()
-        invoice_total = float(inv_total['total_amount']) if inv_total else grand_total
-
-        # Calculate paid amount from invoice_item_payments with payment type breakdown
-        paid_card = 0.0
-        paid_cash = 0.0
-        paid_total = 0.0
-        
-        # Read all payments for this invoice
-        pays = db.execute("""
-            SELECT item_type, item_id, payment_type, is_paid 
-            FROM invoice_item_payments 
-            WHERE invoice_id = ?
-        """, (invoice_id,)).fetchall()
-        
-        for p in pays:
-            if p['is_paid'] == 1:
-                # Find the item in items to get its patient_share
-                for it in items:
-                    if it.get('type') == p['item_type'] and it.get('id') == p['item_id']:
-                        amt = float(it.get('patient_share') or 0)
-                        paid_total += amt
-                        if p['payment_type'] == 'card':
-                            paid_card += amt
-                        elif p['payment_type'] == 'cash':
-                            paid_cash += amt
-                        break
-
-        remaining = invoice_total - paid_total if invoice_total > paid_total else 0.0
-
-        return {
-            'visits': totals['visit'],
-            'injections': totals['injection'],
-            'procedures': totals['procedure'],
-            'consumables': consumables_total,
-            'revenue': revenue_total,  # درآمد (بدون مصرفی)
-            'total': grand_total,      # جمع کل فاکتور
-            'paid': paid_total,
-            'paid_card': paid_card,    # پرداخت کارتخوان
-            'paid_cash': paid_cash,    # پرداخت نقدی
-            'remaining': remaining
-        }
+        return self.get_invoice_view(invoice_id)[1]
@@ -0,0 +1,287 @@
+"""
+Activity Log Archive
+انتقال لاگ‌های قدیمی‌تر از افق نگهداری به دیتابیس آرشیو جداگانه (پارتیشن ماهانه)
+
+Whole months older than ACTIVITY_LOG_RETENTION_MONTHS are moved from
+``activity_logs`` in the main database to ``activity_logs`` in the archive
+database (ACTIVITY_LOG_ARCHIVE_PATH, default ``<db>_logs_archive.db``);
+``archive_months`` lists the archived months. The archive is ATTACHed to a
+connection only when a query's date range reaches archived months, so the
+hot database and everyday log queries never touch it.
+
+Ids are only unique per database file: after a reset or restore they start
+over, so rows are matched on the whole row and the archive is rotated
+(`rotate_archive`) whenever the main database is replaced.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from typing import List, Optional, Tuple
+
+from src.common.utils import iran_now
+from src.config.settings import Config
+
+ARCHIVE_SCHEMA = 'log_archive'
+
+# کانکشن‌هایی که آرشیو را ATTACH کرده‌اند - فایل تا DETACH/بسته شدن آن‌ها باز است
+_holders = weakref.WeakSet()
+_holders_lock = threading.Lock()
+
+
+def archive_path(db_path=None) -> Optional[str]:
+    path = getattr(Config, 'ACTIVITY_LOG_ARCHIVE_PATH', None)
+    if path:
+        return path
+    db_path = str(db_path or Config.DATABASE_PATH or '')
+    if not db_path or db_path == ':memory:':
+        return None
+    root, _ = os.path.splitext(db_path)
+    return f"{root}_logs_archive.db"
+
+
+def _is_attached(db) -> bool:
+    return any(row[1] == ARCHIVE_SCHEMA for row in db.execute("PRAGMA database_list").fetchall())
+
+
+def _ensure_archive_schema(db) -> None:
+    s = ARCHIVE_SCHEMA
+    db.execute(f"CREATE TABLE IF NOT EXISTS {s}.activity_logs AS SELECT * FROM main.activity_logs WHERE 0")
+    # ستون‌هایی که بعداً به جدول اصلی اضافه شده‌اند (UNION ALL ترتیب یکسان ستون‌ها را لازم دارد)
+    archived = {c[1] for c in db.execute(f"PRAGMA {s}.table_info(activity_logs)").fetchall()}
+    for c in db.execute("PRAGMA main.table_info(activity_logs)").fetchall():
+        if c[1] not in archived:
+            db.execute(f"ALTER TABLE {s}.activity_logs ADD COLUMN {c[1]} {c[2]}")
+    # id در آرشیو یکتا نیست (بعد از ریست/بازگردانی id ها از نو شروع می‌شوند)
+    db.execute(f"DROP INDEX IF EXISTS {s}.idx_archive_logs_id")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {s}.idx_archive_logs_row_id ON activity_logs (id)")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {s}.idx_archive_logs_created_id ON activity_logs (created_at DESC, id DESC)")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {s}.idx_archive_logs_user_id ON activity_logs (user_id)")
+    db.execute(f"""
+        CREATE TABLE IF NOT EXISTS {s}.archive_months (
+            month TEXT PRIMARY KEY,
+            row_count INTEGER NOT NULL,
+            until TEXT NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+    """)
+
+
+def attach_archive(db, create: bool = False) -> bool:
+    """ATTACH the archive to this connection; False when there is no archive (or inside a transaction)."""
+    path = archive_path()
+    if not path or (not create and not os.path.exists(path)):
+        return False
+    if _is_attached(db):
+        return True
+    if db.in_transaction:
+        # ATTACH داخل تراکنش مجاز نیست - این کوئری فقط داده زنده را می‌بیند
+        return False
+    db.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (path,))
+    with _holders_lock:
+        _holders.add(db)
+    _ensure_archive_schema(db)
+    return True
+
+
+def detach_archive(db) -> None:
+    """DETACH the archive from this connection (no-op when it is not attached).
+
+    Called when a pooled connection is released, so idle connections never
+    keep the archive file open.
+    """
+    with _holders_lock:
+        if db not in _holders:
+            return
+    if db.in_transaction:
+        db.rollback()
+    db.execute(f"DETACH DATABASE {ARCHIVE_SCHEMA}")
+    with _holders_lock:
+        _holders.discard(db)
+
+
+def _open_holders() -> list:
+    with _holders_lock:
+        holders = list(_holders)
+    alive = []
+    for conn in holders:
+        try:
+            conn.total_changes
+        except sqlite3.ProgrammingError:
+            # بسته شده - فایل آرشیو را نگه نمی‌دارد
+            with _holders_lock:
+                _holders.discard(conn)
+            continue
+        alive.append(conn)
+    return alive
+
+
+def wait_archive_released(timeout: float = 10.0) -> bool:
+    """Wait until no connection has the archive attached; False on timeout."""
+    deadline = time.monotonic() + timeout
+    while _open_holders():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def archived_until(db) -> Optional[str]:
+    """Exclusive created_at upper bound of archived logs, or None when nothing is archived."""
+    if not attach_archive(db):
+        return None
+    return db.execute(f"SELECT MAX(until) FROM {ARCHIVE_SCHEMA}.archive_months").fetchone()[0]
+
+
+def needs_archive(db, datetime_from: Optional[str], datetime_to: Optional[str]) -> bool:
+    """True when a date-bounded query reaches archived months (and the archive is attached)."""
+    if not (datetime_from or datetime_to):
+        return False
+    until = archived_until(db)
+    return until is not None and (datetime_from or '') < until
+
+
+def log_source(db, datetime_from: Optional[str] = None, datetime_to: Optional[str] = None) -> str:
+    """FROM expression for activity logs in [from, to): live table, or live + archive."""
+    if needs_archive(db, datetime_from, datetime_to):
+        return (f"(SELECT * FROM main.activity_logs UNION ALL "
+                f"SELECT * FROM {ARCHIVE_SCHEMA}.activity_logs)")
+    return "activity_logs"
+
+
+def archive_cutoff(months: Optional[int] = None, now=None) -> str:
+    """Start of the oldest month kept live."""
+    if months is None:
+        months = int(getattr(Config, 'ACTIVITY_LOG_RETENTION_MONTHS', 3))
+    now = now or iran_now()
+    year, month = now.year, now.month - months
+    while month < 1:
+        month += 12
+        year -= 1
+    return f"{year:04d}-{month:02d}-01 00:00:00"
+
+
+def _month_bounds(month: str) -> Tuple[str, str]:
+    year, mon = int(month[:4]), int(month[5:7])
+    year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    return f"{month}-01 00:00:00", f"{year:04d}-{mon:02d}-01 00:00:00"
+
+
+def archive_logs(db, months: Optional[int] = None, dry_run: bool = False) -> List[Tuple[str, int]]:
+    """Move whole months older than the retention horizon to the archive; returns [(month, rows)].
+
+    A transaction over attached WAL databases is not atomic across files, so
+    each month is copied and committed first, then deleted from the live
+    table. Rows are matched on all columns, not on id alone, so an interrupted
+    run is safe to repeat and a live row never collides with an archived one.
+    """
+    cutoff = archive_cutoff(months)
+    pending = [
+        (row[0], row[1]) for row in db.execute(
+            "SELECT substr(created_at, 1, 7) AS month, COUNT(*) FROM activity_logs "
+            "WHERE created_at < ? GROUP BY month ORDER BY month",
+            (cutoff,)
+        ).fetchall()
+    ]
+    if dry_run or not pending:
+        return pending
+
+    if db.in_transaction:
+        db.commit()
+    attach_archive(db, create=True)
+    try:
+        return _archive_months(db, pending)
+    finally:
+        detach_archive(db)
+
+
+def _archive_months(db, pending: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
+    s = ARCHIVE_SCHEMA
+    done = []
+    for month, count in pending:
+        start, end = _month_bounds(month)
+        try:
+            db.execute(
+                f"INSERT INTO {s}.activity_logs "
+                f"SELECT * FROM main.activity_logs WHERE created_at >= ? AND created_at < ? "
+                f"EXCEPT SELECT * FROM {s}.activity_logs WHERE created_at >= ? AND created_at < ?",
+                (start, end, start, end)
+            )
+            archived = db.execute(
+                f"SELECT COUNT(*) FROM {s}.activity_logs WHERE created_at >= ? AND created_at < ?",
+                (start, end)
+            ).fetchone()[0]
+            db.execute(
+                f"""INSERT INTO {s}.archive_months (month, row_count, until, archived_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT(month) DO UPDATE SET
+                        row_count = excluded.row_count, until = excluded.until,
+                        archived_at = excluded.archived_at""",
+                (month, archived, end, iran_now().strftime('%Y-%m-%d %H:%M:%S'))
+            )
+            db.commit()
+            # فقط ردیف‌هایی که عیناً (همه ستون‌ها) در آرشیو هستند حذف می‌شوند
+            db.execute(
+                f"DELETE FROM main.activity_logs WHERE id IN (SELECT id FROM ("
+                f"SELECT * FROM main.activity_logs WHERE created_at >= ? AND created_at < ? "
+                f"INTERSECT SELECT * FROM {s}.activity_logs WHERE created_at >= ? AND created_at < ?))",
+                (start, end, start, end)
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"[LogArchive] Archiving {month} failed: {e}")
+            break
+        done.append((month, count))
+    return done
+
+
+def _remove_sidecars(path: str) -> None:
+    for suffix in ('-wal', '-shm', '-journal'):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def rotate_archive(db_path=None, keep: bool = True) -> Optional[str]:
+    """Retire the archive of a database that is being replaced (reset/restore).
+
+    Archived rows belong to the old database (its ids start over in the new
+    one), so the file is checkpointed and renamed to
+    ``<archive>_<timestamp>.db`` (``keep``) or deleted; the next archive run
+    starts a fresh one. Returns the rotated path, if any.
+
+    The file is only moved once no connection has it attached (a request
+    still reading old logs); if that does not happen in time it is left in
+    place - rows are matched on the whole row, so nothing is lost.
+    """
+    path = archive_path(db_path)
+    if not path or not os.path.exists(path):
+        return None
+    if not wait_archive_released():
+        print(f"[LogArchive] Archive still in use, not rotated: {path}")
+        return None
+    try:
+        conn = sqlite3.connect(path, timeout=30)
+        try:
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"[LogArchive] Checkpoint before rotation failed: {e}")
+    rotated = None
+    if keep:
+        root, ext = os.path.splitext(path)
+        stamp = iran_now().strftime('%Y%m%d_%H%M%S')
+        rotated, n = f"{root}_{stamp}{ext}", 1
+        while os.path.exists(rotated):
+            # دو چرخش در یک ثانیه نباید آرشیو قبلی را بازنویسی کند
+            rotated, n = f"{root}_{stamp}_{n}{ext}", n + 1
+        os.replace(path, rotated)
+    else:
+        os.remove(path)
+    _remove_sidecars(path)
+    return rotated
@@ -0,0 +1,73 @@
+from typing import List, Tuple
+
+from src.adapters.sqlite.patient_search import build_match_query, normalize_sql
+
+
+# ستون‌های ایندکس جستجوی لاگ (rowid = activity_logs.id)
+LOG_FTS_COLUMNS = ('description', 'patient_name', 'target_name')
+
+
+def _fts_values(alias: str) -> str:
+    return ', '.join(normalize_sql(f'{alias}.{c}') for c in LOG_FTS_COLUMNS)
+
+
+def _fts_ddl() -> List[str]:
+    cols = ', '.join(LOG_FTS_COLUMNS)
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS activity_logs_fts USING fts5(
+                {cols}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+            )""",
+        f"""CREATE TRIGGER IF NOT EXISTS activity_logs_fts_ai AFTER INSERT ON activity_logs BEGIN
+                INSERT INTO activity_logs_fts (rowid, {cols}) VALUES (NEW.id, {_fts_values('NEW')});
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS activity_logs_fts_ad AFTER DELETE ON activity_logs BEGIN
+                DELETE FROM activity_logs_fts WHERE rowid = OLD.id;
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS activity_logs_fts_au AFTER UPDATE OF {cols} ON activity_logs BEGIN
+                DELETE FROM activity_logs_fts WHERE rowid = OLD.id;
+                INSERT INTO activity_logs_fts (rowid, {cols}) VALUES (NEW.id, {_fts_values('NEW')});
+            END""",
+    ]
+
+
+def ensure_log_search(db) -> bool:
+    """Create the activity log FTS index + sync triggers and backfill it; False if it exists.
+
+    Raises without FTS5, like ensure_patient_search. The caller commits.
+    """
+    if has_log_search(db):
+        return False
+    for stmt in _fts_ddl():
+        db.execute(stmt)
+    db.execute(
+        f"INSERT INTO activity_logs_fts (rowid, {', '.join(LOG_FTS_COLUMNS)}) "
+        f"SELECT l.id, {_fts_values('l')} FROM activity_logs l"
+    )
+    return True
+
+
+def has_log_search(db) -> bool:
+    return db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'activity_logs_fts'"
+    ).fetchone() is not None
+
+
+def search_predicate(db, search_text: str) -> Tuple[str, List]:
+    """SQL predicate on activity_logs for free-text search.
+
+    Substring match (LIKE) as the viewer always did - the same predicate
+    archived logs get. With the FTS index, rows whose normalized text has
+    every word as a prefix (ي/ك variants, diacritics) match as well.
+    """
+    like_sql, like_params = like_predicate(search_text)
+    match = build_match_query(search_text) if has_log_search(db) else None
+    if match is None:
+        return like_sql, like_params
+    return (f"(id IN (SELECT rowid FROM activity_logs_fts WHERE activity_logs_fts MATCH ?) OR {like_sql})",
+            [match] + like_params)
+
+
+def like_predicate(search_text: str) -> Tuple[str, List]:
+    """LIKE fallback (also used for archived logs, which have no FTS index)."""
+    pattern = f"%{search_text}%"
+    return "(description LIKE ? OR patient_name LIKE ? OR target_name LIKE ?)", [pattern, pattern, pattern]
@@ -0,0 +1,273 @@
+"""
+Schema Migrations
+مهاجرت‌های نسخه‌دار دیتابیس - هر مرحله فقط یک بار اجرا می‌شود (PRAGMA user_version)
+
+Each entry in `MIGRATIONS` brings the schema of an existing database up to
+``version``. A database created from schema.sql runs them too (they are
+idempotent and cheap on empty tables). Once a database is current, process
+start costs one ``PRAGMA user_version`` read regardless of table size.
+
+Append new steps at the end with the next version number; never renumber
+or edit a step that has shipped.
+
+Optional FTS5 search indexes are not versioned steps: SQLite builds without
+FTS5 cannot create them, so `ensure_search_indexes` checks for them on every
+start (two sqlite_master lookups) and builds whatever is missing.
+"""
+
+import threading
+from dataclasses import dataclass
+from typing import Callable, List
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable
+
+
+def _has_column(db, table: str, column: str) -> bool:
+    return any(c[1] == column for c in db.execute(f"PRAGMA table_info({table})").fetchall())
+
+
+def _add_column(db, table: str, column: str, decl_sql: str) -> None:
+    if not _has_column(db, table, column):
+        db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl_sql}")
+
+
+def _work_date_columns(db) -> None:
+    """Ensure `work_date` exists on operational tables and backfill it.
+
+    Manual shifts can span midnight (especially night shift). Relying on
+    DATE(timestamp) splits a single work shift across two calendar dates.
+    We persist `work_date` so reports/ledgers can stay consistent.
+    """
+    _add_column(db, "invoices", "work_date", "TEXT")
+    _add_column(db, "invoices", "shift", "TEXT")
+    _add_column(db, "visits", "work_date", "TEXT")
+    _add_column(db, "injections", "work_date", "TEXT")
+    _add_column(db, "procedures", "work_date", "TEXT")
+    _add_column(db, "consumables_ledger", "work_date", "TEXT")
+
+    db.execute("UPDATE invoices SET work_date = substr(opened_at, 1, 10) WHERE work_date IS NULL OR work_date = ''")
+
+    # Backfill shift for invoices based on hour
+    db.execute("""
+        UPDATE invoices SET shift = CASE
+            WHEN strftime('%H', opened_at) BETWEEN '07' AND '13' THEN 'morning'
+            WHEN strftime('%H', opened_at) BETWEEN '14' AND '19' THEN 'evening'
+            ELSE 'night'
+        END
+        WHERE shift IS NULL OR shift = ''
+    """)
+
+    db.execute("UPDATE visits SET work_date = substr(visit_date, 1, 10) WHERE work_date IS NULL OR work_date = ''")
+    db.execute("UPDATE injections SET work_date = substr(injection_date, 1, 10) WHERE work_date IS NULL OR work_date = ''")
+    db.execute("UPDATE procedures SET work_date = substr(procedure_date, 1, 10) WHERE work_date IS NULL OR work_date = ''")
+    db.execute("UPDATE consumables_ledger SET work_date = substr(usage_date, 1, 10) WHERE work_date IS NULL OR work_date = ''")
+
+
+def _indexes(db) -> None:
+    """Performance indexes."""
+    statements = (
+        # Invoices indexes
+        "CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices (status)",
+        "CREATE INDEX IF NOT EXISTS idx_invoices_work_date ON invoices (work_date)",
+        "CREATE INDEX IF NOT EXISTS idx_invoices_patient_id ON invoices (patient_id)",
+        "CREATE INDEX IF NOT EXISTS idx_invoices_status_opened_at ON invoices (status, opened_at DESC)",
+        # Visits indexes
+        "CREATE INDEX IF NOT EXISTS idx_visits_invoice_id ON visits (invoice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_visits_work_date ON visits (work_date)",
+        "CREATE INDEX IF NOT EXISTS idx_visits_patient_id ON visits (patient_id)",
+        # Injections indexes
+        "CREATE INDEX IF NOT EXISTS idx_injections_invoice_id ON injections (invoice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_injections_work_date ON injections (work_date)",
+        "CREATE INDEX IF NOT EXISTS idx_injections_patient_id ON injections (patient_id)",
+        # Procedures indexes
+        "CREATE INDEX IF NOT EXISTS idx_procedures_invoice_id ON procedures (invoice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_procedures_work_date ON procedures (work_date)",
+        "CREATE INDEX IF NOT EXISTS idx_procedures_patient_id ON procedures (patient_id)",
+        # Consumables indexes
+        "CREATE INDEX IF NOT EXISTS idx_consumables_invoice_id ON consumables_ledger (invoice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_consumables_work_date ON consumables_ledger (work_date)",
+        # Patients indexes
+        "CREATE INDEX IF NOT EXISTS idx_patients_national_id ON patients (national_id)",
+        # Activity logs indexes
+        "CREATE INDEX IF NOT EXISTS idx_activity_logs_created_at ON activity_logs (created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_activity_logs_user_id ON activity_logs (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_activity_logs_invoice_id ON activity_logs (invoice_id)",
+        # Medical staff indexes
+        "CREATE INDEX IF NOT EXISTS idx_medical_staff_type_active ON medical_staff (staff_type, is_active)",
+        # Payments indexes
+        "CREATE INDEX IF NOT EXISTS idx_payments_invoice_id ON invoice_item_payments (invoice_id)",
+    )
+    for sql in statements:
+        db.execute(sql)
+
+
+def _settings_table(db) -> None:
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT UNIQUE NOT NULL,
+            value TEXT,
+            created_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes')),
+            updated_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes'))
+        )
+    """)
+
+
+def _visit_tariff_flags(db) -> None:
+    """Columns the insurance pages used to ALTER on every request."""
+    _add_column(db, "visit_tariffs", "nursing_covers", "INTEGER DEFAULT 0")
+    _add_column(db, "visit_tariffs", "is_base_tariff", "INTEGER DEFAULT 0")
+
+
+def _user_active_shift_table(db) -> None:
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS user_active_shift (
+            user_id INTEGER PRIMARY KEY,
+            active_shift TEXT NOT NULL,
+            work_date TEXT NOT NULL,
+            shift_started_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes')),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    """)
+
+
+def _daily_stats_table(db) -> None:
+    """daily_stats rollup; built from history when the table is new."""
+    exists = db.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='daily_stats'").fetchone()
+    if exists:
+        return
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            work_date TEXT NOT NULL,
+            shift TEXT NOT NULL DEFAULT '',
+            invoices_count INTEGER DEFAULT 0,
+            closed_invoices_count INTEGER DEFAULT 0,
+            visits_count INTEGER DEFAULT 0,
+            injections_count INTEGER DEFAULT 0,
+            nursing_count INTEGER DEFAULT 0,
+            procedures_count INTEGER DEFAULT 0,
+            consumables_count INTEGER DEFAULT 0,
+            visits_revenue REAL DEFAULT 0,
+            injections_revenue REAL DEFAULT 0,
+            procedures_revenue REAL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes')),
+            PRIMARY KEY (work_date, shift)
+        )
+    """)
+    from src.adapters.sqlite.daily_stats_repo import rebuild_daily_stats
+    rebuild_daily_stats(db)
+
+
+def _patient_search(db) -> None:
+    """Precomputed last invoice insurance (the FTS index: ensure_search_indexes)."""
+    from src.adapters.sqlite.patient_search import ensure_last_invoice_insurance
+    ensure_last_invoice_insurance(db)
+
+
+def _activity_log_search(db) -> None:
+    """Keyset pagination index (created_at, id) for the log viewer."""
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_activity_logs_created_id ON activity_logs (created_at DESC, id DESC)"
+    )
+
+
+def _lookup_indexes(db) -> None:
+    """Indexes for lookups the query plan check found scanning whole tables."""
+    statements = (
+        # آخرین فاکتورها در داشبورد مدیر (ORDER BY opened_at DESC LIMIT)
+        "CREATE INDEX IF NOT EXISTS idx_invoices_opened_at ON invoices (opened_at DESC)",
+        # سابقه بیمار
+        "CREATE INDEX IF NOT EXISTS idx_consumables_patient_id ON consumables_ledger (patient_id)",
+        # وضعیت پرداخت یک آیتم (کلید اصلی با invoice_id شروع می‌شود)
+        "CREATE INDEX IF NOT EXISTS idx_payments_item ON invoice_item_payments (item_type, item_id)",
+        # حقوق پرستاران (invoice_id: شمارش شیفت‌ها فقط از ایندکس خوانده می‌شود)
+        "CREATE INDEX IF NOT EXISTS idx_injections_nurse_id ON injections (nurse_id, work_date, invoice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_procedures_nurse_id ON procedures (nurse_id, work_date, invoice_id)",
+    )
+    for sql in statements:
+        db.execute(sql)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'work_date / shift columns + backfill', _work_date_columns),
+    Migration(2, 'performance indexes', _indexes),
+    Migration(3, 'settings table', _settings_table),
+    Migration(4, 'visit_tariffs nursing_covers / is_base_tariff', _visit_tariff_flags),
+    Migration(5, 'user_active_shift table', _user_active_shift_table),
+    Migration(6, 'daily_stats rollup', _daily_stats_table),
+    Migration(7, 'patient last invoice insurance', _patient_search),
+    Migration(8, 'activity log keyset index', _activity_log_search),
+    Migration(9, 'lookup indexes (opened_at, patient consumables, item payments, nurse work)', _lookup_indexes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+_lock = threading.Lock()
+
+
+def current_version(db) -> int:
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def pending_migrations(db) -> List[Migration]:
+    version = current_version(db)
+    return [m for m in MIGRATIONS if m.version > version]
+
+
+def ensure_search_indexes(db, verbose: bool = False) -> None:
+    """Build missing FTS5 search indexes, each in its own transaction.
+
+    Without FTS5 the build fails, is rolled back and is tried again on the
+    next start; search falls back to LIKE meanwhile.
+    """
+    from src.adapters.sqlite.log_search import ensure_log_search
+    from src.adapters.sqlite.patient_search import ensure_patient_search
+    for name, ensure in (('patient', ensure_patient_search), ('activity log', ensure_log_search)):
+        try:
+            if not db.in_transaction:
+                db.execute("BEGIN")
+            built = ensure(db)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"[DB] {name.capitalize()} search index not available: {e}")
+            continue
+        if built and verbose:
+            print(f"[DB] Built {name} search index")
+
+
+def run_migrations(db, dry_run: bool = False, verbose: bool = False) -> List[Migration]:
+    """Apply pending steps in order; returns the steps applied (or pending, with ``dry_run``).
+
+    Each step and its ``user_version`` bump commit together (steps never
+    commit themselves). A failing step is rolled back and stops the run so
+    it is retried on the next start; the app keeps working with the older
+    schema. Missing search indexes are built afterwards (ensure_search_indexes).
+    """
+    with _lock:
+        pending = pending_migrations(db)
+        if dry_run:
+            return pending
+        applied = []
+        for m in pending:
+            try:
+                if not db.in_transaction:
+                    db.execute("BEGIN")
+                m.apply(db)
+                # PRAGMA مقدار پارامتری نمی‌پذیرد؛ version عدد صحیح خود کد است
+                db.execute(f"PRAGMA user_version = {int(m.version)}")
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"[DB] Migration {m.version} ({m.name}) failed: {e}")
+                break
+            applied.append(m)
+            if verbose:
+                print(f"[DB] Applied migration {m.version}: {m.name}")
+        ensure_search_indexes(db, verbose=verbose)
+        return applied
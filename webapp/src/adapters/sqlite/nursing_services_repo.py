@@ -1,24 +1,26 @@
 from typing import List, Dict, Optional
 from src.adapters.sqlite.core import get_db
+from src.adapters.sqlite.tariff_cache import get_tariffs, bump_tariff_generation
 
 class NursingServicesRepository:
     def list_active(self) -> List[Dict]:
-        db = get_db()
-        rows = db.execute("SELECT id, service_name, unit_price FROM nursing_services WHERE is_active = 1 ORDER BY service_name").fetchall()
-        return [dict(r) for r in rows]
+        rows = [r for r in get_tariffs().nursing_services if r['is_active'] == 1]
+        rows.sort(key=lambda r: r['service_name'])
+        return [{'id': r['id'], 'service_name': r['service_name'], 'unit_price': r['unit_price']} for r in rows]
 
     def create(self, service_name: str, unit_price: float) -> int:
         db = get_db()
         cur = db.execute("INSERT INTO nursing_services (service_name, unit_price) VALUES (?, ?)", (service_name, unit_price))
+        bump_tariff_generation(db)
         db.commit()
         return cur.lastrowid
 
     def deactivate(self, service_id: int):
         db = get_db()
         db.execute("UPDATE nursing_services SET is_active = 0 WHERE id = ?", (service_id,))
+        bump_tariff_generation(db)
         db.commit()
 
     def get(self, service_id: int) -> Optional[Dict]:
-        db = get_db()
-        row = db.execute("SELECT id, service_name, unit_price FROM nursing_services WHERE id = ?", (service_id,)).fetchone()
-        return dict(row) if row else None
+        row = next((r for r in get_tariffs().nursing_services if r['id'] == service_id), None)
+        return {'id': row['id'], 'service_name': row['service_name'], 'unit_price': row['unit_price']} if row else None
@@ -0,0 +1,117 @@
+import re
+from typing import List, Optional
+
+from src.common.utils import PERSIAN_NORMALIZE_MAP, normalize_persian
+
+
+# ستون‌های ایندکس جستجوی بیمار (rowid = patients.id)
+FTS_COLUMNS = ('name', 'family_name', 'national_id', 'phone_number')
+# کوئری‌های کوتاه‌تر از این بدون رتبه‌بندی (جدیدترین بیماران اول) برگردانده می‌شوند
+RANK_MIN_QUERY_LENGTH = 3
+
+
+def normalize_sql(expr: str) -> str:
+    """SQL expression applying `normalize_persian` in pure SQL (usable inside triggers)."""
+    sql = f"COALESCE({expr}, '')"
+    for src, dst in PERSIAN_NORMALIZE_MAP.items():
+        sql = f"replace({sql}, '{src}', '{dst}')"
+    return sql
+
+
+def _fts_values(alias: str) -> str:
+    return ', '.join(normalize_sql(f'{alias}.{c}') for c in FTS_COLUMNS)
+
+
+def _insurance_ddl() -> List[str]:
+    # بیمه آخرین فاکتور (جایگزین subquery همبسته در لیست بیماران)
+    return [
+        """CREATE TRIGGER IF NOT EXISTS invoices_last_insurance_ai AFTER INSERT ON invoices BEGIN
+                UPDATE patients SET last_invoice_insurance = NEW.insurance_type WHERE id = NEW.patient_id;
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS invoices_last_insurance_au AFTER UPDATE OF insurance_type, patient_id ON invoices BEGIN
+                UPDATE patients SET last_invoice_insurance = (
+                    SELECT insurance_type FROM invoices WHERE patient_id = patients.id ORDER BY id DESC LIMIT 1
+                ) WHERE id IN (NEW.patient_id, OLD.patient_id);
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS invoices_last_insurance_ad AFTER DELETE ON invoices BEGIN
+                UPDATE patients SET last_invoice_insurance = (
+                    SELECT insurance_type FROM invoices WHERE patient_id = patients.id ORDER BY id DESC LIMIT 1
+                ) WHERE id = OLD.patient_id;
+            END""",
+    ]
+
+
+def _fts_ddl() -> List[str]:
+    cols = ', '.join(FTS_COLUMNS)
+    return [
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+                {cols}, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3'
+            )""",
+        f"""CREATE TRIGGER IF NOT EXISTS patients_fts_ai AFTER INSERT ON patients BEGIN
+                INSERT INTO patients_fts (rowid, {cols}) VALUES (NEW.id, {_fts_values('NEW')});
+            END""",
+        """CREATE TRIGGER IF NOT EXISTS patients_fts_ad AFTER DELETE ON patients BEGIN
+                DELETE FROM patients_fts WHERE rowid = OLD.id;
+            END""",
+        f"""CREATE TRIGGER IF NOT EXISTS patients_fts_au AFTER UPDATE OF {cols} ON patients BEGIN
+                DELETE FROM patients_fts WHERE rowid = OLD.id;
+                INSERT INTO patients_fts (rowid, {cols}) VALUES (NEW.id, {_fts_values('NEW')});
+            END""",
+    ]
+
+
+def ensure_last_invoice_insurance(db) -> None:
+    """Precomputed last invoice insurance column + the triggers keeping it current."""
+    cols = [r[1] for r in db.execute("PRAGMA table_info(patients)").fetchall()]
+    if 'last_invoice_insurance' not in cols:
+        db.execute("ALTER TABLE patients ADD COLUMN last_invoice_insurance TEXT")
+        db.execute("""
+            UPDATE patients SET last_invoice_insurance = (
+                SELECT insurance_type FROM invoices WHERE patient_id = patients.id ORDER BY id DESC LIMIT 1
+            )
+        """)
+    for stmt in _insurance_ddl():
+        db.execute(stmt)
+
+
+def ensure_patient_search(db) -> bool:
+    """Create the FTS index + sync triggers and backfill it; False if it already exists.
+
+    Raises sqlite3.OperationalError without FTS5 (old SQLite builds); search
+    then falls back to LIKE. The caller commits.
+    """
+    has_fts = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients_fts'"
+    ).fetchone()
+    if has_fts:
+        return False
+    for stmt in _fts_ddl():
+        db.execute(stmt)
+    db.execute(
+        f"INSERT INTO patients_fts (rowid, {', '.join(FTS_COLUMNS)}) "
+        f"SELECT p.id, {_fts_values('p')} FROM patients p"
+    )
+    return True
+
+
+def build_match_query(query: str, columns: Optional[List[str]] = None) -> Optional[str]:
+    """Turn user input into an FTS5 MATCH expression: every token as a prefix, all required."""
+    tokens = re.findall(r'\w+', normalize_persian(query))
+    if not tokens:
+        return None
+    match = ' '.join(f'"{t}"*' for t in tokens)
+    if columns:
+        match = '{' + ' '.join(columns) + '} : (' + match + ')'
+    return match
+
+
+def numeric_query(query: str) -> Optional[str]:
+    """Digits of a phone / national id query (spaces and dashes ignored), else None."""
+    text = normalize_persian(query).strip()
+    if not text or not re.fullmatch(r'[\d\s-]+', text):
+        return None
+    return re.sub(r'\D', '', text) or None
+
+
+def should_rank(query: str) -> bool:
+    return len(normalize_persian(query).strip()) >= RANK_MIN_QUERY_LENGTH
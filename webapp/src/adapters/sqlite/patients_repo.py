@@ -1,6 +1,30 @@
-from src.adapters.sqlite.core import get_db
+from typing import Dict, List, Optional, Tuple
+from src.adapters.sqlite.core import get_db, pool_epoch
+from src.adapters.sqlite.patient_search import build_match_query, numeric_query, should_rank
 from src.domain.patients import Patient
 
+# سقف نتایج جستجوی بیمار
+SEARCH_LIMIT = 50
+# تعداد نتایج جدیدتری که برای رتبه‌بندی (bm25) بررسی می‌شوند
+RANK_CANDIDATES = 1000
+
+# (pool_epoch, has patients_fts, has last_invoice_insurance) - schema یک بار برای هر فایل دیتابیس بررسی می‌شود
+_search_schema: Optional[Tuple[int, bool, bool]] = None
+
+
+def _probe_search_schema(db) -> Tuple[bool, bool]:
+    """Whether the FTS index / precomputed insurance column exist (cached per pool_epoch)."""
+    global _search_schema
+    epoch = pool_epoch()
+    probe = _search_schema
+    if probe is None or probe[0] != epoch:
+        has_fts = db.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients_fts'"
+        ).fetchone() is not None
+        cols = [r[1] for r in db.execute("PRAGMA table_info(patients)").fetchall()]
+        probe = _search_schema = (epoch, has_fts, 'last_invoice_insurance' in cols)
+    return probe[1], probe[2]
+
 class PatientRepository:
     def get_by_national_id(self, national_id: str) -> Patient:
         db = get_db()
@@ -25,14 +49,123 @@ class PatientRepository:
         ).fetchone()
         return self._map_row(row) if row else None
 
-    def search_by_name(self, query: str):
+    def search_by_name(self, query: str, limit: int = SEARCH_LIMIT):
+        """Patients whose name/family name starts with the query words (FTS5, ranked)."""
         db = get_db()
-        rows = db.execute(
-            'SELECT * FROM patients WHERE name LIKE ? OR family_name LIKE ?', 
-            (f'%{query}%', f'%{query}%')
-        ).fetchall()
+        match = build_match_query(query, columns=['name', 'family_name'])
+        if match is None:
+            return []
+        if self._has_search_index(db):
+            rows = self._fts_search(db, 'p.*', match, query, limit)
+        else:
+            rows = db.execute(
+                'SELECT * FROM patients WHERE name LIKE ? OR family_name LIKE ? ORDER BY id DESC LIMIT ?',
+                (f'%{query}%', f'%{query}%', limit)
+            ).fetchall()
         return [self._map_row(row) for row in rows]
 
+    def search(self, query: str, limit: int = SEARCH_LIMIT) -> List[Dict]:
+        """Reception patient lookup: name, family name, national id or phone.
+
+        Words match as prefixes (FTS5); a digits-only query also matches
+        anywhere inside the national id / phone number (e.g. the last digits
+        of a phone), listed after the prefix matches. Returns rows with
+        `effective_insurance_type` (patient insurance, else the precomputed
+        insurance of the latest invoice).
+        """
+        db = get_db()
+        match = build_match_query(query)
+        if match is None:
+            return self.recent(limit)
+        if not self._has_search_index(db):
+            return self._like_search(db, query, limit)
+        rows = [dict(r) for r in self._fts_search(db, """
+            p.id, p.name, p.family_name, p.national_id, p.phone_number,
+            COALESCE(p.insurance_type, p.last_invoice_insurance) AS effective_insurance_type
+        """, match, query, limit)]
+        digits = numeric_query(query)
+        if digits and len(rows) < limit:
+            # FTS فقط ابتدای کلمه را پیدا می‌کند؛ چند رقم آخر تلفن/کدملی با LIKE
+            seen = {r['id'] for r in rows}
+            rows += self._numeric_substring(db, digits, limit, seen)[:limit - len(rows)]
+        return rows
+
+    def _like_search(self, db, query: str, limit: int) -> List[Dict]:
+        """Substring search without the FTS index (old SQLite builds)."""
+        q = f'%{query}%'
+        rows = db.execute(f"""
+            SELECT p.id, p.name, p.family_name, p.national_id, p.phone_number,
+                   {self._effective_insurance_sql(db)} AS effective_insurance_type
+            FROM patients p
+            WHERE p.name LIKE ? OR p.family_name LIKE ? OR p.national_id LIKE ? OR p.phone_number LIKE ?
+            ORDER BY p.id DESC
+            LIMIT ?
+        """, (q, q, q, q, limit)).fetchall()
+        return [dict(r) for r in rows]
+
+    def recent(self, limit: int = 1000) -> List[Dict]:
+        """Latest registered patients (search modal without query)."""
+        db = get_db()
+        rows = db.execute(f"""
+            SELECT p.id, p.name, p.family_name, p.national_id, p.phone_number,
+                   {self._effective_insurance_sql(db)} AS effective_insurance_type
+            FROM patients p
+            ORDER BY p.id DESC
+            LIMIT ?
+        """, (limit,)).fetchall()
+        return [dict(r) for r in rows]
+
+    def _fts_search(self, db, select: str, match: str, query: str, limit: int):
+        """Run a MATCH against patients_fts.
+
+        Ranking (bm25) is computed only for the newest `RANK_CANDIDATES`
+        matches, so broad queries like a common first name stay fast.
+        """
+        if should_rank(query):
+            return db.execute(f"""
+                SELECT {select}
+                FROM (
+                    SELECT rowid, rank FROM patients_fts
+                    WHERE patients_fts MATCH ?
+                    ORDER BY rowid DESC
+                    LIMIT ?
+                ) f
+                JOIN patients p ON p.id = f.rowid
+                ORDER BY f.rank, p.id DESC
+                LIMIT ?
+            """, (match, RANK_CANDIDATES, limit)).fetchall()
+        return db.execute(f"""
+            SELECT {select}
+            FROM patients_fts
+            JOIN patients p ON p.id = patients_fts.rowid
+            WHERE patients_fts MATCH ?
+            ORDER BY patients_fts.rowid DESC
+            LIMIT ?
+        """, (match, limit)).fetchall()
+
+    def _numeric_substring(self, db, digits: str, limit: int, exclude) -> List[Dict]:
+        """Patients whose national id or phone contains ``digits`` (LIKE; digits-only queries)."""
+        q = f'%{digits}%'
+        rows = db.execute(f"""
+            SELECT p.id, p.name, p.family_name, p.national_id, p.phone_number,
+                   {self._effective_insurance_sql(db)} AS effective_insurance_type
+            FROM patients p
+            WHERE p.national_id LIKE ? OR p.phone_number LIKE ?
+            ORDER BY p.id DESC
+            LIMIT ?
+        """, (q, q, limit + len(exclude))).fetchall()
+        return [dict(r) for r in rows if r['id'] not in exclude]
+
+    def _has_search_index(self, db) -> bool:
+        return _probe_search_schema(db)[0]
+
+    def _effective_insurance_sql(self, db) -> str:
+        if _probe_search_schema(db)[1]:
+            return "COALESCE(p.insurance_type, p.last_invoice_insurance)"
+        return """COALESCE(p.insurance_type, (
+                     SELECT insurance_type FROM invoices i WHERE i.patient_id = p.id ORDER BY i.id DESC LIMIT 1
+                   ))"""
+
     def create(self, patient: Patient) -> int:
         db = get_db()
         cursor = db.execute(
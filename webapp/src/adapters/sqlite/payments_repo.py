@@ -1,22 +1,80 @@
-from typing import List, Dict, Optional
+from typing import Iterable, List, Dict, Optional, Tuple
 from src.adapters.sqlite.core import get_db
 
+_UPSERT_SQL = '''INSERT INTO invoice_item_payments (invoice_id, item_type, item_id, payment_type, is_paid)
+               VALUES (?, ?, ?, ?, ?)
+               ON CONFLICT(invoice_id, item_type, item_id) DO UPDATE SET
+                   payment_type = excluded.payment_type,
+                   is_paid = excluded.is_paid,
+                   updated_at = datetime('now', '+3 hours', '+30 minutes')'''
+
+# همه آیتم‌های یک فاکتور (نوع، شناسه، تاریخ، توضیح) - پارامتر invoice_id چهار بار
+_INVOICE_ITEMS_SQL = '''
+    SELECT 'visit' AS item_type, v.id AS item_id, v.visit_date AS date, 'ویزیت' AS description
+    FROM visits v WHERE v.invoice_id = ?
+    UNION ALL
+    SELECT 'injection', i.id, i.injection_date, i.injection_type
+    FROM injections i WHERE i.invoice_id = ?
+    UNION ALL
+    SELECT 'procedure', pr.id, pr.procedure_date,
+           CASE WHEN pr.performer_type = 'nurse' THEN pr.procedure_type || ' (پرستار)'
+                WHEN pr.performer_type = 'doctor' THEN pr.procedure_type || ' (پزشک)'
+                ELSE pr.procedure_type END
+    FROM procedures pr WHERE pr.invoice_id = ?
+    UNION ALL
+    SELECT 'consumable', c.id, c.usage_date, c.item_name
+    FROM consumables_ledger c WHERE c.invoice_id = ?
+'''
+
+
 class InvoiceItemPaymentRepository:
     """Repository for invoice item payment tracking."""
 
     def set_payment(self, invoice_id: int, item_type: str, item_id: int,
                     payment_type: Optional[str], is_paid: bool) -> None:
         db = get_db()
-        db.execute(
-            '''INSERT INTO invoice_item_payments (invoice_id, item_type, item_id, payment_type, is_paid)
-               VALUES (?, ?, ?, ?, ?)
-               ON CONFLICT(invoice_id, item_type, item_id) DO UPDATE SET
-                   payment_type = excluded.payment_type,
-                   is_paid = excluded.is_paid,
-                   updated_at = datetime('now', '+3 hours', '+30 minutes')''',
+        db.execute(_UPSERT_SQL, (invoice_id, item_type, item_id, payment_type, 1 if is_paid else 0))
+        db.commit()
+
+    def set_payments(self, invoice_id: int,
+                     payments: Iterable[Tuple[str, int, Optional[str], bool]]) -> int:
+        """Upsert many item payments (item_type, item_id, payment_type, is_paid) in one transaction."""
+        db = get_db()
+        rows = [
             (invoice_id, item_type, item_id, payment_type, 1 if is_paid else 0)
+            for item_type, item_id, payment_type, is_paid in payments
+        ]
+        try:
+            db.executemany(_UPSERT_SQL, rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return len(rows)
+
+    def settle_all(self, invoice_id: int, payment_type: Optional[str]) -> int:
+        """Mark every item of the invoice as paid with `payment_type` (one read + one batch upsert)."""
+        db = get_db()
+        keys = db.execute(
+            f"SELECT item_type, item_id FROM ({_INVOICE_ITEMS_SQL})", (invoice_id,) * 4
+        ).fetchall()
+        return self.set_payments(
+            invoice_id, ((k['item_type'], k['item_id'], payment_type, True) for k in keys)
         )
-        db.commit()
+
+    def get_unpaid_items(self, invoice_id: int) -> List[Dict]:
+        """Items without a paid payment row (anti-join), newest first."""
+        db = get_db()
+        rows = db.execute(f"""
+            SELECT it.item_type AS type, it.item_id AS id, it.description
+            FROM ({_INVOICE_ITEMS_SQL}) it
+            LEFT JOIN invoice_item_payments p
+                ON p.invoice_id = ? AND p.item_type = it.item_type AND p.item_id = it.item_id
+                AND p.is_paid = 1
+            WHERE p.item_id IS NULL
+            ORDER BY it.date DESC
+        """, (invoice_id,) * 5).fetchall()
+        return [dict(r) for r in rows]
 
     def get_payments_for_invoice(self, invoice_id: int) -> List[Dict]:
         db = get_db()
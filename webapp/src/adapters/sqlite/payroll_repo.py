@@ -0,0 +1,167 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from src.adapters.sqlite.core import get_db
+from src.domain.payroll import StaffWork, compute_salary
+
+
+class PayrollRepository:
+    """Payroll for many staff members with a fixed number of grouped queries.
+
+    Attendance and commission bases are aggregated per staff id for the whole
+    period (one query per measure, not per person); rates are applied in
+    memory by `compute_salary`.
+
+    Rules (unchanged):
+    - doctor shifts: distinct (work_date, shift) of the doctor's visits
+    - nurse shifts: distinct (work_date, shift) of visits on invoices where the
+      nurse has an injection or a procedure
+    - commissions count closed invoices only; a doctor's injections count only
+      when the same invoice has a visit by that doctor
+    """
+
+    def get_staff(self, staff_id: Optional[str] = None, staff_type: Optional[str] = None) -> List:
+        db = get_db()
+        query = """
+            SELECT m.*, p.base_morning, p.base_evening, p.base_night,
+                   p.visit_fee, p.injection_percent, p.procedure_percent, p.tax_percent,
+                   p.nursing_percent, p.nurse_procedure_percent
+            FROM medical_staff m
+            LEFT JOIN payroll_settings p ON m.id = p.staff_id
+            WHERE m.is_active = 1
+        """
+        params: List = []
+        if staff_id and staff_id != 'all':
+            query += " AND m.id = ?"
+            params.append(staff_id)
+        elif staff_type and staff_type != 'all':
+            query += " AND m.staff_type = ?"
+            params.append(staff_type)
+        return db.execute(query, params).fetchall()
+
+    def calculate(self, staff: Sequence, date_from: Optional[str] = None,
+                  date_to: Optional[str] = None, shift: Optional[str] = None) -> List[Dict]:
+        """Payroll rows (id, name, type, type_label, details, total_salary) for `staff`."""
+        work = self.collect_work({p['id']: p['staff_type'] for p in staff}, date_from, date_to, shift)
+        results = []
+        for person in staff:
+            salary = compute_salary(person, work.get(person['id'], StaffWork()))
+            results.append({
+                'id': person['id'],
+                'name': person['full_name'],
+                'type': person['staff_type'],
+                'type_label': 'پزشک' if person['staff_type'] == 'doctor' else 'پرستار',
+                'details': salary['details'],
+                'total_salary': salary['total_salary']
+            })
+        return results
+
+    def collect_work(self, staff_types: Dict[int, str], date_from: Optional[str] = None,
+                     date_to: Optional[str] = None, shift: Optional[str] = None) -> Dict[int, StaffWork]:
+        """{staff_id: StaffWork} for the period (work_date range + optional shift).
+
+        `staff_types` maps staff id -> 'doctor' / 'nurse'; each measure is
+        queried only for the staff type it applies to.
+        """
+        work: Dict[int, StaffWork] = {sid: StaffWork() for sid in staff_types}
+        doctors = [sid for sid, t in staff_types.items() if t == 'doctor']
+        nurses = [sid for sid, t in staff_types.items() if t != 'doctor']
+        db = get_db()
+
+        def period(alias: str) -> Tuple[str, List]:
+            sql, params = '', []
+            # بازه فقط وقتی هر دو تاریخ داده شده اعمال می‌شود
+            if date_from and date_to:
+                sql += f" AND {alias}.work_date BETWEEN ? AND ?"
+                params.extend([date_from, date_to])
+            if shift and shift != 'all':
+                sql += f" AND {alias}.shift = ?"
+                params.append(shift)
+            return sql, params
+
+        def placeholders(ids: List[int]) -> str:
+            return ', '.join('?' for _ in ids)
+
+        s_sql, s_params = period('s')
+        v_sql, v_params = period('v')
+        i_sql, i_params = period('i')
+        p_sql, p_params = period('p')
+
+        if doctors:
+            ph = placeholders(doctors)
+            # شیفت‌های پزشک - فقط از ویزیت‌ها
+            for r in db.execute(f"""
+                SELECT s.staff_id, s.shift, COUNT(*) AS cnt FROM (
+                    SELECT DISTINCT doctor_id AS staff_id, work_date, shift
+                    FROM visits WHERE doctor_id IN ({ph})
+                ) s
+                WHERE 1=1{s_sql}
+                GROUP BY s.staff_id, s.shift
+            """, doctors + s_params):
+                work[r['staff_id']].shifts[r['shift']] = r['cnt']
+
+            # ویزیت‌ها (فقط فاکتورهای بسته)
+            for r in db.execute(f"""
+                SELECT v.doctor_id AS staff_id, COUNT(*) AS cnt
+                FROM visits v JOIN invoices inv ON v.invoice_id = inv.id
+                WHERE inv.status = 'closed' AND v.doctor_id IN ({ph}){v_sql}
+                GROUP BY v.doctor_id
+            """, doctors + v_params):
+                work[r['staff_id']].visit_count = r['cnt']
+
+            # تزریقاتی که در همان فاکتور ویزیت پزشک هم وجود دارد
+            for r in db.execute(f"""
+                SELECT i.doctor_id AS staff_id, SUM(i.total_price) AS total
+                FROM injections i JOIN invoices inv ON i.invoice_id = inv.id
+                WHERE inv.status = 'closed' AND i.doctor_id IN ({ph})
+                  AND EXISTS (
+                      SELECT 1 FROM visits v
+                      WHERE v.invoice_id = i.invoice_id AND v.doctor_id = i.doctor_id
+                  ){i_sql}
+                GROUP BY i.doctor_id
+            """, doctors + i_params):
+                work[r['staff_id']].injection_total = r['total'] or 0
+
+            for r in db.execute(f"""
+                SELECT p.doctor_id AS staff_id, SUM(p.price) AS total
+                FROM procedures p JOIN invoices inv ON p.invoice_id = inv.id
+                WHERE inv.status = 'closed' AND p.doctor_id IN ({ph}){p_sql}
+                GROUP BY p.doctor_id
+            """, doctors + p_params):
+                work[r['staff_id']].procedure_total = r['total'] or 0
+
+        if nurses:
+            ph = placeholders(nurses)
+            # شیفت‌های پرستار - شیفت ویزیت فاکتورهایی که پرستار در آن تزریق/کار عملی دارد
+            for r in db.execute(f"""
+                SELECT s.staff_id, s.shift, COUNT(*) AS cnt FROM (
+                    SELECT DISTINCT ni.nurse_id AS staff_id, v.work_date, v.shift
+                    FROM (
+                        SELECT nurse_id, invoice_id FROM injections WHERE nurse_id IN ({ph})
+                        UNION
+                        SELECT nurse_id, invoice_id FROM procedures WHERE nurse_id IN ({ph})
+                    ) ni
+                    JOIN invoices inv ON inv.id = ni.invoice_id
+                    JOIN visits v ON v.invoice_id = inv.id
+                ) s
+                WHERE 1=1{s_sql}
+                GROUP BY s.staff_id, s.shift
+            """, nurses + nurses + s_params):
+                work[r['staff_id']].shifts[r['shift']] = r['cnt']
+
+            for r in db.execute(f"""
+                SELECT i.nurse_id AS staff_id, SUM(i.total_price) AS total
+                FROM injections i JOIN invoices inv ON i.invoice_id = inv.id
+                WHERE inv.status = 'closed' AND i.nurse_id IN ({ph}){i_sql}
+                GROUP BY i.nurse_id
+            """, nurses + i_params):
+                work[r['staff_id']].injection_total = r['total'] or 0
+
+            for r in db.execute(f"""
+                SELECT p.nurse_id AS staff_id, SUM(p.price) AS total
+                FROM procedures p JOIN invoices inv ON p.invoice_id = inv.id
+                WHERE inv.status = 'closed' AND p.nurse_id IN ({ph}){p_sql}
+                GROUP BY p.nurse_id
+            """, nurses + p_params):
+                work[r['staff_id']].procedure_total = r['total'] or 0
+
+        return work
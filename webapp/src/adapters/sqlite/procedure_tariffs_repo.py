@@ -1,25 +1,27 @@
 from typing import List, Dict, Optional
 from src.adapters.sqlite.core import get_db
+from src.adapters.sqlite.tariff_cache import get_tariffs, bump_tariff_generation
 
 class ProcedureTariffsRepository:
     """Catalog repository for procedure tariffs."""
 
     def list_active(self) -> List[Dict]:
-        db = get_db()
-        rows = db.execute("SELECT id, name, unit_price FROM procedure_tariffs WHERE is_active = 1 ORDER BY name").fetchall()
-        return [dict(r) for r in rows]
+        rows = [r for r in get_tariffs().procedure_tariffs if r['is_active'] == 1]
+        rows.sort(key=lambda r: r['name'])
+        return [{'id': r['id'], 'name': r['name'], 'unit_price': r['unit_price']} for r in rows]
 
     def get(self, tariff_id: int) -> Optional[Dict]:
-        db = get_db()
-        row = db.execute("SELECT id, name, unit_price FROM procedure_tariffs WHERE id = ? AND is_active = 1", (tariff_id,)).fetchone()
-        return dict(row) if row else None
+        row = next((r for r in get_tariffs().procedure_tariffs if r['id'] == tariff_id and r['is_active'] == 1), None)
+        return {'id': row['id'], 'name': row['name'], 'unit_price': row['unit_price']} if row else None
 
     def create(self, name: str, unit_price: float) -> int:
         db = get_db()
         cur = db.execute("INSERT INTO procedure_tariffs (name, unit_price, is_active) VALUES (?, ?, 1)", (name, unit_price))
+        bump_tariff_generation(db)
         db.commit(); return cur.lastrowid
 
     def deactivate(self, tariff_id: int) -> bool:
         db = get_db()
         cur = db.execute("UPDATE procedure_tariffs SET is_active = 0 WHERE id = ?", (tariff_id,))
+        bump_tariff_generation(db)
         db.commit(); return cur.rowcount > 0
@@ -0,0 +1,277 @@
+"""
+SQL Instrumentation
+شمارش و زمان‌سنجی کوئری‌های هر درخواست، هدر Server-Timing، لاگ کوئری‌های کند و آمار مسیرها
+
+While a request is active, `get_db` attaches a `QueryStats` to the request
+connection; `ClinicConnection.execute` then runs statements on a
+`TimedCursor`, so the recorded time includes fetching the rows, not just
+the first step. At the end of the request the totals go to the
+``Server-Timing`` header and to `route_db_stats` (shown on
+/manager/diagnostics). Statements slower than SLOW_QUERY_MS go to a
+rotating log with literals replaced by ``?``.
+"""
+
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from logging.handlers import RotatingFileHandler
+from typing import Dict, List, Optional
+
+from src.common.metrics import metrics
+from src.config.settings import Config
+
+db_queries = metrics.counter('clinic_db_queries_total', 'SQL statements run by requests.', ('endpoint',))
+db_seconds = metrics.counter('clinic_db_query_seconds_total', 'SQL time (execute + fetch) spent by requests.', ('endpoint',))
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def normalize_statement(sql: str) -> str:
+    """SQL text with literals as ``?`` and whitespace collapsed (groups the same statement)."""
+    text = _STRING.sub('?', sql)
+    text = _NUMBER.sub('?', text)
+    text = _IN_LIST.sub('(?, ...)', text)
+    return _SPACE.sub(' ', text).strip()
+
+
+class Statement:
+    __slots__ = ('sql', 'count', 'total', 'max')
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class QueryStats:
+    """Query count and SQL time of one request, grouped by statement text."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self._statements: Dict[str, Statement] = {}
+
+    def statement(self, sql: str) -> Statement:
+        stmt = self._statements.get(sql)
+        if stmt is None:
+            stmt = self._statements[sql] = Statement(sql)
+        stmt.count += 1
+        self.count += 1
+        return stmt
+
+    def execute(self, conn, sql: str, parameters=()):
+        cursor = conn.cursor(TimedCursor)
+        cursor.track(self, self.statement(sql))
+        return cursor.run(sql, parameters)
+
+    def timed(self, sql: str, fn, *args):
+        """Time a call that has no cursor to follow (executemany / executescript)."""
+        stmt = self.statement(sql)
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            stmt.total += elapsed
+            stmt.max = max(stmt.max, elapsed)
+            self.total += elapsed
+
+    def slowest(self, limit: int = 5) -> List[Dict]:
+        """Statements by total time, literals normalized and identical texts merged."""
+        merged: Dict[str, Dict] = {}
+        for stmt in self._statements.values():
+            key = normalize_statement(stmt.sql)
+            entry = merged.setdefault(key, {'sql': key, 'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            entry['count'] += stmt.count
+            entry['total_ms'] += stmt.total * 1000
+            entry['max_ms'] = max(entry['max_ms'], stmt.max * 1000)
+        return sorted(merged.values(), key=lambda e: e['total_ms'], reverse=True)[:limit]
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that adds execute and fetch time to its statement."""
+
+    def track(self, stats: QueryStats, stmt: Statement) -> None:
+        self._stats = stats
+        self._stmt = stmt
+        self._elapsed = 0.0
+
+    def _add(self, seconds: float) -> None:
+        self._elapsed += seconds
+        self._stmt.total += seconds
+        if self._elapsed > self._stmt.max:
+            self._stmt.max = self._elapsed
+        self._stats.total += seconds
+
+    def run(self, sql: str, parameters):
+        started = time.perf_counter()
+        try:
+            sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            self._add(time.perf_counter() - started)
+        return self
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._add(time.perf_counter() - started)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany() if size is None else super().fetchmany(size)
+        finally:
+            self._add(time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._add(time.perf_counter() - started)
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self._add(time.perf_counter() - started)
+
+
+class RouteDbStats:
+    """Process-wide DB totals per endpoint and the most recent slow statements."""
+
+    def __init__(self, recent_slow: int = 50):
+        self._lock = threading.Lock()
+        self._routes: Dict[str, Dict] = {}
+        self._slow = deque(maxlen=recent_slow)
+        self.since = time.time()
+
+    def record(self, endpoint: str, stats: QueryStats, request_seconds: float) -> None:
+        with self._lock:
+            entry = self._routes.get(endpoint)
+            if entry is None:
+                entry = self._routes[endpoint] = {
+                    'endpoint': endpoint, 'requests': 0, 'queries': 0, 'max_queries': 0,
+                    'db_ms': 0.0, 'max_db_ms': 0.0, 'request_ms': 0.0,
+                }
+            db_ms = stats.total * 1000
+            entry['requests'] += 1
+            entry['queries'] += stats.count
+            entry['max_queries'] = max(entry['max_queries'], stats.count)
+            entry['db_ms'] += db_ms
+            entry['max_db_ms'] = max(entry['max_db_ms'], db_ms)
+            entry['request_ms'] += request_seconds * 1000
+
+    def record_slow(self, endpoint: str, statement: Dict) -> None:
+        with self._lock:
+            self._slow.appendleft(dict(statement, endpoint=endpoint, at=time.time()))
+
+    def top(self, limit: int = 20) -> List[Dict]:
+        """Endpoints by total DB time, with per-request averages."""
+        with self._lock:
+            rows = [dict(e) for e in self._routes.values()]
+        for row in rows:
+            n = row['requests']
+            row['avg_queries'] = row['queries'] / n
+            row['avg_db_ms'] = row['db_ms'] / n
+            row['avg_request_ms'] = row['request_ms'] / n
+        return sorted(rows, key=lambda r: r['db_ms'], reverse=True)[:limit]
+
+    def recent_slow(self) -> List[Dict]:
+        with self._lock:
+            return list(self._slow)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._routes.clear()
+            self._slow.clear()
+            self.since = time.time()
+
+
+route_db_stats = RouteDbStats()
+
+_slow_logger: Optional[logging.Logger] = None
+_slow_logger_lock = threading.Lock()
+
+
+def slow_query_logger() -> logging.Logger:
+    """Rotating file logger for slow statements (created on first use)."""
+    global _slow_logger
+    with _slow_logger_lock:
+        if _slow_logger is None:
+            logger = logging.getLogger('clinic.slow_sql')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            path = getattr(Config, 'SLOW_QUERY_LOG_PATH', None)
+            if path:
+                try:
+                    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                    handler = RotatingFileHandler(
+                        path, encoding='utf-8',
+                        maxBytes=getattr(Config, 'SLOW_QUERY_LOG_MAX_BYTES', 1_000_000),
+                        backupCount=getattr(Config, 'SLOW_QUERY_LOG_BACKUPS', 5),
+                    )
+                    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                    logger.addHandler(handler)
+                except OSError as e:
+                    print(f"[QueryStats] Slow query log not available: {e}")
+            _slow_logger = logger
+        return _slow_logger
+
+
+def init_query_stats(app) -> None:
+    """Register the request hooks (skipped when SQL_INSTRUMENTATION is off)."""
+    if not getattr(Config, 'SQL_INSTRUMENTATION', True):
+        return
+    from flask import g, request
+
+    @app.before_request
+    def _start_query_stats():
+        g.query_stats = QueryStats()
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _finish_query_stats(response):
+        stats = g.pop('query_stats', None)
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - g.pop('request_started', time.perf_counter())
+        # کانکشن تا teardown در g می‌ماند؛ کوئری‌های بعد از این نقطه شمرده نمی‌شوند
+        db = g.get('_database')
+        if db is not None:
+            db.query_stats = None
+
+        slowest = stats.slowest()
+        timing = [f'db;dur={stats.total * 1000:.2f};desc="{stats.count} queries"']
+        if slowest:
+            timing.append(f'db-max;dur={slowest[0]["max_ms"]:.2f}')
+        timing.append(f'app;dur={elapsed * 1000:.2f}')
+        response.headers.add('Server-Timing', ', '.join(timing))
+
+        # مسیرهای ناشناخته (404) یک کلید مشترک دارند تا _routes بی‌حد بزرگ نشود
+        endpoint = request.endpoint or 'unmatched'
+        route_db_stats.record(endpoint, stats, elapsed)
+        db_queries.inc(stats.count, endpoint=endpoint)
+        db_seconds.inc(stats.total, endpoint=endpoint)
+        threshold = getattr(Config, 'SLOW_QUERY_MS', 100)
+        for statement in slowest:
+            if statement['max_ms'] >= threshold:
+                route_db_stats.record_slow(endpoint, statement)
+                slow_query_logger().info(
+                    f"{statement['max_ms']:.1f}ms max, {statement['count']}x {statement['total_ms']:.1f}ms total "
+                    f"| {request.method} {request.path} ({endpoint}) | {statement['sql']}"
+                )
+        return response
@@ -0,0 +1,497 @@
+from typing import Dict, List, Optional
+from datetime import date, timedelta
+from src.adapters.sqlite.core import get_db
+
+
+# هر متریک نمودار = یک کوئری GROUP BY work_date روی کل بازه
+# Additive metrics come from the daily_stats rollup (see DailyStatsRepository);
+# distinct patients are not additive across shifts so they are counted from invoices.
+_DAILY_SERIES_SQL = {
+    # Revenue = visits + injections + procedures (NOT consumables), closed invoices only
+    'revenue': """
+        SELECT work_date, COALESCE(SUM(visits_revenue + injections_revenue + procedures_revenue), 0) AS val
+        FROM daily_stats
+        WHERE work_date BETWEEN ? AND ?
+        GROUP BY work_date
+    """,
+    'invoices': """
+        SELECT work_date, SUM(invoices_count) AS val FROM daily_stats
+        WHERE work_date BETWEEN ? AND ?
+        GROUP BY work_date
+    """,
+    'patients': """
+        SELECT work_date, COUNT(DISTINCT patient_id) AS val FROM invoices
+        WHERE work_date BETWEEN ? AND ?
+        GROUP BY work_date
+    """,
+    'visits': """
+        SELECT work_date, SUM(visits_count) AS val FROM daily_stats
+        WHERE work_date BETWEEN ? AND ?
+        GROUP BY work_date
+    """,
+    'injections': """
+        SELECT work_date, SUM(injections_count) AS val FROM daily_stats
+        WHERE work_date BETWEEN ? AND ?
+        GROUP BY work_date
+    """,
+    'procedures': """
+        SELECT work_date, SUM(procedures_count) AS val FROM daily_stats
+        WHERE work_date BETWEEN ? AND ?
+        GROUP BY work_date
+    """,
+    # Count only consumables provided by the center and not exception items
+    'consumables': """
+        SELECT work_date, SUM(consumables_count) AS val FROM daily_stats
+        WHERE work_date BETWEEN ? AND ?
+        GROUP BY work_date
+    """,
+}
+
+
+def date_range_keys(start: date, end: date) -> List[str]:
+    """Return YYYY-MM-DD keys for every day in [start, end]."""
+    days = []
+    current = start
+    while current <= end:
+        days.append(current.strftime('%Y-%m-%d'))
+        current += timedelta(days=1)
+    return days
+
+
+class ReportsRepository:
+    """Set-based aggregate queries for manager reports and charts."""
+
+    def daily_totals(self, metric: str, start_key: str, end_key: str) -> Dict[str, float]:
+        """Return {work_date: value} for one metric over the whole range in a single query.
+
+        Days without rows are absent; callers fill gaps with `fill_series`.
+        """
+        sql = _DAILY_SERIES_SQL.get(metric)
+        if sql is None:
+            return {}
+        db = get_db()
+        params = (start_key, end_key) * sql.count('BETWEEN')
+        rows = db.execute(sql, params).fetchall()
+        return {r['work_date']: (r['val'] or 0) for r in rows}
+
+    def fill_series(self, totals: Dict[str, float], day_keys: List[str]) -> List[float]:
+        """Map a sparse {work_date: value} dict onto an ordered list of days (missing days = 0)."""
+        return [totals.get(k, 0) or 0 for k in day_keys]
+
+    def daily_series(self, metric: str, day_keys: List[str]) -> List[float]:
+        """Dense per-day series for `metric` aligned with `day_keys`."""
+        if not day_keys:
+            return []
+        if metric == 'services':
+            # مجموع ویزیت + تزریق + کار عملی
+            parts = self.services_breakdown(day_keys)
+            return [a + b + c for a, b, c in zip(parts['visits'], parts['injections'], parts['procedures'])]
+        totals = self.daily_totals(metric, day_keys[0], day_keys[-1])
+        return self.fill_series(totals, day_keys)
+
+    def services_breakdown(self, day_keys: List[str]) -> Dict[str, List[float]]:
+        """Per-day counts of visits, injections and procedures (single rollup query)."""
+        if not day_keys:
+            return {'visits': [], 'injections': [], 'procedures': []}
+        db = get_db()
+        rows = db.execute("""
+            SELECT work_date, SUM(visits_count) AS visits, SUM(injections_count) AS injections,
+                   SUM(procedures_count) AS procedures
+            FROM daily_stats
+            WHERE work_date BETWEEN ? AND ?
+            GROUP BY work_date
+        """, (day_keys[0], day_keys[-1])).fetchall()
+        return {
+            metric: self.fill_series({r['work_date']: r[metric] for r in rows}, day_keys)
+            for metric in ('visits', 'injections', 'procedures')
+        }
+
+    def patient_stats(self, start_date: str, end_date: str,
+                      search_name: Optional[str] = None,
+                      insurance_type: Optional[str] = None,
+                      gender: Optional[str] = None) -> List[Dict]:
+        """Per-patient visit/payment statistics for patients with invoices in the range.
+
+        Everything (counts, revenue, last visit, latest insurance and the
+        name/insurance/gender filters) is computed in one CTE query instead of
+        several queries per patient.
+        """
+        db = get_db()
+        where = []
+        params: List = [
+            start_date, end_date,                      # inv
+            start_date, end_date,                      # rev: visits
+            start_date, end_date,                      # rev: injections
+            start_date, end_date,                      # rev: procedures
+            start_date, end_date,                      # vis
+        ]
+        if search_name:
+            where.append("instr(lower(COALESCE(p.name, '') || ' ' || COALESCE(p.family_name, '')), lower(?)) > 0")
+            params.append(search_name)
+        if insurance_type:
+            where.append("li.insurance_type = ?")
+            params.append(insurance_type)
+        if gender:
+            where.append("p.gender = ?")
+            params.append(gender)
+        where_sql = ('WHERE ' + ' AND '.join(where)) if where else ''
+
+        rows = db.execute(f"""
+            WITH inv AS (
+                SELECT patient_id, COUNT(*) AS invoices_count, MAX(opened_at) AS last_visit
+                FROM invoices
+                WHERE work_date BETWEEN ? AND ?
+                GROUP BY patient_id
+            ),
+            -- Revenue = visits + injections + procedures (NOT consumables)
+            rev AS (
+                SELECT patient_id, SUM(amount) AS total_paid FROM (
+                    SELECT i.patient_id, v.price AS amount FROM visits v
+                    JOIN invoices i ON i.id = v.invoice_id
+                    WHERE i.work_date BETWEEN ? AND ? AND i.status = 'closed'
+                    UNION ALL
+                    SELECT i.patient_id, inj.total_price FROM injections inj
+                    JOIN invoices i ON i.id = inj.invoice_id
+                    WHERE i.work_date BETWEEN ? AND ? AND i.status = 'closed'
+                    UNION ALL
+                    SELECT i.patient_id, pr.price FROM procedures pr
+                    JOIN invoices i ON i.id = pr.invoice_id
+                    WHERE i.work_date BETWEEN ? AND ? AND i.status = 'closed'
+                )
+                GROUP BY patient_id
+            ),
+            vis AS (
+                SELECT i.patient_id, COUNT(*) AS visits_count
+                FROM visits v
+                JOIN invoices i ON i.id = v.invoice_id
+                WHERE v.work_date BETWEEN ? AND ?
+                GROUP BY i.patient_id
+            ),
+            -- بیمه از آخرین ویزیت (کل سابقه بیمار، نه فقط بازه)
+            li AS (
+                SELECT patient_id, insurance_type FROM (
+                    SELECT i.patient_id, v.insurance_type,
+                           ROW_NUMBER() OVER (PARTITION BY i.patient_id ORDER BY v.visit_date DESC, v.id DESC) AS rn
+                    FROM visits v
+                    JOIN invoices i ON i.id = v.invoice_id
+                    WHERE i.patient_id IN (SELECT patient_id FROM inv)
+                )
+                WHERE rn = 1
+            )
+            SELECT p.id, p.name, p.family_name, p.national_id, p.phone_number,
+                   inv.invoices_count, inv.last_visit,
+                   COALESCE(rev.total_paid, 0) AS total_paid,
+                   COALESCE(vis.visits_count, 0) AS visits_count,
+                   li.insurance_type
+            FROM inv
+            JOIN patients p ON p.id = inv.patient_id
+            LEFT JOIN rev ON rev.patient_id = inv.patient_id
+            LEFT JOIN vis ON vis.patient_id = inv.patient_id
+            LEFT JOIN li ON li.patient_id = inv.patient_id
+            {where_sql}
+            ORDER BY inv.invoices_count DESC, p.id
+        """, params).fetchall()
+
+        return [{
+            'id': r['id'],
+            'full_name': f"{r['name']} {r['family_name']}",
+            'national_id': r['national_id'] if r['national_id'] else '',
+            'phone': r['phone_number'] if r['phone_number'] else '',
+            'insurance_type': r['insurance_type'],
+            'invoices_count': r['invoices_count'],
+            'visits_count': r['visits_count'],
+            'total_paid': r['total_paid'],
+            'last_visit': r['last_visit'],
+        } for r in rows]
+
+    def users_performance(self, start_date: str, end_date: str,
+                          role_filter: Optional[str] = None,
+                          user_filter: Optional[str] = None) -> List[Dict]:
+        """Per-person performance (reception users, doctors, nurses) for a work_date range.
+
+        Each role is one UNION ALL of `GROUP BY reception_user / doctor_id /
+        nurse_id` aggregates over the item tables; people are merged in
+        memory, so the query count does not grow with headcount.
+        Revenue = visits + injections + procedures of closed invoices (NOT consumables).
+        """
+        db = get_db()
+        results: List[Dict] = []
+        rng = (start_date, end_date)
+
+        def grouped(sql: str, params: tuple) -> Dict:
+            # {key: {kind: (count, revenue)}}
+            out: Dict = {}
+            for r in db.execute(sql, params).fetchall():
+                out.setdefault(r['k'], {})[r['kind']] = (r['cnt'] or 0, r['rev'] or 0)
+            return out
+
+        # ===== پذیرش: بر اساس کسی که آیتم را ثبت کرده (reception_user) =====
+        if not role_filter or role_filter == 'reception':
+            stats = grouped("""
+                SELECT 'invoices' AS kind, opened_by AS k, COUNT(*) AS cnt, 0 AS rev
+                FROM invoices WHERE work_date BETWEEN ? AND ?
+                GROUP BY opened_by
+                UNION ALL
+                SELECT 'visits', v.reception_user, COUNT(*),
+                       SUM(CASE WHEN i.status = 'closed' THEN v.price END)
+                FROM visits v LEFT JOIN invoices i ON i.id = v.invoice_id
+                WHERE v.work_date BETWEEN ? AND ?
+                GROUP BY v.reception_user
+                UNION ALL
+                SELECT 'nursing', inj.reception_user, COUNT(*),
+                       SUM(CASE WHEN i.status = 'closed' THEN inj.total_price END)
+                FROM injections inj LEFT JOIN invoices i ON i.id = inj.invoice_id
+                WHERE inj.work_date BETWEEN ? AND ?
+                GROUP BY inj.reception_user
+                UNION ALL
+                SELECT 'procedures', pr.reception_user, COUNT(*),
+                       SUM(CASE WHEN i.status = 'closed' THEN pr.price END)
+                FROM procedures pr LEFT JOIN invoices i ON i.id = pr.invoice_id
+                WHERE pr.work_date BETWEEN ? AND ?
+                GROUP BY pr.reception_user
+                UNION ALL
+                SELECT 'consumables_' || cl.category, cl.reception_user, COUNT(*), 0
+                FROM consumables_ledger cl
+                WHERE cl.work_date BETWEEN ? AND ? AND cl.category IN ('supply', 'drug')
+                  AND (cl.patient_provided = 0 OR COALESCE(cl.is_exception, 0) = 1)
+                GROUP BY cl.category, cl.reception_user
+            """, rng * 5)
+            users = db.execute(
+                "SELECT username, full_name FROM users WHERE role = 'reception' ORDER BY full_name"
+            ).fetchall()
+            for u in users:
+                uname = u['username']
+                if user_filter and uname != user_filter:
+                    continue
+                s = stats.get(uname, {})
+                count = {kind: s.get(kind, (0, 0))[0] for kind in (
+                    'invoices', 'visits', 'nursing', 'procedures', 'consumables_supply', 'consumables_drug'
+                )}
+                results.append({
+                    'user': uname,
+                    'full_name': u['full_name'],
+                    'role': 'reception',
+                    'role_fa': 'پذیرش',
+                    **count,
+                    'revenue': sum(s.get(kind, (0, 0))[1] for kind in ('visits', 'nursing', 'procedures')),
+                })
+
+        # ===== پزشکان =====
+        if not role_filter or role_filter == 'doctor':
+            stats = grouped("""
+                SELECT 'visits' AS kind, v.doctor_id AS k, COUNT(*) AS cnt,
+                       SUM(CASE WHEN i.status = 'closed' THEN v.price END) AS rev
+                FROM visits v LEFT JOIN invoices i ON i.id = v.invoice_id
+                WHERE v.doctor_id IS NOT NULL AND v.work_date BETWEEN ? AND ?
+                GROUP BY v.doctor_id
+                UNION ALL
+                -- خدمات پرستاری تحت نظر پزشک - فقط وقتی در همان فاکتور ویزیت همان پزشک هست
+                SELECT 'nursing', inj.doctor_id, COUNT(*),
+                       SUM(CASE WHEN i.status = 'closed' THEN inj.total_price END)
+                FROM injections inj LEFT JOIN invoices i ON i.id = inj.invoice_id
+                WHERE inj.doctor_id IS NOT NULL AND inj.work_date BETWEEN ? AND ?
+                  AND EXISTS (SELECT 1 FROM visits v WHERE v.invoice_id = inj.invoice_id AND v.doctor_id = inj.doctor_id)
+                GROUP BY inj.doctor_id
+                UNION ALL
+                SELECT 'procedures', pr.doctor_id, COUNT(*),
+                       SUM(CASE WHEN i.status = 'closed' THEN pr.price END)
+                FROM procedures pr LEFT JOIN invoices i ON i.id = pr.invoice_id
+                WHERE pr.doctor_id IS NOT NULL AND pr.performer_type = 'doctor' AND pr.work_date BETWEEN ? AND ?
+                GROUP BY pr.doctor_id
+            """, rng * 3)
+            results.extend(self._staff_rows(db, 'doctor', 'پزشک', stats, user_filter))
+
+        # ===== پرستاران =====
+        if not role_filter or role_filter == 'nurse':
+            stats = grouped("""
+                SELECT 'nursing' AS kind, inj.nurse_id AS k, COUNT(*) AS cnt,
+                       SUM(CASE WHEN i.status = 'closed' THEN inj.total_price END) AS rev
+                FROM injections inj LEFT JOIN invoices i ON i.id = inj.invoice_id
+                WHERE inj.nurse_id IS NOT NULL AND inj.work_date BETWEEN ? AND ?
+                GROUP BY inj.nurse_id
+                UNION ALL
+                SELECT 'procedures', pr.nurse_id, COUNT(*),
+                       SUM(CASE WHEN i.status = 'closed' THEN pr.price END)
+                FROM procedures pr LEFT JOIN invoices i ON i.id = pr.invoice_id
+                WHERE pr.nurse_id IS NOT NULL AND pr.performer_type = 'nurse' AND pr.work_date BETWEEN ? AND ?
+                GROUP BY pr.nurse_id
+            """, rng * 2)
+            results.extend(self._staff_rows(db, 'nurse', 'پرستار', stats, user_filter))
+
+        return results
+
+    def _staff_rows(self, db, staff_type: str, role_fa: str, stats: Dict,
+                    user_filter: Optional[str]) -> List[Dict]:
+        rows = []
+        staff = db.execute(
+            "SELECT id, full_name FROM medical_staff WHERE staff_type = ? ORDER BY full_name", (staff_type,)
+        ).fetchall()
+        for person in staff:
+            if user_filter and str(person['id']) != user_filter:
+                continue
+            s = stats.get(person['id'], {})
+            visits = s.get('visits', (0, 0))
+            nursing = s.get('nursing', (0, 0))
+            procedures = s.get('procedures', (0, 0))
+            rows.append({
+                'user': str(person['id']),
+                'full_name': person['full_name'],
+                'role': staff_type,
+                'role_fa': role_fa,
+                'invoices': 0,
+                'visits': visits[0],
+                'nursing': nursing[0],
+                'procedures': procedures[0],
+                'consumables': 0,
+                'revenue': visits[1] + nursing[1] + procedures[1],
+            })
+        return rows
+
+    def users_export_rows(self, start_date: str, end_date: str,
+                          role_filter: Optional[str] = None,
+                          user_filter: Optional[str] = None) -> List[list]:
+        """Rows of the users CSV export (users_report.csv).
+
+        Same columns and attribution as the export always had: every user is
+        credited with the invoices they opened (`invoices.opened_by`), staff by
+        doctor_id / nurse_id. One grouped query per role instead of a handful
+        of queries per person.
+        """
+        db = get_db()
+        rows: List[list] = []
+        rng = (start_date, end_date)
+
+        def grouped(sql: str, params: tuple) -> Dict:
+            # {key: {kind: value}}
+            out: Dict = {}
+            for r in db.execute(sql, params).fetchall():
+                out.setdefault(r['k'], {})[r['kind']] = r['val'] or 0
+            return out
+
+        # پذیرش: همه کاربران، بر اساس کسی که فاکتور را باز کرده
+        if not role_filter or role_filter == 'reception':
+            stats = grouped("""
+                SELECT 'invoices' AS kind, opened_by AS k, COUNT(*) AS val
+                FROM invoices WHERE work_date BETWEEN ? AND ?
+                GROUP BY opened_by
+                UNION ALL
+                SELECT 'visits', i.opened_by, COUNT(*)
+                FROM visits v JOIN invoices i ON i.id = v.invoice_id
+                WHERE v.work_date BETWEEN ? AND ?
+                GROUP BY i.opened_by
+                UNION ALL
+                SELECT 'nursing', i.opened_by, COUNT(*)
+                FROM injections inj JOIN invoices i ON i.id = inj.invoice_id
+                WHERE inj.work_date BETWEEN ? AND ?
+                GROUP BY i.opened_by
+                UNION ALL
+                SELECT 'procedures', i.opened_by, COUNT(*)
+                FROM procedures pr JOIN invoices i ON i.id = pr.invoice_id
+                WHERE pr.work_date BETWEEN ? AND ?
+                GROUP BY i.opened_by
+                UNION ALL
+                SELECT 'consumables', i.opened_by, COUNT(*)
+                FROM consumables_ledger cl JOIN invoices i ON i.id = cl.invoice_id
+                WHERE cl.work_date BETWEEN ? AND ?
+                  AND (cl.patient_provided = 0 OR COALESCE(cl.is_exception, 0) = 1)
+                GROUP BY i.opened_by
+                UNION ALL
+                -- Revenue = visits + injections + procedures (NOT consumables), by invoice work_date
+                SELECT 'visits_rev', i.opened_by, SUM(v.price)
+                FROM visits v JOIN invoices i ON i.id = v.invoice_id
+                WHERE i.work_date BETWEEN ? AND ? AND i.status = 'closed'
+                GROUP BY i.opened_by
+                UNION ALL
+                SELECT 'nursing_rev', i.opened_by, SUM(inj.total_price)
+                FROM injections inj JOIN invoices i ON i.id = inj.invoice_id
+                WHERE i.work_date BETWEEN ? AND ? AND i.status = 'closed'
+                GROUP BY i.opened_by
+                UNION ALL
+                SELECT 'procedures_rev', i.opened_by, SUM(pr.price)
+                FROM procedures pr JOIN invoices i ON i.id = pr.invoice_id
+                WHERE i.work_date BETWEEN ? AND ? AND i.status = 'closed'
+                GROUP BY i.opened_by
+            """, rng * 8)
+            for u in db.execute("SELECT username, full_name FROM users ORDER BY full_name").fetchall():
+                uname = u['username']
+                if user_filter and uname != user_filter:
+                    continue
+                s = stats.get(uname, {})
+                rows.append([uname, u['full_name'], 'پذیرش', s.get('invoices', 0), s.get('visits', 0),
+                             s.get('nursing', 0), s.get('procedures', 0), s.get('consumables', 0),
+                             s.get('visits_rev', 0) + s.get('nursing_rev', 0) + s.get('procedures_rev', 0)])
+
+        # پزشکان
+        if not role_filter or role_filter == 'doctor':
+            stats = grouped("""
+                SELECT 'visits' AS kind, doctor_id AS k, COUNT(*) AS val
+                FROM visits WHERE doctor_id IS NOT NULL AND work_date BETWEEN ? AND ?
+                GROUP BY doctor_id
+                UNION ALL
+                SELECT 'visits_rev', v.doctor_id, SUM(v.price)
+                FROM visits v JOIN invoices i ON i.id = v.invoice_id AND i.status = 'closed'
+                WHERE v.doctor_id IS NOT NULL AND v.work_date BETWEEN ? AND ?
+                GROUP BY v.doctor_id
+                UNION ALL
+                SELECT 'nursing', doctor_id, COUNT(*)
+                FROM injections WHERE doctor_id IS NOT NULL AND work_date BETWEEN ? AND ?
+                GROUP BY doctor_id
+                UNION ALL
+                SELECT 'nursing_rev', inj.doctor_id, SUM(inj.total_price)
+                FROM injections inj JOIN invoices i ON i.id = inj.invoice_id AND i.status = 'closed'
+                WHERE inj.doctor_id IS NOT NULL AND inj.work_date BETWEEN ? AND ?
+                GROUP BY inj.doctor_id
+                UNION ALL
+                SELECT 'procedures', doctor_id, COUNT(*)
+                FROM procedures
+                WHERE doctor_id IS NOT NULL AND performer_type = 'doctor' AND work_date BETWEEN ? AND ?
+                GROUP BY doctor_id
+                UNION ALL
+                SELECT 'procedures_rev', pr.doctor_id, SUM(pr.price)
+                FROM procedures pr JOIN invoices i ON i.id = pr.invoice_id AND i.status = 'closed'
+                WHERE pr.doctor_id IS NOT NULL AND pr.performer_type = 'doctor' AND pr.work_date BETWEEN ? AND ?
+                GROUP BY pr.doctor_id
+            """, rng * 6)
+            for doc in db.execute(
+                "SELECT id, full_name FROM medical_staff WHERE staff_type='doctor' ORDER BY full_name"
+            ).fetchall():
+                if user_filter and str(doc['id']) != user_filter:
+                    continue
+                s = stats.get(doc['id'], {})
+                rows.append([str(doc['id']), doc['full_name'], 'پزشک', 0, s.get('visits', 0),
+                             s.get('nursing', 0), s.get('procedures', 0), 0,
+                             s.get('visits_rev', 0) + s.get('nursing_rev', 0) + s.get('procedures_rev', 0)])
+
+        # پرستاران
+        if not role_filter or role_filter == 'nurse':
+            stats = grouped("""
+                SELECT 'nursing' AS kind, nurse_id AS k, COUNT(*) AS val
+                FROM injections WHERE nurse_id IS NOT NULL AND work_date BETWEEN ? AND ?
+                GROUP BY nurse_id
+                UNION ALL
+                SELECT 'nursing_rev', inj.nurse_id, SUM(inj.total_price)
+                FROM injections inj JOIN invoices i ON i.id = inj.invoice_id AND i.status = 'closed'
+                WHERE inj.nurse_id IS NOT NULL AND inj.work_date BETWEEN ? AND ?
+                GROUP BY inj.nurse_id
+                UNION ALL
+                SELECT 'procedures', nurse_id, COUNT(*)
+                FROM procedures
+                WHERE nurse_id IS NOT NULL AND performer_type = 'nurse' AND work_date BETWEEN ? AND ?
+                GROUP BY nurse_id
+                UNION ALL
+                SELECT 'procedures_rev', pr.nurse_id, SUM(pr.price)
+                FROM procedures pr JOIN invoices i ON i.id = pr.invoice_id AND i.status = 'closed'
+                WHERE pr.nurse_id IS NOT NULL AND pr.performer_type = 'nurse' AND pr.work_date BETWEEN ? AND ?
+                GROUP BY pr.nurse_id
+            """, rng * 4)
+            for nurse in db.execute(
+                "SELECT id, full_name FROM medical_staff WHERE staff_type='nurse' ORDER BY full_name"
+            ).fetchall():
+                if user_filter and str(nurse['id']) != user_filter:
+                    continue
+                s = stats.get(nurse['id'], {})
+                rows.append([str(nurse['id']), nurse['full_name'], 'پرستار', 0, 0,
+                             s.get('nursing', 0), s.get('procedures', 0), 0,
+                             s.get('nursing_rev', 0) + s.get('procedures_rev', 0)])
+
+        return rows
@@ -36,9 +36,13 @@ CREATE TABLE IF NOT EXISTS patients (
     address TEXT,
     is_foreign INTEGER DEFAULT 0,
     created_by TEXT,
+    -- بیمه آخرین فاکتور؛ با trigger روی invoices به‌روز می‌شود (patient_search.py)
+    last_invoice_insurance TEXT,
     created_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes')),
     updated_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes'))
 );
+-- ایندکس جستجوی بیمار (patients_fts, FTS5) و triggerهای آن در get_db ساخته می‌شوند:
+-- src/adapters/sqlite/patient_search.py
 
 -- Visit Tariffs (pricing for different insurance types)
 CREATE TABLE IF NOT EXISTS visit_tariffs (
@@ -317,6 +321,25 @@ CREATE TABLE IF NOT EXISTS settings (
     updated_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes'))
 );
 
+-- Daily stats rollup (خلاصه آمار روزانه به تفکیک شیفت)
+-- Materialized KPIs for dashboard/charts; kept in sync by DailyStatsRepository
+CREATE TABLE IF NOT EXISTS daily_stats (
+    work_date TEXT NOT NULL,             -- YYYY-MM-DD
+    shift TEXT NOT NULL DEFAULT '',      -- 'morning', 'evening', 'night' ('' = unknown)
+    invoices_count INTEGER DEFAULT 0,
+    closed_invoices_count INTEGER DEFAULT 0,
+    visits_count INTEGER DEFAULT 0,
+    injections_count INTEGER DEFAULT 0,
+    nursing_count INTEGER DEFAULT 0,
+    procedures_count INTEGER DEFAULT 0,
+    consumables_count INTEGER DEFAULT 0,
+    visits_revenue REAL DEFAULT 0,
+    injections_revenue REAL DEFAULT 0,
+    procedures_revenue REAL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes')),
+    PRIMARY KEY (work_date, shift)
+);
+
 -- =====================================================
 -- PERFORMANCE INDEXES (critical for fast queries)
 -- =====================================================
@@ -326,6 +349,7 @@ CREATE INDEX IF NOT EXISTS idx_invoices_status ON invoices (status);
 CREATE INDEX IF NOT EXISTS idx_invoices_work_date ON invoices (work_date);
 CREATE INDEX IF NOT EXISTS idx_invoices_patient_id ON invoices (patient_id);
 CREATE INDEX IF NOT EXISTS idx_invoices_status_opened_at ON invoices (status, opened_at DESC);
+CREATE INDEX IF NOT EXISTS idx_invoices_opened_at ON invoices (opened_at DESC);
 
 -- Visits: frequently joined/filtered by invoice_id, work_date
 CREATE INDEX IF NOT EXISTS idx_visits_invoice_id ON visits (invoice_id);
@@ -336,21 +360,25 @@ CREATE INDEX IF NOT EXISTS idx_visits_patient_id ON visits (patient_id);
 CREATE INDEX IF NOT EXISTS idx_injections_invoice_id ON injections (invoice_id);
 CREATE INDEX IF NOT EXISTS idx_injections_work_date ON injections (work_date);
 CREATE INDEX IF NOT EXISTS idx_injections_patient_id ON injections (patient_id);
+CREATE INDEX IF NOT EXISTS idx_injections_nurse_id ON injections (nurse_id, work_date, invoice_id);
 
 -- Procedures: frequently joined/filtered by invoice_id, work_date
 CREATE INDEX IF NOT EXISTS idx_procedures_invoice_id ON procedures (invoice_id);
 CREATE INDEX IF NOT EXISTS idx_procedures_work_date ON procedures (work_date);
 CREATE INDEX IF NOT EXISTS idx_procedures_patient_id ON procedures (patient_id);
+CREATE INDEX IF NOT EXISTS idx_procedures_nurse_id ON procedures (nurse_id, work_date, invoice_id);
 
 -- Consumables: frequently joined/filtered by invoice_id, work_date
 CREATE INDEX IF NOT EXISTS idx_consumables_invoice_id ON consumables_ledger (invoice_id);
 CREATE INDEX IF NOT EXISTS idx_consumables_work_date ON consumables_ledger (work_date);
+CREATE INDEX IF NOT EXISTS idx_consumables_patient_id ON consumables_ledger (patient_id);
 
 -- Patients: frequently searched by national_id
 CREATE INDEX IF NOT EXISTS idx_patients_national_id ON patients (national_id);
 
 -- Activity logs: frequently filtered by date, user, category
 CREATE INDEX IF NOT EXISTS idx_activity_logs_created_at ON activity_logs (created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_activity_logs_created_id ON activity_logs (created_at DESC, id DESC);
 CREATE INDEX IF NOT EXISTS idx_activity_logs_user_id ON activity_logs (user_id);
 CREATE INDEX IF NOT EXISTS idx_activity_logs_invoice_id ON activity_logs (invoice_id);
 
@@ -359,3 +387,4 @@ CREATE INDEX IF NOT EXISTS idx_medical_staff_type_active ON medical_staff (staff
 
 -- Payments: frequently queried by invoice_id
 CREATE INDEX IF NOT EXISTS idx_payments_invoice_id ON invoice_item_payments (invoice_id);
+CREATE INDEX IF NOT EXISTS idx_payments_item ON invoice_item_payments (item_type, item_id);
@@ -0,0 +1,124 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+
+from flask import g
+
+from src.adapters.sqlite.core import get_db
+from src.config.settings import Config
+from src.domain.billing import TariffSnapshot
+
+
+# کلید شمارنده نسل تعرفه‌ها در جدول settings
+TARIFF_GENERATION_KEY = 'tariff_generation'
+
+
+@dataclass
+class TariffData:
+    """Immutable-by-convention copy of all tariff tables for one generation.
+
+    Shared between threads: callers must copy rows before modifying them.
+    """
+    generation: str
+    visit_tariffs: List[Dict] = field(default_factory=list)
+    nursing_services: List[Dict] = field(default_factory=list)
+    procedure_tariffs: List[Dict] = field(default_factory=list)
+    consumable_tariffs: List[Dict] = field(default_factory=list)
+    # insurance_type -> nursing service ids NOT covered by that insurance
+    exclusions: Dict[str, Set[int]] = field(default_factory=dict)
+    snapshot: TariffSnapshot = field(default_factory=TariffSnapshot)
+
+    def base_tariff(self, active_only: bool = True) -> Optional[Dict]:
+        """Base (آزاد) visit tariff row: `is_base_tariff` first, then insurance 'آزاد'."""
+        rows = [r for r in self.visit_tariffs if r.get('is_active') == 1 or not active_only]
+        row = next((r for r in rows if r.get('is_base_tariff') == 1), None)
+        if row is None:
+            row = next((r for r in rows if r['insurance_type'] == 'آزاد'), None)
+        return row
+
+    def is_excluded(self, insurance_type: Optional[str], service_id) -> bool:
+        """True if the nursing service is excluded (not covered) for the insurance."""
+        if not insurance_type or service_id is None:
+            return False
+        return int(service_id) in self.exclusions.get(insurance_type, ())
+
+
+def _load(db, generation: str) -> TariffData:
+    visit_tariffs = [dict(r) for r in db.execute("SELECT * FROM visit_tariffs ORDER BY id").fetchall()]
+    exclusion_rows = db.execute(
+        "SELECT insurance_type, nursing_service_id FROM insurance_nursing_exclusions"
+    ).fetchall()
+    exclusions: Dict[str, Set[int]] = {}
+    for r in exclusion_rows:
+        exclusions.setdefault(r['insurance_type'], set()).add(r['nursing_service_id'])
+    return TariffData(
+        generation=generation,
+        visit_tariffs=visit_tariffs,
+        nursing_services=[dict(r) for r in db.execute("SELECT * FROM nursing_services ORDER BY id").fetchall()],
+        procedure_tariffs=[dict(r) for r in db.execute("SELECT * FROM procedure_tariffs ORDER BY id").fetchall()],
+        consumable_tariffs=[dict(r) for r in db.execute("SELECT * FROM consumable_tariffs ORDER BY id").fetchall()],
+        exclusions=exclusions,
+        snapshot=TariffSnapshot.from_rows(visit_tariffs, exclusion_rows),
+    )
+
+
+def read_generation(db) -> str:
+    row = db.execute("SELECT value FROM settings WHERE key = ?", (TARIFF_GENERATION_KEY,)).fetchone()
+    return row['value'] if row and row['value'] is not None else '0'
+
+
+class TariffCache:
+    """Process-wide tariff cache, refreshed lazily when the generation in `settings` changes.
+
+    The generation is read at most once per request (memoized on `g`), so a
+    request costs one tiny indexed lookup instead of a tariff query per item.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data: Optional[TariffData] = None
+        self._db_path: Optional[str] = None
+
+    def get(self) -> TariffData:
+        data = g.get('_tariff_data')
+        if data is not None:
+            return data
+        db = get_db()
+        generation = read_generation(db)
+        with self._lock:
+            data = self._data
+            if data is None or data.generation != generation or self._db_path != Config.DATABASE_PATH:
+                data = _load(db, generation)
+                self._data = data
+                self._db_path = Config.DATABASE_PATH
+        g._tariff_data = data
+        return data
+
+    def invalidate(self) -> None:
+        """Drop cached data in this process (e.g. after the DB file was replaced)."""
+        with self._lock:
+            self._data = None
+        g.pop('_tariff_data', None)
+
+
+tariff_cache = TariffCache()
+
+
+def get_tariffs() -> TariffData:
+    """Current tariff data (cached)."""
+    return tariff_cache.get()
+
+
+def bump_tariff_generation(db) -> None:
+    """Mark tariffs as changed so every worker reloads them.
+
+    Runs inside the caller's transaction; the caller commits together with
+    the tariff change itself.
+    """
+    db.execute("""
+        INSERT INTO settings (key, value) VALUES (?, '1')
+        ON CONFLICT(key) DO UPDATE SET
+            value = CAST(COALESCE(value, '0') AS INTEGER) + 1,
+            updated_at = datetime('now', '+3 hours', '+30 minutes')
+    """, (TARIFF_GENERATION_KEY,))
+    tariff_cache.invalidate()
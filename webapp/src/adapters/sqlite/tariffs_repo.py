@@ -1,5 +1,6 @@
 from typing import Optional, List, Dict
 from src.adapters.sqlite.core import get_db
+from src.adapters.sqlite.tariff_cache import get_tariffs
 
 
 class TariffRepository:
@@ -32,25 +33,20 @@ class TariffRepository:
     
     def get_active_visit_tariffs(self) -> List[Dict]:
         """Get active visit tariffs (insurance types with prices)."""
-        db = get_db()
-        # Query visit_tariffs table for active tariffs
-        rows = db.execute("""
-            SELECT insurance_type, tariff_price 
-            FROM visit_tariffs 
-            WHERE is_active = 1 AND COALESCE(is_supplementary, 0) = 0
-            ORDER BY insurance_type
-        """).fetchall()
+        rows = [
+            r for r in get_tariffs().visit_tariffs
+            if r['is_active'] == 1 and not (r.get('is_supplementary') or 0)
+        ]
+        rows.sort(key=lambda r: r['insurance_type'])
         return [{'insurance_type': r['insurance_type'], 'tariff_price': r['tariff_price']} for r in rows]
 
     def get_active_supplementary_insurances(self) -> List[Dict]:
         """Get active supplementary insurance names (for 'بیمه تکمیلی' dropdown)."""
-        db = get_db()
-        rows = db.execute("""
-            SELECT insurance_type, tariff_price, nursing_tariff, is_active
-            FROM visit_tariffs
-            WHERE is_active = 1 AND COALESCE(is_supplementary, 0) = 1
-            ORDER BY insurance_type
-        """).fetchall()
+        rows = [
+            r for r in get_tariffs().visit_tariffs
+            if r['is_active'] == 1 and (r.get('is_supplementary') or 0) == 1
+        ]
+        rows.sort(key=lambda r: r['insurance_type'])
         return [
             {
                 'insurance_type': r['insurance_type'],
@@ -60,15 +56,16 @@ class TariffRepository:
             } for r in rows
         ]
     
+    def _find_visit_tariff(self, insurance_type: str, supplementary: bool) -> Optional[Dict]:
+        return next((
+            r for r in get_tariffs().visit_tariffs
+            if r['insurance_type'] == insurance_type and r['is_active'] == 1
+            and bool(r.get('is_supplementary') or 0) == supplementary
+        ), None)
+
     def get_visit_tariff_by_insurance(self, insurance_type: str) -> Optional[float]:
         """Get visit price for specific insurance type."""
-        db = get_db()
-        row = db.execute("""
-            SELECT tariff_price 
-            FROM visit_tariffs 
-            WHERE insurance_type = ? AND is_active = 1 AND COALESCE(is_supplementary, 0) = 0
-            LIMIT 1
-        """, (insurance_type,)).fetchone()
+        row = self._find_visit_tariff(insurance_type, supplementary=False)
         return float(row['tariff_price']) if row else 0.0
 
     def resolve_visit_price(self, insurance_type: Optional[str], supplementary_insurance: Optional[str]) -> float:
@@ -80,10 +77,8 @@ class TariffRepository:
         """
         # If a supplementary insurance is provided and exists in visit_tariffs, prefer its tariff_price
         if supplementary_insurance and supplementary_insurance.strip():
-            row = db = None
             try:
-                db = get_db()
-                r = db.execute("SELECT tariff_price FROM visit_tariffs WHERE insurance_type = ? AND is_active = 1 AND COALESCE(is_supplementary,0) = 1 LIMIT 1", (supplementary_insurance,)).fetchone()
+                r = self._find_visit_tariff(supplementary_insurance, supplementary=True)
                 if r and r['tariff_price'] is not None:
                     return float(r['tariff_price'])
             except Exception:
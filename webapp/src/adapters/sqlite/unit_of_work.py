@@ -0,0 +1,152 @@
+"""
+Unit of Work
+یک تراکنش برای کل یک عملیات پذیرش (ثبت بیمار + فاکتور + ویزیت + لاگ) - یک commit به‌جای چند commit
+
+Repositories keep calling ``db.commit()``; inside a unit that call is a no-op
+on the request connection (``ClinicConnection``) and the unit commits once
+at the end. The write lock is taken up front with ``BEGIN IMMEDIATE`` so a
+busy database fails fast at the start (and is retried with backoff) instead
+of in the middle of the action.
+"""
+
+import random
+import sqlite3
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable
+
+from flask import request
+
+from src.adapters.sqlite.core import get_db
+from src.common.metrics import metrics
+from src.config.settings import Config
+
+busy_retries = metrics.counter('clinic_db_busy_retries_total', 'Transactions retried after SQLITE_BUSY.')
+busy_errors = metrics.counter('clinic_db_busy_errors_total', 'Transactions that gave up on SQLITE_BUSY after all retries.')
+lock_wait = metrics.histogram('clinic_db_lock_wait_seconds', 'Time to acquire the write lock (BEGIN IMMEDIATE, including busy_timeout waits).')
+
+
+def _is_busy(exc: Exception) -> bool:
+    msg = str(exc).lower()
+    return isinstance(exc, sqlite3.OperationalError) and ('locked' in msg or 'busy' in msg)
+
+
+def _with_busy_retry(fn: Callable, *args):
+    """Run ``fn`` and retry on SQLITE_BUSY with exponential backoff + jitter."""
+    retries = int(getattr(Config, 'DB_TX_RETRIES', 5))
+    backoff = getattr(Config, 'DB_TX_BACKOFF_MS', 25) / 1000.0
+    attempt = 0
+    while True:
+        try:
+            return fn(*args)
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e):
+                raise
+            if attempt >= retries:
+                busy_errors.inc()
+                raise
+            busy_retries.inc()
+            time.sleep(backoff * (2 ** attempt) * (1 + random.random()))
+            attempt += 1
+
+
+def _begin(db) -> None:
+    if db.in_transaction:
+        # تغییرات commit نشده قبلی (خارج از unit) را جدا ذخیره می‌کنیم
+        sqlite3.Connection.commit(db)
+    started = time.perf_counter()
+    try:
+        db.execute("BEGIN IMMEDIATE")
+    finally:
+        lock_wait.observe(time.perf_counter() - started)
+
+
+@contextmanager
+def unit_of_work():
+    """Request-scoped transaction that repositories join.
+
+    Nested units join the outermost one. The outermost unit commits once on
+    success; an exception or any repository ``rollback()`` rolls back the
+    whole unit. Callbacks registered with `after_commit` run only after a
+    successful commit.
+    """
+    db = get_db()
+    outermost = db.uow_depth == 0
+    if outermost:
+        _with_busy_retry(_begin, db)
+        db.uow_rollback_only = False
+        db.uow_after_commit = []
+    db.uow_depth += 1
+    try:
+        yield db
+    except BaseException:
+        db.uow_rollback_only = True
+        raise
+    finally:
+        db.uow_depth -= 1
+        if outermost:
+            callbacks, db.uow_after_commit = db.uow_after_commit, []
+            try:
+                if db.uow_rollback_only:
+                    sqlite3.Connection.rollback(db)
+                    callbacks = []
+                else:
+                    _with_busy_retry(sqlite3.Connection.commit, db)
+            except Exception:
+                sqlite3.Connection.rollback(db)
+                raise
+            finally:
+                db.uow_rollback_only = False
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"[UnitOfWork] after_commit callback failed: {e}")
+
+
+def in_unit_of_work() -> bool:
+    db = get_db()
+    return bool(getattr(db, 'uow_depth', 0))
+
+
+def fail() -> None:
+    """Mark the current unit rollback-only (no-op outside a unit).
+
+    Call it in a route's error branch before returning, so the unit rolls back
+    whatever the response looks like (e.g. flash + redirect with a 302).
+    """
+    db = get_db()
+    if getattr(db, 'uow_depth', 0):
+        db.uow_rollback_only = True
+
+
+def after_commit(callback: Callable[[], None]) -> None:
+    """Run ``callback`` after the current unit commits (immediately when there is no unit)."""
+    db = get_db()
+    if getattr(db, 'uow_depth', 0):
+        db.uow_after_commit.append(callback)
+    else:
+        callback()
+
+
+def transactional(view):
+    """Route decorator: run a write request (non-GET) inside one unit of work.
+
+    The unit rolls back on an exception, on a 4xx/5xx response, or when the
+    view called `fail()`; anything else commits.
+    """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if request.method in ('GET', 'HEAD', 'OPTIONS'):
+            return view(*args, **kwargs)
+        with unit_of_work():
+            response = view(*args, **kwargs)
+            # پاسخ خطا (4xx/5xx) یعنی عملیات ناقص - هیچ تغییری ذخیره نشود
+            status = getattr(response, 'status_code', None)
+            if isinstance(response, tuple) and len(response) > 1 and isinstance(response[1], int):
+                status = response[1]
+            if status is not None and status >= 400:
+                fail()
+            return response
+    return wrapped
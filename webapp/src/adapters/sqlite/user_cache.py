@@ -0,0 +1,69 @@
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from src.adapters.sqlite.core import get_db, pool_epoch
+from src.config.settings import Config
+
+
+class UserStateCache:
+    """Process-wide TTL cache of `users` rows and `user_active_shift` rows, keyed by user_id.
+
+    Removes the fixed per-request queries of `load_logged_in_user` and
+    `_ensure_user_shift_state`. Writers invalidate explicitly
+    (`invalidate_user`); the TTL (USER_CACHE_TTL_SECONDS) only bounds
+    staleness for edits made outside this process. Cached rows are dicts
+    shared between threads: callers must not modify them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (kind, user_id) -> (expires_at, epoch, value)
+        self._entries: Dict[Tuple[str, int], Tuple[float, int, object]] = {}
+        # هر invalidate یکی زیاد می‌کند؛ مقداری که حین invalidate خوانده شده ذخیره نمی‌شود
+        self._version = 0
+
+    def _get(self, kind: str, user_id: int, loader: Callable[[], object]):
+        key = (kind, int(user_id))
+        epoch = pool_epoch()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            version = self._version
+        if entry is not None and entry[0] > now and entry[1] == epoch:
+            return entry[2]
+        value = loader()
+        ttl = getattr(Config, 'USER_CACHE_TTL_SECONDS', 30)
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = (now + ttl, epoch, value)
+        return value
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        def load():
+            row = get_db().execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+            return dict(row) if row else None
+        return self._get('user', user_id, load)
+
+    def get_active_shift(self, user_id: int, loader: Callable[[], Optional[Dict]]) -> Optional[Dict]:
+        return self._get('shift', user_id, loader)
+
+    def invalidate_user(self, user_id: Optional[int] = None) -> None:
+        """Drop one user's entries, or everything when ``user_id`` is None."""
+        self._invalidate(('user', 'shift'), user_id)
+
+    def invalidate_shift(self, user_id: int) -> None:
+        """Drop only the cached active shift (shift switch / logout)."""
+        self._invalidate(('shift',), user_id)
+
+    def _invalidate(self, kinds, user_id: Optional[int]) -> None:
+        with self._lock:
+            self._version += 1
+            if user_id is None:
+                self._entries.clear()
+                return
+            for kind in kinds:
+                self._entries.pop((kind, int(user_id)), None)
+
+
+user_cache = UserStateCache()
@@ -12,52 +12,39 @@ from datetime import datetime, timedelta
 from src.common.utils import iran_now
 
 from src.adapters.sqlite.core import get_db
-
-# Module-level flag to track if table has been ensured in this process
-_table_ensured = False
+from src.adapters.sqlite.unit_of_work import after_commit
+from src.adapters.sqlite.user_cache import user_cache
+from src.common.event_hub import event_hub
 
 
 class UserShiftRepository:
     """Repository for user active shift management."""
 
-    def _ensure_table(self):
-        """Create table if not exists - only runs once per process."""
-        global _table_ensured
-        if _table_ensured:
-            return
-        db = get_db()
-        db.execute("""
-            CREATE TABLE IF NOT EXISTS user_active_shift (
-                user_id INTEGER PRIMARY KEY,
-                active_shift TEXT NOT NULL,
-                work_date TEXT NOT NULL,
-                shift_started_at TIMESTAMP DEFAULT (datetime('now', '+3 hours', '+30 minutes')),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        """)
-        db.commit()
-        _table_ensured = True
-
     def get_user_active_shift(self, user_id: int) -> Optional[Dict]:
         """
         Get the user's current active shift info.
         Returns dict with: active_shift, work_date, shift_started_at
         Returns None if user has no active shift record.
         """
-        self._ensure_table()
-        db = get_db()
-        row = db.execute(
-            "SELECT * FROM user_active_shift WHERE user_id = ?",
-            (user_id,)
-        ).fetchone()
-        return dict(row) if row else None
+        def load():
+            db = get_db()
+            row = db.execute(
+                "SELECT * FROM user_active_shift WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+            return dict(row) if row else None
+        return user_cache.get_active_shift(user_id, load)
+
+    def _invalidate(self, user_id: int) -> None:
+        # هم فوراً (ادامه همین درخواست) و هم بعد از commit (درخواست‌های همزمان)
+        user_cache.invalidate_shift(user_id)
+        after_commit(lambda: user_cache.invalidate_shift(user_id))
 
     def set_user_active_shift(self, user_id: int, shift: str, work_date: str) -> None:
         """
         Set/update the user's active shift.
         Called when user confirms shift change.
         """
-        self._ensure_table()
         db = get_db()
         now = iran_now().strftime('%Y-%m-%d %H:%M:%S')
         db.execute("""
@@ -69,6 +56,13 @@ class UserShiftRepository:
                 shift_started_at = excluded.shift_started_at
         """, (user_id, shift, work_date, now))
         db.commit()
+        self._invalidate(user_id)
+        # فقط تب‌های همین کاربر شیفتشان عوض می‌شود
+        after_commit(lambda: event_hub.publish('shift_changed', {
+            'active_shift': shift,
+            'work_date': work_date,
+            'shift_started_at': now,
+        }, user_id=user_id))
 
     def mark_shift_overdue(self, user_id: int) -> None:
         """No-op: manual shifts do not expire automatically."""
@@ -80,10 +74,10 @@ class UserShiftRepository:
 
     def clear_user_shift(self, user_id: int) -> None:
         """Remove user's active shift record (on logout)."""
-        self._ensure_table()
         db = get_db()
         db.execute("DELETE FROM user_active_shift WHERE user_id = ?", (user_id,))
         db.commit()
+        self._invalidate(user_id)
 
     def get_effective_shift_for_user(self, user_id: int) -> tuple[str, str, bool, bool]:
         """
@@ -96,8 +90,6 @@ class UserShiftRepository:
             - is_overdue: always False
             - should_prompt: always False
         """
-        self._ensure_table()
-
         now = iran_now()
         user_shift = self.get_user_active_shift(user_id)
         
@@ -1,5 +1,5 @@
 from flask import (
-    Blueprint, render_template, redirect, url_for, g
+    Blueprint, render_template, redirect, url_for, g, request, Response, abort
 )
 from src.api.auth import login_required
 
@@ -13,3 +13,18 @@ def index():
         return redirect(url_for('manager.index'))
     else:
         return redirect(url_for('reception.index'))
+
+
+@bp.route('/metrics')
+def metrics():
+    """Prometheus text exposition (localhost or manager only unless METRICS_ALLOW_REMOTE)."""
+    from src.config.settings import Config
+    from src.common.metrics import metrics as registry, CONTENT_TYPE
+
+    if not getattr(Config, 'METRICS_ENABLED', True):
+        abort(404)
+    local = request.remote_addr in ('127.0.0.1', '::1')
+    is_manager = g.user is not None and g.user['role'] == 'manager'
+    if not (local or is_manager or getattr(Config, 'METRICS_ALLOW_REMOTE', False)):
+        abort(403)
+    return Response(registry.render(), content_type=CONTENT_TYPE)
@@ -1,17 +1,29 @@
 from flask import (
-    Blueprint, render_template, request, flash, redirect, url_for, g, jsonify, Response, make_response, session, current_app
+    Blueprint, render_template, request, flash, redirect, url_for, g, jsonify, session, current_app
 )
 from src.api.auth import login_required
-from src.adapters.sqlite.core import get_db
+from src.adapters.sqlite.core import get_db, close_connection, replace_database
+from src.adapters.sqlite.log_archive import rotate_archive
+from src.adapters.sqlite.reports_repo import ReportsRepository, date_range_keys
+from src.adapters.sqlite.daily_stats_repo import DailyStatsRepository
+from src.adapters.sqlite.tariff_cache import bump_tariff_generation
+from src.adapters.sqlite.user_cache import user_cache
 from datetime import datetime, timedelta, date
 from src.common.jalali import Gregorian
 from src.common.utils import iran_now
+from src.common.csv_export import stream_csv_response, iter_cursor
+from src.services.activity_logger import flush_activity_logs
+from src.services.backup_service import (
+    backup_dependents, create_full_backup, materialize_backup, delete_backup, is_backup_file,
+    restore_log_archive
+)
 import jdatetime
-import csv
-import io
 
 bp = Blueprint('manager', __name__, url_prefix='/manager')
 
+# حداکثر ردیف جزئیات هر تب در صفحه معوقات بیمه (?detail=all برای همه)
+ARREARS_DETAIL_LIMIT = 500
+
 
 @bp.route('/')
 @login_required
@@ -29,38 +41,16 @@ def index():
     today_date = get_work_date_for_datetime()
     today_dt = datetime.strptime(today_date, '%Y-%m-%d')
     
-    # Today's invoices count
-    today_invoices = db.execute("""
-        SELECT COUNT(*) as count FROM invoices 
-        WHERE work_date = ?
-    """, (today_date,)).fetchone()['count']
+    # KPIهای امروز از جدول خلاصه daily_stats (به جای اسکن جداول اصلی)
+    stats_repo = DailyStatsRepository()
+    today_stats = stats_repo.get_totals(today_date, today_date)
+    today_invoices = today_stats['invoices_count']
     
     # Today's revenue (from closed invoices) - EXCLUDING consumables
     # درآمد = ویزیت + خدمات پرستاری + کارهای عملی (بدون مصرفی)
-    visits_today = db.execute("""
-        SELECT COALESCE(SUM(v.price), 0) as total 
-        FROM visits v
-        JOIN invoices i ON v.invoice_id = i.id
-        WHERE i.work_date = ? AND i.status = 'closed'
-    """, (today_date,)).fetchone()['total']
-    
-    injections_today = db.execute("""
-        SELECT COALESCE(SUM(inj.total_price), 0) as total 
-        FROM injections inj
-        JOIN invoices i ON inj.invoice_id = i.id
-        WHERE i.work_date = ? AND i.status = 'closed'
-    """, (today_date,)).fetchone()['total']
-    
-    procedures_today = db.execute("""
-        SELECT COALESCE(SUM(pr.price), 0) as total 
-        FROM procedures pr
-        JOIN invoices i ON pr.invoice_id = i.id
-        WHERE i.work_date = ? AND i.status = 'closed'
-    """, (today_date,)).fetchone()['total']
+    today_revenue = today_stats['revenue']
     
-    today_revenue = visits_today + injections_today + procedures_today
-    
-    # Today's unique patients
+    # Today's unique patients (distinct -> not additive, read from invoices index)
     today_patients = db.execute("""
         SELECT COUNT(DISTINCT patient_id) as count FROM invoices 
         WHERE work_date = ?
@@ -86,27 +76,12 @@ def index():
     # با استفاده از تابع کمکی که تاریخ کاری دستی را برمی‌گرداند
     
     # خدمات امروز
-    today_visits = db.execute("""
-        SELECT COUNT(*) as count FROM visits 
-        WHERE work_date = ?
-    """, (today_date,)).fetchone()['count']
-    
-    today_injections = db.execute("""
-        SELECT COUNT(*) as count FROM injections 
-        WHERE work_date = ?
-    """, (today_date,)).fetchone()['count']
-    
-    today_procedures = db.execute("""
-        SELECT COUNT(*) as count FROM procedures 
-        WHERE work_date = ?
-    """, (today_date,)).fetchone()['count']
+    today_visits = today_stats['visits_count']
+    today_injections = today_stats['injections_count']
+    today_procedures = today_stats['procedures_count']
     
     # شمارش خدمات پرستاری (از جدول injections که nurse_id دارد)
-    today_nursing = db.execute("""
-        SELECT COUNT(*) as count FROM injections 
-        WHERE work_date = ?
-        AND nurse_id IS NOT NULL
-    """, (today_date,)).fetchone()['count']
+    today_nursing = today_stats['nursing_count']
     
     # کادر درمان
     active_doctors = db.execute("""
@@ -142,35 +117,13 @@ def index():
     month_start = datetime(g_month_start.year, g_month_start.month, g_month_start.day)
     month_start_date = month_start.strftime('%Y-%m-%d')
     
-    month_invoices = db.execute("""
-        SELECT COUNT(*) as count FROM invoices 
-        WHERE work_date >= ?
-    """, (month_start_date,)).fetchone()['count']
+    # جمع ماه = چند ردیف ایندکس‌شده از daily_stats
+    month_stats = stats_repo.get_totals(month_start_date, '9999-12-31')
+    month_invoices = month_stats['invoices_count']
     
     # Month revenue - EXCLUDING consumables
     # درآمد = ویزیت + خدمات پرستاری + کارهای عملی (بدون مصرفی)
-    visits_month = db.execute("""
-        SELECT COALESCE(SUM(v.price), 0) as total 
-        FROM visits v
-        JOIN invoices i ON v.invoice_id = i.id
-        WHERE i.work_date >= ? AND i.status = 'closed'
-    """, (month_start_date,)).fetchone()['total']
-    
-    injections_month = db.execute("""
-        SELECT COALESCE(SUM(inj.total_price), 0) as total 
-        FROM injections inj
-        JOIN invoices i ON inj.invoice_id = i.id
-        WHERE i.work_date >= ? AND i.status = 'closed'
-    """, (month_start_date,)).fetchone()['total']
-    
-    procedures_month = db.execute("""
-        SELECT COALESCE(SUM(pr.price), 0) as total 
-        FROM procedures pr
-        JOIN invoices i ON pr.invoice_id = i.id
-        WHERE i.work_date >= ? AND i.status = 'closed'
-    """, (month_start_date,)).fetchone()['total']
-    
-    month_revenue = visits_month + injections_month + procedures_month
+    month_revenue = month_stats['revenue']
     
     avg_daily = month_revenue / 30 if month_revenue > 0 else 0
 
@@ -417,21 +370,18 @@ def export_invoices_csv():
         LEFT JOIN users u_close ON u_close.username = i.closed_by
         WHERE {where_sql}
         ORDER BY i.opened_at DESC
-    ''', params).fetchall()
+    ''', params)
 
-    output = io.StringIO(); output.write('\ufeff')
-    writer = csv.writer(output)
-    writer.writerow(['شماره فاکتور', 'زمان باز شدن', 'زمان بستن', 'وضعیت', 'مبلغ کل', 'بیمه', 'بیمه تکمیلی', 'پذیرش', 'بستن توسط', 'بیمار'])
-    for r in rows:
-        writer.writerow([
+    data = (
+        [
             r['id'], r['opened_at'] or '', r['closed_at'] or '', r['status'] or '',
             int(r['total_amount'] or 0), r['insurance_type'] or '', r['supplementary_insurance'] or '',
-            (r.get('opened_by_name') or r.get('opened_by') or ''), (r.get('closed_by_name') or r.get('closed_by') or ''), r['patient_name'] or ''
-        ])
-    resp = make_response(output.getvalue())
-    resp.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    resp.headers['Content-Disposition'] = 'attachment; filename="invoices_report.csv"'
-    return resp
+            (r['opened_by_name'] or r['opened_by'] or ''), (r['closed_by_name'] or r['closed_by'] or ''), r['patient_name'] or ''
+        ]
+        for r in iter_cursor(rows)
+    )
+    headers = ['شماره فاکتور', 'زمان باز شدن', 'زمان بستن', 'وضعیت', 'مبلغ کل', 'بیمه', 'بیمه تکمیلی', 'پذیرش', 'بستن توسط', 'بیمار']
+    return make_csv_response(data, headers, 'invoices_report.csv')
 
 
 @bp.route('/staff')
@@ -517,7 +467,6 @@ def settings():
         return redirect(url_for('reception.index'))
     
     import os
-    import shutil
     from pathlib import Path
     from flask import current_app
     
@@ -532,12 +481,13 @@ def settings():
             # ایجاد بکاپ دستی
             try:
                 db_path = Path(current_app.config.get('DATABASE_PATH'))
-                timestamp = iran_now().strftime('%Y%m%d_%H%M%S')
-                backup_name = f"backup_{timestamp}.db"
-                backup_path = backup_dir / backup_name
-                
-                shutil.copy2(db_path, backup_path)
-                flash(f'بکاپ با موفقیت ایجاد شد: {backup_name}', 'success')
+                # بکاپ آنلاین (SQLite backup API) - پذیرش حین بکاپ متوقف نمی‌شود
+                backup_path = create_full_backup(
+                    db_path, backup_dir, 'backup',
+                    pages=current_app.config.get('BACKUP_PAGES_PER_STEP', 256),
+                    step_sleep=current_app.config.get('BACKUP_STEP_SLEEP_MS', 5) / 1000.0
+                )
+                flash(f'بکاپ با موفقیت ایجاد شد: {backup_path.name}', 'success')
             except Exception as e:
                 flash(f'خطا در ایجاد بکاپ: {str(e)}', 'error')
         
@@ -549,14 +499,29 @@ def settings():
                     backup_path = backup_dir / backup_name
                     db_path = Path(current_app.config.get('DATABASE_PATH'))
                     
-                    if backup_path.exists():
+                    if backup_path.exists() and is_backup_file(backup_name):
                         # ابتدا از دیتابیس فعلی بکاپ می‌گیریم
-                        timestamp = iran_now().strftime('%Y%m%d_%H%M%S')
-                        pre_restore_backup = backup_dir / f"pre_restore_{timestamp}.db"
-                        shutil.copy2(db_path, pre_restore_backup)
+                        create_full_backup(db_path, backup_dir, 'pre_restore')
                         
-                        # بازگردانی
-                        shutil.copy2(backup_path, db_path)
+                        # بکاپ فشرده/افزایشی ابتدا به یک فایل SQLite کامل تبدیل می‌شود
+                        restore_source = backup_path
+                        if not backup_name.endswith('.db'):
+                            restore_source = materialize_backup(backup_path, backup_dir / '.restore.db')
+                        
+                        # لاگ‌های صف پیش از بازگردانی در دیتابیس فعلی نوشته شوند
+                        flush_activity_logs()
+                        close_connection(None)
+                        
+                        # بازگردانی با backup API داخل همان فایل (نه کپی روی فایل در حالت WAL)
+                        replace_database(restore_source, db_path)
+                        if restore_source != backup_path:
+                            restore_source.unlink()
+                        # آرشیو لاگ‌ها هم از همان بکاپ (id لاگ‌ها به دیتابیس بازگردانی‌شده تعلق دارد)
+                        restore_log_archive(backup_path, db_path)
+                        # نسل تعرفه‌ها بالا می‌رود تا همه پروسه‌ها تعرفه‌های بکاپ را دوباره بخوانند
+                        restored_db = get_db()
+                        bump_tariff_generation(restored_db)
+                        restored_db.commit()
                         flash(f'دیتابیس با موفقیت بازگردانی شد از: {backup_name}', 'success')
                     else:
                         flash('فایل بکاپ یافت نشد', 'error')
@@ -569,9 +534,16 @@ def settings():
             if backup_name:
                 try:
                     backup_path = backup_dir / backup_name
-                    if backup_path.exists():
-                        backup_path.unlink()
-                        flash(f'بکاپ حذف شد: {backup_name}', 'success')
+                    if backup_path.exists() and is_backup_file(backup_name):
+                        # بکاپ‌های افزایشی بعدی بدون این فایل قابل بازگردانی نیستند
+                        dependents = backup_dependents(backup_path)
+                        if dependents:
+                            names = '، '.join(p.name for p in dependents)
+                            flash(f'این بکاپ پایه بکاپ‌های افزایشی بعدی است و حذف نشد. '
+                                  f'ابتدا این بکاپ‌ها را حذف کنید: {names}', 'error')
+                        else:
+                            delete_backup(backup_path)
+                            flash(f'بکاپ حذف شد: {backup_name}', 'success')
                     else:
                         flash('فایل بکاپ یافت نشد', 'error')
                 except Exception as e:
@@ -598,7 +570,8 @@ def settings():
     # دریافت لیست بکاپ‌ها
     backups = []
     if backup_dir.exists():
-        for f in sorted(backup_dir.glob('*.db'), key=lambda x: x.stat().st_mtime, reverse=True):
+        backup_files = (f for f in backup_dir.iterdir() if f.is_file() and is_backup_file(f.name))
+        for f in sorted(backup_files, key=lambda x: x.stat().st_mtime, reverse=True):
             stat = f.stat()
             # تبدیل تاریخ به شمسی
             mtime = datetime.fromtimestamp(stat.st_mtime)
@@ -682,17 +655,16 @@ def reset_database():
             # حالت سورس
             schema_path = Path(__file__).parent.parent / 'adapters' / 'sqlite' / 'schema.sql'
         
-        # بستن کانکشن فعلی
-        db = get_db()
-        db.close()
-        
-        # حذف فایل دیتابیس قدیمی
-        if db_path.exists():
-            os.remove(db_path)
+        flush_activity_logs()
+        close_connection(None)
         
-        # ایجاد دیتابیس جدید
+        # دیتابیس خالی جدید در یک فایل موقت ساخته و سپس با backup API جایگزین فایل فعلی می‌شود
+        # (فایل زنده حذف نمی‌شود: -wal/-shm باقی‌مانده و کانکشن‌های باز آن را خراب می‌کردند)
+        fresh_path = db_path.with_name('.reset.db')
+        if fresh_path.exists():
+            os.remove(fresh_path)
         import sqlite3
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(fresh_path)
         conn.row_factory = sqlite3.Row
         
         # اجرای schema
@@ -710,6 +682,15 @@ def reset_database():
         
         conn.commit()
         conn.close()
+        try:
+            replace_database(fresh_path, db_path)
+        finally:
+            os.remove(fresh_path)
+        # آرشیو لاگ‌های دیتابیس قبلی کنار گذاشته می‌شود (id ها از نو شروع می‌شوند)
+        rotate_archive(db_path)
+        new_db = get_db()
+        bump_tariff_generation(new_db)
+        new_db.commit()
         
         # لاگ اوت کردن کاربر فعلی
         session.clear()
@@ -733,7 +714,7 @@ def download_backup(backup_name):
     backup_dir = Path(__file__).parent.parent.parent / 'backups'
     backup_path = backup_dir / backup_name
     
-    if backup_path.exists() and backup_name.endswith('.db'):
+    if backup_path.exists() and is_backup_file(backup_name):
         return send_file(
             backup_path,
             as_attachment=True,
@@ -786,8 +767,6 @@ def chart_data():
     if g.user['role'] != 'manager':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    db = get_db()
-    
     # دریافت پارامترها
     date_from = request.args.get('from', '')  # فرمت: 1404/09/01
     date_to = request.args.get('to', '')      # فرمت: 1404/09/06
@@ -822,104 +801,19 @@ def chart_data():
         start_date, end_date = end_date, start_date
     
     # تولید لیست روزها
-    labels = []
-    values = []
-    visits_data = []
-    injections_data = []
-    procedures_data = []
-    current = start_date
-    
-    while current <= end_date:
-        next_day = current + timedelta(days=1)
-        day_key = current.strftime('%Y-%m-%d')
-        
-        # لیبل شمسی
-        labels.append(gregorian_to_jalali_label(current))
-        
-        # کوئری بر اساس نوع داده
-        if data_type == 'revenue':
-            # Revenue = visits + injections + procedures (NOT consumables)
-            v_rev = db.execute("""
-                SELECT COALESCE(SUM(v.price), 0) as val FROM visits v
-                JOIN invoices i ON v.invoice_id = i.id
-                WHERE i.work_date = ? AND i.status = 'closed'
-            """, (day_key,)).fetchone()['val']
-            inj_rev = db.execute("""
-                SELECT COALESCE(SUM(inj.total_price), 0) as val FROM injections inj
-                JOIN invoices i ON inj.invoice_id = i.id
-                WHERE i.work_date = ? AND i.status = 'closed'
-            """, (day_key,)).fetchone()['val']
-            pr_rev = db.execute("""
-                SELECT COALESCE(SUM(pr.price), 0) as val FROM procedures pr
-                JOIN invoices i ON pr.invoice_id = i.id
-                WHERE i.work_date = ? AND i.status = 'closed'
-            """, (day_key,)).fetchone()['val']
-            result = v_rev + inj_rev + pr_rev
-        
-        elif data_type == 'invoices':
-            result = db.execute("""
-                SELECT COUNT(*) as val FROM invoices 
-                WHERE work_date = ?
-            """, (day_key,)).fetchone()['val']
-        
-        elif data_type == 'patients':
-            result = db.execute("""
-                SELECT COUNT(DISTINCT patient_id) as val FROM invoices 
-                WHERE work_date = ?
-            """, (day_key,)).fetchone()['val']
-        
-        elif data_type == 'visits':
-            result = db.execute("""
-                SELECT COUNT(*) as val FROM visits 
-                WHERE work_date = ?
-            """, (day_key,)).fetchone()['val']
-        
-        elif data_type == 'injections':
-            result = db.execute("""
-                SELECT COUNT(*) as val FROM injections 
-                WHERE work_date = ?
-            """, (day_key,)).fetchone()['val']
-        
-        elif data_type == 'procedures':
-            result = db.execute("""
-                SELECT COUNT(*) as val FROM procedures 
-                WHERE work_date = ?
-            """, (day_key,)).fetchone()['val']
-        
-        elif data_type == 'consumables':
-            # Count only consumables provided by the center and not exception items
-            result = db.execute("""
-                SELECT COUNT(*) as val FROM consumables_ledger 
-                WHERE work_date = ? AND (COALESCE(patient_provided,0) = 0 AND COALESCE(is_exception,0) = 0)
-            """, (day_key,)).fetchone()['val']
-        
-        elif data_type == 'services':
-            # خدمات تفکیکی - برگرداندن هر سه نوع
-            visits_count = db.execute("""
-                SELECT COUNT(*) as val FROM visits 
-                WHERE work_date = ?
-            """, (day_key,)).fetchone()['val'] or 0
-            
-            injections_count = db.execute("""
-                SELECT COUNT(*) as val FROM injections 
-                WHERE work_date = ?
-            """, (day_key,)).fetchone()['val'] or 0
-            
-            procedures_count = db.execute("""
-                SELECT COUNT(*) as val FROM procedures 
-                WHERE work_date = ?
-            """, (day_key,)).fetchone()['val'] or 0
-            
-            visits_data.append(visits_count)
-            injections_data.append(injections_count)
-            procedures_data.append(procedures_count)
-            result = visits_count + injections_count + procedures_count
-        
-        else:
-            result = 0
-        
-        values.append(result or 0)
-        current = next_day
+    day_keys = date_range_keys(start_date.date(), end_date.date())
+    labels = [gregorian_to_jalali_label(datetime.strptime(k, '%Y-%m-%d')) for k in day_keys]
+    
+    # یک کوئری GROUP BY work_date برای هر متریک (به جای چند کوئری برای هر روز)
+    reports_repo = ReportsRepository()
+    if data_type == 'services':
+        breakdown = reports_repo.services_breakdown(day_keys)
+        visits_data = breakdown['visits']
+        injections_data = breakdown['injections']
+        procedures_data = breakdown['procedures']
+        values = [a + b + c for a, b, c in zip(visits_data, injections_data, procedures_data)]
+    else:
+        values = reports_repo.daily_series(data_type, day_keys)
     
     # اگر نوع services بود، داده‌های تفکیکی برگردان
     if data_type == 'services':
@@ -1378,175 +1272,7 @@ def users_report():
     start_date = start_dt.strftime('%Y-%m-%d')
     end_date = end_dt.strftime('%Y-%m-%d')
 
-    results = []
-
-    # ===== عملکرد کاربران پذیرش (reception) =====
-    if not role_filter or role_filter == 'reception':
-        # only list users with role 'reception' here — avoid showing managers or other roles
-        reception_users = db.execute("SELECT username, full_name FROM users WHERE role = 'reception' ORDER BY full_name").fetchall()
-        for u in reception_users:
-            uname = u['username']
-            if user_filter and uname != user_filter:
-                continue
-            # فاکتورهای باز شده
-            inv_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM invoices
-                WHERE opened_by = ? AND work_date BETWEEN ? AND ?
-            """, (uname, start_date, end_date)).fetchone()['cnt']
-            # ویزیت‌ها - بر اساس reception_user (کسی که ویزیت را ثبت کرده)
-            visits_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM visits v
-                WHERE v.reception_user = ? AND v.work_date BETWEEN ? AND ?
-            """, (uname, start_date, end_date)).fetchone()['cnt']
-            # خدمات پرستاری - بر اساس reception_user (کسی که تزریق را ثبت کرده)
-            nursing_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM injections inj
-                WHERE inj.reception_user = ? AND inj.work_date BETWEEN ? AND ?
-            """, (uname, start_date, end_date)).fetchone()['cnt']
-            # کارهای عملی - بر اساس reception_user
-            proc_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM procedures pr
-                WHERE pr.reception_user = ? AND pr.work_date BETWEEN ? AND ?
-            """, (uname, start_date, end_date)).fetchone()['cnt']
-            # مصرفی‌ها - بر اساس reception_user - جدا محاسبه کن: عمومی (supply) و دارو (drug)
-            cons_supply_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM consumables_ledger cl
-                WHERE cl.reception_user = ? AND cl.work_date BETWEEN ? AND ? AND cl.category = 'supply' AND (cl.patient_provided = 0 OR COALESCE(cl.is_exception,0) = 1)
-            """, (uname, start_date, end_date)).fetchone()['cnt']
-            cons_drug_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM consumables_ledger cl
-                WHERE cl.reception_user = ? AND cl.work_date BETWEEN ? AND ? AND cl.category = 'drug' AND (cl.patient_provided = 0 OR COALESCE(cl.is_exception,0) = 1)
-            """, (uname, start_date, end_date)).fetchone()['cnt']
-            # درآمد کل (فاکتورهای بسته) - بر اساس reception_user - بدون مصرفی
-            # Revenue = visits + injections + procedures (NOT consumables)
-            visits_rev = db.execute("""
-                SELECT COALESCE(SUM(v.price), 0) as total FROM visits v
-                JOIN invoices i ON i.id = v.invoice_id
-                WHERE v.reception_user = ? AND v.work_date BETWEEN ? AND ? AND i.status = 'closed'
-            """, (uname, start_date, end_date)).fetchone()['total']
-            injections_rev = db.execute("""
-                SELECT COALESCE(SUM(inj.total_price), 0) as total FROM injections inj
-                JOIN invoices i ON i.id = inj.invoice_id
-                WHERE inj.reception_user = ? AND inj.work_date BETWEEN ? AND ? AND i.status = 'closed'
-            """, (uname, start_date, end_date)).fetchone()['total']
-            procedures_rev = db.execute("""
-                SELECT COALESCE(SUM(pr.price), 0) as total FROM procedures pr
-                JOIN invoices i ON i.id = pr.invoice_id
-                WHERE pr.reception_user = ? AND pr.work_date BETWEEN ? AND ? AND i.status = 'closed'
-            """, (uname, start_date, end_date)).fetchone()['total']
-            revenue = visits_rev + injections_rev + procedures_rev
-
-            results.append({
-                'user': uname,
-                'full_name': u['full_name'],
-                'role': 'reception',
-                'role_fa': 'پذیرش',
-                'invoices': inv_count,
-                'visits': visits_count,
-                'nursing': nursing_count,
-                'procedures': proc_count,
-                'consumables_supply': cons_supply_count,
-                'consumables_drug': cons_drug_count,
-                'revenue': revenue,
-            })
-
-    # ===== عملکرد پزشکان (doctor) =====
-    if not role_filter or role_filter == 'doctor':
-        doctors = db.execute("SELECT id, full_name FROM medical_staff WHERE staff_type='doctor' ORDER BY full_name").fetchall()
-        for doc in doctors:
-            doc_id = doc['id']
-            if user_filter and str(doc_id) != user_filter:
-                continue
-            # ویزیت‌ها
-            visits_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM visits
-                WHERE doctor_id = ? AND work_date BETWEEN ? AND ?
-            """, (doc_id, start_date, end_date)).fetchone()['cnt']
-            visits_revenue = db.execute("""
-                SELECT COALESCE(SUM(price), 0) as total FROM visits v
-                JOIN invoices i ON i.id = v.invoice_id AND i.status = 'closed'
-                WHERE v.doctor_id = ? AND v.work_date BETWEEN ? AND ?
-            """, (doc_id, start_date, end_date)).fetchone()['total']
-            # خدمات پرستاری تحت نظر این پزشک - فقط زمانی که در همان فاکتور ویزیت هم وجود دارد
-            nursing_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM injections inj
-                WHERE inj.doctor_id = ? AND inj.work_date BETWEEN ? AND ?
-                AND EXISTS (SELECT 1 FROM visits v WHERE v.invoice_id = inj.invoice_id AND v.doctor_id = inj.doctor_id)
-            """, (doc_id, start_date, end_date)).fetchone()['cnt']
-            nursing_revenue = db.execute("""
-                SELECT COALESCE(SUM(inj.total_price), 0) as total FROM injections inj
-                JOIN invoices i ON i.id = inj.invoice_id AND i.status = 'closed'
-                WHERE inj.doctor_id = ? AND inj.work_date BETWEEN ? AND ?
-                AND EXISTS (SELECT 1 FROM visits v WHERE v.invoice_id = inj.invoice_id AND v.doctor_id = inj.doctor_id)
-            """, (doc_id, start_date, end_date)).fetchone()['total']
-            # کارهای عملی - فقط کارهایی که پزشک انجام‌دهنده بوده (performer_type='doctor')
-            proc_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM procedures
-                WHERE doctor_id = ? AND performer_type = 'doctor' AND work_date BETWEEN ? AND ?
-            """, (doc_id, start_date, end_date)).fetchone()['cnt']
-            proc_revenue = db.execute("""
-                SELECT COALESCE(SUM(price), 0) as total FROM procedures pr
-                JOIN invoices i ON i.id = pr.invoice_id AND i.status = 'closed'
-                WHERE pr.doctor_id = ? AND pr.performer_type = 'doctor' AND pr.work_date BETWEEN ? AND ?
-            """, (doc_id, start_date, end_date)).fetchone()['total']
-            
-            total_revenue = visits_revenue + nursing_revenue + proc_revenue
-
-            results.append({
-                'user': str(doc_id),
-                'full_name': doc['full_name'],
-                'role': 'doctor',
-                'role_fa': 'پزشک',
-                'invoices': 0,
-                'visits': visits_count,
-                'nursing': nursing_count,
-                'procedures': proc_count,
-                'consumables': 0,
-                'revenue': total_revenue,
-            })
-
-    # ===== عملکرد پرستاران (nurse) =====
-    if not role_filter or role_filter == 'nurse':
-        nurses = db.execute("SELECT id, full_name FROM medical_staff WHERE staff_type='nurse' ORDER BY full_name").fetchall()
-        for nurse in nurses:
-            nurse_id = nurse['id']
-            if user_filter and str(nurse_id) != user_filter:
-                continue
-            # خدمات پرستاری
-            nursing_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM injections
-                WHERE nurse_id = ? AND work_date BETWEEN ? AND ?
-            """, (nurse_id, start_date, end_date)).fetchone()['cnt']
-            nursing_revenue = db.execute("""
-                SELECT COALESCE(SUM(total_price), 0) as total FROM injections inj
-                JOIN invoices i ON i.id = inj.invoice_id AND i.status = 'closed'
-                WHERE inj.nurse_id = ? AND inj.work_date BETWEEN ? AND ?
-            """, (nurse_id, start_date, end_date)).fetchone()['total']
-            # کارهای عملی - فقط کارهایی که پرستار انجام‌دهنده بوده (performer_type='nurse')
-            proc_count = db.execute("""
-                SELECT COUNT(*) as cnt FROM procedures
-                WHERE nurse_id = ? AND performer_type = 'nurse' AND work_date BETWEEN ? AND ?
-            """, (nurse_id, start_date, end_date)).fetchone()['cnt']
-            proc_revenue = db.execute("""
-                SELECT COALESCE(SUM(price), 0) as total FROM procedures pr
-                JOIN invoices i ON i.id = pr.invoice_id AND i.status = 'closed'
-                WHERE pr.nurse_id = ? AND pr.performer_type = 'nurse' AND pr.work_date BETWEEN ? AND ?
-            """, (nurse_id, start_date, end_date)).fetchone()['total']
-            
-            total_revenue = nursing_revenue + proc_revenue
-
-            results.append({
-                'user': str(nurse_id),
-                'full_name': nurse['full_name'],
-                'role': 'nurse',
-                'role_fa': 'پرستار',
-                'invoices': 0,
-                'visits': 0,
-                'nursing': nursing_count,
-                'procedures': proc_count,
-                'consumables': 0,
-                'revenue': total_revenue,
-            })
+    results = ReportsRepository().users_performance(start_date, end_date, role_filter, user_filter)
 
     # لیست کاربران و نقش‌ها برای فیلتر
     all_users = db.execute("SELECT username, full_name FROM users ORDER BY full_name").fetchall()
@@ -1596,19 +1322,12 @@ def users_report():
 # ===================== Export APIs =====================
 
 def make_csv_response(data, headers, filename):
-    """ساخت پاسخ CSV با پشتیبانی کامل فارسی (UTF-8 BOM)."""
-    output = io.StringIO()
-    # اضافه کردن BOM برای Excel
-    output.write('\ufeff')
-    writer = csv.writer(output)
-    writer.writerow(headers)
-    for row in data:
-        writer.writerow(row)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-    return response
+    """ساخت پاسخ CSV با پشتیبانی کامل فارسی (UTF-8 BOM).
+
+    `data` can be a list or a lazy iterator of rows; the file is streamed
+    (and gzipped with `?gzip=1`).
+    """
+    return stream_csv_response(data, headers, filename)
 
 
 @bp.route('/export/users/csv')
@@ -1618,7 +1337,6 @@ def export_users_csv():
     if g.user['role'] != 'manager':
         return jsonify({'error': 'Unauthorized'}), 403
 
-    db = get_db()
     date_from = request.args.get('from', '')
     date_to = request.args.get('to', '')
     role_filter = request.args.get('role', '').strip() or None
@@ -1649,54 +1367,7 @@ def export_users_csv():
     start_date = start_dt.strftime('%Y-%m-%d')
     end_date = end_dt.strftime('%Y-%m-%d')
 
-    results = []
-
-    # پذیرش
-    if not role_filter or role_filter == 'reception':
-        reception_users = db.execute("SELECT username, full_name FROM users ORDER BY full_name").fetchall()
-        for u in reception_users:
-            uname = u['username']
-            if user_filter and uname != user_filter:
-                continue
-            inv_count = db.execute("SELECT COUNT(*) as cnt FROM invoices WHERE opened_by = ? AND work_date BETWEEN ? AND ?", (uname, start_date, end_date)).fetchone()['cnt']
-            visits_count = db.execute("SELECT COUNT(*) as cnt FROM visits v JOIN invoices i ON i.id = v.invoice_id WHERE i.opened_by = ? AND v.work_date BETWEEN ? AND ?", (uname, start_date, end_date)).fetchone()['cnt']
-            nursing_count = db.execute("SELECT COUNT(*) as cnt FROM injections inj JOIN invoices i ON i.id = inj.invoice_id WHERE i.opened_by = ? AND inj.work_date BETWEEN ? AND ?", (uname, start_date, end_date)).fetchone()['cnt']
-            proc_count = db.execute("SELECT COUNT(*) as cnt FROM procedures pr JOIN invoices i ON i.id = pr.invoice_id WHERE i.opened_by = ? AND pr.work_date BETWEEN ? AND ?", (uname, start_date, end_date)).fetchone()['cnt']
-            cons_count = db.execute("SELECT COUNT(*) as cnt FROM consumables_ledger cl JOIN invoices i ON i.id = cl.invoice_id WHERE i.opened_by = ? AND cl.work_date BETWEEN ? AND ? AND (cl.patient_provided = 0 OR COALESCE(cl.is_exception,0) = 1)", (uname, start_date, end_date)).fetchone()['cnt']
-            # Revenue = visits + injections + procedures (NOT consumables)
-            v_rev = db.execute("SELECT COALESCE(SUM(v.price), 0) as total FROM visits v JOIN invoices i ON i.id = v.invoice_id WHERE i.opened_by = ? AND i.work_date BETWEEN ? AND ? AND i.status = 'closed'", (uname, start_date, end_date)).fetchone()['total']
-            inj_rev = db.execute("SELECT COALESCE(SUM(inj.total_price), 0) as total FROM injections inj JOIN invoices i ON i.id = inj.invoice_id WHERE i.opened_by = ? AND i.work_date BETWEEN ? AND ? AND i.status = 'closed'", (uname, start_date, end_date)).fetchone()['total']
-            pr_rev = db.execute("SELECT COALESCE(SUM(pr.price), 0) as total FROM procedures pr JOIN invoices i ON i.id = pr.invoice_id WHERE i.opened_by = ? AND i.work_date BETWEEN ? AND ? AND i.status = 'closed'", (uname, start_date, end_date)).fetchone()['total']
-            revenue = v_rev + inj_rev + pr_rev
-            results.append([uname, u['full_name'], 'پذیرش', inv_count, visits_count, nursing_count, proc_count, cons_count, revenue])
-
-    # پزشکان
-    if not role_filter or role_filter == 'doctor':
-        doctors = db.execute("SELECT id, full_name FROM medical_staff WHERE staff_type='doctor' ORDER BY full_name").fetchall()
-        for doc in doctors:
-            doc_id = doc['id']
-            if user_filter and str(doc_id) != user_filter:
-                continue
-            visits_count = db.execute("SELECT COUNT(*) as cnt FROM visits WHERE doctor_id = ? AND work_date BETWEEN ? AND ?", (doc_id, start_date, end_date)).fetchone()['cnt']
-            visits_revenue = db.execute("SELECT COALESCE(SUM(price), 0) as total FROM visits v JOIN invoices i ON i.id = v.invoice_id AND i.status = 'closed' WHERE v.doctor_id = ? AND v.work_date BETWEEN ? AND ?", (doc_id, start_date, end_date)).fetchone()['total']
-            nursing_count = db.execute("SELECT COUNT(*) as cnt FROM injections WHERE doctor_id = ? AND work_date BETWEEN ? AND ?", (doc_id, start_date, end_date)).fetchone()['cnt']
-            nursing_revenue = db.execute("SELECT COALESCE(SUM(total_price), 0) as total FROM injections inj JOIN invoices i ON i.id = inj.invoice_id AND i.status = 'closed' WHERE inj.doctor_id = ? AND inj.work_date BETWEEN ? AND ?", (doc_id, start_date, end_date)).fetchone()['total']
-            proc_count = db.execute("SELECT COUNT(*) as cnt FROM procedures WHERE doctor_id = ? AND performer_type = 'doctor' AND work_date BETWEEN ? AND ?", (doc_id, start_date, end_date)).fetchone()['cnt']
-            proc_revenue = db.execute("SELECT COALESCE(SUM(price), 0) as total FROM procedures pr JOIN invoices i ON i.id = pr.invoice_id AND i.status = 'closed' WHERE pr.doctor_id = ? AND pr.performer_type = 'doctor' AND pr.work_date BETWEEN ? AND ?", (doc_id, start_date, end_date)).fetchone()['total']
-            results.append([str(doc_id), doc['full_name'], 'پزشک', 0, visits_count, nursing_count, proc_count, 0, visits_revenue + nursing_revenue + proc_revenue])
-
-    # پرستاران
-    if not role_filter or role_filter == 'nurse':
-        nurses = db.execute("SELECT id, full_name FROM medical_staff WHERE staff_type='nurse' ORDER BY full_name").fetchall()
-        for nurse in nurses:
-            nurse_id = nurse['id']
-            if user_filter and str(nurse_id) != user_filter:
-                continue
-            nursing_count = db.execute("SELECT COUNT(*) as cnt FROM injections WHERE nurse_id = ? AND work_date BETWEEN ? AND ?", (nurse_id, start_date, end_date)).fetchone()['cnt']
-            nursing_revenue = db.execute("SELECT COALESCE(SUM(total_price), 0) as total FROM injections inj JOIN invoices i ON i.id = inj.invoice_id AND i.status = 'closed' WHERE inj.nurse_id = ? AND inj.work_date BETWEEN ? AND ?", (nurse_id, start_date, end_date)).fetchone()['total']
-            proc_count = db.execute("SELECT COUNT(*) as cnt FROM procedures WHERE nurse_id = ? AND performer_type = 'nurse' AND work_date BETWEEN ? AND ?", (nurse_id, start_date, end_date)).fetchone()['cnt']
-            proc_revenue = db.execute("SELECT COALESCE(SUM(price), 0) as total FROM procedures pr JOIN invoices i ON i.id = pr.invoice_id AND i.status = 'closed' WHERE pr.nurse_id = ? AND pr.performer_type = 'nurse' AND pr.work_date BETWEEN ? AND ?", (nurse_id, start_date, end_date)).fetchone()['total']
-            results.append([str(nurse_id), nurse['full_name'], 'پرستار', 0, 0, nursing_count, proc_count, 0, nursing_revenue + proc_revenue])
+    results = ReportsRepository().users_export_rows(start_date, end_date, role_filter, user_filter)
 
     headers = ['کاربر', 'نام کامل', 'نقش', 'فاکتورهای بازشده', 'ویزیت‌ها', 'خدمات پرستاری', 'کارهای عملی', 'مصرفی‌ها', 'درآمد کل (تومان)']
     return make_csv_response(results, headers, 'users_report.csv')
@@ -1762,11 +1433,12 @@ def export_visits_csv():
         JOIN invoices inv ON inv.id = v.invoice_id
         WHERE {where_sql}
         ORDER BY v.visit_date DESC
-    ''', params).fetchall()
+    ''', params)
 
-    data = []
-    for v in visits:
-        data.append([v['visit_date'], v['patient_name'], v['doctor_name'] or '', v['insurance_type'] or '', v['supplementary_insurance'] or '', v['shift'] or '', v['total_amount'] or 0, v['notes'] or ''])
+    data = (
+        [v['visit_date'], v['patient_name'], v['doctor_name'] or '', v['insurance_type'] or '', v['supplementary_insurance'] or '', v['shift'] or '', v['total_amount'] or 0, v['notes'] or '']
+        for v in iter_cursor(visits)
+    )
 
     headers = ['تاریخ ویزیت', 'بیمار', 'پزشک', 'بیمه', 'بیمه تکمیلی', 'شیفت', 'مبلغ (تومان)', 'یادداشت']
     return make_csv_response(data, headers, 'visits_report.csv')
@@ -1834,11 +1506,12 @@ def export_nursing_csv():
         LEFT JOIN medical_staff nurse ON nurse.id = i.nurse_id
         WHERE {where_sql}
         ORDER BY i.injection_date DESC
-    ''', params).fetchall()
+    ''', params)
 
-    data = []
-    for r in rows:
-        data.append([r['injection_date'], r['patient_name'], r['injection_type'] or '', r['count'] or 1, r['unit_price'] or 0, r['total_price'] or 0, r['doctor_name'] or '', r['nurse_name'] or '', r['shift'] or '', r['notes'] or ''])
+    data = (
+        [r['injection_date'], r['patient_name'], r['injection_type'] or '', r['count'] or 1, r['unit_price'] or 0, r['total_price'] or 0, r['doctor_name'] or '', r['nurse_name'] or '', r['shift'] or '', r['notes'] or '']
+        for r in iter_cursor(rows)
+    )
 
     headers = ['تاریخ', 'بیمار', 'نوع خدمت', 'تعداد', 'مبلغ واحد', 'مبلغ کل', 'پزشک', 'پرستار', 'شیفت', 'یادداشت']
     return make_csv_response(data, headers, 'nursing_report.csv')
@@ -1910,13 +1583,14 @@ def export_procedures_csv():
         LEFT JOIN medical_staff nurse ON nurse.id = pr.nurse_id
         WHERE {where_sql}
         ORDER BY pr.procedure_date DESC
-    ''', params).fetchall()
+    ''', params)
 
-    data = []
-    for r in rows:
-        # تبدیل performer_type به فارسی
-        performer_fa = 'پزشک' if r['performer_type'] == 'doctor' else ('پرستار' if r['performer_type'] == 'nurse' else '')
-        data.append([r['procedure_date'], r['patient_name'], r['procedure_type'] or '', performer_fa, r['doctor_name'] or '', r['nurse_name'] or '', r['shift'] or '', r['price'] or 0, r['notes'] or ''])
+    # تبدیل performer_type به فارسی
+    performer_fa = {'doctor': 'پزشک', 'nurse': 'پرستار'}
+    data = (
+        [r['procedure_date'], r['patient_name'], r['procedure_type'] or '', performer_fa.get(r['performer_type'], ''), r['doctor_name'] or '', r['nurse_name'] or '', r['shift'] or '', r['price'] or 0, r['notes'] or '']
+        for r in iter_cursor(rows)
+    )
 
     headers = ['تاریخ', 'بیمار', 'نوع کار', 'انجام‌دهنده', 'پزشک', 'پرستار', 'شیفت', 'مبلغ (تومان)', 'یادداشت']
     return make_csv_response(data, headers, 'procedures_report.csv')
@@ -2113,13 +1787,16 @@ def export_consumables_csv():
         JOIN invoices inv ON inv.id = cl.invoice_id AND inv.status = 'closed'
         WHERE {where_sql}
         ORDER BY cl.usage_date DESC
-    ''', params).fetchall()
-
-    data = []
-    for r in rows:
-        cat_fa = 'دارو' if r['category'] == 'drug' else 'عمومی'
-        bbp_fa = 'بله' if r['patient_provided'] else 'خیر'
-        data.append([r['usage_date'], r['patient_name'], r['item_name'], cat_fa, r['quantity'] or 1, r['unit_price'] or 0, r['total_cost'] or 0, bbp_fa, r['shift'] or '', r['notes'] or ''])
+    ''', params)
+
+    data = (
+        [r['usage_date'], r['patient_name'], r['item_name'],
+         'دارو' if r['category'] == 'drug' else 'عمومی',
+         r['quantity'] or 1, r['unit_price'] or 0, r['total_cost'] or 0,
+         'بله' if r['patient_provided'] else 'خیر',
+         r['shift'] or '', r['notes'] or '']
+        for r in iter_cursor(rows)
+    )
 
     headers = ['تاریخ', 'بیمار', 'نام قلم', 'دسته', 'تعداد', 'مبلغ واحد', 'مبلغ کل', 'آورده بیمار', 'شیفت', 'یادداشت']
     return make_csv_response(data, headers, 'consumables_report.csv')
@@ -2136,121 +1813,14 @@ def patients_report():
 
     db = get_db()
 
-    date_from = request.args.get('from', '')
-    date_to = request.args.get('to', '')
-    search_name = request.args.get('search_name', '').strip() or None
-    insurance_type = request.args.get('insurance_type', '').strip() or None
-    gender = request.args.get('gender', '').strip() or None
-
-    def jalali_to_start_end(jalali_str, is_start=True):
-        if not jalali_str:
-            return None
-        try:
-            parts = jalali_str.split('/')
-            jd = jdatetime.date(int(parts[0]), int(parts[1]), int(parts[2]))
-            gd = jd.togregorian()
-            if is_start:
-                return datetime(gd.year, gd.month, gd.day, 0, 0, 0)
-            else:
-                return datetime(gd.year, gd.month, gd.day, 23, 59, 59)
-        except Exception:
-            return None
-
-    start_dt = jalali_to_start_end(date_from, True)
-    end_dt = jalali_to_start_end(date_to, False)
-    if not start_dt or not end_dt:
-        end_dt = iran_now()
-        start_dt = end_dt - timedelta(days=29)
-    if start_dt > end_dt:
-        start_dt, end_dt = end_dt, start_dt
+    filters = _patients_report_filters()
+    date_from = filters['from']
+    date_to = filters['to']
+    search_name = filters['search_name']
+    insurance_type = filters['insurance_type']
+    gender = filters['gender']
 
-    start_date = start_dt.strftime('%Y-%m-%d')
-    end_date = end_dt.strftime('%Y-%m-%d')
-
-    # گرفتن بیماران که در بازه زمانی فاکتور داشتند
-    patient_ids_sql = """
-        SELECT DISTINCT patient_id FROM invoices
-        WHERE work_date BETWEEN ? AND ?
-    """
-    patient_ids = [r['patient_id'] for r in db.execute(patient_ids_sql, (start_date, end_date)).fetchall()]
-
-    results = []
-    for pid in patient_ids:
-        patient = db.execute("SELECT * FROM patients WHERE id = ?", (pid,)).fetchone()
-        if not patient:
-            continue
-
-        # ساخت نام کامل
-        full_name = f"{patient['name']} {patient['family_name']}"
-
-        # فیلترها
-        if search_name and search_name.lower() not in full_name.lower():
-            continue
-
-        # آمار مراجعات
-        invoices_count = db.execute("""
-            SELECT COUNT(*) as cnt FROM invoices
-            WHERE patient_id = ? AND work_date BETWEEN ? AND ?
-        """, (pid, start_date, end_date)).fetchone()['cnt']
-
-        # جمع پرداخت‌ها - بدون مصرفی
-        # Revenue = visits + injections + procedures (NOT consumables)
-        v_paid = db.execute("""
-            SELECT COALESCE(SUM(v.price), 0) as total FROM visits v
-            JOIN invoices i ON i.id = v.invoice_id
-            WHERE i.patient_id = ? AND i.work_date BETWEEN ? AND ? AND i.status = 'closed'
-        """, (pid, start_date, end_date)).fetchone()['total']
-        inj_paid = db.execute("""
-            SELECT COALESCE(SUM(inj.total_price), 0) as total FROM injections inj
-            JOIN invoices i ON i.id = inj.invoice_id
-            WHERE i.patient_id = ? AND i.work_date BETWEEN ? AND ? AND i.status = 'closed'
-        """, (pid, start_date, end_date)).fetchone()['total']
-        pr_paid = db.execute("""
-            SELECT COALESCE(SUM(pr.price), 0) as total FROM procedures pr
-            JOIN invoices i ON i.id = pr.invoice_id
-            WHERE i.patient_id = ? AND i.work_date BETWEEN ? AND ? AND i.status = 'closed'
-        """, (pid, start_date, end_date)).fetchone()['total']
-        total_paid = v_paid + inj_paid + pr_paid
-
-        # ویزیت‌ها
-        visits_count = db.execute("""
-            SELECT COUNT(*) as cnt FROM visits v
-            JOIN invoices i ON i.id = v.invoice_id
-            WHERE i.patient_id = ? AND v.work_date BETWEEN ? AND ?
-        """, (pid, start_date, end_date)).fetchone()['cnt']
-
-        # آخرین مراجعه
-        last_visit = db.execute("""
-            SELECT MAX(opened_at) as last_date FROM invoices
-            WHERE patient_id = ? AND work_date BETWEEN ? AND ?
-        """, (pid, start_date, end_date)).fetchone()['last_date']
-
-        # بیمه (از آخرین ویزیت)
-        last_ins = db.execute("""
-            SELECT v.insurance_type FROM visits v
-            JOIN invoices i ON i.id = v.invoice_id
-            WHERE i.patient_id = ?
-            ORDER BY v.visit_date DESC LIMIT 1
-        """, (pid,)).fetchone()
-        ins_type = last_ins['insurance_type'] if last_ins else None
-
-        if insurance_type and ins_type != insurance_type:
-            continue
-
-        results.append({
-            'id': pid,
-            'full_name': full_name,
-            'national_id': patient['national_id'] if patient['national_id'] else '',
-            'phone': patient['phone_number'] if patient['phone_number'] else '',
-            'insurance_type': ins_type,
-            'invoices_count': invoices_count,
-            'visits_count': visits_count,
-            'total_paid': total_paid,
-            'last_visit': last_visit,
-        })
-
-    # مرتب‌سازی بر اساس تعداد مراجعات
-    results.sort(key=lambda x: x['invoices_count'], reverse=True)
+    results = _patients_report_rows(filters)
 
     total_patients = len(results)
     total_revenue = sum(r['total_paid'] for r in results)
@@ -2306,12 +1876,21 @@ def export_patients_csv():
     if g.user['role'] != 'manager':
         return jsonify({'error': 'Unauthorized'}), 403
 
-    db = get_db()
+    results = _patients_report_rows(_patients_report_filters())
+
+    data = [
+        [r['full_name'], r['national_id'], r['phone'], r['insurance_type'] or '',
+         r['invoices_count'], r['visits_count'], r['total_paid'], r['last_visit'] or '']
+        for r in results
+    ]
+    headers = ['نام بیمار', 'کد ملی', 'تلفن', 'بیمه', 'تعداد فاکتور', 'تعداد ویزیت', 'جمع پرداخت (تومان)', 'آخرین مراجعه']
+    return make_csv_response(data, headers, 'patients_report.csv')
+
+
+def _patients_report_filters():
+    """خواندن فیلترهای گزارش بیماران از query string (مشترک بین صفحه و CSV)."""
     date_from = request.args.get('from', '')
     date_to = request.args.get('to', '')
-    search_name = request.args.get('search_name', '').strip() or None
-    insurance_type = request.args.get('insurance_type', '').strip() or None
-    gender = request.args.get('gender', '').strip() or None
 
     def jalali_to_start_end(jalali_str, is_start=True):
         if not jalali_str:
@@ -2335,40 +1914,26 @@ def export_patients_csv():
     if start_dt > end_dt:
         start_dt, end_dt = end_dt, start_dt
 
-    start_date = start_dt.strftime('%Y-%m-%d')
-    end_date = end_dt.strftime('%Y-%m-%d')
+    return {
+        'from': date_from,
+        'to': date_to,
+        'start_date': start_dt.strftime('%Y-%m-%d'),
+        'end_date': end_dt.strftime('%Y-%m-%d'),
+        'search_name': request.args.get('search_name', '').strip() or None,
+        'insurance_type': request.args.get('insurance_type', '').strip() or None,
+        'gender': request.args.get('gender', '').strip() or None,
+    }
 
-    patient_ids = [r['patient_id'] for r in db.execute("SELECT DISTINCT patient_id FROM invoices WHERE work_date BETWEEN ? AND ?", (start_date, end_date)).fetchall()]
-
-    data = []
-    for pid in patient_ids:
-        patient = db.execute("SELECT * FROM patients WHERE id = ?", (pid,)).fetchone()
-        if not patient:
-            continue
-        full_name = f"{patient['name']} {patient['family_name']}"
-        if search_name and search_name.lower() not in full_name.lower():
-            continue
-
-        invoices_count = db.execute("SELECT COUNT(*) as cnt FROM invoices WHERE patient_id = ? AND work_date BETWEEN ? AND ?", (pid, start_date, end_date)).fetchone()['cnt']
-        # Revenue = visits + injections + procedures (NOT consumables)
-        v_paid = db.execute("SELECT COALESCE(SUM(v.price), 0) as total FROM visits v JOIN invoices i ON i.id = v.invoice_id WHERE i.patient_id = ? AND i.work_date BETWEEN ? AND ? AND i.status = 'closed'", (pid, start_date, end_date)).fetchone()['total']
-        inj_paid = db.execute("SELECT COALESCE(SUM(inj.total_price), 0) as total FROM injections inj JOIN invoices i ON i.id = inj.invoice_id WHERE i.patient_id = ? AND i.work_date BETWEEN ? AND ? AND i.status = 'closed'", (pid, start_date, end_date)).fetchone()['total']
-        pr_paid = db.execute("SELECT COALESCE(SUM(pr.price), 0) as total FROM procedures pr JOIN invoices i ON i.id = pr.invoice_id WHERE i.patient_id = ? AND i.work_date BETWEEN ? AND ? AND i.status = 'closed'", (pid, start_date, end_date)).fetchone()['total']
-        total_paid = v_paid + inj_paid + pr_paid
-        visits_count = db.execute("SELECT COUNT(*) as cnt FROM visits v JOIN invoices i ON i.id = v.invoice_id WHERE i.patient_id = ? AND v.work_date BETWEEN ? AND ?", (pid, start_date, end_date)).fetchone()['cnt']
-        last_visit = db.execute("SELECT MAX(opened_at) as last_date FROM invoices WHERE patient_id = ? AND work_date BETWEEN ? AND ?", (pid, start_date, end_date)).fetchone()['last_date']
-        last_ins = db.execute("SELECT v.insurance_type FROM visits v JOIN invoices i ON i.id = v.invoice_id WHERE i.patient_id = ? ORDER BY v.visit_date DESC LIMIT 1", (pid,)).fetchone()
-        ins_type = last_ins['insurance_type'] if last_ins else ''
-        if insurance_type and ins_type != insurance_type:
-            continue
-
-        phone = patient['phone_number'] if patient['phone_number'] else ''
-        national_id = patient['national_id'] if patient['national_id'] else ''
-        data.append([full_name, national_id, phone, ins_type or '', invoices_count, visits_count, total_paid, last_visit or ''])
-
-    data.sort(key=lambda x: x[4], reverse=True)
-    headers = ['نام بیمار', 'کد ملی', 'تلفن', 'بیمه', 'تعداد فاکتور', 'تعداد ویزیت', 'جمع پرداخت (تومان)', 'آخرین مراجعه']
-    return make_csv_response(data, headers, 'patients_report.csv')
+
+def _patients_report_rows(filters):
+    """آمار هر بیمار در بازه - یک کوئری واحد (بدون حلقه کوئری برای هر بیمار)."""
+    return ReportsRepository().patient_stats(
+        filters['start_date'],
+        filters['end_date'],
+        search_name=filters['search_name'],
+        insurance_type=filters['insurance_type'],
+        gender=filters['gender'],
+    )
 
 
 # ==================== معوقات بیمه ====================
@@ -2381,18 +1946,6 @@ def insurance_arrears():
         flash('دسترسی محدود', 'error')
         return redirect(url_for('reception.index'))
     
-    db = get_db()
-    
-    # اطمینان از وجود ستون‌های جدید
-    try:
-        db.execute("ALTER TABLE visit_tariffs ADD COLUMN nursing_covers INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        db.execute("ALTER TABLE visit_tariffs ADD COLUMN is_base_tariff INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    
     # Jalali ranges for date picker
     g_today = iran_now().date()
     j_today = Gregorian(g_today).persian_tuple()
@@ -2446,263 +1999,32 @@ def insurance_arrears():
         except Exception:
             pass
     
-    # دریافت تعرفه پایه (آزاد)
-    base_tariff = db.execute("SELECT * FROM visit_tariffs WHERE is_base_tariff = 1").fetchone()
-    if not base_tariff:
-        # اگر تعرفه پایه تعریف نشده، از آزاد استفاده کن
-        base_tariff = db.execute("SELECT * FROM visit_tariffs WHERE insurance_type = 'آزاد'").fetchone()
-    base_visit_price = base_tariff['tariff_price'] if base_tariff else 0
-    
-    # دریافت تمام تعرفه‌های بیمه و بررسی پوشش پرستاری
-    insurance_tariffs = {}
-    tariffs_rows = db.execute("SELECT * FROM visit_tariffs WHERE insurance_type != 'آزاد' AND (is_base_tariff = 0 OR is_base_tariff IS NULL)").fetchall()
-    for t in tariffs_rows:
-        # بررسی ستون nursing_covers
-        nursing_covers = False
-        try:
-            nursing_covers = bool(t['nursing_covers'])
-        except Exception:
-            pass
-        insurance_tariffs[t['insurance_type']] = {
-            'visit_tariff': t['tariff_price'],
-            'nursing_covers': nursing_covers  # آیا بیمه پرستاری را پوشش می‌دهد؟
-        }
-    
-    # دریافت تعرفه‌های بیمه تکمیلی
-    supplementary_tariffs = {}
-    supp_rows = db.execute("SELECT * FROM visit_tariffs WHERE is_supplementary = 1 AND is_active = 1").fetchall()
-    for t in supp_rows:
-        row = dict(t)
-        supplementary_tariffs[row['insurance_type']] = {
-            'visit_tariff': row.get('tariff_price'),
-            'nursing_covers': bool(row.get('nursing_covers', 0))
-        }
-    
-    # ساخت کوئری پایه برای ویزیت‌ها - شامل بیمه تکمیلی
-    visit_query = """
-        SELECT v.id, v.visit_date, v.insurance_type, v.supplementary_insurance, v.price as visit_price,
-               p.full_name as patient_name, p.national_id,
-               inv.id as invoice_id, inv.status as invoice_status
-        FROM visits v
-        JOIN patients p ON v.patient_id = p.id
-        JOIN invoices inv ON v.invoice_id = inv.id
-        WHERE v.insurance_type IS NOT NULL AND v.insurance_type != 'آزاد'
-    """
-    params = []
-    
-    if date_from_gregorian:
-        visit_query += " AND v.work_date >= ?"
-        params.append(date_from_gregorian)
-    if date_to_gregorian:
-        visit_query += " AND v.work_date <= ?"
-        params.append(date_to_gregorian)
-    if insurance_filter:
-        visit_query += " AND v.insurance_type = ?"
-        params.append(insurance_filter)
-    
-    visit_query += " ORDER BY v.visit_date DESC"
-    visits = db.execute(visit_query, params).fetchall()
-    
-    # ساخت کوئری برای تزریقات (خدمات پرستاری) - شامل بیمه تکمیلی
-    injection_query = """
-        SELECT i.id, i.injection_date, i.injection_type, i.total_price,
-               i.service_id,
-               p.full_name as patient_name, p.national_id,
-               inv.id as invoice_id, inv.status as invoice_status, inv.insurance_type,
-               inv.supplementary_insurance
-        FROM injections i
-        JOIN patients p ON i.patient_id = p.id
-        JOIN invoices inv ON i.invoice_id = inv.id
-        WHERE inv.insurance_type IS NOT NULL AND inv.insurance_type != 'آزاد'
-    """
-    inj_params = []
-    
-    if date_from_gregorian:
-        injection_query += " AND i.work_date >= ?"
-        inj_params.append(date_from_gregorian)
-    if date_to_gregorian:
-        injection_query += " AND i.work_date <= ?"
-        inj_params.append(date_to_gregorian)
-    if insurance_filter:
-        injection_query += " AND inv.insurance_type = ?"
-        inj_params.append(insurance_filter)
-    
-    injection_query += " ORDER BY i.injection_date DESC"
-    injections = db.execute(injection_query, inj_params).fetchall()
-    
-    # محاسبه معوقات برای هر ویزیت
-    # معوقه ویزیت بیمه پایه = تعرفه پایه - سهم بیمار (تعرفه بیمه)
-    # معوقه ویزیت بیمه تکمیلی = سهم بیمار از بیمه پایه (که تکمیلی باید بپردازد)
-    visit_arrears = []
-    supplementary_arrears = []  # لیست جداگانه برای معوقات بیمه تکمیلی
-    
-    for v in visits:
-        ins_type = v['insurance_type']
-        supp_ins = v['supplementary_insurance']
-        
-        # سهم بیمار = تعرفه ویزیت برای آن بیمه
-        ins_tariff = insurance_tariffs.get(ins_type, {})
-        patient_share = ins_tariff.get('visit_tariff', 0) or 0  # تعرفه بیمه = سهم بیمار
-        base_insurance_debt = base_visit_price - patient_share  # معوقه از بیمه پایه
-        
-        # معوقه بیمه پایه
-        if base_insurance_debt > 0:
-            visit_arrears.append({
-                'id': v['id'],
-                'date': v['visit_date'],
-                'type': 'visit',
-                'type_fa': 'ویزیت',
-                'insurance_type': ins_type,
-                'patient_name': v['patient_name'],
-                'national_id': v['national_id'],
-                'invoice_id': v['invoice_id'],
-                'base_price': base_visit_price,
-                'patient_paid': patient_share,
-                'insurance_debt': base_insurance_debt
-            })
-        
-        # معوقه بیمه تکمیلی: اگر بیمه تکمیلی دارد، سهم بیمار از بیمه پایه را تکمیلی باید بپردازد
-        if supp_ins and supp_ins in supplementary_tariffs and patient_share > 0:
-            # تعرفه بیمه تکمیلی (سهم بیمار با تکمیلی) - معمولاً 0 یا خیلی کم
-            supp_tariff = supplementary_tariffs.get(supp_ins, {})
-            final_patient_share = supp_tariff.get('visit_tariff', 0) or 0
-            supp_debt = patient_share - final_patient_share  # مقداری که تکمیلی باید بپردازد
-            
-            if supp_debt > 0:
-                supplementary_arrears.append({
-                    'id': v['id'],
-                    'date': v['visit_date'],
-                    'type': 'visit',
-                    'type_fa': 'ویزیت',
-                    'insurance_type': supp_ins,  # نام بیمه تکمیلی
-                    'base_insurance': ins_type,  # نام بیمه پایه
-                    'patient_name': v['patient_name'],
-                    'national_id': v['national_id'],
-                    'invoice_id': v['invoice_id'],
-                    'base_price': patient_share,  # سهم بیمار از بیمه پایه
-                    'patient_paid': final_patient_share,  # سهم نهایی بیمار با تکمیلی
-                    'insurance_debt': supp_debt  # معوقه از بیمه تکمیلی
-                })
-    
-    # محاسبه معوقات برای خدمات پرستاری
-    # فقط بیمه‌هایی که پرستاری را پوشش می‌دهند (nursing_covers = true)
-    nursing_arrears = []
-
-    for i in injections:
-        ins_type = i['insurance_type']
-        ins_tariff = insurance_tariffs.get(ins_type, {})
-        # Check if this specific nursing service is excluded for this insurance (insurance_nursing_exclusions)
-        excluded = False
-        svc_id = None
-        try:
-            try:
-                keys = list(i.keys())
-            except Exception:
-                keys = []
-            if 'service_id' in keys and i['service_id'] is not None:
-                svc_id = int(i['service_id'])
-            else:
-                svc_id = None
-        except Exception:
-            svc_id = None
-        if svc_id:
-            row = db.execute("SELECT 1 FROM insurance_nursing_exclusions WHERE insurance_type = ? AND nursing_service_id = ? LIMIT 1", (ins_type, svc_id)).fetchone()
-            if row:
-                excluded = True
-
-        include = bool(ins_tariff.get('nursing_covers', False) and not excluded)
-
-        # (diagnostic logging removed)
-
-        if include:
-            service_price = i['total_price'] or 0
-            nursing_arrears.append({
-                'id': i['id'],
-                'date': i['injection_date'],
-                'type': 'injection',
-                'type_fa': i['injection_type'],
-                'insurance_type': ins_type,
-                'patient_name': i['patient_name'],
-                'national_id': i['national_id'],
-                'invoice_id': i['invoice_id'],
-                'service_price': service_price,  # مبلغ خدمت که بیمه باید پرداخت کند
-            })
-    
-    # خلاصه معوقات به تفکیک بیمه (شامل بیمه‌های پایه و تکمیلی)
-    summary_by_insurance = {}
-    
-    # معوقات بیمه پایه
-    for arr in visit_arrears:
-        ins = arr['insurance_type']
-        if ins not in summary_by_insurance:
-            summary_by_insurance[ins] = {
-                'visit_count': 0,
-                'visit_debt': 0,
-                'nursing_count': 0,
-                'nursing_debt': 0,
-                'supplementary_count': 0,
-                'supplementary_debt': 0,
-                'total_debt': 0,
-                'is_supplementary': False
-            }
-        summary_by_insurance[ins]['visit_count'] += 1
-        summary_by_insurance[ins]['visit_debt'] += arr['insurance_debt']
-        summary_by_insurance[ins]['total_debt'] += arr['insurance_debt']
-    
-    # معوقات بیمه تکمیلی
-    for arr in supplementary_arrears:
-        ins = arr['insurance_type']
-        if ins not in summary_by_insurance:
-            summary_by_insurance[ins] = {
-                'visit_count': 0,
-                'visit_debt': 0,
-                'nursing_count': 0,
-                'nursing_debt': 0,
-                'supplementary_count': 0,
-                'supplementary_debt': 0,
-                'total_debt': 0,
-                'is_supplementary': True
-            }
-        summary_by_insurance[ins]['supplementary_count'] += 1
-        summary_by_insurance[ins]['supplementary_debt'] += arr['insurance_debt']
-        summary_by_insurance[ins]['total_debt'] += arr['insurance_debt']
-        summary_by_insurance[ins]['is_supplementary'] = True
-    
-    for arr in nursing_arrears:
-        ins = arr['insurance_type']
-        if ins not in summary_by_insurance:
-            summary_by_insurance[ins] = {
-                'visit_count': 0,
-                'visit_debt': 0,
-                'nursing_count': 0,
-                'nursing_debt': 0,
-                'supplementary_count': 0,
-                'supplementary_debt': 0,
-                'total_debt': 0,
-                'is_supplementary': False
-            }
-        summary_by_insurance[ins]['nursing_count'] += 1
-        summary_by_insurance[ins]['nursing_debt'] += arr['service_price']
-        summary_by_insurance[ins]['total_debt'] += arr['service_price']
+    # موتور معوقات: جمع‌ها با GROUP BY در SQL، ردیف‌های جزئیات فقط به تعداد محدود
+    from src.adapters.sqlite.arrears_repo import InsuranceArrearsRepository
+    arrears = InsuranceArrearsRepository(date_from_gregorian, date_to_gregorian, insurance_filter)
+    base_visit_price = arrears.rules.base_visit_price
+    summary = arrears.summary()
+    summary_by_insurance = summary['by_insurance']
+    totals = summary['totals']
     
     # لیست بیمه‌ها برای فیلتر (شامل پایه و تکمیلی)
-    all_insurances = db.execute(
-        "SELECT DISTINCT insurance_type FROM visit_tariffs WHERE insurance_type != 'آزاد' AND (is_base_tariff = 0 OR is_base_tariff IS NULL) ORDER BY insurance_type"
-    ).fetchall()
+    all_insurances = arrears.rules.insurance_names
+    
+    total_visit_debt = totals['visit_debt']
+    total_supplementary_debt = totals['supplementary_debt']
+    total_nursing_debt = totals['nursing_debt']
+    total_debt = totals['total_debt']
     
-    # جمع کل معوقات
-    total_visit_debt = sum(a['insurance_debt'] for a in visit_arrears)
-    total_supplementary_debt = sum(a['insurance_debt'] for a in supplementary_arrears)
-    total_nursing_debt = sum(a['service_price'] for a in nursing_arrears)
-    total_debt = total_visit_debt + total_supplementary_debt + total_nursing_debt
+    # ?detail=all -> همه ردیف‌ها، در غیر این صورت فقط جدیدترین‌ها
+    detail_limit = None if request.args.get('detail') == 'all' else ARREARS_DETAIL_LIMIT
     # Diagnostic: return raw data when requested by manager for debugging
     try:
         if request.args.get('_diag') and g.user and (g.user['role'] if isinstance(g.user, dict) or hasattr(g.user, '__getitem__') else getattr(g.user, 'role', None)) == 'manager':
             from flask import jsonify
             return jsonify({
-                'visit_arrears': visit_arrears,
-                'supplementary_arrears': supplementary_arrears,
-                'nursing_arrears': nursing_arrears,
+                'visit_arrears': arrears.visit_rows(),
+                'supplementary_arrears': arrears.supplementary_rows(),
+                'nursing_arrears': arrears.nursing_rows(),
                 'summary_by_insurance': summary_by_insurance,
                 'total_visit_debt': total_visit_debt,
                 'total_supplementary_debt': total_supplementary_debt,
@@ -2712,18 +2034,28 @@ def insurance_arrears():
     except Exception:
         pass
     
+    visit_arrears = arrears.visit_rows(detail_limit)
+    supplementary_arrears = arrears.supplementary_rows(detail_limit)
+    nursing_arrears = arrears.nursing_rows(detail_limit)
+    
     return render_template(
         'manager/insurance_arrears.html',
         visit_arrears=visit_arrears,
         supplementary_arrears=supplementary_arrears,
         nursing_arrears=nursing_arrears,
         summary_by_insurance=summary_by_insurance,
-        all_insurances=[i['insurance_type'] for i in all_insurances],
+        all_insurances=all_insurances,
         base_visit_price=base_visit_price,
         total_visit_debt=total_visit_debt,
         total_supplementary_debt=total_supplementary_debt,
         total_nursing_debt=total_nursing_debt,
         total_debt=total_debt,
+        arrears_counts={
+            'visit': totals['visit_count'],
+            'supplementary': totals['supplementary_count'],
+            'nursing': totals['nursing_count'],
+        },
+        detail_limit=detail_limit,
         active_filters={'from': date_from_jalali, 'to': date_to_jalali},
         insurance_filter=insurance_filter,
         jalali_ranges=ranges
@@ -2737,8 +2069,6 @@ def export_insurance_arrears():
     if g.user['role'] != 'manager':
         return jsonify({'error': 'دسترسی محدود'}), 403
     
-    db = get_db()
-    
     # دریافت فیلترها - تاریخ شمسی
     date_from_jalali = request.args.get('from', '')
     date_to_jalali = request.args.get('to', '')
@@ -2768,116 +2098,11 @@ def export_insurance_arrears():
         except Exception:
             pass
     
-    base_tariff = db.execute("SELECT * FROM visit_tariffs WHERE is_base_tariff = 1").fetchone()
-    if not base_tariff:
-        base_tariff = db.execute("SELECT * FROM visit_tariffs WHERE insurance_type = 'آزاد'").fetchone()
-    base_visit_price = base_tariff['tariff_price'] if base_tariff else 0
-    
-    # دریافت تعرفه‌های بیمه با پوشش پرستاری
-    insurance_tariffs = {}
-    tariffs_rows = db.execute("SELECT * FROM visit_tariffs WHERE insurance_type != 'آزاد' AND (is_base_tariff = 0 OR is_base_tariff IS NULL)").fetchall()
-    for t in tariffs_rows:
-        nursing_covers = False
-        try:
-            nursing_covers = bool(t['nursing_covers'])
-        except Exception:
-            pass
-        insurance_tariffs[t['insurance_type']] = {'nursing_covers': nursing_covers}
-    
-    # ویزیت‌ها
-    visit_query = """
-        SELECT v.visit_date, v.insurance_type, v.price as visit_price,
-               p.full_name as patient_name, p.national_id
-        FROM visits v
-        JOIN patients p ON v.patient_id = p.id
-        JOIN invoices inv ON v.invoice_id = inv.id
-        WHERE v.insurance_type IS NOT NULL AND v.insurance_type != 'آزاد'
-    """
-    params = []
-    if date_from_gregorian:
-        visit_query += " AND v.work_date >= ?"
-        params.append(date_from_gregorian)
-    if date_to_gregorian:
-        visit_query += " AND v.work_date <= ?"
-        params.append(date_to_gregorian)
-    if insurance_filter:
-        visit_query += " AND v.insurance_type = ?"
-        params.append(insurance_filter)
-    
-    visits = db.execute(visit_query, params).fetchall()
-    
-    # تزریقات
-    injection_query = """
-        SELECT i.injection_date, i.injection_type, i.total_price, i.service_id,
-               p.full_name as patient_name, p.national_id, inv.insurance_type
-        FROM injections i
-        JOIN patients p ON i.patient_id = p.id
-        JOIN invoices inv ON i.invoice_id = inv.id
-        WHERE inv.insurance_type IS NOT NULL AND inv.insurance_type != 'آزاد'
-    """
-    inj_params = []
-    if date_from_gregorian:
-        injection_query += " AND i.work_date >= ?"
-        inj_params.append(date_from_gregorian)
-    if date_to_gregorian:
-        injection_query += " AND i.work_date <= ?"
-        inj_params.append(date_to_gregorian)
-    if insurance_filter:
-        injection_query += " AND inv.insurance_type = ?"
-        inj_params.append(insurance_filter)
-    
-    injections = db.execute(injection_query, inj_params).fetchall()
-    
-    data = []
-    for v in visits:
-        ins_type = v['insurance_type']
-        ins_tariff = insurance_tariffs.get(ins_type, {})
-        patient_paid = ins_tariff.get('visit_tariff', 0) or 0  # تعرفه بیمه = سهم بیمار
-        insurance_debt = base_visit_price - patient_paid
-        if insurance_debt > 0:
-            data.append([
-                v['visit_date'],
-                v['patient_name'],
-                v['national_id'] or '',
-                v['insurance_type'],
-                'ویزیت',
-                base_visit_price,
-                patient_paid,
-                insurance_debt
-            ])
-    
-    for i in injections:
-        ins_type = i['insurance_type']
-        ins_tariff = insurance_tariffs.get(ins_type, {})
-        # Skip if insurance does not cover nursing
-        if not ins_tariff.get('nursing_covers', False):
-            continue
-        # If this injection's service is excluded for this insurance, skip it
-        svc_id = i.get('service_id')
-        excluded = False
-        try:
-            if svc_id is not None:
-                row = db.execute("SELECT 1 FROM insurance_nursing_exclusions WHERE insurance_type = ? AND nursing_service_id = ? LIMIT 1", (ins_type, svc_id)).fetchone()
-                if row:
-                    excluded = True
-        except Exception:
-            excluded = False
-        if excluded:
-            continue
-        service_price = i['total_price'] or 0
-        data.append([
-            i['injection_date'],
-            i['patient_name'],
-            i['national_id'] or '',
-            i['insurance_type'],
-            i['injection_type'],
-            '-',
-            '0',
-            service_price
-        ])
+    from src.adapters.sqlite.arrears_repo import InsuranceArrearsRepository
+    arrears = InsuranceArrearsRepository(date_from_gregorian, date_to_gregorian, insurance_filter)
     
     headers = ['تاریخ', 'نام بیمار', 'کد ملی', 'نوع بیمه', 'نوع خدمت', 'تعرفه پایه', 'پرداخت بیمار', 'معوقه بیمه']
-    return make_csv_response(data, headers, 'insurance_arrears.csv')
+    return stream_csv_response(arrears.iter_export_rows(), headers, 'insurance_arrears.csv')
 
 
 # ==================== تعرفه‌ها ====================
@@ -2919,6 +2144,7 @@ def nursing_tariffs():
                     "INSERT INTO nursing_services (service_name, unit_price, is_active) VALUES (?, ?, 1)",
                     (service_name, unit_price)
                 )
+                bump_tariff_generation(db)
                 db.commit()
                 flash(f'خدمت "{service_name}" با موفقیت اضافه شد.', 'success')
         
@@ -2937,6 +2163,7 @@ def nursing_tariffs():
                     "UPDATE nursing_services SET service_name = ?, unit_price = ?, is_active = ? WHERE id = ?",
                     (service_name, unit_price, 1 if is_active else 0, service_id)
                 )
+                bump_tariff_generation(db)
                 db.commit()
                 flash('تعرفه با موفقیت بروزرسانی شد.', 'success')
         
@@ -2944,6 +2171,7 @@ def nursing_tariffs():
             service_id = request.form.get('service_id')
             if service_id:
                 db.execute("DELETE FROM nursing_services WHERE id = ?", (service_id,))
+                bump_tariff_generation(db)
                 db.commit()
                 flash('خدمت با موفقیت حذف شد.', 'success')
         
@@ -2966,16 +2194,6 @@ def insurance_tariffs():
     
     db = get_db()
     
-    # اطمینان از وجود ستون‌های جدید
-    try:
-        db.execute("ALTER TABLE visit_tariffs ADD COLUMN nursing_covers INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    try:
-        db.execute("ALTER TABLE visit_tariffs ADD COLUMN is_base_tariff INTEGER DEFAULT 0")
-    except Exception:
-        pass
-    
     if request.method == 'POST':
         action = request.form.get('action')
         
@@ -3002,6 +2220,7 @@ def insurance_tariffs():
                         "INSERT INTO visit_tariffs (insurance_type, tariff_price, nursing_covers, is_active, is_supplementary) VALUES (?, ?, ?, 1, ?)",
                         (insurance_type, tariff_price, 1 if nursing_covers else 0, 1 if is_supplementary else 0)
                     )
+                    bump_tariff_generation(db)
                     db.commit()
                     flash(f'بیمه "{insurance_type}" با موفقیت اضافه شد.', 'success')
         
@@ -3022,6 +2241,7 @@ def insurance_tariffs():
                     "UPDATE visit_tariffs SET insurance_type = ?, tariff_price = ?, nursing_covers = ?, is_active = ?, is_supplementary = ? WHERE id = ?",
                     (insurance_type, tariff_price, 1 if nursing_covers else 0, 1 if is_active else 0, 1 if is_supplementary else 0, tariff_id)
                 )
+                bump_tariff_generation(db)
                 db.commit()
                 flash('تعرفه بیمه با موفقیت بروزرسانی شد.', 'success')
         
@@ -3034,6 +2254,7 @@ def insurance_tariffs():
                     flash('تعرفه پایه (آزاد) قابل حذف نیست.', 'error')
                 else:
                     db.execute("DELETE FROM visit_tariffs WHERE id = ?", (tariff_id,))
+                    bump_tariff_generation(db)
                     db.commit()
                     flash('بیمه با موفقیت حذف شد.', 'success')
         
@@ -3057,6 +2278,7 @@ def insurance_tariffs():
                     "INSERT INTO visit_tariffs (insurance_type, tariff_price, nursing_covers, is_active, is_supplementary, is_base_tariff) VALUES ('آزاد', ?, 0, 1, 0, 1)",
                     (base_price,)
                 )
+            bump_tariff_generation(db)
             db.commit()
             flash('تعرفه پایه (آزاد) با موفقیت ذخیره شد.', 'success')
         
@@ -3116,6 +2338,7 @@ def set_nursing_exclusions(insurance_type: str):
     db.execute("DELETE FROM insurance_nursing_exclusions WHERE insurance_type = ?", (insurance_type,))
     for sid in service_ids:
         db.execute("INSERT INTO insurance_nursing_exclusions (insurance_type, nursing_service_id) VALUES (?, ?)", (insurance_type, sid))
+    bump_tariff_generation(db)
     db.commit()
     return jsonify({'success': True, 'insurance_type': insurance_type, 'service_ids': service_ids})
 
@@ -3155,6 +2378,7 @@ def consumables_tariffs():
                         "INSERT INTO consumable_tariffs (name, default_price, category, is_active) VALUES (?, ?, ?, 1)",
                         (name, default_price, category)
                     )
+                    bump_tariff_generation(db)
                     db.commit()
                     flash(f'مصرفی "{name}" با موفقیت اضافه شد.', 'success')
         
@@ -3174,6 +2398,7 @@ def consumables_tariffs():
                     "UPDATE consumable_tariffs SET name = ?, default_price = ?, category = ?, is_active = ? WHERE id = ?",
                     (name, default_price, category, 1 if is_active else 0, item_id)
                 )
+                bump_tariff_generation(db)
                 db.commit()
                 flash('مصرفی با موفقیت بروزرسانی شد.', 'success')
         
@@ -3181,6 +2406,7 @@ def consumables_tariffs():
             item_id = request.form.get('item_id')
             if item_id:
                 db.execute("DELETE FROM consumable_tariffs WHERE id = ?", (item_id,))
+                bump_tariff_generation(db)
                 db.commit()
                 flash('مصرفی با موفقیت حذف شد.', 'success')
         
@@ -3276,6 +2502,7 @@ def users_management():
                                 (username, role, full_name, 1 if is_active else 0, user_id)
                             )
                         db.commit()
+                        user_cache.invalidate_user(user_id)
                         flash('کاربر با موفقیت بروزرسانی شد.', 'success')
             
             elif action == 'delete':
@@ -3284,6 +2511,7 @@ def users_management():
                 if user_id and int(user_id) != g.user['id']:
                     db.execute("DELETE FROM users WHERE id = ?", (user_id,))
                     db.commit()
+                    user_cache.invalidate_user(user_id)
                     flash('کاربر با موفقیت حذف شد.', 'success')
                 else:
                     flash('نمی‌توانید حساب کاربری خودتان را حذف کنید.', 'error')
@@ -3444,8 +2672,6 @@ def calculate_payroll():
     if g.user['role'] != 'manager':
         return jsonify({'error': 'دسترسی محدود'}), 403
     
-    db = get_db()
-    
     # دریافت پارامترها
     staff_id = request.form.get('staff_id')
     staff_type = request.form.get('staff_type')  # doctor یا nurse یا all
@@ -3485,294 +2711,10 @@ def calculate_payroll():
     work_date_from = date_from
     work_date_to = date_to
     
-    results = []
-    
-    # تعیین لیست پرسنل
-    if staff_id and staff_id != 'all':
-        staff_list = db.execute("""
-            SELECT m.*, p.base_morning, p.base_evening, p.base_night,
-                   p.visit_fee, p.injection_percent, p.procedure_percent, p.tax_percent,
-                   p.nursing_percent, p.nurse_procedure_percent
-            FROM medical_staff m
-            LEFT JOIN payroll_settings p ON m.id = p.staff_id
-            WHERE m.id = ? AND m.is_active = 1
-        """, (staff_id,)).fetchall()
-    else:
-        query = """
-            SELECT m.*, p.base_morning, p.base_evening, p.base_night,
-                   p.visit_fee, p.injection_percent, p.procedure_percent, p.tax_percent,
-                   p.nursing_percent, p.nurse_procedure_percent
-            FROM medical_staff m
-            LEFT JOIN payroll_settings p ON m.id = p.staff_id
-            WHERE m.is_active = 1
-        """
-        if staff_type and staff_type != 'all':
-            query += f" AND m.staff_type = '{staff_type}'"
-        staff_list = db.execute(query).fetchall()
-    
-    for person in staff_list:
-        person_id = person['id']
-        person_type = person['staff_type']
-        person_name = person['full_name']
-        
-        # تنظیمات حقوق
-        base_morning = person['base_morning'] or 0
-        base_evening = person['base_evening'] or 0
-        base_night = person['base_night'] or 0
-        
-        details = []
-        total_salary = 0
-        
-        # ========== محاسبه شیفت‌ها از کار واقعی (تزریقات/ویزیت/کار عملی) ==========
-        # توجه: جدول shift_staff فقط یک پزشک/پرستار در هر شیفت ذخیره می‌کند
-        # اما ممکن است چند نفر در یک شیفت کار کنند، پس از کار واقعی می‌خوانیم
-        # در نسخه جدید، تاریخ کاری از ساعت/شیفت مشتق نمی‌شود؛ از work_date استفاده می‌کنیم.
-        
-        if person_type == 'doctor':
-            # شیفت‌های پزشک - فقط از ویزیت‌ها (شیفت اصلی حضور پزشک)
-            # تزریقات و کارهای عملی تحت نظر پزشک در محاسبه شیفت لحاظ نمی‌شوند
-            # چون ممکن است توسط پذیرش دیگر در شیفت دیگر ثبت شوند
-            shift_query = f"""
-                SELECT shift, COUNT(*) as cnt FROM (
-                    SELECT DISTINCT work_date as work_date, shift
-                    FROM visits WHERE doctor_id = ?
-                ) AS actual_shifts
-            """
-            shift_params = [person_id]
-        else:
-            # شیفت‌های پرستار - بر اساس شیفت ویزیت در فاکتور
-            # منطق: پرستار حقوق پایه را فقط برای شیفتی دریافت می‌کند که ویزیت در آن شیفت ثبت شده
-            # نه شیفتی که تزریق یا کار عملی ثبت شده (چون ممکن است پذیرش دیگری در شیفت دیگر ثبت کرده باشد)
-            shift_query = f"""
-                SELECT shift, COUNT(*) as cnt FROM (
-                    SELECT DISTINCT v.work_date as work_date, v.shift
-                    FROM visits v
-                    JOIN invoices inv ON inv.id = v.invoice_id
-                    WHERE EXISTS (
-                        SELECT 1 FROM injections i WHERE i.invoice_id = inv.id AND i.nurse_id = ?
-                    ) OR EXISTS (
-                        SELECT 1 FROM procedures p WHERE p.invoice_id = inv.id AND p.nurse_id = ?
-                    )
-                ) AS actual_shifts
-            """
-            shift_params = [person_id, person_id]
-        
-        # اضافه کردن فیلتر تاریخ و فیلتر نوع شیفت
-        # قرار می‌دهیم WHERE بعد از derived table باشد (بعد از "AS actual_shifts")
-        # تا بتوانیم روی work_date مجموع union را فیلتر کنیم.
-        has_where = False
-        if work_date_from and work_date_to:
-            shift_query += f" WHERE work_date BETWEEN '{work_date_from}' AND '{work_date_to}'"
-            has_where = True
-
-        # اضافه کردن فیلتر نوع شیفت
-        if shift_filter and shift_filter != 'all':
-            if has_where:
-                shift_query += f" AND shift = '{shift_filter}'"
-            else:
-                shift_query += f" WHERE shift = '{shift_filter}'"
-
-        shift_query += " GROUP BY shift"
-        
-        shifts = db.execute(shift_query, shift_params).fetchall()
-        
-        morning_count = sum(s['cnt'] for s in shifts if s['shift'] == 'morning')
-        evening_count = sum(s['cnt'] for s in shifts if s['shift'] == 'evening')
-        night_count = sum(s['cnt'] for s in shifts if s['shift'] == 'night')
-        
-        shift_total = (morning_count * base_morning) + (evening_count * base_evening) + (night_count * base_night)
-        
-        if morning_count > 0:
-            details.append({
-                'type': 'شیفت صبح',
-                'count': morning_count,
-                'unit_price': base_morning,
-                'total': morning_count * base_morning
-            })
-        if evening_count > 0:
-            details.append({
-                'type': 'شیفت عصر',
-                'count': evening_count,
-                'unit_price': base_evening,
-                'total': evening_count * base_evening
-            })
-        if night_count > 0:
-            details.append({
-                'type': 'شیفت شب',
-                'count': night_count,
-                'unit_price': base_night,
-                'total': night_count * base_night
-            })
-        
-        total_salary += shift_total
-        
-        if person_type == 'doctor':
-            # ========== ویزیت‌ها ==========
-            visit_fee = person['visit_fee'] or 20000
-            # فقط ویزیت‌های فاکتورهای بسته‌شده را بشمار
-            visit_query = """SELECT COUNT(*) as cnt FROM visits v
-                             JOIN invoices inv ON v.invoice_id = inv.id
-                             WHERE inv.status = 'closed' AND v.doctor_id = ?"""
-            visit_params = [person_id]
-            
-            if work_date_from and work_date_to:
-                visit_query += " AND v.work_date BETWEEN ? AND ?"
-                visit_params.extend([work_date_from, work_date_to])
-            
-            if shift_filter and shift_filter != 'all':
-                visit_query += " AND v.shift = ?"
-                visit_params.append(shift_filter)
-            
-            visit_count = db.execute(visit_query, visit_params).fetchone()['cnt']
-            visit_total = visit_count * visit_fee
-            
-            if visit_count > 0:
-                details.append({
-                    'type': 'ویزیت',
-                    'count': visit_count,
-                    'unit_price': visit_fee,
-                    'total': visit_total
-                })
-            total_salary += visit_total
-            
-            # ========== تزریقات پزشک ==========
-            # فقط تزریقاتی که در همان فاکتور ویزیت پزشک هم وجود دارد
-            injection_percent = person['injection_percent'] or 30
-            inj_query = """SELECT SUM(i.total_price) as total FROM injections i
-                           JOIN invoices inv ON i.invoice_id = inv.id
-                           WHERE inv.status = 'closed' AND i.doctor_id = ?
-                           AND EXISTS (
-                               SELECT 1 FROM visits v 
-                               WHERE v.invoice_id = i.invoice_id 
-                               AND v.doctor_id = i.doctor_id
-                           )"""
-            inj_params = [person_id]
-            
-            if work_date_from and work_date_to:
-                inj_query += " AND i.work_date BETWEEN ? AND ?"
-                inj_params.extend([work_date_from, work_date_to])
-            
-            if shift_filter and shift_filter != 'all':
-                inj_query += " AND i.shift = ?"
-                inj_params.append(shift_filter)
-            
-            inj_result = db.execute(inj_query, inj_params).fetchone()
-            inj_total = (inj_result['total'] or 0) * injection_percent / 100
-            
-            if inj_total > 0:
-                details.append({
-                    'type': f'سهم تزریقات ({injection_percent}%)',
-                    'count': 1,
-                    'unit_price': inj_result['total'] or 0,
-                    'total': inj_total
-                })
-            total_salary += inj_total
-            
-            # ========== کار عملی پزشک ==========
-            procedure_percent = person['procedure_percent'] or 40
-            proc_query = """SELECT SUM(p.price) as total FROM procedures p
-                            JOIN invoices inv ON p.invoice_id = inv.id
-                            WHERE inv.status = 'closed' AND p.doctor_id = ?"""
-            proc_params = [person_id]
-            
-            if work_date_from and work_date_to:
-                proc_query += " AND p.work_date BETWEEN ? AND ?"
-                proc_params.extend([work_date_from, work_date_to])
-            
-            if shift_filter and shift_filter != 'all':
-                proc_query += " AND p.shift = ?"
-                proc_params.append(shift_filter)
-            
-            proc_result = db.execute(proc_query, proc_params).fetchone()
-            proc_total = (proc_result['total'] or 0) * procedure_percent / 100
-            
-            if proc_total > 0:
-                details.append({
-                    'type': f'سهم کار عملی ({procedure_percent}%)',
-                    'count': 1,
-                    'unit_price': proc_result['total'] or 0,
-                    'total': proc_total
-                })
-            total_salary += proc_total
-            
-            # ========== کسر مالیات ==========
-            tax_percent = person['tax_percent'] or 10
-            tax_amount = total_salary * tax_percent / 100
-            
-            details.append({
-                'type': f'کسر مالیات ({tax_percent}%)',
-                'count': 1,
-                'unit_price': total_salary,
-                'total': -tax_amount
-            })
-            total_salary -= tax_amount
-        
-        else:  # پرستار
-            # ========== خدمات پرستاری ==========
-            # Note: فعلاً از جدول injections استفاده می‌کنیم که nurse_id دارد
-            nursing_percent = person['nursing_percent'] or 6
-            
-            # تزریقات پرستار
-            nurse_inj_query = """SELECT SUM(i.total_price) as total FROM injections i
-                                 JOIN invoices inv ON i.invoice_id = inv.id
-                                 WHERE inv.status = 'closed' AND i.nurse_id = ?"""
-            nurse_inj_params = [person_id]
-            
-            if work_date_from and work_date_to:
-                nurse_inj_query += " AND i.work_date BETWEEN ? AND ?"
-                nurse_inj_params.extend([work_date_from, work_date_to])
-            
-            if shift_filter and shift_filter != 'all':
-                nurse_inj_query += " AND i.shift = ?"
-                nurse_inj_params.append(shift_filter)
-            
-            nurse_inj_result = db.execute(nurse_inj_query, nurse_inj_params).fetchone()
-            nursing_total = (nurse_inj_result['total'] or 0) * nursing_percent / 100
-            
-            if nursing_total > 0:
-                details.append({
-                    'type': f'سهم خدمات پرستاری ({nursing_percent}%)',
-                    'count': 1,
-                    'unit_price': nurse_inj_result['total'] or 0,
-                    'total': nursing_total
-                })
-            total_salary += nursing_total
-            
-            # ========== کار عملی پرستار ==========
-            nurse_procedure_percent = person['nurse_procedure_percent'] or 35
-            nurse_proc_query = """SELECT SUM(p.price) as total FROM procedures p
-                                  JOIN invoices inv ON p.invoice_id = inv.id
-                                  WHERE inv.status = 'closed' AND p.nurse_id = ?"""
-            nurse_proc_params = [person_id]
-            
-            if work_date_from and work_date_to:
-                nurse_proc_query += " AND p.work_date BETWEEN ? AND ?"
-                nurse_proc_params.extend([work_date_from, work_date_to])
-            
-            if shift_filter and shift_filter != 'all':
-                nurse_proc_query += " AND p.shift = ?"
-                nurse_proc_params.append(shift_filter)
-            
-            nurse_proc_result = db.execute(nurse_proc_query, nurse_proc_params).fetchone()
-            nurse_proc_total = (nurse_proc_result['total'] or 0) * nurse_procedure_percent / 100
-            
-            if nurse_proc_total > 0:
-                details.append({
-                    'type': f'سهم کار عملی پرستار ({nurse_procedure_percent}%)',
-                    'count': 1,
-                    'unit_price': nurse_proc_result['total'] or 0,
-                    'total': nurse_proc_total
-                })
-            total_salary += nurse_proc_total
-        
-        results.append({
-            'id': person_id,
-            'name': person_name,
-            'type': person_type,
-            'type_label': 'پزشک' if person_type == 'doctor' else 'پرستار',
-            'details': details,
-            'total_salary': total_salary
-        })
+    from src.adapters.sqlite.payroll_repo import PayrollRepository
+    repo = PayrollRepository()
+    staff_list = repo.get_staff(staff_id, staff_type)
+    results = repo.calculate(staff_list, work_date_from, work_date_to, shift_filter)
     
     return jsonify({'success': True, 'results': results})
 
@@ -3786,11 +2728,12 @@ def activity_logs():
     if g.user['role'] != 'manager':
         return redirect(url_for('reception.index'))
     
-    from src.services.activity_logger import get_activity_logs, get_logs_count, ActionType, ActionCategory
+    from src.services.activity_logger import get_activity_logs_page, get_logs_count, ActionType, ActionCategory
     
     # فیلترها
-    page = request.args.get('page', 1, type=int)
     per_page = 50
+    before = request.args.get('before', '')
+    after = request.args.get('after', '')
     user_id = request.args.get('user_id', type=int)
     action_type = request.args.get('action_type', '')
     action_category = request.args.get('action_category', '')
@@ -3799,19 +2742,7 @@ def activity_logs():
     search_text = request.args.get('patient_name', '')  # جستجو در نام بیمار و توضیحات
     invoice_id = request.args.get('invoice_id', type=int)
     
-    # دریافت لاگ‌ها با پارامترهای صحیح
-    logs = get_activity_logs(
-        user_id=user_id if user_id else None,
-        action_type=action_type if action_type else None,
-        action_category=action_category if action_category else None,
-        invoice_id=invoice_id if invoice_id else None,
-        date_from=date_from if date_from else None,
-        date_to=date_to if date_to else None,
-        search_text=search_text if search_text else None,
-        limit=per_page,
-        offset=(page - 1) * per_page
-    )
-    total = get_logs_count(
+    filter_kwargs = dict(
         user_id=user_id if user_id else None,
         action_type=action_type if action_type else None,
         action_category=action_category if action_category else None,
@@ -3820,7 +2751,22 @@ def activity_logs():
         date_to=date_to if date_to else None,
         search_text=search_text if search_text else None
     )
-    total_pages = (total + per_page - 1) // per_page
+    # صفحه‌بندی keyset: before/after = cursor ردیف مرز صفحه فعلی
+    page_data = get_activity_logs_page(
+        limit=per_page,
+        before=before if before else None,
+        after=after if after else None,
+        **filter_kwargs
+    )
+    logs = page_data['logs']
+    total, total_is_estimate = get_logs_count(**filter_kwargs)
+    # بدون فیلتر: تخمین (~)، با فیلتر: سقف شمارش (+)
+    if not total_is_estimate:
+        total_label = str(total)
+    elif any(filter_kwargs.values()):
+        total_label = f"{total}+"
+    else:
+        total_label = f"~{total}"
     
     # لیست کاربران برای فیلتر
     db = get_db()
@@ -3883,9 +2829,10 @@ def activity_logs():
     
     return render_template('manager/logs.html',
         logs=logs,
-        page=page,
-        total_pages=total_pages,
+        older_cursor=page_data['older'],
+        newer_cursor=page_data['newer'],
         total=total,
+        total_label=total_label,
         users=users,
         action_types=action_types,
         action_categories=action_categories,
@@ -3901,7 +2848,7 @@ def export_logs():
     if g.user['role'] != 'manager':
         return jsonify({'error': 'دسترسی غیرمجاز'}), 403
     
-    from src.services.activity_logger import get_activity_logs
+    from src.services.activity_logger import iter_activity_logs
     
     # فیلترها
     user_id = request.args.get('user_id', type=int)
@@ -3911,8 +2858,8 @@ def export_logs():
     date_to = request.args.get('date_to', '')
     search_text = request.args.get('patient_name', '')
     
-    # دریافت همه لاگ‌ها (بدون محدودیت)
-    logs = get_activity_logs(
+    # لاگ‌ها به صورت جریانی از cursor خوانده می‌شوند (بدون بارگذاری کامل در حافظه)
+    logs = iter_activity_logs(
         user_id=user_id if user_id else None,
         action_type=action_type if action_type else None,
         action_category=action_category if action_category else None,
@@ -3922,29 +2869,21 @@ def export_logs():
         limit=10000
     )
     
-    # ساخت CSV با BOM برای پشتیبانی فارسی در Excel
-    output = io.StringIO()
-    output.write('\ufeff')  # UTF-8 BOM
-    writer = csv.writer(output)
-    writer.writerow(['تاریخ', 'کاربر', 'نوع عملیات', 'دسته', 'توضیحات', 'بیمار', 'فاکتور', 'مبلغ'])
-    
-    for log in logs:
-        writer.writerow([
-            log.get('created_at', ''),
-            log.get('username', ''),
-            log.get('action_type', ''),
-            log.get('action_category', ''),
-            log.get('description', ''),
-            log.get('patient_name', ''),
-            log.get('invoice_id', ''),
-            log.get('amount', ''),
-        ])
-    
-    output.seek(0)
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-    response.headers['Content-Disposition'] = f'attachment; filename=logs_{iran_now().strftime("%Y%m%d_%H%M%S")}.csv'
-    return response
+    data = (
+        [
+            log['created_at'],
+            log['username'],
+            log['action_type'],
+            log['action_category'],
+            log['description'],
+            log['patient_name'],
+            log['invoice_id'],
+            log['amount'],
+        ]
+        for log in logs
+    )
+    headers = ['تاریخ', 'کاربر', 'نوع عملیات', 'دسته', 'توضیحات', 'بیمار', 'فاکتور', 'مبلغ']
+    return make_csv_response(data, headers, f'logs_{iran_now().strftime("%Y%m%d_%H%M%S")}.csv')
 
 
 @bp.route('/logs/stats')
@@ -3962,3 +2901,46 @@ def logs_stats():
     stats = get_action_stats(date_from, date_to)
     return jsonify({'success': True, 'stats': stats})
 
+
+
+# ====== عیب‌یابی کارایی (کوئری‌ها) ======
+
+@bp.route('/diagnostics')
+@login_required
+def diagnostics():
+    """مسیرها به ترتیب زمان دیتابیس + آخرین کوئری‌های کند (از شروع پروسه یا آخرین ریست)."""
+    if g.user['role'] != 'manager':
+        return redirect(url_for('reception.index'))
+    
+    from src.adapters.sqlite.query_stats import route_db_stats
+    from src.config.settings import Config
+    
+    routes = route_db_stats.top(30)
+    total_db_ms = sum(r['db_ms'] for r in routes) or 1
+    for r in routes:
+        r['share'] = r['db_ms'] * 100 / total_db_ms
+    slow = route_db_stats.recent_slow()
+    for s in slow:
+        s['at_text'] = datetime.fromtimestamp(s['at']).strftime('%Y-%m-%d %H:%M:%S')
+    
+    return render_template('manager/diagnostics.html',
+        routes=routes,
+        slow=slow,
+        since=datetime.fromtimestamp(route_db_stats.since).strftime('%Y-%m-%d %H:%M:%S'),
+        enabled=getattr(Config, 'SQL_INSTRUMENTATION', True),
+        slow_ms=getattr(Config, 'SLOW_QUERY_MS', 100),
+        slow_log_path=getattr(Config, 'SLOW_QUERY_LOG_PATH', None)
+    )
+
+
+@bp.route('/diagnostics/reset', methods=['POST'])
+@login_required
+def diagnostics_reset():
+    """صفر کردن آمار مسیرها."""
+    if g.user['role'] != 'manager':
+        return jsonify({'error': 'دسترسی غیرمجاز'}), 403
+    
+    from src.adapters.sqlite.query_stats import route_db_stats
+    route_db_stats.reset()
+    flash('آمار عیب‌یابی صفر شد', 'success')
+    return redirect(url_for('manager.diagnostics'))
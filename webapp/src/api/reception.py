@@ -4,6 +4,9 @@ from flask import (
 from src.api.auth import login_required
 from src.services.reception_service import ReceptionService
 from src.services.activity_logger import log_activity, ActionType, ActionCategory
+from src.adapters.sqlite.unit_of_work import transactional, fail
+from src.adapters.sqlite.daily_stats_repo import DailyStatsRepository
+from src.common.event_hub import event_hub
 from src.common.utils import iran_now
 from datetime import datetime, timedelta
 
@@ -31,8 +34,7 @@ def index():
     invoice_items = []
     if selected_invoice_id:
         invoice_details = invoice_repo.get_invoice_by_id(selected_invoice_id)
-        invoice_items = invoice_repo.get_invoice_items(selected_invoice_id)
-        financials = invoice_repo.get_financials(selected_invoice_id)
+        invoice_items, financials = invoice_repo.get_invoice_view(selected_invoice_id)
         from src.adapters.sqlite.payments_repo import InvoiceItemPaymentRepository
         pay_repo = InvoiceItemPaymentRepository()
         payments = pay_repo.get_payments_for_invoice(selected_invoice_id)
@@ -117,11 +119,8 @@ def _ensure_user_shift_state():
         user_shift = shift_repo.get_user_active_shift(g.user['id'])
         shift_started_at = user_shift.get('shift_started_at') if user_shift else None
         
-        # Get open invoice count with a faster COUNT query
-        from src.adapters.sqlite.core import get_db
-        db = get_db()
-        count_row = db.execute("SELECT COUNT(*) as cnt FROM invoices WHERE status = 'open'").fetchone()
-        open_count = count_row['cnt'] if count_row else 0
+        # تعداد فاکتورهای باز از کش event hub (با باز/بسته شدن فاکتور به‌روز می‌شود)
+        open_count = event_hub.open_invoice_count(InvoiceRepository().count_open_invoices)
 
         g.user_shift_status = {
             'active_shift': active_shift,
@@ -143,6 +142,7 @@ def _ensure_user_shift_state():
 
 @bp.route('/new', methods=('GET', 'POST'))
 @login_required
+@transactional
 def new_visit():
     """باز کردن فاکتور جدید برای بیمار (open new invoice)."""
     service = ReceptionService()
@@ -225,6 +225,7 @@ def new_visit():
     except Exception as e:
         import traceback
         traceback.print_exc()
+        fail()
         return jsonify({'error': f'خطا در باز کردن فاکتور: {str(e)}'}), 500
 
 @bp.route('/search_patient')
@@ -255,30 +256,15 @@ def search_patient():
 @bp.route('/patients/list')
 @login_required
 def list_patients():
-    """Return all patients or filtered by query (for modal search)."""
-    from src.adapters.sqlite.core import get_db
-    db = get_db()
+    """Return latest patients or FTS matches for the query (for modal search)."""
+    from src.adapters.sqlite.patients_repo import PatientRepository, SEARCH_LIMIT
     q = request.args.get('q','').strip()
-    if q:
-        rows = db.execute("""
-            SELECT p.id, p.name, p.family_name, p.national_id, p.phone_number,
-                   COALESCE(p.insurance_type, (
-                     SELECT insurance_type FROM invoices i WHERE i.patient_id = p.id ORDER BY i.id DESC LIMIT 1
-                   )) AS effective_insurance_type
-            FROM patients p
-            WHERE p.name LIKE ? OR p.family_name LIKE ? OR p.national_id LIKE ? OR p.phone_number LIKE ?
-            ORDER BY p.id DESC
-        """, (f'%{q}%', f'%{q}%', f'%{q}%', f'%{q}%')).fetchall()
-    else:
-        rows = db.execute("""
-            SELECT p.id, p.name, p.family_name, p.national_id, p.phone_number,
-                   COALESCE(p.insurance_type, (
-                     SELECT insurance_type FROM invoices i WHERE i.patient_id = p.id ORDER BY i.id DESC LIMIT 1
-                   )) AS effective_insurance_type
-            FROM patients p
-            ORDER BY p.id DESC
-            LIMIT 1000
-        """).fetchall()
+    try:
+        limit = max(1, min(int(request.args.get('limit', SEARCH_LIMIT)), 200))
+    except ValueError:
+        limit = SEARCH_LIMIT
+    repo = PatientRepository()
+    rows = repo.search(q, limit) if q else repo.recent(1000)
     return jsonify({'patients': [
         {
             'id': r['id'],
@@ -390,6 +376,7 @@ def patient_history(patient_id: int):
 
 @bp.route('/invoice/open_existing', methods=['POST'])
 @login_required
+@transactional
 def open_invoice_existing():
     """Directly open a new invoice for an existing patient id (used in history modal)."""
     pid = request.form.get('patient_id', type=int)
@@ -428,6 +415,7 @@ def open_invoice_existing():
 
 @bp.route('/shift_staff', methods=['POST'])
 @login_required
+@transactional
 def set_shift_staff_route():
     """Set doctor/nurse for current shift (global, not per-invoice).
     
@@ -486,6 +474,7 @@ def set_shift_staff_route():
 
 @bp.route('/add_visit', methods=['POST'])
 @login_required
+@transactional
 def add_visit_to_invoice():
     """Add a new visit item to selected invoice (like desktop 'ثبت ویزیت جدید').
     
@@ -542,6 +531,7 @@ def add_visit_to_invoice():
 
     # Update invoice totals
     invoice_repo.update_invoice_totals(invoice_id)
+    DailyStatsRepository().items_added('visit', [visit_id])
     
     # لاگ ثبت ویزیت
     log_activity(
@@ -560,6 +550,7 @@ def add_visit_to_invoice():
 
 @bp.route('/item/payment', methods=['POST'])
 @login_required
+@transactional
 def set_item_payment():
     """Set payment status/type for an item then return updated financials."""
     from src.adapters.sqlite.payments_repo import InvoiceItemPaymentRepository
@@ -593,8 +584,7 @@ def set_item_payment():
     pay_repo = InvoiceItemPaymentRepository()
     pay_repo.set_payment(invoice_id, item_type, item_id, payment_type, is_paid)
 
-    inv_repo.update_invoice_totals(invoice_id)
-    financials = inv_repo.get_financials(invoice_id)
+    financials = inv_repo.update_invoice_totals(invoice_id)
     
     # لاگ تغییر وضعیت پرداخت
     type_names = {'visit': 'ویزیت', 'injection': 'تزریق', 'procedure': 'کار عملی', 'consumable': 'مصرفی'}
@@ -617,6 +607,7 @@ def set_item_payment():
 
 @bp.route('/item/settle_all', methods=['POST'])
 @login_required
+@transactional
 def settle_all_items():
     """Set all items in an invoice as paid with the given payment type."""
     from src.adapters.sqlite.payments_repo import InvoiceItemPaymentRepository
@@ -636,20 +627,15 @@ def settle_all_items():
     if invoice_check.get('status') == 'closed':
         return jsonify({'error': 'فاکتور بسته شده است و امکان تغییر وضعیت پرداخت وجود ندارد'}), 400
 
-    # Get all items for this invoice
-    items = inv_repo.get_invoice_items(invoice_id)
-    pay_repo = InvoiceItemPaymentRepository()
-    # Set payment for each item
-    for it in items:
-        try:
-            pay_repo.set_payment(invoice_id, it.get('type'), it.get('id'), payment_type, True)
-        except Exception:
-            # continue on failure for individual items
-            continue
+    # همه آیتم‌ها در یک تراکنش (executemany) - یا همه تسویه می‌شوند یا هیچ‌کدام
+    try:
+        InvoiceItemPaymentRepository().settle_all(invoice_id, payment_type)
+    except Exception as e:
+        fail()
+        return jsonify({'error': f'خطا در تسویه آیتم‌ها: {str(e)}'}), 500
 
     # Update totals and return new financials
-    inv_repo.update_invoice_totals(invoice_id)
-    financials = inv_repo.get_financials(invoice_id)
+    financials = inv_repo.update_invoice_totals(invoice_id)
 
     # Log activity
     db = get_db()
@@ -671,6 +657,7 @@ def settle_all_items():
 
 @bp.route('/item/delete', methods=['POST'])
 @login_required
+@transactional
 def delete_item():
     """Delete an item from invoice (visit/injection/procedure/consumable)."""
     from src.adapters.sqlite.invoices_repo import InvoiceRepository
@@ -715,6 +702,8 @@ def delete_item():
         # حذف آیتم
         db.execute(f"DELETE FROM {table} WHERE id = ?", (item_id,))
         db.execute("DELETE FROM invoice_item_payments WHERE invoice_id = ? AND item_type = ? AND item_id = ?", (invoice_id, item_type, item_id))
+        # روز کاری آیتم حذف‌شده ممکن است با روز فاکتور فرق کند - از ردیف خودش
+        DailyStatsRepository().item_deleted(item_type, row)
         db.commit()
         
         # لاگ حذف
@@ -744,16 +733,15 @@ def delete_item():
         )
         
         inv_repo = InvoiceRepository()
-        inv_repo.update_invoice_totals(invoice_id)
-        financials = inv_repo.get_financials(invoice_id)
+        financials = inv_repo.update_invoice_totals(invoice_id)
         return jsonify({'success': True, 'financials': financials})
     except Exception as e:
-        if db:
-            db.rollback()
+        fail()
         return jsonify({'error': f'خطا در حذف آیتم: {str(e)}'}), 500
 
 @bp.route('/invoice/close', methods=['POST'])
 @login_required
+@transactional
 def close_invoice():
     """Close an invoice (prevent further item additions, enable ledger inclusion)."""
     from src.adapters.sqlite.invoices_repo import InvoiceRepository
@@ -771,12 +759,7 @@ def close_invoice():
     # Ensure every invoice item is marked as paid before closing
     from src.adapters.sqlite.payments_repo import InvoiceItemPaymentRepository
     pay_repo = InvoiceItemPaymentRepository()
-    items = repo.get_invoice_items(invoice_id)
-    unpaid_items = []
-    for it in items:
-        p = pay_repo.get_item_payment(invoice_id, it.get('type'), it.get('id'))
-        if not p or int(p.get('is_paid', 0)) != 1:
-            unpaid_items.append({'type': it.get('type'), 'id': it.get('id'), 'description': it.get('description')})
+    unpaid_items = pay_repo.get_unpaid_items(invoice_id)
     if unpaid_items:
         # Return a clear error listing count of unpaid items and the items themselves
         return jsonify({
@@ -786,6 +769,7 @@ def close_invoice():
 
     success = repo.close_invoice(invoice_id, g.user['username'])
     if not success:
+        fail()
         return jsonify({'error': 'بستن فاکتور ناموفق بود یا فاکتور قبلاً بسته شده'}), 400
     
     financials = repo.get_financials(invoice_id)
@@ -814,6 +798,7 @@ def nursing_form():
 
 @bp.route('/nursing', methods=['POST'])
 @login_required
+@transactional
 def nursing_submit():
     """ثبت خدمات پرستاری انتخاب شده و ایجاد رکورد تزریق برای هر واحد."""
     from src.adapters.sqlite.injections_repo import InjectionRepository
@@ -847,6 +832,7 @@ def nursing_submit():
     if not pairs and not consumables_raw:
         return jsonify({'error': 'هیچ موردی انتخاب نشده است'}), 400
     created_ids = []
+    consumable_ids = []
     from src.adapters.sqlite.consumables_repo import ConsumableLedgerRepository
     cons_repo = ConsumableLedgerRepository()
     try:
@@ -862,6 +848,7 @@ def nursing_submit():
                 qty = int(qty_str)
                 service = service_repo.get(sid)
                 if not service:
+                    fail()
                     return jsonify({'error': f'خدمت {sid} یافت نشد'}), 400
                 for _ in range(qty):
                     inj_id = inj_repo.add_injection(
@@ -885,6 +872,7 @@ def nursing_submit():
                 # name|category|qty|unit_price
                 parts = row.split('|')
                 if len(parts) != 4:
+                    fail()
                     return jsonify({'error': 'فرمت مصرفی نامعتبر'}), 400
                 # support optional patient_provided flag as 5th part (backwards-compatible)
                 name = parts[0]
@@ -899,10 +887,11 @@ def nursing_submit():
                     qty = float(qty_str)
                     unit_price = float(price_str)
                 except ValueError:
+                    fail()
                     return jsonify({'error': 'مقادیر عددی مصرفی نامعتبر'}), 400
                 # attach to invoice so it appears in the invoice view; mark patient_provided for reports
                 invoice_for_insert = invoice_id
-                cons_repo.add_consumable(
+                consumable_ids.append(cons_repo.add_consumable(
                     patient_id=invoice['patient_id'],
                     item_name=name,
                     category=category,
@@ -914,10 +903,12 @@ def nursing_submit():
                     patient_provided=1 if patient_provided else 0,
                     doctor_id=staff.get('doctor_id'),
                     nurse_id=staff.get('nurse_id')
-                )
+                ))
                 consumable_count += 1
-        inv_repo.update_invoice_totals(invoice_id)
-        financials = inv_repo.get_financials(invoice_id)
+        financials = inv_repo.update_invoice_totals(invoice_id)
+        stats_repo = DailyStatsRepository()
+        stats_repo.items_added('injection', created_ids)
+        stats_repo.items_added('consumable', consumable_ids)
         
         # لاگ ثبت خدمات پرستاری
         if created_ids or consumable_count:
@@ -945,6 +936,7 @@ def nursing_submit():
         
         return jsonify({'success': True, 'created_services': len(created_ids), 'created_consumables': consumable_count, 'financials': financials})
     except Exception as e:
+        fail()
         return jsonify({'error': f'خطا در ثبت: {str(e)}'}), 500
 
 @bp.route('/injections/new', methods=['GET'])
@@ -966,6 +958,7 @@ def injections_new():
 
 @bp.route('/injections', methods=['POST'])
 @login_required
+@transactional
 def injections_submit():
     """JSON endpoint submit nursing services + consumables + drugs.
     
@@ -1006,14 +999,16 @@ def injections_submit():
     from src.adapters.sqlite.nursing_services_repo import NursingServicesRepository
     from src.adapters.sqlite.consumables_repo import ConsumableLedgerRepository
     inj_repo = InjectionRepository(); ns_repo = NursingServicesRepository(); cons_repo = ConsumableLedgerRepository()
-    created_services = 0
+    created_services = 0; injection_ids = []
     for svc in services_payload:
         sid = svc.get('id'); qty = int(svc.get('qty', 0))
         if not sid or qty < 1: continue
         service = ns_repo.get(int(sid))
-        if not service: return jsonify({'error': f'خدمت {sid} نامعتبر'}), 400
+        if not service:
+            fail()
+            return jsonify({'error': f'خدمت {sid} نامعتبر'}), 400
         for _ in range(qty):
-            inj_repo.add_injection(
+            injection_ids.append(inj_repo.add_injection(
                 patient_id=invoice['patient_id'],
                 injection_type=service['service_name'],
                 count=1,
@@ -1024,8 +1019,8 @@ def injections_submit():
                 service_id=service['id'],
                 doctor_id=doctor_id,
                 nurse_id=nurse_id
-            ); created_services += 1
-    created_consumables = 0
+            )); created_services += 1
+    created_consumables = 0; consumable_ids = []
     for item in consumables_payload:
         name = (item.get('name') or '').strip();
         if not name: continue
@@ -1038,13 +1033,16 @@ def injections_submit():
         # We still mark `patient_provided` so reports can exclude them, but items
         # marked `is_exception` should still surface in manager reports.
         invoice_for_insert = invoice_id
-        cons_repo.add_consumable(
+        consumable_ids.append(cons_repo.add_consumable(
             patient_id=invoice['patient_id'], item_name=name, category=cat, quantity=qty,
             unit_price=unit_price, reception_user=g.user['username'], invoice_id=invoice_for_insert,
             notes=notes, patient_provided=patient_provided, is_exception=is_exception,
             doctor_id=doctor_id, nurse_id=nurse_id
-        ); created_consumables += 1
-    inv_repo.update_invoice_totals(invoice_id); financials = inv_repo.get_financials(invoice_id)
+        )); created_consumables += 1
+    financials = inv_repo.update_invoice_totals(invoice_id)
+    stats_repo = DailyStatsRepository()
+    stats_repo.items_added('injection', injection_ids)
+    stats_repo.items_added('consumable', consumable_ids)
     
     # لاگ ثبت تزریقات
     if created_services or created_consumables:
@@ -1091,6 +1089,7 @@ def procedures_new():
 
 @bp.route('/procedures', methods=['POST'])
 @login_required
+@transactional
 def procedures_submit():
     """Submit procedure items + consumables.
     
@@ -1129,7 +1128,7 @@ def procedures_submit():
     from src.adapters.sqlite.procedures_repo import ProcedureRepository
     from src.adapters.sqlite.consumables_repo import ConsumableLedgerRepository
     proc_repo = ProcedureRepository(); cons_repo = ConsumableLedgerRepository()
-    created_procs = 0; created_cons = 0
+    created_procs = 0; created_cons = 0; procedure_ids = []; consumable_ids = []
     
     # Add manual procedures
     for pr in procedures_payload:
@@ -1143,7 +1142,7 @@ def procedures_submit():
         actual_nurse_id = nurse_id if performer_type == 'nurse' else None
         if not name or unit_price <= 0 or qty < 1: continue
         for _ in range(qty):
-            proc_repo.add_procedure(
+            procedure_ids.append(proc_repo.add_procedure(
                 patient_id=invoice['patient_id'],
                 procedure_type=name,
                 price=unit_price,
@@ -1154,7 +1153,7 @@ def procedures_submit():
                 performer_id=performer_id,
                 doctor_id=actual_doctor_id,
                 nurse_id=actual_nurse_id
-            ); created_procs += 1
+            )); created_procs += 1
     # Add consumables ledger entries
     for item in consumables_payload:
         name = (item.get('name') or '').strip(); qty = float(item.get('qty',0) or 0); unit_price = float(item.get('unit_price',0) or 0)
@@ -1164,13 +1163,16 @@ def procedures_submit():
         if not name or qty <= 0: continue
         # attach to invoice so it appears in the invoice view; mark patient_provided and is_exception for reports
         invoice_for_insert = invoice_id
-        cons_repo.add_consumable(
+        consumable_ids.append(cons_repo.add_consumable(
             patient_id=invoice['patient_id'], item_name=name, category=category, quantity=qty,
             unit_price=unit_price, reception_user=g.user['username'], invoice_id=invoice_for_insert,
             notes=notes, patient_provided=patient_provided, is_exception=is_exception,
             doctor_id=doctor_id, nurse_id=nurse_id
-        ); created_cons += 1
-    inv_repo.update_invoice_totals(invoice_id); financials = inv_repo.get_financials(invoice_id)
+        )); created_cons += 1
+    financials = inv_repo.update_invoice_totals(invoice_id)
+    stats_repo = DailyStatsRepository()
+    stats_repo.items_added('procedure', procedure_ids)
+    stats_repo.items_added('consumable', consumable_ids)
     
     # لاگ ثبت کار عملی
     if created_procs or created_cons:
@@ -1504,6 +1506,7 @@ def my_shifts_report():
 def _generate_shift_report(db, work_date: str, shift: str, username: str) -> dict:
     """Generate comprehensive shift report with all details."""
     from src.common.jalali import Gregorian
+    from src.adapters.sqlite.tariff_cache import get_tariffs
     
     if not work_date or not shift:
         return {}
@@ -1526,28 +1529,25 @@ def _generate_shift_report(db, work_date: str, shift: str, username: str) -> dic
     # - معوقه بیمه پایه = تعرفه پایه - سهم بیمار
     # - اگر بیمه تکمیلی وجود داشته باشد: معوقه تکمیلی = سهم بیمارِ بیمه پایه - سهم نهایی بیمار با تکمیلی
 
-    base_tariff = db.execute("SELECT tariff_price FROM visit_tariffs WHERE is_base_tariff = 1 AND is_active = 1 LIMIT 1").fetchone()
-    if not base_tariff:
-        base_tariff = db.execute("SELECT tariff_price FROM visit_tariffs WHERE insurance_type = 'آزاد' AND is_active = 1 LIMIT 1").fetchone()
+    tariffs = get_tariffs()
+    base_tariff = tariffs.base_tariff(active_only=True)
     base_visit_price = float(base_tariff['tariff_price']) if base_tariff and base_tariff['tariff_price'] is not None else 0.0
 
-    insurance_tariffs_rows = db.execute("""
-        SELECT insurance_type, tariff_price
-        FROM visit_tariffs
-        WHERE insurance_type != 'آزاد'
-          AND COALESCE(is_supplementary, 0) = 0
-          AND COALESCE(is_base_tariff, 0) = 0
-          AND is_active = 1
-    """).fetchall()
+    # تعرفه‌های فعال بیمه پایه (غیر آزاد، غیر تکمیلی، غیر پایه)
+    insurance_tariffs_rows = [
+        r for r in tariffs.visit_tariffs
+        if r['insurance_type'] != 'آزاد'
+        and not (r.get('is_supplementary') or 0)
+        and not (r.get('is_base_tariff') or 0)
+        and r['is_active'] == 1
+    ]
     insurance_tariffs = {r['insurance_type']: float(r['tariff_price'] or 0) for r in insurance_tariffs_rows}
 
-    supplementary_rows = db.execute("""
-        SELECT insurance_type, tariff_price
-        FROM visit_tariffs
-        WHERE COALESCE(is_supplementary, 0) = 1
-          AND is_active = 1
-    """).fetchall()
-    supplementary_tariffs = {r['insurance_type']: float(r['tariff_price'] or 0) for r in supplementary_rows}
+    supplementary_tariffs = {
+        r['insurance_type']: float(r['tariff_price'] or 0)
+        for r in tariffs.visit_tariffs
+        if (r.get('is_supplementary') or 0) == 1 and r['is_active'] == 1
+    }
 
     visits_for_arrears = db.execute("""
         SELECT v.id, v.insurance_type, v.supplementary_insurance
@@ -1588,15 +1588,7 @@ def _generate_shift_report(db, work_date: str, shift: str, username: str) -> dic
     """, (work_date, shift, username)).fetchone()
     
     # خدمات پرستاری - معوقه بیمه (طبق منطق پنل مدیر: nursing_covers و استثناها)
-    nursing_tariffs_rows = db.execute("""
-        SELECT insurance_type, nursing_covers
-        FROM visit_tariffs
-        WHERE insurance_type != 'آزاد'
-          AND COALESCE(is_supplementary, 0) = 0
-          AND COALESCE(is_base_tariff, 0) = 0
-          AND is_active = 1
-    """).fetchall()
-    nursing_covers_map = {r['insurance_type']: bool(r['nursing_covers']) for r in nursing_tariffs_rows}
+    nursing_covers_map = {r['insurance_type']: bool(r['nursing_covers']) for r in insurance_tariffs_rows}
 
     nursing_arrears_rows = db.execute("""
         SELECT inj.id, inj.total_price, inj.service_id, inv.insurance_type
@@ -1612,15 +1604,9 @@ def _generate_shift_report(db, work_date: str, shift: str, username: str) -> dic
         ins_type = r['insurance_type']
         if not nursing_covers_map.get(ins_type, False):
             continue
-        svc_id = r['service_id']
-        if svc_id is not None:
-            excluded = db.execute(
-                "SELECT 1 FROM insurance_nursing_exclusions WHERE insurance_type = ? AND nursing_service_id = ? LIMIT 1",
-                (ins_type, int(svc_id)),
-            ).fetchone()
-            if excluded:
-                # این خدمت پرستاری برای این بیمه استثنا شده (پوشش ندارد)
-                continue
+        if tariffs.is_excluded(ins_type, r['service_id']):
+            # این خدمت پرستاری برای این بیمه استثنا شده (پوشش ندارد)
+            continue
 
         nursing_pending_total += float(r['total_price'] or 0.0)
         nursing_pending_count += 1
@@ -1901,8 +1887,7 @@ def get_invoice_details_api(invoice_id):
     if not invoice:
         return jsonify({'error': 'فاکتور یافت نشد'}), 404
     
-    items = invoice_repo.get_invoice_items(invoice_id)
-    financials = invoice_repo.get_financials(invoice_id)
+    items, financials = invoice_repo.get_invoice_view(invoice_id)
     
     # Convert datetime fields to Jalali string (already converted to Iran time)
     if invoice.get('opened_at'):
@@ -1932,10 +1917,13 @@ def get_shift_status():
     Get current shift status for the logged-in user.
     Returns: active_shift, work_date, open_invoices_count
     """
+    return jsonify(_shift_status_payload(g.user['id']))
+
+
+def _shift_status_payload(user_id: int) -> dict:
     from src.adapters.sqlite.user_shift_repo import UserShiftRepository
     from src.adapters.sqlite.invoices_repo import InvoiceRepository
-    
-    user_id = g.user['id']
+
     shift_repo = UserShiftRepository()
     invoice_repo = InvoiceRepository()
     
@@ -1944,9 +1932,8 @@ def get_shift_status():
     user_shift = shift_repo.get_user_active_shift(user_id)
     shift_started_at = user_shift.get('shift_started_at') if user_shift else None
     
-    # Count open invoices
-    open_invoices = invoice_repo.get_open_invoices()
-    open_count = len(open_invoices) if open_invoices else 0
+    # Count open invoices (cached, no full open-invoice join)
+    open_count = event_hub.open_invoice_count(invoice_repo.count_open_invoices)
     
     # Shift names in Persian
     shift_names = {
@@ -1955,7 +1942,7 @@ def get_shift_status():
         'night': 'شب'
     }
     
-    return jsonify({
+    return {
         'active_shift': active_shift,
         'active_shift_fa': shift_names.get(active_shift, active_shift),
         'work_date': work_date,
@@ -1968,11 +1955,52 @@ def get_shift_status():
             {'key': 'evening', 'label': 'عصر'},
             {'key': 'night', 'label': 'شب'},
         ],
+    }
+
+
+@bp.route('/api/events', methods=['GET'])
+@login_required
+def events_stream():
+    """Server-Sent Events: shift status, open-invoice count and invoice open/close.
+
+    The first message is a full `status` snapshot; after that only changes
+    are pushed (``open_invoices``, ``invoice_opened``, ``invoice_closed``,
+    ``shift_changed``). A comment line is sent every SSE_HEARTBEAT_SECONDS to
+    keep proxies from closing the connection.
+    """
+    from flask import Response
+    from src.common.event_hub import format_sse
+    from src.config.settings import Config
+
+    user_id = g.user['id']
+    # اول subscribe، بعد snapshot: تغییری که بین این دو رخ دهد از دست نمی‌رود
+    sub = event_hub.subscribe(user_id)
+    try:
+        snapshot = _shift_status_payload(user_id)
+    except Exception:
+        event_hub.unsubscribe(sub)
+        raise
+    heartbeat = getattr(Config, 'SSE_HEARTBEAT_SECONDS', 15)
+
+    # بدون stream_with_context: کانکشن دیتابیس درخواست همین‌جا آزاد می‌شود و stream به DB نیاز ندارد
+    def stream():
+        try:
+            yield 'retry: 5000\n' + format_sse('status', snapshot)
+            while not sub.closed:
+                message = sub.get(timeout=heartbeat)
+                yield message if message is not None else ': keepalive\n\n'
+        finally:
+            event_hub.unsubscribe(sub)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
     })
 
 
 @bp.route('/api/shift/change', methods=['POST'])
 @login_required
+@transactional
 def change_shift():
     """
     Change user's active shift (manual).
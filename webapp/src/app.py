@@ -91,9 +91,65 @@ def create_app(test_config=None):
         else:
             print(f"User {username} already exists or error occurred.")
 
+    @app.cli.command("migrate")
+    @click.option("--dry-run", is_flag=True, help="Only list pending migrations.")
+    def migrate(dry_run):
+        """Apply pending schema migrations (tracked by PRAGMA user_version)."""
+        from src.adapters.sqlite.core import get_pool
+        from src.adapters.sqlite.migrations import LATEST_VERSION, current_version, run_migrations
+        # کانکشن مستقیم از pool: get_db خودش migrate می‌کند و dry-run بی‌معنی می‌شود
+        pool = get_pool()
+        db = pool.acquire()
+        try:
+            version = current_version(db)
+            steps = run_migrations(db, dry_run=dry_run, verbose=not dry_run)
+            if dry_run:
+                print(f"Schema version {version} (latest {LATEST_VERSION}); {len(steps)} pending.")
+                for m in steps:
+                    print(f"  {m.version}: {m.name}")
+            else:
+                print(f"Schema version {version} -> {current_version(db)} (latest {LATEST_VERSION}).")
+        finally:
+            pool.release(db)
+
+    @app.cli.command("archive-logs")
+    @click.option("--months", type=int, default=None, help="Months kept live (default ACTIVITY_LOG_RETENTION_MONTHS).")
+    @click.option("--dry-run", is_flag=True, help="Only list the months that would move.")
+    @click.option("--vacuum", is_flag=True, help="VACUUM the main database afterwards to return the space.")
+    def archive_logs(months, dry_run, vacuum):
+        """Move old activity logs to the archive database (whole months)."""
+        from src.adapters.sqlite.core import get_pool
+        from src.adapters.sqlite.log_archive import archive_logs as run_archive, archive_path
+        pool = get_pool()
+        db = pool.acquire()
+        try:
+            moved = run_archive(db, months=months, dry_run=dry_run)
+            verb = "Would move" if dry_run else "Moved"
+            for month, rows in moved:
+                print(f"  {month}: {rows} rows")
+            print(f"{verb} {sum(r for _, r in moved)} log rows in {len(moved)} months -> {archive_path()}")
+            if vacuum and moved and not dry_run:
+                db.execute("VACUUM main")
+                print("Main database vacuumed.")
+        finally:
+            pool.release(db)
+
+    @app.cli.command("rebuild-daily-stats")
+    def rebuild_daily_stats():
+        """Recompute the daily_stats rollup from source tables."""
+        from src.adapters.sqlite.daily_stats_repo import DailyStatsRepository
+        rows = DailyStatsRepository().rebuild()
+        print(f"daily_stats rebuilt: {rows} rows.")
+
+    # --------- شمارش و زمان‌سنجی کوئری‌ها (قبل از لود کاربر ثبت می‌شود تا آن هم شمرده شود) ---------
+    from src.adapters.sqlite.query_stats import init_query_stats
+    init_query_stats(app)
+    from src.common.metrics import init_metrics
+    init_metrics(app)
+
     # --------- لود کاربر لاگین‌شده ---------
     from flask import session, g
-    from src.adapters.sqlite.core import get_db
+    from src.adapters.sqlite.user_cache import user_cache
 
     @app.before_request
     def load_logged_in_user():
@@ -111,10 +167,8 @@ def create_app(test_config=None):
         if user_id is None:
             g.user = None
         else:
-            db = get_db()
-            g.user = db.execute(
-                "SELECT * FROM users WHERE id = ?", (user_id,)
-            ).fetchone()
+            # کش پروسه‌ای - بدون کوئری در هر درخواست (با ویرایش کاربر invalidate می‌شود)
+            g.user = user_cache.get_user(user_id)
 
     # --------- ثبت Blueprints ---------
     from src.api.auth import bp as auth_bp
@@ -0,0 +1,117 @@
+"""
+Event Hub
+پخش رویدادهای پذیرش (باز/بسته شدن فاکتور، تعداد فاکتورهای باز، تغییر شیفت) به کلاینت‌های SSE
+
+In-process publish/subscribe: repositories publish after their transaction
+commits, `/reception/api/events` streams to browsers. Each subscriber owns a
+bounded queue; a client that stops reading is dropped instead of blocking
+publishers. The open-invoice count is cached here so requests do not need a
+``COUNT(*)`` each time.
+"""
+
+import json
+import queue
+import threading
+from typing import Callable, Dict, Optional
+
+from src.common.metrics import metrics
+
+
+class Subscription:
+    """One connected client. ``user_id`` limits user-scoped events (shift changes)."""
+
+    def __init__(self, user_id: Optional[int], max_queue: int):
+        self.user_id = user_id
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+
+    def get(self, timeout: float) -> Optional[str]:
+        """Next formatted SSE message, or None on timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+def format_sse(event: str, data: Dict) -> str:
+    payload = json.dumps(data, ensure_ascii=False, default=str)
+    return f"event: {event}\ndata: {payload}\n\n"
+
+
+class EventHub:
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        self._subs = set()
+        self._lock = threading.Lock()
+        # شمارش و ذخیره تعداد فاکتورهای باز سریالی است تا شمارش قدیمی‌تر روی جدیدتر ننشیند
+        self._count_lock = threading.Lock()
+        self._open_count: Optional[int] = None
+
+    # ---------- subscribers ----------
+
+    def subscribe(self, user_id: Optional[int] = None) -> Subscription:
+        sub = Subscription(user_id, self.max_queue)
+        with self._lock:
+            self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        sub.closed = True
+        with self._lock:
+            self._subs.discard(sub)
+
+    def publish(self, event: str, data: Dict, user_id: Optional[int] = None) -> None:
+        """Send to every subscriber (or only to ``user_id``'s subscribers)."""
+        message = format_sse(event, data)
+        with self._lock:
+            subs = list(self._subs)
+        for sub in subs:
+            if user_id is not None and sub.user_id != user_id:
+                continue
+            try:
+                sub.queue.put_nowait(message)
+            except queue.Full:
+                # کلاینت کند/قطع - حذف می‌شود و با reconnect وضعیت کامل را می‌گیرد
+                self.unsubscribe(sub)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'subscribers': len(self._subs), 'open_invoices_count': self._open_count}
+
+    # ---------- open-invoice count ----------
+
+    def open_invoice_count(self, loader: Callable[[], int]) -> int:
+        """Cached count; ``loader`` runs only on first use or after `invalidate`."""
+        count = self._open_count
+        if count is None:
+            with self._count_lock:
+                count = self._open_count
+                if count is None:
+                    count = self._open_count = loader()
+        return count
+
+    def refresh_open_invoice_count(self, loader: Callable[[], int]) -> None:
+        """Recount after a committed change and broadcast the count when it changed.
+
+        ``loader`` runs under the hub's count lock, so concurrent commits
+        recount one after another and the last stored count is the newest.
+        """
+        with self._count_lock:
+            count = loader()
+            changed = count != self._open_count
+            self._open_count = count
+            if changed:
+                self.publish('open_invoices', {'open_invoices_count': count})
+
+    def invalidate(self) -> None:
+        """Forget cached state (database restored/reset)."""
+        with self._count_lock:
+            self._open_count = None
+
+
+event_hub = EventHub()
+
+metrics.gauge('clinic_open_invoices', 'Open invoices (cached count; absent until first loaded).',
+              fn=lambda: event_hub.stats()['open_invoices_count'])
+metrics.gauge('clinic_sse_subscribers', 'Connected reception event-stream clients.',
+              fn=lambda: event_hub.stats()['subscribers'])
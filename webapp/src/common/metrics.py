@@ -0,0 +1,237 @@
+"""
+Metrics Registry
+شمارنده، گیج و هیستوگرام درون‌پروسه‌ای - خروجی متنی Prometheus در /metrics
+
+Modules define their metrics at import time through the `metrics`
+registry and update them in place; `render` produces the Prometheus text
+exposition format (0.0.4), so a local Prometheus or plain ``curl`` can
+scrape it. Gauges can take a callback that is read at scrape time (pool
+size, queue depth), so nothing has to push those values.
+"""
+
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _labels_text(names: Sequence[str], values: Sequence, extra: Tuple = ()) -> str:
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in pairs) + '}'
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+        if not self.labelnames:
+            # بدون برچسب از همان ابتدا با صفر نمایش داده می‌شود
+            self._values[()] = self._zero()
+
+    def _zero(self):
+        return 0
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name}: expected labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f'{self.name}{_labels_text(self.labelnames, key)} {_format_value(v)}' for key, v in items]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Set directly, or pass ``fn`` returning a number (no labels) or ``{label-values tuple: number}``."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), fn: Optional[Callable] = None):
+        super().__init__(name, documentation, labels)
+        self.fn = fn
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> List[str]:
+        if self.fn is None:
+            return super().samples()
+        try:
+            value = self.fn()
+        except Exception:
+            # کالبک خراب نباید کل /metrics را از کار بیندازد
+            return []
+        if value is None:
+            return []
+        if isinstance(value, dict):
+            return [f'{self.name}{_labels_text(self.labelnames, key)} {_format_value(v)}'
+                    for key, v in value.items() if v is not None]
+        return [f'{self.name} {_format_value(value)}']
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        super().__init__(name, documentation, labels)
+
+    def _zero(self):
+        return [[0] * len(self.buckets), 0.0, 0]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = self._zero()
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(key, (list(s[0]), s[1], s[2])) for key, s in self._values.items()]
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = (('le', _format_value(bound)),)
+                lines.append(f'{self.name}_bucket{_labels_text(self.labelnames, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels_text(self.labelnames, key)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_labels_text(self.labelnames, key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'metric {name} already registered as {metric.kind}')
+            return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labels)
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = (),
+              fn: Optional[Callable] = None) -> Gauge:
+        gauge = self._register(Gauge, name, documentation, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram, name, documentation, labels, buckets=buckets)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.header())
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_started_at = time.time()
+metrics.gauge('clinic_process_start_time_seconds', 'Start time of the process (unix seconds).',
+              fn=lambda: _started_at)
+
+http_requests = metrics.counter(
+    'clinic_http_requests_total', 'HTTP requests by endpoint, method and status.',
+    ('endpoint', 'method', 'status'))
+http_latency = metrics.histogram(
+    'clinic_http_request_duration_seconds', 'Request handling time by endpoint (until the response is returned).',
+    ('endpoint', 'method'))
+http_in_flight = metrics.gauge('clinic_http_requests_in_flight', 'Requests being handled now.')
+
+
+def init_metrics(app) -> None:
+    """Request count/latency hooks (skipped when METRICS_ENABLED is off)."""
+    from flask import g, request
+    from src.config.settings import Config
+
+    if not getattr(Config, 'METRICS_ENABLED', True):
+        return
+
+    @app.before_request
+    def _metrics_start():
+        g.metrics_started = time.perf_counter()
+        http_in_flight.inc()
+
+    @app.after_request
+    def _metrics_finish(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            http_in_flight.dec()
+            # فقط endpointهای ثبت‌شده - مسیرهای ناشناخته (404) یک برچسب مشترک دارند
+            endpoint = request.endpoint or 'unmatched'
+            http_requests.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+            http_latency.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method)
+        return response
+
+    @app.teardown_request
+    def _metrics_abort(exc):
+        # after_request اجرا نشده (exception) - شمارنده در جریان نباید بالا بماند
+        if g.pop('metrics_started', None) is not None:
+            http_in_flight.dec()
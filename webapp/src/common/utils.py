@@ -147,3 +147,21 @@ def get_datetime_range_for_date_range(date_from: str, date_to: str) -> tuple[str
     datetime_to = next_day.strftime('%Y-%m-%d') + ' 00:00:00'
 
     return datetime_from, datetime_to
+
+
+# یکسان‌سازی حروف عربی/فارسی و ارقام برای جستجو
+PERSIAN_NORMALIZE_MAP = {
+    'ي': 'ی', 'ى': 'ی',
+    'ك': 'ک',
+    '\u200c': ' ',  # نیم‌فاصله
+    **{chr(0x06F0 + i): str(i) for i in range(10)},  # ارقام فارسی
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # ارقام عربی
+}
+_PERSIAN_NORMALIZE_TABLE = str.maketrans(PERSIAN_NORMALIZE_MAP)
+
+
+def normalize_persian(text: str | None) -> str:
+    """Normalize Arabic yeh/kaf, Persian/Arabic digits and ZWNJ for search matching."""
+    if not text:
+        return ''
+    return text.translate(_PERSIAN_NORMALIZE_TABLE)
@@ -20,11 +20,56 @@ class Config:
     # Database file location
     DATABASE_PATH = os.path.join(PROJECT_ROOT, 'clinic_new.db')
 
+    # SQLite connection pool / pragma tuning (see adapters/sqlite/core.py)
+    DB_POOL_SIZE = 8              # max idle connections kept for reuse
+    DB_POOL_MAX = 32              # max open connections (idle + borrowed)
+    DB_POOL_WAIT_SECONDS = 10     # wait this long for a free connection before failing
+    DB_BUSY_TIMEOUT_MS = 5000     # wait this long on a locked DB before failing
+    DB_CACHE_SIZE_KB = 20000      # page cache per connection (~20 MB)
+    DB_MMAP_SIZE = 268435456      # 256 MB memory-mapped I/O
+    DB_TX_RETRIES = 5             # BEGIN IMMEDIATE / COMMIT retries on SQLITE_BUSY
+    DB_TX_BACKOFF_MS = 25         # first retry delay (doubles each attempt, with jitter)
+    USER_CACHE_TTL_SECONDS = 30   # cached users / user_active_shift rows (see user_cache.py)
+
+    # Activity log writer (see services/log_writer.py)
+    ACTIVITY_LOG_ASYNC = True             # write activity_logs from a background thread
+    ACTIVITY_LOG_BATCH_SIZE = 100         # flush after this many rows...
+    ACTIVITY_LOG_FLUSH_MS = 200           # ...or this many ms after the first queued row
+    ACTIVITY_LOG_QUEUE_MAX = 5000         # bounded queue (backpressure)
+    ACTIVITY_LOG_ENQUEUE_TIMEOUT_MS = 50  # wait on a full queue, then write synchronously
+    LOG_COUNT_CAP = 10000                 # filtered log viewer counts stop here ("10000+")
+    LOG_COUNT_CACHE_SECONDS = 60          # unfiltered total is an id-range estimate cached this long
+
+    # Activity log archive (see adapters/sqlite/log_archive.py)
+    ACTIVITY_LOG_RETENTION_MONTHS = 3     # whole months older than this move to the archive DB
+    ACTIVITY_LOG_ARCHIVE_PATH = None      # default: <DATABASE_PATH stem>_logs_archive.db
+    ACTIVITY_LOG_ARCHIVE_AUTO = True      # archive during the weekly automatic backup run
+
+    # SQL instrumentation (see adapters/sqlite/query_stats.py, /manager/diagnostics)
+    SQL_INSTRUMENTATION = True            # per-request query count/time + Server-Timing header
+    SLOW_QUERY_MS = 100                   # statements slower than this go to the slow query log
+    SLOW_QUERY_LOG_PATH = os.path.join(PROJECT_ROOT, 'logs', 'slow_queries.log')
+    SLOW_QUERY_LOG_MAX_BYTES = 1_000_000  # rotate after ~1 MB...
+    SLOW_QUERY_LOG_BACKUPS = 5            # ...keeping this many old files
+
+    # Prometheus text endpoint (see common/metrics.py, /metrics)
+    METRICS_ENABLED = True
+    METRICS_ALLOW_REMOTE = False          # False: only localhost (or a logged-in manager) may scrape
+
+    # Reception push channel (see common/event_hub.py, /reception/api/events)
+    SSE_HEARTBEAT_SECONDS = 15
+
     DEBUG = True
     TESTING = False
 
     # Folder where automatic backups are stored (used by scheduler)
     BACKUP_FOLDER = os.path.join(PROJECT_ROOT, 'backups')
+    BACKUP_PAGES_PER_STEP = 256   # pages copied per backup step (SQLite backup API)
+    BACKUP_STEP_SLEEP_MS = 5      # pause between steps so requests keep flowing
+    BACKUP_COMPRESS = True        # gzip automatic full backups (.db.gz)
+    BACKUP_INCREMENTAL = True     # automatic backups store only changed pages between fulls
+    BACKUP_FULL_EVERY = 4         # one full automatic backup every N runs (rest incremental)
+    BACKUP_KEEP = 4               # automatic backups kept (weekly -> 4 weeks); a kept increment also keeps its base
 
 
 class TestConfig(Config):
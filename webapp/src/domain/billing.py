@@ -0,0 +1,184 @@
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+@dataclass
+class TariffSnapshot:
+    """In-memory copy of the tariff tables needed to price invoice items.
+
+    Loaded once (a couple of small queries) instead of once per visit row.
+    """
+    base_visit_price: float = 0.0
+    # insurance_type -> patient share (active, non-supplementary rows)
+    insurance_prices: Dict[str, float] = field(default_factory=dict)
+    # supplementary insurance -> final patient share (active supplementary rows)
+    supplementary_prices: Dict[str, float] = field(default_factory=dict)
+    # insurance_type -> (nursing_covers, nursing_tariff) for every visit_tariffs row
+    nursing_rules: Dict[str, Tuple[Optional[bool], Optional[float]]] = field(default_factory=dict)
+    # insurance_type -> nursing service ids NOT covered by that insurance
+    exclusions: Dict[str, Set[int]] = field(default_factory=dict)
+
+    @classmethod
+    def from_rows(cls, tariff_rows: Iterable, exclusion_rows: Iterable) -> 'TariffSnapshot':
+        """Build a snapshot from `visit_tariffs` and `insurance_nursing_exclusions` rows."""
+        snap = cls()
+        base_flagged = None
+        base_free = None
+        for r in tariff_rows:
+            ins = r['insurance_type']
+            keys = r.keys()
+            is_active = bool(r['is_active'])
+            is_supp = bool(r['is_supplementary'] or 0) if 'is_supplementary' in keys else False
+            price = r['tariff_price']
+            nursing_covers = bool(r['nursing_covers']) if 'nursing_covers' in keys else None
+            nursing_tariff = r['nursing_tariff'] if 'nursing_tariff' in keys else None
+            snap.nursing_rules[ins] = (nursing_covers, nursing_tariff)
+            if not is_active:
+                continue
+            if 'is_base_tariff' in keys and r['is_base_tariff'] == 1 and base_flagged is None:
+                base_flagged = price
+            if ins == 'آزاد' and base_free is None:
+                base_free = price
+            if price is None:
+                continue
+            if is_supp:
+                snap.supplementary_prices[ins] = float(price)
+            else:
+                snap.insurance_prices[ins] = float(price)
+        # Base tariff (آزاد / پایه): explicit is_base_tariff first, then 'آزاد'
+        base = base_flagged if base_flagged is not None else base_free
+        snap.base_visit_price = float(base) if base is not None else 0.0
+        for r in exclusion_rows:
+            snap.exclusions.setdefault(r['insurance_type'], set()).add(r['nursing_service_id'])
+        return snap
+
+    def nursing_covered(self, insurance_type: Optional[str]) -> bool:
+        """Prefer `nursing_covers` flag (manager UI), fall back to legacy `nursing_tariff == 0`."""
+        if not insurance_type or insurance_type not in self.nursing_rules:
+            return False
+        nursing_covers, nursing_tariff = self.nursing_rules[insurance_type]
+        if nursing_covers is not None:
+            return nursing_covers
+        return nursing_tariff is not None and float(nursing_tariff) == 0
+
+
+def _set_shares(it: Dict, recorded: float, patient_share: float, insurance_share: float, covered: int) -> Dict:
+    it['recorded_price'] = float(recorded)
+    it['patient_share'] = float(patient_share)
+    it['insurance_share'] = float(insurance_share)
+    it['covered_by_insurance'] = covered
+    return it
+
+
+def price_invoice_items(invoice_insurance: Optional[str], snapshot: TariffSnapshot,
+                        visits: Iterable, injections: Iterable,
+                        procedures: Iterable, consumables: Iterable) -> List[Dict]:
+    """Price every item of an invoice in one pass using a tariff snapshot.
+
+    Rules (unchanged from the per-row implementation):
+    - visit: recorded = base tariff; patient share = insurance tariff, overridden by supplementary
+    - injection: fully covered if the invoice insurance covers nursing and the service is not excluded
+    - procedure: nurse-performed procedures follow the nursing coverage rule
+    - consumable: never covered
+    """
+    items: List[Dict] = []
+    nursing_covered = snapshot.nursing_covered(invoice_insurance)
+    excluded = snapshot.exclusions.get(invoice_insurance, set()) if invoice_insurance else set()
+    base = snapshot.base_visit_price
+
+    for r in visits:
+        it = dict(r)
+        patient_share = base  # default to base if no insurance
+        visit_insurance = it.get('insurance_type') or invoice_insurance
+        if visit_insurance and visit_insurance in snapshot.insurance_prices:
+            patient_share = snapshot.insurance_prices[visit_insurance]
+        supp = it.get('supplementary_insurance')
+        if supp and supp in snapshot.supplementary_prices:
+            patient_share = snapshot.supplementary_prices[supp]
+        insurance_share = base - patient_share if base > patient_share else 0
+        covered = 1 if patient_share == 0 and base > 0 else 0
+        items.append(_set_shares(it, base, patient_share, insurance_share, covered))
+
+    for r in injections:
+        it = dict(r)
+        original = float(it.get('recorded_price') or 0)
+        svc_id = it.get('service_id')
+        if nursing_covered and not (svc_id and svc_id in excluded):
+            items.append(_set_shares(it, original, 0, original, 1))
+        else:
+            items.append(_set_shares(it, original, original, 0, 0))
+
+    for r in procedures:
+        it = dict(r)
+        original = float(it.get('recorded_price') or 0)
+        if nursing_covered and (it.get('description') or '').endswith('(پرستار)'):
+            items.append(_set_shares(it, original, 0, original, 1))
+        else:
+            items.append(_set_shares(it, original, original, 0, 0))
+
+    for r in consumables:
+        it = dict(r)
+        original = float(it.get('recorded_price') or 0)
+        items.append(_set_shares(it, original, original, 0, 0))
+
+    # Fallback: if doctor_name still empty for non-visit items, use latest visit doctor
+    last_visit_doctor = next((it['doctor_name'] for it in items if it['type'] == 'visit' and it.get('doctor_name')), None)
+    if last_visit_doctor:
+        for it in items:
+            if it['type'] != 'visit' and not it.get('doctor_name'):
+                it['doctor_name'] = last_visit_doctor
+    return sorted(items, key=lambda x: x['date'], reverse=True)
+
+
+def compute_financials(items: List[Dict], payments: Iterable, invoice_total: Optional[float] = None) -> Dict:
+    """Totals per category, paid amount (by type) and remaining for priced items.
+
+    IMPORTANT: Consumables are NOT counted in revenue/income calculations.
+    Payments are matched to items through a dict keyed by (type, id).
+    """
+    totals = {'visit': 0.0, 'injection': 0.0, 'procedure': 0.0, 'consumable': 0.0}
+    share_by_key = {}
+    for it in items:
+        t = it.get('type')
+        amt = float(it.get('patient_share') or 0)
+        if t in totals:
+            totals[t] += amt
+        share_by_key[(t, it.get('id'))] = amt
+
+    # Revenue = visits + injections + procedures (NOT consumables)
+    revenue_total = totals['visit'] + totals['injection'] + totals['procedure']
+    consumables_total = totals['consumable']
+    # Grand total includes consumables for invoice balance
+    grand_total = revenue_total + consumables_total
+    if invoice_total is None:
+        invoice_total = grand_total
+
+    paid_card = 0.0
+    paid_cash = 0.0
+    paid_total = 0.0
+    for p in payments:
+        if p['is_paid'] != 1:
+            continue
+        amt = share_by_key.get((p['item_type'], p['item_id']))
+        if amt is None:
+            continue
+        paid_total += amt
+        if p['payment_type'] == 'card':
+            paid_card += amt
+        elif p['payment_type'] == 'cash':
+            paid_cash += amt
+
+    remaining = invoice_total - paid_total if invoice_total > paid_total else 0.0
+
+    return {
+        'visits': totals['visit'],
+        'injections': totals['injection'],
+        'procedures': totals['procedure'],
+        'consumables': consumables_total,
+        'revenue': revenue_total,  # درآمد (بدون مصرفی)
+        'total': grand_total,      # جمع کل فاکتور
+        'paid': paid_total,
+        'paid_card': paid_card,    # پرداخت کارتخوان
+        'paid_cash': paid_cash,    # پرداخت نقدی
+        'remaining': remaining
+    }
@@ -0,0 +1,118 @@
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+
+# نرخ‌های پیش‌فرض وقتی payroll_settings مقداری ندارد (یا صفر است)
+DEFAULT_VISIT_FEE = 20000
+DEFAULT_INJECTION_PERCENT = 30
+DEFAULT_PROCEDURE_PERCENT = 40
+DEFAULT_TAX_PERCENT = 10
+DEFAULT_NURSING_PERCENT = 6
+DEFAULT_NURSE_PROCEDURE_PERCENT = 35
+
+SHIFT_LABELS = (
+    ('morning', 'شیفت صبح', 'base_morning'),
+    ('evening', 'شیفت عصر', 'base_evening'),
+    ('night', 'شیفت شب', 'base_night'),
+)
+
+
+@dataclass
+class StaffWork:
+    """Attendance and commission bases of one staff member over a period."""
+    # shift -> number of distinct (work_date, shift) pairs
+    shifts: Dict[str, int] = field(default_factory=dict)
+    visit_count: int = 0             # پزشک: ویزیت‌های فاکتورهای بسته
+    injection_total: float = 0.0     # پزشک: تزریقات همراه ویزیت خودش / پرستار: تزریقات
+    procedure_total: float = 0.0     # کار عملی (پزشک یا پرستار)
+
+
+def compute_salary(person, work: StaffWork) -> Dict:
+    """Apply `payroll_settings` rates to a staff member's work.
+
+    `person` is a medical_staff row joined with payroll_settings. Returns the
+    `{details, total_salary}` part of the payroll response.
+    """
+    details: List[Dict] = []
+    total_salary = 0
+
+    for shift, label, key in SHIFT_LABELS:
+        count = work.shifts.get(shift, 0)
+        unit = person[key] or 0
+        if count > 0:
+            details.append({
+                'type': label,
+                'count': count,
+                'unit_price': unit,
+                'total': count * unit
+            })
+        total_salary += count * unit
+
+    if person['staff_type'] == 'doctor':
+        visit_fee = person['visit_fee'] or DEFAULT_VISIT_FEE
+        visit_total = work.visit_count * visit_fee
+        if work.visit_count > 0:
+            details.append({
+                'type': 'ویزیت',
+                'count': work.visit_count,
+                'unit_price': visit_fee,
+                'total': visit_total
+            })
+        total_salary += visit_total
+
+        injection_percent = person['injection_percent'] or DEFAULT_INJECTION_PERCENT
+        inj_total = work.injection_total * injection_percent / 100
+        if inj_total > 0:
+            details.append({
+                'type': f'سهم تزریقات ({injection_percent}%)',
+                'count': 1,
+                'unit_price': work.injection_total,
+                'total': inj_total
+            })
+        total_salary += inj_total
+
+        procedure_percent = person['procedure_percent'] or DEFAULT_PROCEDURE_PERCENT
+        proc_total = work.procedure_total * procedure_percent / 100
+        if proc_total > 0:
+            details.append({
+                'type': f'سهم کار عملی ({procedure_percent}%)',
+                'count': 1,
+                'unit_price': work.procedure_total,
+                'total': proc_total
+            })
+        total_salary += proc_total
+
+        # کسر مالیات
+        tax_percent = person['tax_percent'] or DEFAULT_TAX_PERCENT
+        tax_amount = total_salary * tax_percent / 100
+        details.append({
+            'type': f'کسر مالیات ({tax_percent}%)',
+            'count': 1,
+            'unit_price': total_salary,
+            'total': -tax_amount
+        })
+        total_salary -= tax_amount
+    else:
+        nursing_percent = person['nursing_percent'] or DEFAULT_NURSING_PERCENT
+        nursing_total = work.injection_total * nursing_percent / 100
+        if nursing_total > 0:
+            details.append({
+                'type': f'سهم خدمات پرستاری ({nursing_percent}%)',
+                'count': 1,
+                'unit_price': work.injection_total,
+                'total': nursing_total
+            })
+        total_salary += nursing_total
+
+        nurse_procedure_percent = person['nurse_procedure_percent'] or DEFAULT_NURSE_PROCEDURE_PERCENT
+        nurse_proc_total = work.procedure_total * nurse_procedure_percent / 100
+        if nurse_proc_total > 0:
+            details.append({
+                'type': f'سهم کار عملی پرستار ({nurse_procedure_percent}%)',
+                'count': 1,
+                'unit_price': work.procedure_total,
+                'total': nurse_proc_total
+            })
+        total_salary += nurse_proc_total
+
+    return {'details': details, 'total_salary': total_salary}
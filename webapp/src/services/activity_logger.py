@@ -3,12 +3,20 @@ Activity Logger Service
 Logs all user activities in the reception system
 """
 
+import time
 from datetime import datetime
 
 from src.common.utils import get_datetime_range_for_date_range, iran_now
 from flask import request, g
 from src.adapters.sqlite.core import get_db
+from src.adapters.sqlite.unit_of_work import after_commit
 from src.common.jalali import Persian
+from src.common.csv_export import iter_cursor
+from src.config.settings import Config
+from src.services.log_writer import log_writer, write_rows
+from src.common.metrics import metrics
+from src.adapters.sqlite.log_search import like_predicate, search_predicate
+from src.adapters.sqlite.log_archive import ARCHIVE_SCHEMA, log_source, needs_archive
 
 
 def jalali_to_gregorian(jalali_date: str) -> str:
@@ -182,8 +190,6 @@ def log_activity(
         username: نام کاربر (اگر ندهید از g.user می‌گیرد)
     """
     try:
-        db = get_db()
-        
         # گرفتن اطلاعات کاربر
         if user_id is None and hasattr(g, 'user') and g.user:
             user_id = g.user['id']
@@ -197,7 +203,7 @@ def log_activity(
         if description is None:
             description = ACTION_DESCRIPTIONS.get(action_type, action_type)
         
-        # گرفتن IP و User-Agent
+        # گرفتن IP و User-Agent (باید همین‌جا در context درخواست خوانده شوند)
         ip_address = None
         user_agent = None
         try:
@@ -206,30 +212,61 @@ def log_activity(
         except Exception as e:
             print(f"[ActivityLogger] Error getting request info: {e}")
         
-        # زمان فعلی تهران
+        # زمان فعلی تهران (زمان رویداد، نه زمان نوشتن در دیتابیس)
         created_at = iran_now().strftime('%Y-%m-%d %H:%M:%S')
         
-        db.execute("""
-            INSERT INTO activity_logs (
-                user_id, username, action_type, action_category, description,
-                target_type, target_id, target_name, invoice_id, patient_id,
-                patient_name, amount, old_value, new_value, ip_address,
-                user_agent, created_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        row = (
             user_id, username, action_type, action_category, description,
             target_type, target_id, target_name, invoice_id, patient_id,
             patient_name, amount, old_value, new_value, ip_address,
             user_agent, created_at
-        ))
-        db.commit()
+        )
+        
+        if _async_enabled():
+            # داخل unit of work فقط بعد از commit موفق به صف می‌رود
+            after_commit(lambda: _submit(row))
+        else:
+            # نوشتن همزمان روی کانکشن درخواست - با unit of work یکجا commit/rollback می‌شود
+            write_rows(get_db(), [row])
         
     except Exception as e:
         # لاگ نباید خطا ایجاد کند - فقط چاپ می‌کنیم
         print(f"[ActivityLogger] Error logging activity: {e}")
 
 
-def get_activity_logs(
+sync_writes = metrics.counter('clinic_activity_log_sync_writes_total',
+                              'Log rows written in the request because the writer queue was full or stopped.')
+
+
+def _submit(row) -> None:
+    # نوشتن در پس‌زمینه؛ اگر صف پر بود یا writer خاموش است، همین‌جا می‌نویسیم
+    if not log_writer.submit(row):
+        sync_writes.inc()
+        write_rows(get_db(), [row])
+
+
+def _async_enabled() -> bool:
+    # دیتابیس :memory: برای هر کانکشن جداست - فقط نوشتن همزمان
+    return getattr(Config, 'ACTIVITY_LOG_ASYNC', True) and Config.DATABASE_PATH != ':memory:'
+
+
+def flush_activity_logs() -> None:
+    """Write buffered log rows now (before reading logs or replacing the DB file)."""
+    log_writer.flush()
+
+
+def _datetime_bounds(date_from: str = None, date_to: str = None):
+    """بازه [from, to) روی created_at برای تاریخ‌های میلادی - هر طرف ممکن است None باشد"""
+    if date_from and date_to:
+        return get_datetime_range_for_date_range(date_from, date_to)
+    if date_from:
+        return f"{date_from} 00:00:00", None
+    if date_to:
+        return None, get_datetime_range_for_date_range(date_to, date_to)[1]
+    return None, None
+
+
+def _logs_query(
     user_id: int = None,
     action_type: str = None,
     action_category: str = None,
@@ -238,67 +275,80 @@ def get_activity_logs(
     date_from: str = None,
     date_to: str = None,
     search_text: str = None,
-    limit: int = 100,
-    offset: int = 0
-) -> list:
-    """
-    دریافت لیست لاگ‌ها با فیلتر
-    تاریخ‌ها می‌توانند شمسی باشند - به میلادی تبدیل می‌شوند
-    """
-    db = get_db()
-    
+):
+    """ساخت کوئری فیلتر لاگ‌ها (بدون ORDER/LIMIT) - خروجی: (query, params)"""
     # تبدیل تاریخ شمسی به میلادی
     gregorian_date_from = jalali_to_gregorian(date_from) if date_from else None
     gregorian_date_to = jalali_to_gregorian(date_to) if date_to else None
+    datetime_from, datetime_to = _datetime_bounds(gregorian_date_from, gregorian_date_to)
     
-    query = "SELECT * FROM activity_logs WHERE 1=1"
+    where = ""
     params = []
     
     if user_id:
-        query += " AND user_id = ?"
+        where += " AND user_id = ?"
         params.append(user_id)
     
     if action_type:
-        query += " AND action_type = ?"
+        where += " AND action_type = ?"
         params.append(action_type)
     
     if action_category:
-        query += " AND action_category = ?"
+        where += " AND action_category = ?"
         params.append(action_category)
     
     if invoice_id:
-        query += " AND invoice_id = ?"
+        where += " AND invoice_id = ?"
         params.append(invoice_id)
     
     if patient_id:
-        query += " AND patient_id = ?"
+        where += " AND patient_id = ?"
         params.append(patient_id)
     
-    if gregorian_date_from and gregorian_date_to:
-        datetime_from, datetime_to = get_datetime_range_for_date_range(gregorian_date_from, gregorian_date_to)
-        query += " AND created_at >= ? AND created_at < ?"
-        params.extend([datetime_from, datetime_to])
-    elif gregorian_date_from:
-        query += " AND created_at >= ?"
-        params.append(f"{gregorian_date_from} 00:00:00")
-    elif gregorian_date_to:
-        _, datetime_to = get_datetime_range_for_date_range(gregorian_date_to, gregorian_date_to)
-        query += " AND created_at < ?"
+    if datetime_from:
+        where += " AND created_at >= ?"
+        params.append(datetime_from)
+    if datetime_to:
+        where += " AND created_at < ?"
         params.append(datetime_to)
     
+    db = get_db()
+    query = f"SELECT * FROM activity_logs WHERE 1=1{where}"
+    live_params = list(params)
     if search_text:
-        query += " AND (description LIKE ? OR patient_name LIKE ? OR target_name LIKE ?)"
-        search_pattern = f"%{search_text}%"
-        params.extend([search_pattern, search_pattern, search_pattern])
+        # جستجوی زیررشته (LIKE) + FTS5 برای متن نرمال‌شده
+        predicate, search_params = search_predicate(db, search_text)
+        query += f" AND {predicate}"
+        live_params.extend(search_params)
     
-    query += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
+    if not needs_archive(db, datetime_from, datetime_to):
+        return query, live_params
     
-    rows = db.execute(query, params).fetchall()
-    return [dict(row) for row in rows]
+    # بازه تاریخ به ماه‌های آرشیوشده می‌رسد: همان فیلترها روی آرشیو (جستجو با LIKE)
+    archive_query = f"SELECT * FROM {ARCHIVE_SCHEMA}.activity_logs WHERE 1=1{where}"
+    archive_params = list(params)
+    if search_text:
+        predicate, search_params = like_predicate(search_text)
+        archive_query += f" AND {predicate}"
+        archive_params.extend(search_params)
+    return (f"SELECT * FROM ({query} UNION ALL {archive_query}) WHERE 1=1",
+            live_params + archive_params)
 
 
-def get_logs_count(
+def encode_log_cursor(log: dict) -> str:
+    """Keyset cursor of a log row: position (created_at, id)."""
+    return f"{log['created_at']}|{log['id']}"
+
+
+def _decode_log_cursor(cursor: str):
+    try:
+        created_at, log_id = cursor.rsplit('|', 1)
+        return created_at, int(log_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def get_activity_logs_page(
     user_id: int = None,
     action_type: str = None,
     action_category: str = None,
@@ -306,70 +356,136 @@ def get_logs_count(
     patient_id: int = None,
     date_from: str = None,
     date_to: str = None,
-    search_text: str = None
-) -> int:
-    """
-    شمارش تعداد لاگ‌ها با فیلتر
-    تاریخ‌ها می‌توانند شمسی باشند - به میلادی تبدیل می‌شوند
+    search_text: str = None,
+    limit: int = 50,
+    before: str = None,
+    after: str = None
+) -> dict:
     """
-    db = get_db()
-    
-    # تبدیل تاریخ شمسی به میلادی
-    gregorian_date_from = jalali_to_gregorian(date_from) if date_from else None
-    gregorian_date_to = jalali_to_gregorian(date_to) if date_to else None
+    یک صفحه از لاگ‌ها (جدیدترین اول) با صفحه‌بندی keyset روی (created_at, id)
     
-    query = "SELECT COUNT(*) as count FROM activity_logs WHERE 1=1"
-    params = []
+    `before`: cursor آخرین ردیف صفحه فعلی -> صفحه قدیمی‌تر
+    `after`: cursor اولین ردیف صفحه فعلی -> صفحه جدیدتر
+    هزینه هر صفحه مستقل از عمق صفحه است (بدون OFFSET).
     
-    if user_id:
-        query += " AND user_id = ?"
-        params.append(user_id)
-    
-    if action_type:
-        query += " AND action_type = ?"
-        params.append(action_type)
-    
-    if action_category:
-        query += " AND action_category = ?"
-        params.append(action_category)
-    
-    if invoice_id:
-        query += " AND invoice_id = ?"
-        params.append(invoice_id)
-    
-    if patient_id:
-        query += " AND patient_id = ?"
-        params.append(patient_id)
-    
-    if gregorian_date_from and gregorian_date_to:
-        datetime_from, datetime_to = get_datetime_range_for_date_range(gregorian_date_from, gregorian_date_to)
-        query += " AND created_at >= ? AND created_at < ?"
-        params.extend([datetime_from, datetime_to])
-    elif gregorian_date_from:
-        query += " AND created_at >= ?"
-        params.append(f"{gregorian_date_from} 00:00:00")
-    elif gregorian_date_to:
-        _, datetime_to = get_datetime_range_for_date_range(gregorian_date_to, gregorian_date_to)
-        query += " AND created_at < ?"
-        params.append(datetime_to)
-    
-    if search_text:
-        query += " AND (description LIKE ? OR patient_name LIKE ? OR target_name LIKE ?)"
-        search_pattern = f"%{search_text}%"
-        params.extend([search_pattern, search_pattern, search_pattern])
+    Returns: {'logs', 'older': cursor|None, 'newer': cursor|None}
+    """
+    flush_activity_logs()
+    db = get_db()
+    query, params = _logs_query(user_id, action_type, action_category, invoice_id,
+                                patient_id, date_from, date_to, search_text)
+    after_pos = _decode_log_cursor(after) if after else None
+    before_pos = _decode_log_cursor(before) if before else None
+    if after_pos:
+        query += " AND (created_at, id) > (?, ?) ORDER BY created_at ASC, id ASC LIMIT ?"
+        params.extend([after_pos[0], after_pos[1], limit + 1])
+    else:
+        if before_pos:
+            query += " AND (created_at, id) < (?, ?)"
+            params.extend(before_pos)
+        query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+        params.append(limit + 1)
+    
+    rows = [dict(row) for row in db.execute(query, params).fetchall()]
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if after_pos:
+        rows.reverse()
+        has_older, has_newer = True, has_more
+    else:
+        has_older, has_newer = has_more, before_pos is not None
+    return {
+        'logs': rows,
+        'older': encode_log_cursor(rows[-1]) if rows and has_older else None,
+        'newer': encode_log_cursor(rows[0]) if rows and has_newer else None,
+    }
+
+
+def iter_activity_logs(
+    user_id: int = None,
+    action_type: str = None,
+    action_category: str = None,
+    date_from: str = None,
+    date_to: str = None,
+    search_text: str = None,
+    limit: int = None
+):
+    """
+    مثل get_activity_logs_page ولی ردیف‌ها را به صورت جریانی (fetchmany) برمی‌گرداند - برای خروجی CSV
+    """
+    flush_activity_logs()
+    db = get_db()
+    query, params = _logs_query(user_id, action_type, action_category, None,
+                                None, date_from, date_to, search_text)
+    query += " ORDER BY created_at DESC, id DESC"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    return iter_cursor(db.execute(query, params))
+
+
+# تعداد کل بدون فیلتر - تخمینی و کش‌شده
+_total_estimate = {'value': None, 'expires': 0.0}
+
+
+def get_logs_count(
+    user_id: int = None,
+    action_type: str = None,
+    action_category: str = None,
+    invoice_id: int = None,
+    patient_id: int = None,
+    date_from: str = None,
+    date_to: str = None,
+    search_text: str = None,
+    cap: int = None
+) -> tuple:
+    """
+    شمارش تعداد لاگ‌ها با فیلتر - خروجی: (count, is_estimate)
     
-    return db.execute(query, params).fetchone()['count']
+    بدون فیلتر: تخمین از بازه id (کش LOG_COUNT_CACHE_SECONDS ثانیه)
+    با فیلتر: شمارش دقیق حداکثر تا `cap` ردیف؛ بیشتر از آن (cap, True)
+    """
+    flush_activity_logs()
+    db = get_db()
+    filtered = any([user_id, action_type, action_category, invoice_id, patient_id,
+                    date_from, date_to, search_text])
+    
+    if not filtered:
+        now = time.monotonic()
+        if _total_estimate['value'] is None or now >= _total_estimate['expires']:
+            row = db.execute("SELECT MAX(id) - MIN(id) + 1 FROM activity_logs").fetchone()
+            _total_estimate['value'] = row[0] or 0
+            _total_estimate['expires'] = now + getattr(Config, 'LOG_COUNT_CACHE_SECONDS', 60)
+        return _total_estimate['value'], True
+    
+    if cap is None:
+        cap = getattr(Config, 'LOG_COUNT_CAP', 10000)
+    query, params = _logs_query(user_id, action_type, action_category, invoice_id,
+                                patient_id, date_from, date_to, search_text)
+    count = db.execute(
+        f"SELECT COUNT(*) FROM ({query.replace('SELECT *', 'SELECT 1', 1)} LIMIT ?)",
+        params + [cap + 1]
+    ).fetchone()[0]
+    if count > cap:
+        return cap, True
+    return count, False
 
 
 def get_user_sessions(user_id: int = None, date: str = None) -> list:
     """
     دریافت لیست جلسات کاری کاربران (ورود تا خروج)
     """
+    flush_activity_logs()
     db = get_db()
     
-    query = """
+    datetime_from = datetime_to = None
+    if date:
+        gregorian_date = jalali_to_gregorian(date) or date
+        datetime_from, datetime_to = get_datetime_range_for_date_range(gregorian_date, gregorian_date)
+    
+    query = f"""
         SELECT user_id, username, action_type, created_at
-        FROM activity_logs 
+        FROM {log_source(db, datetime_from, datetime_to)} 
         WHERE action_type IN ('login', 'logout')
     """
     params = []
@@ -379,8 +495,6 @@ def get_user_sessions(user_id: int = None, date: str = None) -> list:
         params.append(user_id)
     
     if date:
-        gregorian_date = jalali_to_gregorian(date) or date
-        datetime_from, datetime_to = get_datetime_range_for_date_range(gregorian_date, gregorian_date)
         query += " AND created_at >= ? AND created_at < ?"
         params.extend([datetime_from, datetime_to])
     
@@ -393,24 +507,21 @@ def get_action_stats(date_from: str = None, date_to: str = None) -> dict:
     """
     آمار عملیات‌ها برای گزارش
     """
+    flush_activity_logs()
     db = get_db()
     
-    query = """
+    datetime_from, datetime_to = _datetime_bounds(date_from, date_to)
+    query = f"""
         SELECT action_category, action_type, COUNT(*) as count
-        FROM activity_logs
+        FROM {log_source(db, datetime_from, datetime_to)}
         WHERE 1=1
     """
     params = []
     
-    if date_from and date_to:
-        datetime_from, datetime_to = get_datetime_range_for_date_range(date_from, date_to)
-        query += " AND created_at >= ? AND created_at < ?"
-        params.extend([datetime_from, datetime_to])
-    elif date_from:
+    if datetime_from:
         query += " AND created_at >= ?"
-        params.append(f"{date_from} 00:00:00")
-    elif date_to:
-        _, datetime_to = get_datetime_range_for_date_range(date_to, date_to)
+        params.append(datetime_from)
+    if datetime_to:
         query += " AND created_at < ?"
         params.append(datetime_to)
     
@@ -0,0 +1,188 @@
+"""
+Activity Log Writer
+نوشتن لاگ فعالیت‌ها در پس‌زمینه - صف + یک thread که ردیف‌ها را دسته‌ای در یک تراکنش ذخیره می‌کند
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from src.adapters.sqlite.core import get_pool
+from src.common.metrics import metrics
+from src.config.settings import Config
+
+
+INSERT_SQL = """
+    INSERT INTO activity_logs (
+        user_id, username, action_type, action_category, description,
+        target_type, target_id, target_name, invoice_id, patient_id,
+        patient_name, amount, old_value, new_value, ip_address,
+        user_agent, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def write_rows(db, rows: List[Tuple]) -> None:
+    """Insert log rows in one transaction on the given connection."""
+    db.executemany(INSERT_SQL, rows)
+    db.commit()
+
+
+class ActivityLogWriter:
+    """Buffered, asynchronous writer for `activity_logs`.
+
+    Requests only enqueue a prepared row tuple; a daemon thread flushes the
+    queue every `batch_size` rows or `flush_ms` milliseconds using one pooled
+    connection and one commit. The queue is bounded: when it is full the
+    caller waits up to `enqueue_timeout_ms` and then returns False so the row
+    can be written synchronously. On shutdown the remaining rows are drained
+    synchronously.
+    """
+
+    def __init__(self, batch_size: int = 100, flush_ms: int = 200,
+                 max_queue: int = 5000, enqueue_timeout_ms: int = 50):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000.0
+        self.enqueue_timeout = enqueue_timeout_ms / 1000.0
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = None
+        self._stopped = False
+
+    # ---------- API ----------
+
+    def submit(self, row: Tuple) -> bool:
+        """Queue one row. False means "not queued" (stopped or queue full) - write it yourself."""
+        if self._stopped or not self._ensure_thread():
+            return False
+        try:
+            self._queue.put(row, timeout=self.enqueue_timeout)
+            return True
+        except queue.Full:
+            return False
+
+    def flush(self, timeout: float = 2.0) -> bool:
+        """Block until every queued row is written (or timeout). Used before reading logs."""
+        if self._thread is None or not self._thread.is_alive():
+            self._drain()
+            return True
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.005)
+        return True
+
+    def stop(self) -> None:
+        """Stop the thread and write whatever is left (synchronous fallback on shutdown)."""
+        self._stopped = True
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join(timeout=5)
+        self._drain()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'running': bool(self._thread and self._thread.is_alive()),
+        }
+
+    # ---------- internals ----------
+
+    def _ensure_thread(self) -> bool:
+        thread = self._thread
+        if thread is not None and thread.is_alive() and self._pid == os.getpid():
+            return True
+        with self._lock:
+            # بعد از fork (مثلاً gunicorn --preload) thread والد در فرزند وجود ندارد
+            if self._thread is None or not self._thread.is_alive() or self._pid != os.getpid():
+                try:
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(
+                        target=self._run, name='activity-log-writer', daemon=True
+                    )
+                    self._thread.start()
+                except RuntimeError:
+                    # interpreter shutting down
+                    return False
+        return True
+
+    def _run(self) -> None:
+        while True:
+            batch, stop = self._collect()
+            if batch:
+                self._write(batch)
+            for _ in range(len(batch) + (1 if stop else 0)):
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _collect(self) -> Tuple[List[Tuple], bool]:
+        """Wait for the first row, then gather more until batch_size or flush interval."""
+        first = self._queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                row = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if row is None:
+                return batch, True
+            batch.append(row)
+        return batch, False
+
+    def _write(self, batch: List[Tuple]) -> None:
+        try:
+            pool = get_pool()
+            db = pool.acquire()
+            try:
+                write_rows(db, batch)
+            finally:
+                pool.release(db)
+            rows_written.inc(len(batch))
+        except Exception as e:
+            write_errors.inc()
+            # لاگ نباید خطا ایجاد کند - فقط چاپ می‌کنیم
+            print(f"[ActivityLogWriter] Error writing {len(batch)} log rows: {e}")
+
+    def _drain(self) -> None:
+        batch = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is not None:
+                batch.append(row)
+            self._queue.task_done()
+        if batch:
+            self._write(batch)
+
+
+log_writer = ActivityLogWriter(
+    batch_size=getattr(Config, 'ACTIVITY_LOG_BATCH_SIZE', 100),
+    flush_ms=getattr(Config, 'ACTIVITY_LOG_FLUSH_MS', 200),
+    max_queue=getattr(Config, 'ACTIVITY_LOG_QUEUE_MAX', 5000),
+    enqueue_timeout_ms=getattr(Config, 'ACTIVITY_LOG_ENQUEUE_TIMEOUT_MS', 50),
+)
+
+rows_written = metrics.counter('clinic_log_writer_rows_total', 'Activity log rows written by the background writer.')
+write_errors = metrics.counter('clinic_log_writer_errors_total', 'Background log batches that failed to write.')
+metrics.gauge('clinic_log_writer_queue_depth', 'Activity log rows waiting for the background writer.',
+              fn=lambda: log_writer.stats()['queued'])
+metrics.gauge('clinic_log_writer_running', 'Whether the background log writer thread is alive (1/0).',
+              fn=lambda: int(log_writer.stats()['running']))
+
+# atexit handlers run in reverse order: this drains before core.close_pool
+atexit.register(log_writer.stop)
@@ -3,13 +3,14 @@ Automatic Backup Scheduler
 Runs weekly backups of the database every Saturday at 3:00 AM
 """
 
-import os
-import shutil
 import threading
 import time
 from pathlib import Path
 
 from src.common.utils import iran_now
+from src.services.backup_service import (
+    backup_chain, create_full_backup, create_incremental_backup, delete_backup, is_backup_file
+)
 
 
 class BackupScheduler:
@@ -67,6 +68,7 @@ class BackupScheduler:
                 if now.weekday() == self.backup_day and now.hour == self.backup_hour:
                     # Check if we haven't already done a backup today
                     if self._should_backup():
+                        self._archive_logs()
                         self._create_backup()
                         # Sleep for 2 hours to avoid duplicate backups
                         time.sleep(7200)
@@ -80,33 +82,80 @@ class BackupScheduler:
                 print(f"[BackupScheduler] Error: {e}")
                 time.sleep(3600)  # Wait 1 hour on error
     
+    def _archive_logs(self):
+        """Move old activity log months to the archive DB before the backup (smaller backup)."""
+        config = self.app.config if self.app is not None else {}
+        if not config.get('ACTIVITY_LOG_ARCHIVE_AUTO', False):
+            return
+        from src.adapters.sqlite.core import get_pool
+        from src.adapters.sqlite.log_archive import archive_logs
+        from src.services.log_writer import log_writer
+        try:
+            log_writer.flush()
+            pool = get_pool()
+            db = pool.acquire()
+            try:
+                moved = archive_logs(db)
+            finally:
+                pool.release(db)
+            if moved:
+                print(f"[BackupScheduler] Archived activity logs: {', '.join(m for m, _ in moved)}")
+        except Exception as e:
+            print(f"[BackupScheduler] Log archive failed: {e}")
+    
+    def _auto_backups(self):
+        """All automatic backup files (full/compressed/incremental), newest first."""
+        return sorted(
+            (f for f in self.backup_dir.glob('backup_auto_*') if is_backup_file(f.name)),
+            key=lambda f: f.stat().st_mtime,
+            reverse=True
+        )
+
     def _should_backup(self):
         """Check if we should create a backup (no backup today yet)"""
         today = iran_now().strftime('%Y%m%d')
         
-        for backup_file in self.backup_dir.glob('backup_auto_*.db'):
+        for backup_file in self._auto_backups():
             if today in backup_file.name:
                 return False
         
         return True
     
     def _create_backup(self):
-        """Create an automatic backup"""
+        """Create an automatic backup (online, via SQLite backup API)"""
         if not self.db_path.exists():
             print(f"[BackupScheduler] Database not found: {self.db_path}")
             return False
         
         try:
-            timestamp = iran_now().strftime('%Y%m%d_%H%M%S')
-            backup_name = f"backup_auto_{timestamp}.db"
-            backup_path = self.backup_dir / backup_name
+            config = self.app.config if self.app is not None else {}
+            pages = int(config.get('BACKUP_PAGES_PER_STEP', 256))
+            step_sleep = int(config.get('BACKUP_STEP_SLEEP_MS', 5)) / 1000.0
+            incremental = bool(config.get('BACKUP_INCREMENTAL', False))
+            backup_path = None
+            
+            # بکاپ افزایشی روی آخرین زنجیره، تا وقتی به سقف BACKUP_FULL_EVERY نرسیده
+            if incremental:
+                chain = self._latest_chain()
+                if chain and len(chain) < int(config.get('BACKUP_FULL_EVERY', 4)):
+                    try:
+                        backup_path = create_incremental_backup(
+                            self.db_path, self.backup_dir, chain[-1], 'backup_auto', pages, step_sleep
+                        )
+                    except (ValueError, OSError) as e:
+                        print(f"[BackupScheduler] Incremental backup not possible ({e}), taking a full one")
             
-            shutil.copy2(self.db_path, backup_path)
+            if backup_path is None:
+                backup_path = create_full_backup(
+                    self.db_path, self.backup_dir, 'backup_auto',
+                    compress=bool(config.get('BACKUP_COMPRESS', False)),
+                    manifest=incremental, pages=pages, step_sleep=step_sleep
+                )
             
-            print(f"[BackupScheduler] Automatic backup created: {backup_name}")
+            print(f"[BackupScheduler] Automatic backup created: {backup_path.name}")
             
-            # Clean old automatic backups (keep last 4 weeks)
-            self._cleanup_old_backups()
+            # Clean old automatic backups (keep the last BACKUP_KEEP runs = 4 weeks by default)
+            self._cleanup_old_backups(int(config.get('BACKUP_KEEP', 4)))
             
             return True
             
@@ -114,18 +163,37 @@ class BackupScheduler:
             print(f"[BackupScheduler] Failed to create backup: {e}")
             return False
 
+    def _latest_chain(self):
+        """Chain (full base + increments) ending at the newest automatic backup, or None."""
+        backups = self._auto_backups()
+        if not backups:
+            return None
+        try:
+            return backup_chain(backups[0])
+        except (ValueError, OSError):
+            return None
+
     def _cleanup_old_backups(self, keep_count=4):
-        """Keep only the last N automatic backups"""
+        """Keep only the last N automatic backups (same retention as before increments).
+
+        A kept increment cannot be restored without its parents, so the files
+        of its chain are kept too; older chains are removed as a whole.
+        """
         try:
-            auto_backups = sorted(
-                self.backup_dir.glob('backup_auto_*.db'),
-                key=lambda f: f.stat().st_mtime,
-                reverse=True
-            )
+            backups = self._auto_backups()
             
-            # Remove old backups (keep last 4)
-            for old_backup in auto_backups[keep_count:]:
-                old_backup.unlink()
+            # Remove old backups (keep last N runs + the bases they depend on)
+            keep = set()
+            for recent in backups[:keep_count]:
+                try:
+                    keep.update(backup_chain(recent))
+                except (ValueError, OSError):
+                    # زنجیره ناقص قابل بازگردانی نیست - فقط خود فایل را نگه می‌داریم
+                    keep.add(recent)
+            for old_backup in backups:
+                if old_backup in keep:
+                    continue
+                delete_backup(old_backup)
                 print(f"[BackupScheduler] Removed old backup: {old_backup.name}")
                 
         except Exception as e:
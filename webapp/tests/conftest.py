@@ -0,0 +1,58 @@
+"""
+Shared test fixtures
+دیتاست آزمایشی (generate_clinic_dataset) و اپ با TestConfig
+
+TestConfig's ``:memory:`` database would be a separate empty database on
+every pooled connection, so the app runs on TestConfig with a temp-file
+database instead. Set QUERY_BUDGET_DB to run on a copy of an existing
+dataset (e.g. a large bench.db) instead of the generated one.
+"""
+
+import os
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+WEBAPP_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(WEBAPP_DIR))
+sys.path.insert(0, str(WEBAPP_DIR / 'scripts'))
+
+
+@pytest.fixture(scope='session')
+def dataset_db(tmp_path_factory):
+    """Path of a clinic database with ~60 days of history (always a copy: tests write to it)."""
+    from src.adapters.sqlite.core import close_pool
+
+    db_path = str(tmp_path_factory.mktemp('clinic') / 'clinic.db')
+    source_path = os.environ.get('QUERY_BUDGET_DB')
+    if source_path:
+        source = sqlite3.connect(source_path)
+        target = sqlite3.connect(db_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+    else:
+        from generate_clinic_dataset import generate
+        generate(db_path, years=60 / 365, invoices_per_day=20, patients=800, verbose=False)
+        close_pool()
+    yield db_path
+    close_pool()
+
+
+@pytest.fixture(scope='session')
+def app(dataset_db):
+    """The Flask app on TestConfig, using ``dataset_db``."""
+    from src.config.settings import Config, TestConfig
+    Config.DATABASE_PATH = dataset_db
+    Config.ACTIVITY_LOG_ASYNC = False
+    Config.SQL_INSTRUMENTATION = True
+
+    from src.app import create_app
+    settings = {k: getattr(TestConfig, k) for k in dir(TestConfig) if k.isupper()}
+    settings.update(DATABASE_PATH=dataset_db, SECRET_KEY='test',
+                    BACKUP_FOLDER=os.path.join(os.path.dirname(dataset_db), 'backups'))
+    return create_app(settings)
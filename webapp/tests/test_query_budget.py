@@ -0,0 +1,383 @@
+"""
+Query budget + query plan check
+کنترل تعداد کوئری هر مسیر و پلن کوئری‌ها - جلوگیری از برگشت حلقه‌های N+1 و اسکن کامل جدول‌های بزرگ
+
+    python -m pytest tests/test_query_budget.py                           # generated dataset
+    QUERY_BUDGET_DB=bench.db python -m pytest tests/test_query_budget.py  # copy of an existing one
+
+1. Budget: every GET route of the blueprints is requested as a logged-in
+   manager / receptionist with a date range covering the dataset, plus the
+   reception write flow (open invoice -> items -> payments -> close). The
+   number of SQL statements of each request (from the query_stats hooks,
+   second run so process caches are warm) must stay within BUDGETS. A new
+   GET route without a budget fails too, so it gets one on purpose.
+2. Plans: every statement those requests ran is captured with its bound
+   values and run through ``EXPLAIN QUERY PLAN``. A plain ``SCAN`` (no
+   index) of a large table fails unless the normalized statement is listed
+   in ALLOWED_SCANS with the reason; a missing index gets a migration instead.
+
+The dataset is several items per invoice and hundreds of invoices, so a
+per-row loop in a route shows up as hundreds of statements rather than a few.
+"""
+
+import os
+import re
+import sqlite3
+from collections import defaultdict
+from datetime import datetime
+
+import pytest
+
+LARGE_TABLES = ('invoices', 'visits', 'injections', 'procedures', 'consumables_ledger',
+                'invoice_item_payments', 'activity_logs', 'patients')
+
+# Not requested: endless SSE stream, logout (ends the session), file download by name, and
+# two views whose templates are not in the tree (manager/staff.html, reception/my_shifts.html)
+SKIP = {'static', 'reception.events_stream', 'auth.logout', 'manager.download_backup',
+        'manager.staff', 'reception.my_shifts_report'}
+
+# Upper bound of SQL statements per request (warm caches; reception writes include the
+# synchronous activity-log insert). None of them depends on data size: a route that loops
+# per row blows through its budget on the generated dataset. Lower a budget in the change that
+# saves statements; raise one only on purpose, in the change that needs it. The *_submit flows
+# create 3 injections + 2 consumables / 2 procedures + 1 consumable (one insert each).
+BUDGETS = {
+    'auth.login': 1,
+    'dashboard.index': 0,
+    'dashboard.metrics': 0,
+    'index': 0,
+    'manager.activity_logs': 2,
+    'manager.calculate_payroll': 8,
+    'manager.chart_data': 1,
+    'manager.consumables_report': 2,
+    'manager.consumables_tariffs': 1,
+    'manager.diagnostics': 0,
+    'manager.export_consumables_csv': 1,
+    'manager.export_insurance_arrears': 1,
+    'manager.export_invoices_csv': 1,
+    'manager.export_logs': 1,
+    'manager.export_nursing_csv': 1,
+    'manager.export_patients_csv': 1,
+    'manager.export_procedures_csv': 1,
+    'manager.export_users_csv': 6,
+    'manager.export_visits_csv': 1,
+    'manager.get_nursing_exclusions': 2,
+    'manager.index': 9,
+    'manager.insurance_arrears': 6,
+    'manager.insurance_tariffs': 2,
+    'manager.invoices_report': 3,
+    'manager.logs_stats': 1,
+    'manager.nursing_report': 4,
+    'manager.nursing_tariffs': 1,
+    'manager.patients_report': 2,
+    'manager.payroll': 1,
+    'manager.procedures_report': 4,
+    'manager.reports': 0,
+    'manager.settings': 7,
+    'manager.tariffs_index': 0,
+    'manager.users_management': 2,
+    'manager.users_report': 9,
+    'manager.visits_report': 4,
+    'reception.combined_ledgers': 6,
+    'reception.get_invoice_details_api': 8,
+    'reception.get_shift_status': 0,
+    'reception.index': 14,
+    'reception.injections_new': 1,
+    'reception.list_patients': 2,
+    'reception.new_visit': 1,
+    'reception.nursing_form': 0,
+    'reception.nursing_ledger': 1,
+    'reception.nursing_redirect': 0,
+    'reception.patient_history': 7,
+    'reception.procedures_ledger': 1,
+    'reception.procedures_new': 1,
+    'reception.search_patient': 0,
+    'reception.shift_performance': 16,
+    # write flow (_write_requests)
+    'reception.set_shift_staff_route': 6,
+    'reception.open_invoice_existing': 8,
+    'reception.add_visit_to_invoice': 18,
+    'reception.injections_submit': 26,
+    'reception.procedures_submit': 23,
+    'reception.set_item_payment': 13,
+    'reception.settle_all_items': 14,
+    'reception.close_invoice': 23,
+}
+
+_DROPDOWN = 'filter dropdown: DISTINCT over the whole column'
+_PATIENT_COLUMNS = ('SELECT p.id, p.name, p.family_name, p.national_id, p.phone_number, '
+                    'COALESCE(p.insurance_type, p.last_invoice_insurance) AS effective_insurance_type ')
+# normalized statement (query_stats.normalize_statement) -> why its plain scan is accepted. Only
+# scans that are the right plan (whole-column DISTINCT, LIMIT on rowid, %substring%) belong here;
+# a lookup without an index gets one. Keyed by statement, so another query of the same route
+# scanning the same table still fails.
+ALLOWED_SCANS = {
+    'SELECT DISTINCT item_name FROM consumables_ledger WHERE (COALESCE(patient_provided,?) = ? '
+    'AND COALESCE(is_exception,?) = ?) ORDER BY item_name': _DROPDOWN,
+    'SELECT DISTINCT insurance_type FROM invoices WHERE insurance_type IS NOT NULL '
+    'ORDER BY insurance_type': _DROPDOWN,
+    'SELECT DISTINCT injection_type FROM injections ORDER BY injection_type': _DROPDOWN,
+    'SELECT DISTINCT insurance_type FROM visits WHERE insurance_type IS NOT NULL '
+    'ORDER BY insurance_type': _DROPDOWN,
+    'SELECT DISTINCT procedure_type FROM procedures ORDER BY procedure_type': _DROPDOWN,
+    'SELECT action_category, action_type, COUNT(*) as count FROM activity_logs WHERE ?=? '
+    'GROUP BY action_category, action_type ORDER BY count DESC': 'unfiltered stats group the whole live log',
+    _PATIENT_COLUMNS + 'FROM patients p ORDER BY p.id DESC LIMIT ?':
+        'newest first by rowid with LIMIT - stops after LIMIT rows',
+    _PATIENT_COLUMNS + 'FROM patients p WHERE p.national_id LIKE ? OR p.phone_number LIKE ? '
+    'ORDER BY p.id DESC LIMIT ?': 'digits inside a phone / national id: no index serves a %substring% LIKE',
+}
+
+# Extra query strings per endpoint (besides the default date range)
+VARIANTS = {
+    'manager.chart_data': [{'type': t} for t in ('revenue', 'invoices', 'patients', 'visits', 'injections',
+                                                   'procedures', 'consumables')],
+    # digits inside a phone / national id: FTS prefix match, then PatientRepository._numeric_substring
+    'reception.list_patients': [{}, {'q': 'رضایی'}, {'q': '4567'}],
+    'manager.activity_logs': [{}, {'q': 'فاکتور'}],
+}
+
+_TABLE_REF = re.compile(r'\b(?:FROM|JOIN)\s+(?:\w+\.)?(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+_NOT_ALIAS = {'where', 'on', 'join', 'left', 'inner', 'cross', 'outer', 'group', 'order', 'limit', 'using',
+              'union', 'natural', 'as', 'indexed', 'not', 'window', 'having', 'except', 'intersect'}
+_PLAN_SCAN = re.compile(r'^SCAN (\w+)(.*)$')
+_PLANNED = ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+
+
+def _jalali(d) -> str:
+    import jdatetime
+    jd = jdatetime.date.fromgregorian(date=d)
+    return f"{jd.year}/{jd.month:02d}/{jd.day:02d}"
+
+
+def _aliases(sql: str) -> dict:
+    """alias/table name -> table for the FROM/JOIN clauses of a statement."""
+    names = {}
+    for table, alias in _TABLE_REF.findall(sql):
+        names[table] = table
+        if alias and alias.lower() not in _NOT_ALIAS:
+            names[alias] = table
+    return names
+
+
+def full_scans(conn, sql: str):
+    """Large tables that ``sql`` reads with a plain table scan (no index)."""
+    rows = conn.execute('EXPLAIN QUERY PLAN ' + sql).fetchall()
+    names = _aliases(sql)
+    found = set()
+    for row in rows:
+        match = _PLAN_SCAN.match(row[3])
+        if match and 'INDEX' not in match.group(2):
+            table = names.get(match.group(1), match.group(1))
+            if table in LARGE_TABLES:
+                found.add(table)
+    return found
+
+
+def _ids(db_path: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        first, last = conn.execute("SELECT MIN(work_date), MAX(work_date) FROM invoices").fetchone()
+        # فاکتور با بیشترین آیتم و بیماری با بیشترین فاکتور - بدترین حالت برای حلقه‌ها
+        invoice = conn.execute("""
+            SELECT invoice_id FROM invoice_item_payments
+            GROUP BY invoice_id ORDER BY COUNT(*) DESC, invoice_id DESC LIMIT 1
+        """).fetchone()
+        patient = conn.execute("""
+            SELECT patient_id FROM invoices GROUP BY patient_id ORDER BY COUNT(*) DESC LIMIT 1
+        """).fetchone()
+        manager = conn.execute("SELECT id FROM users WHERE role = 'manager' ORDER BY id LIMIT 1").fetchone()
+        reception = conn.execute("SELECT id FROM users WHERE role = 'reception' ORDER BY id LIMIT 1").fetchone()
+        doctor = conn.execute("SELECT id FROM medical_staff WHERE staff_type = 'doctor' ORDER BY id LIMIT 1").fetchone()
+        nurse = conn.execute("SELECT id FROM medical_staff WHERE staff_type = 'nurse' ORDER BY id LIMIT 1").fetchone()
+        service = conn.execute("SELECT id FROM nursing_services ORDER BY id LIMIT 1").fetchone()
+        insurance = conn.execute("SELECT insurance_type FROM visit_tariffs WHERE is_active = 1 "
+                                 "AND COALESCE(is_supplementary, 0) = 0 ORDER BY id LIMIT 1").fetchone()
+    finally:
+        conn.close()
+    assert last and invoice and manager and reception and doctor and service, (
+        f"{db_path} is missing invoices, users, staff or services - build it with generate_clinic_dataset.py")
+    return {
+        'first_day': datetime.strptime(first, '%Y-%m-%d').date(),
+        'last_day': datetime.strptime(last, '%Y-%m-%d').date(),
+        'invoice_id': invoice[0], 'patient_id': patient[0],
+        'manager_id': manager[0], 'reception_id': reception[0],
+        'doctor_id': doctor[0], 'nurse_id': nurse[0] if nurse else None,
+        'service_id': service[0], 'insurance_type': insurance[0],
+    }
+
+
+class _Recorder:
+    """Statements (with bound values) per endpoint, via the connection trace callback."""
+
+    def __init__(self):
+        self.statements = defaultdict(set)
+        self.endpoint = None
+
+    def __call__(self, sql: str) -> None:
+        if self.endpoint and sql.lstrip()[:6].upper().startswith(_PLANNED):
+            self.statements[self.endpoint].add(sql)
+
+
+def _get_requests(app, ids: dict):
+    """(endpoint, role, path, query) for every GET route."""
+    span = {'from': _jalali(ids['first_day']), 'to': _jalali(ids['last_day'])}
+    url_args = {'invoice_id': ids['invoice_id'], 'patient_id': ids['patient_id'],
+                'insurance_type': ids['insurance_type']}
+    requests = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.endpoint):
+        if rule.endpoint in SKIP or 'GET' not in rule.methods:
+            continue
+        path = rule.build({a: url_args[a] for a in rule.arguments}, append_unknown=False)[1]
+        role = 'reception' if rule.endpoint.startswith('reception.') else 'manager'
+        for extra in VARIANTS.get(rule.endpoint, [{}]):
+            requests.append((rule.endpoint, role, path, dict(span, **extra)))
+    return requests
+
+
+def _write_requests(ids: dict):
+    """The reception flow (POST) in order; ``{invoice}`` / ``{visit}`` are filled from earlier responses."""
+    staff = {'doctor_id': ids['doctor_id']}
+    if ids['nurse_id']:
+        staff['nurse_id'] = ids['nurse_id']
+    consumable = {'name': 'سرنگ 5 سی سی', 'qty': 2, 'unit_price': 5000, 'category': 'supply'}
+    return [
+        ('reception.set_shift_staff_route', 'reception', '/reception/shift_staff', staff, None),
+        ('reception.open_invoice_existing', 'reception', '/reception/invoice/open_existing',
+         {'patient_id': ids['patient_id']}, None),
+        ('reception.add_visit_to_invoice', 'reception', '/reception/add_visit', {'invoice_id': '{invoice}'}, None),
+        ('reception.injections_submit', 'reception', '/reception/injections', None, {
+            'invoice_id': '{invoice}', 'services': [{'id': ids['service_id'], 'qty': 3}],
+            'consumables': [consumable, dict(consumable, name='گاز استریل')]}),
+        ('reception.procedures_submit', 'reception', '/reception/procedures', None, {
+            'invoice_id': '{invoice}', 'consumables': [consumable],
+            'procedures': [{'name': 'بخیه', 'unit_price': 250000, 'qty': 2, 'performer_type': 'doctor'}]}),
+        ('reception.set_item_payment', 'reception', '/reception/item/payment', {
+            'invoice_id': '{invoice}', 'item_type': 'visit', 'item_id': '{visit}',
+            'payment_type': 'cash', 'is_paid': 'true'}, None),
+        ('reception.settle_all_items', 'reception', '/reception/item/settle_all',
+         {'invoice_id': '{invoice}', 'payment_type': 'card'}, None),
+        ('reception.close_invoice', 'reception', '/reception/invoice/close', {'invoice_id': '{invoice}'}, None),
+        ('manager.calculate_payroll', 'manager', '/manager/payroll/calculate', {
+            'staff_type': 'all', 'shift': 'all',
+            'date_from': ids['first_day'].isoformat(), 'date_to': ids['last_day'].isoformat()}, None),
+    ]
+
+
+def _fill(value, state: dict):
+    if isinstance(value, str) and value.startswith('{') and value.endswith('}'):
+        return state[value[1:-1]]
+    if isinstance(value, dict):
+        return {k: _fill(v, state) for k, v in value.items()}
+    return value
+
+
+class _Run:
+    """Statement counts, traced statements and request errors of one pass over the routes."""
+
+    def __init__(self):
+        self.measured = defaultdict(int)
+        self.statements = defaultdict(set)
+        self.errors = []
+
+
+@pytest.fixture(scope='module')
+def budget_run(app, dataset_db):
+    from flask import g, request
+    from src.adapters.sqlite.core import get_db
+    from src.adapters.sqlite.query_stats import route_db_stats
+
+    ids = _ids(dataset_db)
+    run = _Run()
+    recorder = _Recorder()
+    recorder.statements = run.statements
+
+    @app.before_request
+    def _trace():
+        recorder.endpoint = request.endpoint
+        get_db().set_trace_callback(recorder)
+
+    @app.teardown_request
+    def _untrace(exc):
+        recorder.endpoint = None
+        db = g.get('_database')
+        if db is not None:
+            db.set_trace_callback(None)
+
+    clients = {}
+    for role in ('manager', 'reception'):
+        clients[role] = app.test_client()
+        with clients[role].session_transaction() as sess:
+            sess['user_id'] = ids[f'{role}_id']
+            sess['role'] = role
+
+    def measure(endpoint, response):
+        response.get_data()
+        rows = [r for r in route_db_stats.top(1000) if r['endpoint'] == endpoint]
+        count = rows[0]['max_queries'] if rows else 0
+        run.measured[endpoint] = max(run.measured[endpoint], count)
+        if response.status_code >= 400:
+            run.errors.append(f'{endpoint}: HTTP {response.status_code}')
+
+    for endpoint, role, path, query in _get_requests(app, ids):
+        # اجرای اول کش‌های پروسه را گرم می‌کند؛ اجرای دوم شمرده می‌شود
+        clients[role].get(path, query_string=query).get_data()
+        route_db_stats.reset()
+        measure(endpoint, clients[role].get(path, query_string=query))
+
+    state = {}
+    for endpoint, role, path, form, payload in _write_requests(ids):
+        route_db_stats.reset()
+        if payload is not None:
+            response = clients[role].post(path, json=_fill(payload, state))
+        else:
+            response = clients[role].post(path, data=_fill(form, state))
+        measure(endpoint, response)
+        data = response.get_json(silent=True) or {}
+        if endpoint == 'reception.open_invoice_existing':
+            state['invoice'] = data.get('invoice_id')
+        elif endpoint == 'reception.add_visit_to_invoice':
+            state['visit'] = data.get('visit_id')
+        if data.get('error'):
+            run.errors.append(f"{endpoint}: {data['error']}")
+    return run
+
+
+def test_requests_succeed(budget_run):
+    assert budget_run.errors == []
+
+
+def test_every_route_has_a_budget(budget_run):
+    missing = {e: n for e, n in budget_run.measured.items() if e not in BUDGETS}
+    assert missing == {}, 'add these endpoints to BUDGETS (measured statement counts shown)'
+
+
+@pytest.mark.parametrize('endpoint', sorted(BUDGETS))
+def test_query_budget(budget_run, endpoint):
+    assert endpoint in budget_run.measured, f'{endpoint} was not requested'
+    assert budget_run.measured[endpoint] <= BUDGETS[endpoint]
+
+
+def test_no_full_scans(budget_run, dataset_db):
+    from src.adapters.sqlite.log_archive import ARCHIVE_SCHEMA, archive_path
+    from src.adapters.sqlite.query_stats import normalize_statement
+
+    # پلن روی یک کانکشن جدا (با آرشیو لاگ اگر هست)
+    conn = sqlite3.connect(dataset_db)
+    archive = archive_path(dataset_db)
+    if archive and os.path.exists(archive):
+        conn.execute(f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}", (archive,))
+    reported = set()
+    try:
+        for endpoint, statements in sorted(budget_run.statements.items()):
+            for sql in sorted(statements):
+                statement = normalize_statement(sql)
+                if statement in ALLOWED_SCANS:
+                    continue
+                for table in sorted(full_scans(conn, sql)):
+                    # همان کوئری با مقادیر مختلف (حلقه) یک بار گزارش می‌شود
+                    reported.add(f"{endpoint}: full scan of {table}: {statement[:200]}")
+    finally:
+        conn.close()
+    assert sorted(reported) == []